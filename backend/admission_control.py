@@ -0,0 +1,198 @@
+"""
+Admission control: per-worker concurrency limits by route class, in priority order.
+
+Every request is put in a class by its path. The default classes, from most
+to least important, are provider callbacks, payment initiation, auth, the
+user-facing API and the admin API. Each class has three settings:
+
+    limit          requests of the class served at once
+    queue timeout  how long a request may wait for a slot before it is shed
+    share          the fraction of the worker's total in-flight budget the
+                   class may use
+
+Shares fall with priority. As the worker fills up, admin requests stop being
+admitted first, then dashboard traffic and so on, while callbacks can still
+use the whole budget. When a slot frees, the waiting request of the highest
+class that may take it goes next. A request that is not admitted within its
+queue timeout is answered 503 with Retry-After, before any of its work
+begins. Overload is therefore shed from the bottom rather than slowing
+every route equally.
+
+Limits count requests in this process only. With several workers, each
+enforces its own limits.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from fastapi.responses import JSONResponse
+
+from metrics import Registry
+
+# Class name -> path prefixes, most important class first; paths matching none go to the default class
+ROUTE_CLASSES = {
+    "webhook": ("/api/payments/mpesa-callback", "/api/payments/paystack/webhook", "/api/payments/pesapal/ipn"),
+    # Includes /api/payments/pesapal/callback, a browser redirect back from checkout rather than a provider callback
+    "payment": ("/api/payments/",),
+    "auth": ("/api/auth/",),
+    "dashboard": (),
+    "admin": ("/api/admin/",),
+}
+DEFAULT_CLASS = "dashboard"
+
+# Sheds come in bursts under overload; sample them with LOG_SAMPLE_RATES=admission=0.01
+shed_log = logging.getLogger("admission")
+
+
+class RouteClass:
+    def __init__(self, name: str, limit: int, queue_timeout: float, share: float):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.share = share
+        self.in_flight = 0
+        self.waiters = deque()
+
+    @classmethod
+    def parse(cls, name: str, spec: str) -> "RouteClass":
+        """Parses a spec like '60/2000/0.9': in-flight limit, queue timeout in ms, share of the total budget."""
+        limit, queue_ms, share = spec.split("/")
+        return cls(name, int(limit), float(queue_ms) / 1000, float(share))
+
+
+class AdmissionController:
+    def __init__(self, classes: list, max_in_flight: int, registry: Registry, retry_after: int = 2):
+        """`classes` are RouteClass objects, most important first."""
+        self.classes = {route_class.name: route_class for route_class in classes}
+        self.priority = list(classes)
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.shed = registry.counter("admission_shed_total", "Requests refused with a 503 by admission control", ("class",))
+        self.wait = registry.histogram("admission_queue_wait_seconds", "Time admitted requests waited for a slot", ("class",))
+        in_flight = registry.gauge("admission_in_flight", "Requests being served, by route class", ("class",))
+        queued = registry.gauge("admission_queued", "Requests waiting for a slot, by route class", ("class",))
+
+        @registry.collector
+        def collect():
+            for route_class in self.priority:
+                in_flight.set(route_class.name, value=route_class.in_flight)
+                queued.set(route_class.name, value=len(route_class.waiters))
+
+    def classify(self, path: str) -> RouteClass:
+        for name, prefixes in ROUTE_CLASSES.items():
+            if name in self.classes and path.startswith(prefixes):
+                return self.classes[name]
+        return self.classes[DEFAULT_CLASS]
+
+    def _can_admit(self, route_class: RouteClass) -> bool:
+        return route_class.in_flight < route_class.limit and self.in_flight < self.max_in_flight * route_class.share
+
+    def _admit(self, route_class: RouteClass):
+        route_class.in_flight += 1
+        self.in_flight += 1
+
+    async def acquire(self, route_class: RouteClass) -> bool:
+        """Waits for a slot in the class; False if none came within its queue timeout."""
+        if not route_class.waiters and self._can_admit(route_class):
+            self._admit(route_class)
+            return True
+        if route_class.queue_timeout <= 0:
+            return False
+
+        started = time.perf_counter()
+        granted = asyncio.get_running_loop().create_future()
+        route_class.waiters.append(granted)
+        try:
+            await asyncio.wait_for(granted, route_class.queue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        except BaseException:
+            # The client went away; give back a slot granted in the meantime
+            if granted.done() and not granted.cancelled():
+                self.release(route_class)
+            raise
+        finally:
+            if not granted.done() or granted.cancelled():
+                try:
+                    route_class.waiters.remove(granted)
+                except ValueError:
+                    pass
+        self.wait.observe(route_class.name, value=time.perf_counter() - started)
+        return True
+
+    def release(self, route_class: RouteClass):
+        route_class.in_flight -= 1
+        self.in_flight -= 1
+        # Hand freed capacity to waiters, most important class first
+        for candidate in self.priority:
+            while candidate.waiters and self._can_admit(candidate):
+                granted = candidate.waiters.popleft()
+                if not granted.done():
+                    self._admit(candidate)
+                    granted.set_result(None)
+
+    def snapshot(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "classes": {
+                route_class.name: {
+                    "limit": route_class.limit,
+                    "queue_timeout_ms": route_class.queue_timeout * 1000,
+                    "share": route_class.share,
+                    "in_flight": route_class.in_flight,
+                    "queued": len(route_class.waiters)
+                }
+                for route_class in self.priority
+            }
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware holding a slot of the request's class for as long as it is served,
+    streaming included. Paths in `release_on_start` give the slot back once the response
+    starts: their work is done by then and the body streams progress from background tasks.
+    """
+
+    def __init__(self, app, controller: AdmissionController, skip_paths=("/metrics",), release_on_start=()):
+        self.app = app
+        self.controller = controller
+        self.skip_paths = set(skip_paths)
+        self.release_on_start = set(release_on_start)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        route_class = self.controller.classify(scope["path"])
+        if not await self.controller.acquire(route_class):
+            self.controller.shed.inc(route_class.name)
+            shed_log.info(f"Shed {scope['method']} {scope['path']} ({route_class.name}): no slot within {route_class.queue_timeout:g}s")
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Server is busy. Please try again shortly."},
+                headers={"Retry-After": str(self.controller.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+        held = True
+
+        def release_once():
+            nonlocal held
+            if held:
+                held = False
+                self.controller.release(route_class)
+
+        async def releasing_send(message):
+            if message["type"] == "http.response.start":
+                release_once()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, releasing_send if scope["path"] in self.release_on_start else send)
+        finally:
+            release_once()
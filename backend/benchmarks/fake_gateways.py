@@ -0,0 +1,312 @@
+"""
+Local stand-ins for the payment gateways and the exchange-rate API, for load tests.
+
+One app serves every provider under its own prefix; point the server at it with
+    MPESA_BASE_URL=http://127.0.0.1:9100/safaricom
+    PAYPAL_BASE_URL=http://127.0.0.1:9100/paypal
+    PAYSTACK_BASE_URL=http://127.0.0.1:9100/paystack
+    PESAPAL_BASE_URL=http://127.0.0.1:9100/pesapal
+    CURRENCY_API_URL=http://127.0.0.1:9100/rates/latest/USD
+
+Responses follow the shape of the real APIs closely enough for the server's
+parsing. Like the real providers, the fakes call back: an accepted STK push
+is followed by its M-Pesa callback, an initialized Paystack transaction by a
+signed charge.success webhook, and a Pesapal order by an IPN. Every response
+is held for --latency-ms (plus up to --jitter-ms), so gateway slowness can be
+dialled in without touching the server.
+
+Usage (from the backend directory):
+    python benchmarks/fake_gateways.py --port 9100 --app-url http://127.0.0.1:8100 --paystack-secret sk_test_load
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import random
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import httpx
+import uvicorn
+from fastapi import APIRouter, FastAPI, Request
+
+RATES = {"USD": 1, "KES": 129.5, "UGX": 3710.0, "TZS": 2590.0, "RWF": 1375.0, "NGN": 1540.0, "GHS": 15.4, "EUR": 0.92, "GBP": 0.79}
+
+
+class Settings:
+    app_url = "http://127.0.0.1:8100"
+    paystack_secret = "sk_test_load"
+    latency_ms = 0.0
+    jitter_ms = 0.0
+    callback_delay_ms = 200.0
+    fail_rate = 0.0
+
+
+settings = Settings()
+calls = Counter()  # "provider endpoint" -> requests served
+callbacks = Counter()  # callback kind -> delivered / failed
+callback_acks = defaultdict(list)  # callback kind -> [sent at (epoch seconds), seconds until the server answered]
+pesapal_orders = {}  # order_tracking_id -> submitted order
+background = set()
+
+app = FastAPI(title="Gateway fakes")
+safaricom = APIRouter(prefix="/safaricom")
+paypal = APIRouter(prefix="/paypal")
+paystack = APIRouter(prefix="/paystack")
+pesapal = APIRouter(prefix="/pesapal")
+
+
+async def respond(name: str):
+    calls[name] += 1
+    delay = settings.latency_ms + random.uniform(0, settings.jitter_ms)
+    if delay:
+        await asyncio.sleep(delay / 1000)
+
+
+def call_back(kind: str, url: str, body: bytes, headers: dict = None):
+    """Delivers a provider callback after --callback-delay-ms without holding up the response."""
+
+    async def deliver():
+        await asyncio.sleep(settings.callback_delay_ms / 1000)
+        try:
+            async with httpx.AsyncClient(timeout=30) as client:
+                sent, started = time.time(), time.perf_counter()
+                response = await client.post(url, content=body, headers={"Content-Type": "application/json", **(headers or {})})
+                callback_acks[kind].append((sent, time.perf_counter() - started))
+            callbacks[f"{kind}_{'delivered' if response.status_code < 400 else 'rejected'}"] += 1
+        except httpx.HTTPError as e:
+            callbacks[f"{kind}_failed"] += 1
+            logging.warning(f"{kind} callback to {url} failed: {e}")
+
+    task = asyncio.create_task(deliver())
+    background.add(task)
+    task.add_done_callback(background.discard)
+
+
+def paid() -> bool:
+    """Whether this payment succeeds, per --fail-rate."""
+    return random.random() >= settings.fail_rate
+
+
+@safaricom.get("/oauth/v1/generate")
+async def mpesa_token():
+    await respond("mpesa oauth")
+    return {"access_token": uuid.uuid4().hex, "expires_in": "3599"}
+
+
+@safaricom.post("/mpesa/stkpush/v1/processrequest")
+async def mpesa_stk_push(request: Request):
+    await respond("mpesa stkpush")
+    payload = await request.json()
+    checkout_id = f"ws_CO_{datetime.utcnow():%d%m%Y%H%M%S}{uuid.uuid4().hex[:12]}"
+    merchant_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+
+    if paid():
+        callback = {
+            "MerchantRequestID": merchant_id,
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": 0,
+            "ResultDesc": "The service request is processed successfully.",
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": payload["Amount"]},
+                {"Name": "MpesaReceiptNumber", "Value": uuid.uuid4().hex[:10].upper()},
+                {"Name": "TransactionDate", "Value": int(f"{datetime.utcnow():%Y%m%d%H%M%S}")},
+                {"Name": "PhoneNumber", "Value": int(payload["PhoneNumber"])}
+            ]}
+        }
+    else:
+        callback = {
+            "MerchantRequestID": merchant_id,
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": 1032,
+            "ResultDesc": "Request cancelled by user"
+        }
+    call_back("mpesa", payload["CallBackURL"], json.dumps({"Body": {"stkCallback": callback}}).encode())
+
+    return {
+        "MerchantRequestID": merchant_id,
+        "CheckoutRequestID": checkout_id,
+        "ResponseCode": "0",
+        "ResponseDescription": "Success. Request accepted for processing",
+        "CustomerMessage": "Success. Request accepted for processing"
+    }
+
+
+@safaricom.post("/mpesa/b2c/v1/paymentrequest")
+async def mpesa_b2c(request: Request):
+    await respond("mpesa b2c")
+    await request.json()
+    return {
+        "ConversationID": f"AG_{datetime.utcnow():%Y%m%d}_{uuid.uuid4().hex[:20]}",
+        "OriginatorConversationID": uuid.uuid4().hex,
+        "ResponseCode": "0",
+        "ResponseDescription": "Accept the service request successfully."
+    }
+
+
+@paypal.post("/v1/oauth2/token")
+async def paypal_token():
+    await respond("paypal oauth")
+    return {"access_token": uuid.uuid4().hex, "token_type": "Bearer", "expires_in": 32400}
+
+
+@paypal.post("/v2/checkout/orders")
+async def paypal_create_order(request: Request):
+    await respond("paypal orders")
+    await request.json()
+    order_id = uuid.uuid4().hex[:17].upper()
+    return {
+        "id": order_id,
+        "status": "CREATED",
+        "links": [
+            {"href": f"{request.base_url}paypal/v2/checkout/orders/{order_id}", "rel": "self", "method": "GET"},
+            {"href": f"https://www.sandbox.paypal.com/checkoutnow?token={order_id}", "rel": "approve", "method": "GET"}
+        ]
+    }
+
+
+@paystack.post("/transaction/initialize")
+async def paystack_initialize(request: Request):
+    await respond("paystack initialize")
+    payload = await request.json()
+    reference = uuid.uuid4().hex[:16]
+
+    if paid():
+        event = {
+            "event": "charge.success",
+            "data": {
+                "reference": reference,
+                "amount": payload["amount"],
+                "status": "success",
+                "channel": "card",
+                "customer": {"email": payload["email"]},
+                "metadata": payload.get("metadata", {})
+            }
+        }
+        body = json.dumps(event).encode()
+        signature = hmac.new(settings.paystack_secret.encode(), body, hashlib.sha512).hexdigest()
+        call_back("paystack", f"{settings.app_url}/api/payments/paystack/webhook", body, {"x-paystack-signature": signature})
+
+    return {
+        "status": True,
+        "message": "Authorization URL created",
+        "data": {"authorization_url": f"https://checkout.paystack.com/{reference}", "access_code": reference, "reference": reference}
+    }
+
+
+@pesapal.post("/api/Auth/RequestToken")
+async def pesapal_token():
+    await respond("pesapal auth")
+    return {
+        "token": uuid.uuid4().hex,
+        "expiryDate": (datetime.utcnow() + timedelta(minutes=5)).isoformat() + "Z",
+        "error": None,
+        "status": "200",
+        "message": "Request processed successfully"
+    }
+
+
+@pesapal.post("/api/URLSetup/RegisterIPN")
+async def pesapal_register_ipn(request: Request):
+    await respond("pesapal ipn register")
+    payload = await request.json()
+    return {"url": payload.get("url"), "ipn_id": str(uuid.uuid4()), "ipn_notification_type_description": "POST", "ipn_status": 1, "status": "200"}
+
+
+@pesapal.get("/api/URLSetup/GetRegisteredIPNs")
+async def pesapal_list_ipns():
+    await respond("pesapal ipn list")
+    return []
+
+
+@pesapal.post("/api/Transactions/SubmitOrderRequest")
+async def pesapal_submit_order(request: Request):
+    await respond("pesapal order")
+    payload = await request.json()
+    tracking_id = str(uuid.uuid4())
+    pesapal_orders[tracking_id] = {**payload, "completed": paid()}
+
+    ipn = {"OrderTrackingId": tracking_id, "OrderNotificationType": "IPNCHANGE", "OrderMerchantReference": payload.get("id")}
+    call_back("pesapal", f"{settings.app_url}/api/payments/pesapal/ipn", json.dumps(ipn).encode())
+
+    return {
+        "order_tracking_id": tracking_id,
+        "merchant_reference": payload.get("id"),
+        "redirect_url": f"https://cybqa.pesapal.com/pesapaliframe/PesapalIframe3/Index?OrderTrackingId={tracking_id}",
+        "error": None,
+        "status": "200"
+    }
+
+
+@pesapal.get("/api/Transactions/GetTransactionStatus")
+async def pesapal_status(orderTrackingId: str):
+    await respond("pesapal status")
+    order = pesapal_orders.get(orderTrackingId, {})
+    completed = order.get("completed", False)
+    return {
+        "payment_method": "M-Pesa",
+        "amount": order.get("amount", 0),
+        "created_date": datetime.utcnow().isoformat(),
+        "confirmation_code": uuid.uuid4().hex[:10].upper() if completed else "",
+        "payment_status_description": "Completed" if completed else "Failed",
+        "description": None,
+        "message": "Request processed successfully",
+        "payment_account": "2547XXXXXXXX",
+        "status_code": 1 if completed else 2,
+        "merchant_reference": order.get("id"),
+        "currency": order.get("currency", "KES"),
+        "status": "200"
+    }
+
+
+@app.get("/rates/latest/{base}")
+async def exchange_rates(base: str):
+    await respond("rates latest")
+    return {
+        "result": "success",
+        "base_code": base,
+        "time_last_update_utc": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S +0000"),
+        "conversion_rates": {currency: rate / RATES.get(base, 1) for currency, rate in RATES.items()}
+    }
+
+
+@app.get("/stats")
+async def stats():
+    """Requests served, callbacks delivered and how long each took to be acknowledged, for the load-test report."""
+    return {
+        "calls": dict(calls),
+        "callbacks": dict(callbacks),
+        "callback_acks": callback_acks,
+        "pending_callbacks": len(background)
+    }
+
+
+app.include_router(safaricom)
+app.include_router(paypal)
+app.include_router(paystack)
+app.include_router(pesapal)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--app-url", default=settings.app_url, help="Where the server under test listens, for callbacks")
+    parser.add_argument("--paystack-secret", default=settings.paystack_secret, help="Must match the server's PAYSTACK_SECRET_KEY")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added to every gateway response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Random extra latency, up to this much")
+    parser.add_argument("--callback-delay-ms", type=float, default=200.0, help="Between accepting a payment and calling back")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of payments that call back as failed")
+    args = parser.parse_args()
+
+    settings.app_url = args.app_url.rstrip("/")
+    settings.paystack_secret = args.paystack_secret
+    settings.latency_ms = args.latency_ms
+    settings.jitter_ms = args.jitter_ms
+    settings.callback_delay_ms = args.callback_delay_ms
+    settings.fail_rate = args.fail_rate
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,467 @@
+"""
+Generates a production-shaped synthetic dataset of users, ledger and activity.
+
+Users are placed in the referral/binary tree and given transactions, task
+completions and notifications, for benchmarking and index tuning of the
+paths that only slow down at scale (update_leg_sizes, build_team_tree,
+trigger_binary_commissions, the dashboard aggregations). The data follows
+the server's own rules:
+
+- Each user is referred by an earlier one (or joins organically). Sponsors
+  are drawn with --skew: above 1 favours early members (a few huge
+  downlines), below 1 favours recent ones (long chains). --max-depth caps
+  the tree depth. Positions, first children and leg sizes are computed the
+  way register and update_leg_sizes do it.
+- Activated users have a completed deposit. Their activation pays binary
+  commissions to activated uplines (5 levels) and the referral reward to
+  their sponsor, each with its transaction.
+- Activated users complete tasks (Zipf-skewed popularity, each task at most
+  once) and some withdraw. Balances, earnings and withdrawn totals on every
+  user document add up to their ledger.
+- Everything is timestamped across --history-days, in join order.
+
+The tree is worked out in memory first, then users are written in slices by
+--processes worker processes with insert_many batches. Indexes are built
+after the load (faster than maintaining them during it) by the server's own
+startup work, and platform_counters and task_stats are recounted at the end.
+Every user's password is 'synthetic-password' (hashed once; bcrypt per user
+would dominate the run).
+
+Usage (from the backend directory, with the server's .env pointing at a dedicated database):
+    python benchmarks/generate_data.py --users 1000000 [--max-depth 40] [--skew 1.5] [--history-days 365]
+        [--activated-share 0.6] [--tasks 50] [--completions 6] [--notifications 8] [--processes 4] [--drop]
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+import uuid
+from array import array
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from pymongo import MongoClient
+
+# server.py validates the mail settings at import time; nothing is sent from here
+for name, value in {"MAIL_USERNAME": "synthetic", "MAIL_PASSWORD": "synthetic", "MAIL_SERVER": "127.0.0.1", "MAIL_FROM": "synthetic@example.com"}.items():
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from server import (  # noqa: E402
+    MONGO_URL,
+    NOTIFICATION_RETENTION_DAYS,
+    NOTIFICATION_RETENTION_DEFAULT_DAYS,
+    hash_password,
+    run_startup_work,
+    verify_platform_counters,
+    verify_task_stats,
+)
+
+PASSWORD = "synthetic-password"
+COMMISSIONS = (50, 30, 20, 10, 5)  # trigger_binary_commissions, by level
+REFERRAL_REWARD = 50.0
+NONE, LEFT, RIGHT = 0, 1, 2
+POSITIONS = {NONE: None, LEFT: "left", RIGHT: "right"}
+COLLECTIONS = ("users", "transactions", "referrals", "tasks", "task_completions", "notifications")
+DERIVED = ("task_stats", "platform_counters", "notification_state", "notification_counters")
+TASK_TYPES = {"survey": 25, "ad": 5, "writing": 50, "social": 15, "video": 10, "app_install": 40}
+NOTIFICATION_TYPES = ("payment", "reward", "system", "referral", "task")
+
+
+class Tree:
+    """The referral/binary tree and the credits users receive from their downlines, as flat arrays by join order."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.parent = array("l", [-1]) * size
+        self.position = bytearray(size)
+        self.depth = array("H", [0]) * size
+        self.left_leg = array("l", [0]) * size
+        self.right_leg = array("l", [0]) * size
+        self.left_child = array("l", [-1]) * size
+        self.right_child = array("l", [-1]) * size
+        self.referrals = array("l", [0]) * size
+        self.activated = bytearray(size)
+        self.binary_earnings = array("d", [0.0]) * size
+        self.referral_earnings = array("d", [0.0]) * size
+
+    def upline_commissions(self, index: int):
+        """(upline, level, amount) for each commission paid when `index` activates, as trigger_binary_commissions pays them."""
+        current, level = index, 1
+        while self.parent[current] >= 0 and level <= len(COMMISSIONS):
+            upline = self.parent[current]
+            if self.activated[upline]:
+                yield upline, level, COMMISSIONS[level - 1]
+            current = upline
+            level += 1
+
+
+def build_tree(args) -> Tree:
+    rng = random.Random(args.seed)
+    tree = Tree(args.users)
+    for index in range(args.users):
+        tree.activated[index] = rng.random() < args.activated_share
+        if index == 0 or rng.random() < args.organic_share:
+            continue
+
+        sponsor = int(index * rng.random() ** args.skew)
+        while tree.depth[sponsor] >= args.max_depth:
+            sponsor = tree.parent[sponsor]
+        tree.parent[index] = sponsor
+        tree.depth[index] = tree.depth[sponsor] + 1
+        tree.referrals[sponsor] += 1
+
+        # register: the lighter leg of the sponsor, first child on each side is linked
+        position = LEFT if tree.left_leg[sponsor] <= tree.right_leg[sponsor] else RIGHT
+        tree.position[index] = position
+        children = tree.left_child if position == LEFT else tree.right_child
+        if children[sponsor] < 0:
+            children[sponsor] = index
+
+        # update_leg_sizes: every upline grows on the side the new user hangs from
+        current = sponsor
+        while True:
+            if position == LEFT:
+                tree.left_leg[current] += 1
+            else:
+                tree.right_leg[current] += 1
+            position = tree.position[current]
+            if tree.parent[current] < 0 or position == NONE:
+                break
+            current = tree.parent[current]
+
+        if tree.activated[index]:
+            for upline, _, amount in tree.upline_commissions(index):
+                tree.binary_earnings[upline] += amount
+            tree.referral_earnings[sponsor] += REFERRAL_REWARD
+    return tree
+
+
+def make_tasks(args, rng: random.Random, started: datetime) -> list:
+    tasks = []
+    for number in range(args.tasks):
+        task_type = rng.choice(list(TASK_TYPES))
+        tasks.append({
+            "task_id": str(uuid.uuid4()),
+            "title": f"Synthetic {task_type} task {number + 1}",
+            "description": f"Generated {task_type} task",
+            "reward": f"{TASK_TYPES[task_type]:.2f}",
+            "type": task_type,
+            "requirements": {},
+            "media": None,
+            "survey_questions": None,
+            "is_active": rng.random() < 0.85,
+            "created_at": started
+        })
+    return tasks
+
+
+class Writer:
+    """Buffers documents per collection and writes them in unordered insert_many batches."""
+
+    def __init__(self, db, batch_size: int):
+        self.db = db
+        self.batch_size = batch_size
+        self.buffers = {name: [] for name in COLLECTIONS}
+        self.written = dict.fromkeys(COLLECTIONS, 0)
+
+    def add(self, collection: str, doc: dict):
+        buffer = self.buffers[collection]
+        buffer.append(doc)
+        if len(buffer) >= self.batch_size:
+            self.flush(collection)
+
+    def flush(self, collection: str = None):
+        for name in [collection] if collection else COLLECTIONS:
+            if self.buffers[name]:
+                self.db[name].insert_many(self.buffers[name], ordered=False)
+                self.written[name] += len(self.buffers[name])
+                self.buffers[name] = []
+
+
+class Generator:
+    def __init__(self, args, tree: Tree, tasks: list, namespace: int, password_hash: str, started: datetime, ended: datetime):
+        self.args = args
+        self.tree = tree
+        self.tasks = tasks
+        self.task_weights = [1 / (rank + 1) for rank in range(len(tasks))]  # Zipf popularity by creation order
+        self.namespace = namespace
+        self.password_hash = password_hash
+        self.started = started
+        self.span = (ended - started).total_seconds()
+        self.ended = ended
+
+    def user_id(self, index: int) -> str:
+        return str(uuid.UUID(int=self.namespace + index))
+
+    def joined_at(self, index: int) -> datetime:
+        return self.started + timedelta(seconds=self.span * index / self.tree.size)
+
+    def between(self, rng: random.Random, start: datetime) -> datetime:
+        return start + timedelta(seconds=rng.random() * max(0.0, (self.ended - start).total_seconds()))
+
+    def transaction(self, user_id: str, kind: str, amount: float, at: datetime, **fields) -> dict:
+        return {
+            "transaction_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "type": kind,
+            "amount": str(amount),
+            "currency": "KES",
+            "status": "completed",
+            "created_at": at,
+            "completed_at": at,
+            **fields
+        }
+
+    def write_user(self, index: int, rng: random.Random, writer: Writer):
+        tree = self.tree
+        user_id = self.user_id(index)
+        joined = self.joined_at(index)
+        phone = f"+2547{index:08d}"
+        sponsor = tree.parent[index]
+        sponsor_id = self.user_id(sponsor) if sponsor >= 0 else None
+        activated = bool(tree.activated[index])
+
+        writer.add("transactions", self.transaction(user_id, "account_creation", 0.0, joined, description="Initial account creation"))
+
+        deposited = task_earnings = withdrawn = 0.0
+        if activated:
+            activated_at = joined + timedelta(minutes=rng.expovariate(1 / 90))
+            deposited = float(rng.choice((300, 500, 500, 1000, 1000, 2000, 5000)))
+            writer.add("transactions", self.transaction(
+                user_id, "deposit", deposited, activated_at, phone=phone, method="mpesa",
+                payment_details={"mpesa": {"checkout_request_id": f"ws_CO_SYN{self.namespace % 10**6:06d}{index:09d}", "receipt_number": f"S{index:09d}"}}
+            ))
+            for upline, level, amount in tree.upline_commissions(index):
+                writer.add("transactions", self.transaction(
+                    self.user_id(upline), "binary_commission", float(amount), activated_at,
+                    description=f"Binary commission from level {level} downline activation",
+                    metadata={"downline_id": user_id, "level": level}
+                ))
+            if sponsor_id:
+                writer.add("transactions", self.transaction(
+                    sponsor_id, "referral_reward", REFERRAL_REWARD, activated_at, description=f"Referral reward for {user_id}"
+                ))
+
+            completions = min(len(self.tasks), int(rng.expovariate(1 / self.args.completions))) if self.args.completions else 0
+            # Weighted sampling without replacement: a user completes each task at most once
+            chosen = sorted(range(len(self.tasks)), key=lambda i: rng.random() ** (1 / self.task_weights[i]), reverse=True)[:completions]
+            for task_index in chosen:
+                task = self.tasks[task_index]
+                reward = float(task["reward"])
+                task_earnings += reward
+                writer.add("task_completions", {
+                    "completion_id": str(uuid.uuid4()),
+                    "user_id": user_id,
+                    "task_id": task["task_id"],
+                    "completion_data": {},
+                    "reward_amount": str(reward),
+                    "status": "completed",
+                    "created_at": self.between(rng, activated_at)
+                })
+
+        earned = deposited + task_earnings + tree.binary_earnings[index] + tree.referral_earnings[index]
+        if activated and earned >= 1000 and rng.random() < self.args.withdrawal_share:
+            amount = round(rng.uniform(1000, earned), 2)
+            requested = self.between(rng, joined)
+            status = rng.choices(("completed", "pending_admin_approval", "failed"), weights=(75, 15, 10))[0]
+            if status == "completed":
+                withdrawn = amount
+            writer.add("transactions", {
+                "transaction_id": str(uuid.uuid4()),
+                "user_id": user_id,
+                "type": "withdrawal",
+                "original_amount": str(amount),
+                "original_currency": "KES",
+                "kes_amount": str(amount),
+                **({"amount": str(amount)} if status == "completed" else {}),
+                "method": "mpesa",
+                "phone": phone,
+                "status": status,
+                "description": f"mpesa withdrawal request (KES eq: {amount:.2f})",
+                "created_at": requested,
+                "completed_at": requested + timedelta(hours=rng.uniform(1, 48)) if status == "completed" else None
+            })
+
+        if sponsor_id:
+            writer.add("referrals", {
+                "referral_id": str(uuid.uuid4()),
+                "referrer_id": sponsor_id,
+                "referred_id": user_id,
+                "status": "completed" if activated else "pending",
+                "created_at": joined,
+                "activation_date": None,
+                "completed_at": activated_at if activated else None,
+                "reward_amount": f"{REFERRAL_REWARD:.2f}",
+                "currency": "KES"
+            })
+
+        for _ in range(int(rng.expovariate(1 / self.args.notifications)) if self.args.notifications else 0):
+            kind = rng.choice(NOTIFICATION_TYPES)
+            created = self.between(rng, joined)
+            age_days = (self.ended - created).days
+            writer.add("notifications", {
+                "notification_id": str(uuid.uuid4()),
+                "title": f"Synthetic {kind} notification",
+                "message": f"Generated {kind} notification",
+                "user_id": user_id,
+                "type": kind,
+                "priority": rng.choice(("low", "medium", "medium", "high")),
+                "is_read": rng.random() < min(0.95, 0.2 + age_days / 30),
+                "action_url": None,
+                "expires_at": created + timedelta(days=NOTIFICATION_RETENTION_DAYS.get(kind, NOTIFICATION_RETENTION_DEFAULT_DAYS)),
+                "metadata": {},
+                "created_at": created,
+                "updated_at": created
+            })
+
+        left_child, right_child = tree.left_child[index], tree.right_child[index]
+        writer.add("users", {
+            "user_id": user_id,
+            "email": f"user{index}.{self.namespace % 10**6:06d}@synthetic.example.com",
+            "password": self.password_hash,
+            "full_name": f"Synthetic User {index}",
+            "phone": phone,
+            "referral_code": f"SYN{self.namespace % 10**6:06d}{index:08X}",
+            "referred_by": sponsor_id,
+            "parent_id": sponsor_id,
+            "position": POSITIONS[tree.position[index]],
+            "left_leg_size": tree.left_leg[index],
+            "right_leg_size": tree.right_leg[index],
+            "binary_earnings": str(tree.binary_earnings[index]),
+            "wallet_balance": str(round(earned - withdrawn, 2)),
+            "is_activated": activated,
+            "activation_amount": "10.00",
+            "total_earned": str(earned),
+            "total_withdrawn": str(withdrawn),
+            "referral_earnings": str(tree.referral_earnings[index]),
+            "task_earnings": str(task_earnings),
+            "referral_count": tree.referrals[index],
+            "has_spun_once": rng.random() < 0.3,
+            "payment_methods": {
+                "mpesa": {"phone": phone if activated else None, "verified": activated},
+                "paypal": {"email": None, "verified": False},
+                "pesapal": {"phone": None, "verified": False}
+            },
+            "security": {"two_factor_enabled": False, "last_password_change": joined},
+            "created_at": joined,
+            "updated_at": joined,
+            "last_login": self.between(rng, joined),
+            "notifications_enabled": True,
+            "communication_preferences": {"email": True, "sms": True, "push": True},
+            "theme": "light",
+            "role": "user",
+            "preferred_currency": rng.choices(("KES", "USD", "UGX", "TZS"), weights=(85, 8, 4, 3))[0],
+            "status": "active",
+            "verification": {"email_verified": activated, "phone_verified": activated, "identity_verified": False},
+            "left_child_id": self.user_id(left_child) if left_child >= 0 else None,
+            "right_child_id": self.user_id(right_child) if right_child >= 0 else None,
+            "team_earnings": "0.00",
+            "activation_expense": "300.00",
+            "activation_reward": "0.00",
+            "team_reward_claimed": False
+        })
+
+
+def connect():
+    return MongoClient(MONGO_URL).earnplatform
+
+
+def write_slice(generator: Generator, start: int, stop: int) -> dict:
+    """Writes users [start, stop) and their documents. Runs in a worker process with its own client."""
+    rng = random.Random(generator.args.seed * 1_000_003 + start)
+    writer = Writer(connect(), generator.args.batch_size)
+    progress_every = max(1, (stop - start) // 10)
+    began = time.monotonic()
+    for index in range(start, stop):
+        generator.write_user(index, rng, writer)
+        if (index - start + 1) % progress_every == 0:
+            done = index - start + 1
+            logging.info(f"Users {start}-{stop}: {done} written ({done / (time.monotonic() - began):,.0f}/s)")
+    writer.flush()
+    return writer.written
+
+
+# Set before the workers fork, so they share it instead of pickling it per slice
+_generator = None
+
+
+def _write_slice(bounds: tuple) -> dict:
+    return write_slice(_generator, *bounds)
+
+
+def main(args):
+    global _generator
+    db = connect()
+    existing = [name for name in COLLECTIONS if db[name].estimated_document_count()]
+    if existing and not args.drop:
+        raise SystemExit(f"{', '.join(existing)} already hold documents; pass --drop to replace them (this deletes them)")
+    if args.drop:
+        for name in COLLECTIONS + DERIVED:
+            db[name].drop()
+        logging.info("Dropped the existing collections")
+
+    began = time.monotonic()
+    tree = build_tree(args)
+    deepest = max(tree.depth) if args.users else 0
+    logging.info(f"Placed {args.users:,} users (depth {deepest}) in {time.monotonic() - began:.1f}s")
+
+    ended = datetime.utcnow()
+    started = ended - timedelta(days=args.history_days)
+    tasks = make_tasks(args, random.Random(args.seed), started)
+    if tasks:
+        db.tasks.insert_many(tasks)
+    _generator = Generator(args, tree, tasks, random.Random(args.seed).getrandbits(96) << 32, hash_password(PASSWORD), started, ended)
+
+    slice_size = -(-args.users // max(1, args.processes * 4))  # a few slices per process, for balance
+    slices = [(start, min(start + slice_size, args.users)) for start in range(0, args.users, slice_size)]
+    totals = dict.fromkeys(COLLECTIONS, 0)
+    totals["tasks"] = len(tasks)
+    if args.processes > 1:
+        with multiprocessing.get_context("fork").Pool(args.processes) as pool:
+            results = pool.imap_unordered(_write_slice, slices)
+            for written in results:
+                for name, count in written.items():
+                    totals[name] += count
+    else:
+        for bounds in slices:
+            for name, count in _write_slice(bounds).items():
+                totals[name] += count
+    logging.info(f"Loaded in {time.monotonic() - began:.1f}s: " + ", ".join(f"{count:,} {name}" for name, count in totals.items()))
+
+    async def finish():
+        if not args.skip_indexes:
+            logging.info("Building indexes...")
+            await run_startup_work()
+        await verify_platform_counters()
+        await verify_task_stats()
+
+    asyncio.run(finish())
+    logging.info(f"Done in {time.monotonic() - began:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--max-depth", type=int, default=40, help="Deepest level of the referral tree")
+    parser.add_argument("--skew", type=float, default=1.5, help="Sponsor choice: >1 favours early members, <1 recent ones")
+    parser.add_argument("--organic-share", type=float, default=0.02, help="Share of users who join without a referral")
+    parser.add_argument("--activated-share", type=float, default=0.6)
+    parser.add_argument("--history-days", type=int, default=365, help="Period the joins and activity are spread over")
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--completions", type=float, default=6, help="Mean task completions per activated user")
+    parser.add_argument("--withdrawal-share", type=float, default=0.4, help="Share of users with 1,000+ KES earned who withdraw")
+    parser.add_argument("--notifications", type=float, default=8, help="Mean notifications per user")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Documents per insert_many")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--drop", action="store_true", help="Drop the collections this writes before generating")
+    parser.add_argument("--skip-indexes", action="store_true", help="Leave index creation to the next server start")
+    args = parser.parse_args()
+    if args.max_depth < 1:
+        parser.error("--max-depth must be at least 1")
+    main(args)
@@ -0,0 +1,137 @@
+"""
+Import-time audit: how long `import server` takes, and which packages it goes to.
+
+Each startup profile (STARTUP_PROFILE=full and slim) is imported in fresh
+interpreters under `python -X importtime`. A first, untimed run writes the
+bytecode caches, as a built image would have them. The report gives the
+median wall time until the app object exists, the modules server.py
+imports directly, and self time summed per top-level package. That last
+view shows where the time goes whoever imported what first.
+
+--save writes the results to baselines/import_audit.json, which is checked
+in so changes to startup cost show up in review. --compare exits 1 if a
+profile got slower than the saved results by more than --tolerance, and
+--budget-ms exits 1 if the slim profile is over the budget.
+
+Usage (from the backend directory):
+    python benchmarks/import_audit.py [--repeat 5] [--top 15] [--save | --compare [--tolerance 0.15]] [--budget-ms 300]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).resolve().parent / "baselines" / "import_audit.json"
+PROFILES = ("full", "slim")
+
+# server.py validates the mail settings at import in the full profile; nothing is sent from here
+MAIL_SETTINGS = {"MAIL_USERNAME": "audit", "MAIL_PASSWORD": "audit", "MAIL_SERVER": "127.0.0.1", "MAIL_FROM": "audit@example.com"}
+TIMED_IMPORT = "import time; started = time.perf_counter(); import server; print(time.perf_counter() - started)"
+
+
+def import_once(profile: str) -> tuple:
+    """(seconds until `import server` returned, -X importtime rows as (self_us, cumulative_us, depth, module))."""
+    env = {**os.environ, **{name: os.environ.get(name, value) for name, value in MAIL_SETTINGS.items()}, "STARTUP_PROFILE": profile}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", TIMED_IMPORT],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    if result.returncode:
+        raise SystemExit(f"import server failed with STARTUP_PROFILE={profile}:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(self_us), int(cumulative_us), len(name) - len(name.lstrip()), name.strip()))
+    return float(result.stdout.strip().splitlines()[-1]), rows
+
+
+def audit(profile: str, repeat: int, top: int) -> dict:
+    import_once(profile)  # writes __pycache__ for anything not yet compiled
+    runs = [import_once(profile) for _ in range(repeat)]
+    seconds = [elapsed for elapsed, _ in runs]
+    _, rows = min(runs, key=lambda run: run[0])
+
+    # importtime lists each module after everything it imported, so server's subtree is the run of deeper rows before it
+    end = next(index for index, row in enumerate(rows) if row[3] == "server")
+    start = end
+    while start and rows[start - 1][2] > rows[end][2]:
+        start -= 1
+    subtree = rows[start:end + 1]
+    direct = sorted(
+        ((cumulative, name) for _, cumulative, depth, name in subtree if depth == rows[end][2] + 2),
+        reverse=True
+    )
+    packages = Counter()
+    for self_us, _, _, name in subtree:
+        packages[name.split(".")[0]] += self_us
+    return {
+        "median_ms": round(statistics.median(seconds) * 1000, 1),
+        "best_ms": round(min(seconds) * 1000, 1),
+        "modules": len(subtree),
+        "direct_imports_ms": {name: round(cumulative / 1000, 1) for cumulative, name in direct[:top]},
+        "packages_self_ms": {name: round(self_us / 1000, 1) for name, self_us in packages.most_common(top)}
+    }
+
+
+def print_report(profile: str, result: dict, before: dict = None):
+    change = f" ({result['median_ms'] / before['median_ms'] - 1:+.1%} vs saved)" if before else ""
+    print(f"STARTUP_PROFILE={profile}: import server {result['median_ms']} ms median, "
+          f"{result['best_ms']} ms best, {result['modules']} modules{change}")
+    print("  imported by server.py (cumulative ms):")
+    for name, ms in result["direct_imports_ms"].items():
+        print(f"    {name:<40}{ms:>10}")
+    print("  by package (self ms):")
+    for name, ms in result["packages_self_ms"].items():
+        print(f"    {name:<40}{ms:>10}")
+
+
+def main(args) -> int:
+    saved = json.loads(BASELINE_PATH.read_text()) if args.compare and BASELINE_PATH.exists() else None
+    results = {}
+    for profile in PROFILES:
+        results[profile] = audit(profile, args.repeat, args.top)
+        print_report(profile, results[profile], (saved or {}).get("profiles", {}).get(profile))
+
+    status = 0
+    for profile, result in results.items():
+        before = (saved or {}).get("profiles", {}).get(profile)
+        if before and result["median_ms"] > before["median_ms"] * (1 + args.tolerance):
+            print(f"REGRESSION STARTUP_PROFILE={profile}: {before['median_ms']} -> {result['median_ms']} ms "
+                  f"(saved at {saved.get('commit') or 'unknown commit'})")
+            status = 1
+    if args.budget_ms and results["slim"]["median_ms"] > args.budget_ms:
+        print(f"OVER BUDGET: slim profile imports in {results['slim']['median_ms']} ms, budget {args.budget_ms} ms")
+        status = 1
+
+    if args.save:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip()
+        BASELINE_PATH.parent.mkdir(exist_ok=True)
+        BASELINE_PATH.write_text(json.dumps({
+            "created_at": datetime.utcnow().isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "machine": platform.node(),
+            "profiles": results
+        }, indent=2) + "\n")
+        print(f"Saved to {BASELINE_PATH}")
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5, help="Timed imports per profile")
+    parser.add_argument("--top", type=int, default=15, help="Rows per table")
+    parser.add_argument("--save", action="store_true", help="Write the results to baselines/import_audit.json")
+    parser.add_argument("--compare", action="store_true", help="Compare against baselines/import_audit.json; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown of the median")
+    parser.add_argument("--budget-ms", type=float, help="Exit 1 if the slim profile's median import time is over this")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,608 @@
+"""
+End-to-end load test of the API against a local replica set and gateway fakes.
+
+Starts a throwaway mongod replica set (transactions need one), the gateway
+stand-ins from fake_gateways.py and the server itself, then drives these
+scenarios in order:
+
+    register   registration burst, most users joining with a referral code
+    dashboard  users polling their dashboard, notifications and history
+    deposits   M-Pesa and Paystack deposits, settled by the fakes' callbacks
+    approvals  withdrawal requests, then admin bulk approvals in waves
+    webhooks   deposits while dashboard polling runs, timing how fast each
+               provider callback is acknowledged
+
+Each step reports throughput, p50/p95/p99 latency and errors. Each scenario
+reports MongoDB operations per request, from the server's opcounters, so it
+counts every worker and the callbacks too. With --workers 1 the server's
+/metrics also gives operations per route. Reports can be saved as a named
+baseline and later runs compared against it: a regression past --tolerance
+in p95 latency, throughput or Mongo ops per request makes the run exit 1.
+
+--ingress also starts the webhook ingress app (webhook_ingress.py) and has
+the fakes call back to it. The server settles callbacks from the webhook
+inbox, and the webhooks scenario also reports each callback's time from
+being stored to being settled. Run webhooks with and without --ingress to
+compare acknowledgement latency under load.
+
+Outgoing mail points at a closed local port and fails straight away. The
+server already logs and swallows mail failures, so registrations still count.
+
+Usage (from the backend directory, with mongod on PATH):
+    python benchmarks/loadtest.py [--users 300] [--concurrency 50] [--workers 1]
+        [--gateway-latency-ms 150] [--scenarios register,dashboard,deposits,approvals,webhooks] [--ingress]
+        [--save-baseline NAME | --compare NAME [--tolerance 0.2]]
+
+--mongo-url runs against an existing replica set instead. The server always
+uses its 'earnplatform' database, so only point this at a dedicated instance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+SCENARIOS = ("register", "dashboard", "deposits", "approvals", "webhooks")
+ADMIN_EMAIL = "loadtest-admin@example.com"
+ADMIN_PASSWORD = "loadtest-admin-password"
+PAYSTACK_SECRET = "sk_test_loadtest"
+OPCOUNTERS = ("insert", "query", "update", "delete", "getmore", "command")
+METRIC_LINE = re.compile(r'^(\w+)\{(.*)\} ([0-9.e+-]+)$')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Recorder:
+    """Latencies and failures per step, across every virtual user."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.first = {}
+        self.last = {}
+        self.requests = 0
+
+    async def call(self, step: str, client: httpx.AsyncClient, method: str, url: str, **kwargs):
+        """Sends one request, recording it under `step`. Returns the response, or None if it failed."""
+        self.requests += 1
+        started = time.perf_counter()
+        self.first.setdefault(step, started)
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        finished = time.perf_counter()
+        self.last[step] = finished
+        self.latencies[step].append(finished - started)
+        if response is None or response.status_code >= 400:
+            self.errors[step] += 1
+            return None
+        return response
+
+    def observe(self, step: str, seconds: float, started: float, finished: float):
+        """Records a latency measured elsewhere (e.g. callback settlement, from the database)."""
+        self.latencies[step].append(seconds)
+        self.first[step] = min(self.first.get(step, started), started)
+        self.last[step] = max(self.last.get(step, finished), finished)
+
+    def summary(self) -> dict:
+        steps = {}
+        for step, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            wall = max(self.last[step] - self.first[step], 1e-9)
+            steps[step] = {
+                "count": len(ordered),
+                "errors": self.errors[step],
+                "throughput_rps": round(len(ordered) / wall, 1),
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 1),
+            }
+        return steps
+
+
+async def limited(concurrency: int, jobs):
+    """Runs the coroutines in `jobs` with at most `concurrency` in flight; returns their results in order."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with semaphore:
+            return await job
+
+    return await asyncio.gather(*(run(job) for job in jobs))
+
+
+class LoadTest:
+    def __init__(self, args, app_url: str, fakes_url: str, mongo):
+        self.args = args
+        self.app_url = app_url
+        self.fakes_url = fakes_url
+        self.mongo = mongo
+        self.db = mongo.earnplatform
+        self.run_id = uuid.uuid4().hex[:6]
+        self.client = httpx.AsyncClient(
+            base_url=app_url, timeout=60, limits=httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+        )
+        self.users = []  # {"email", "phone", "token", "referral_code"}
+        self.funded = []  # users whose deposit settled
+        self.admin_token = None
+
+    @staticmethod
+    def auth(token: str) -> dict:
+        return {"Authorization": f"Bearer {token}"}
+
+    async def mongo_ops(self) -> int:
+        status = await self.mongo.admin.command("serverStatus")
+        return sum(status["opcounters"].get(name, 0) for name in OPCOUNTERS)
+
+    async def route_counters(self) -> dict:
+        """Per-route request and Mongo command counts from the server's /metrics (exact with one worker)."""
+        if self.args.workers != 1:
+            return {}
+        response = await self.client.get("/metrics")
+        counters = defaultdict(lambda: [0.0, 0.0])  # route -> [requests, mongo commands]
+        for line in response.text.splitlines():
+            match = METRIC_LINE.match(line)
+            if not match or match.group(1) not in ("http_requests_total", "mongo_commands_total"):
+                continue
+            labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2)))
+            counters[labels.get("route", "unmatched")][match.group(1) == "mongo_commands_total"] += float(match.group(3))
+        return counters
+
+    async def fake_stats(self) -> dict:
+        return (await self.client.get(f"{self.fakes_url}/stats")).json()
+
+    async def callbacks_delivered(self) -> int:
+        stats = await self.fake_stats()
+        return sum(count for kind, count in stats["callbacks"].items() if not kind.endswith("_failed"))
+
+    async def run_scenario(self, name: str) -> dict:
+        recorder = Recorder()
+        ops_before, routes_before, callbacks_before = await self.mongo_ops(), await self.route_counters(), await self.callbacks_delivered()
+        started = time.perf_counter()
+        await getattr(self, f"scenario_{name}")(recorder)
+        wall = time.perf_counter() - started
+        ops_after, routes_after, callbacks_after = await self.mongo_ops(), await self.route_counters(), await self.callbacks_delivered()
+
+        served = recorder.requests + (callbacks_after - callbacks_before)
+        report = {
+            "wall_seconds": round(wall, 2),
+            "requests": served,
+            "mongo_ops_per_request": round((ops_after - ops_before) / max(served, 1), 2),
+            "steps": recorder.summary(),
+        }
+        per_route = {}
+        for route, (requests, commands) in routes_after.items():
+            before = routes_before.get(route, [0.0, 0.0])
+            if requests - before[0] > 0:
+                per_route[route] = round((commands - before[1]) / (requests - before[0]), 2)
+        if per_route:
+            report["mongo_ops_per_route"] = per_route
+        return report
+
+    async def login_admin(self):
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            response = await self.client.post("/api/auth/login", json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD})
+            if response.status_code == 200:
+                self.admin_token = response.json()["token"]
+                return
+            await asyncio.sleep(1)  # the leader seeds the admin in the background after startup
+        raise RuntimeError(f"Admin login failed: {response.status_code} {response.text}")
+
+    async def register(self, recorder: Recorder, index: int, referral_code: str = None):
+        user = {"email": f"load-{self.run_id}-{index}@example.com", "phone": f"2547{random.randint(10_000_000, 99_999_999)}"}
+        response = await recorder.call("register", self.client, "POST", "/api/auth/register", json={
+            "email": user["email"],
+            "password": "loadtest-password",
+            "full_name": f"Load User {index}",
+            "phone": user["phone"],
+            "referral_code": referral_code
+        })
+        if response is not None:
+            data = response.json()
+            user["token"] = data["token"]
+            user["referral_code"] = data["user"]["referral_code"]
+            self.users.append(user)
+
+    async def scenario_register(self, recorder: Recorder):
+        # A first wave of organic sign-ups, then a burst of referred ones spread over their codes
+        organic = max(1, self.args.users // 10)
+        await limited(self.args.concurrency, [self.register(recorder, i) for i in range(organic)])
+        codes = [user["referral_code"] for user in self.users]
+        await limited(self.args.concurrency, [
+            self.register(recorder, i, random.choice(codes) if codes else None) for i in range(organic, self.args.users)
+        ])
+
+    async def poll_dashboard(self, recorder: Recorder, deadline: float):
+        while time.monotonic() < deadline:
+            headers = self.auth(random.choice(self.users)["token"])
+            await recorder.call("dashboard stats", self.client, "GET", "/api/dashboard/stats", headers=headers)
+            await recorder.call("notifications", self.client, "GET", "/api/notifications", headers=headers)
+            await recorder.call("unread count", self.client, "GET", "/api/notifications/unread-count", headers=headers)
+            await recorder.call("transaction history", self.client, "GET", "/api/transactions/history", headers=headers)
+            await recorder.call("available tasks", self.client, "GET", "/api/tasks/available", headers=headers)
+            if self.args.think_ms:
+                await asyncio.sleep(self.args.think_ms / 1000)
+
+    async def scenario_dashboard(self, recorder: Recorder):
+        deadline = time.monotonic() + self.args.duration
+        await asyncio.gather(*(self.poll_dashboard(recorder, deadline) for _ in range(self.args.concurrency)))
+
+    async def deposit(self, recorder: Recorder, index: int, user: dict):
+        # Every fourth user pays through Paystack, the rest through M-Pesa STK push
+        if index % 4 == 3:
+            response = await recorder.call("paystack deposit", self.client, "POST", "/api/payments/paystack/deposit",
+                                           headers=self.auth(user["token"]), json={"amount": self.args.deposit_amount, "email": user["email"]})
+        else:
+            response = await recorder.call("mpesa deposit", self.client, "POST", "/api/payments/deposit",
+                                           headers=self.auth(user["token"]), json={"amount": self.args.deposit_amount, "phone": user["phone"]})
+        if response is not None:
+            return response.json().get("transaction_id")
+        return None
+
+    async def scenario_deposits(self, recorder: Recorder):
+        ids = await limited(self.args.concurrency, [self.deposit(recorder, i, user) for i, user in enumerate(self.users)])
+        by_id = {transaction_id: user for transaction_id, user in zip(ids, self.users) if transaction_id}
+
+        # The callback storm: wait for the fakes' callbacks to settle every deposit
+        deadline = time.monotonic() + self.args.settle_timeout
+        settled = []
+        while time.monotonic() < deadline:
+            settled = await self.db.transactions.find(
+                {"transaction_id": {"$in": list(by_id)}, "status": {"$ne": "pending"}},
+                {"transaction_id": 1, "status": 1, "created_at": 1, "completed_at": 1}
+            ).to_list(None)
+            if len(settled) == len(by_id):
+                break
+            await asyncio.sleep(0.5)
+
+        recorder.errors["deposit settled"] = len(by_id) - sum(1 for txn in settled if txn["status"] == "completed")
+        clock = time.perf_counter() - time.time()  # maps wall-clock timestamps onto the perf counter
+        for txn in settled:
+            if txn["status"] == "completed" and txn.get("completed_at"):
+                created = txn["created_at"].replace(tzinfo=timezone.utc).timestamp() + clock
+                completed = txn["completed_at"].replace(tzinfo=timezone.utc).timestamp() + clock
+                recorder.observe("deposit settled", completed - created, created, completed)
+                self.funded.append(by_id[txn["transaction_id"]])
+
+    async def scenario_approvals(self, recorder: Recorder):
+        users = self.funded or self.users
+
+        async def withdraw(user):
+            response = await recorder.call("withdrawal request", self.client, "POST", "/api/payments/withdraw",
+                                           headers=self.auth(user["token"]), json={"amount": 1000, "currency": "KES", "phone": user["phone"]})
+            return response.json().get("transaction_id") if response is not None else None
+
+        ids = [txn for txn in await limited(self.args.concurrency, [withdraw(user) for user in users]) if txn]
+
+        async def approve(wave: list):
+            # The endpoint streams one NDJSON line per withdrawal; the wave ends with its summary line
+            started = time.perf_counter()
+            recorder.requests += 1
+            try:
+                async with self.client.stream("POST", "/api/admin/approve-withdrawals/bulk", headers=self.auth(self.admin_token),
+                                              json={"transaction_ids": wave}) as response:
+                    lines = [line async for line in response.aiter_lines() if line.strip()]
+                failed = response.status_code >= 400 or not lines
+            except httpx.HTTPError:
+                failed = True
+            finished = time.perf_counter()
+            recorder.observe("bulk approval wave", finished - started, started, finished)
+            if failed:
+                recorder.errors["bulk approval wave"] += 1
+
+        waves = [ids[i:i + self.args.wave_size] for i in range(0, len(ids), self.args.wave_size)]
+        await limited(self.args.admins, [approve(wave) for wave in waves])
+
+    async def scenario_webhooks(self, recorder: Recorder):
+        # Half the virtual users poll their dashboards while the other half deposit, so callbacks land on a busy server
+        stats_before = await self.fake_stats()
+        started_at = datetime.utcnow()
+        pollers = max(1, self.args.concurrency // 2)
+        deadline = time.monotonic() + self.args.duration
+        polling = asyncio.gather(*(self.poll_dashboard(recorder, deadline) for _ in range(pollers)))
+        await limited(pollers, [self.deposit(recorder, i, user) for i, user in enumerate(self.users)])
+
+        settle_deadline = time.monotonic() + self.args.settle_timeout
+        while (await self.fake_stats())["pending_callbacks"] and time.monotonic() < settle_deadline:
+            await asyncio.sleep(0.5)
+        await polling
+
+        stats_after = await self.fake_stats()
+        clock = time.perf_counter() - time.time()  # maps wall-clock timestamps onto the perf counter
+        for kind, acks in stats_after["callback_acks"].items():
+            for sent, seconds in acks[len(stats_before["callback_acks"].get(kind, [])):]:
+                recorder.observe(f"{kind} callback ack", seconds, sent + clock, sent + clock + seconds)
+            recorder.errors[f"{kind} callback ack"] = sum(
+                stats_after["callbacks"].get(f"{kind}_{outcome}", 0) - stats_before["callbacks"].get(f"{kind}_{outcome}", 0)
+                for outcome in ("rejected", "failed")
+            )
+
+        if self.args.ingress:
+            # Time from the ingress storing a callback to an API worker settling it
+            query = {"received_at": {"$gte": started_at}}
+            while await self.db.webhook_inbox.count_documents({**query, "processed_at": {"$exists": False}}):
+                if time.monotonic() > settle_deadline:
+                    break
+                await asyncio.sleep(0.5)
+            async for entry in self.db.webhook_inbox.find(query, {"gateway": 1, "status": 1, "received_at": 1, "processed_at": 1}):
+                step = f"{entry['gateway']} inbox settled"
+                if entry.get("processed_at") and entry["status"] == "done":
+                    received = entry["received_at"].replace(tzinfo=timezone.utc).timestamp() + clock
+                    processed = entry["processed_at"].replace(tzinfo=timezone.utc).timestamp() + clock
+                    recorder.observe(step, processed - received, received, processed)
+                else:
+                    recorder.errors[step] += 1
+
+
+def start_process(command: list, env: dict, log_path: Path, cwd: Path = BACKEND_DIR) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args[:3]} exited with {process.returncode}; see its log")
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.25)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def start_mongod(run_dir: Path) -> tuple:
+    """A single-node replica set in run_dir. Returns (process, url)."""
+    if not shutil.which("mongod"):
+        raise SystemExit("mongod is not on PATH; install it or pass --mongo-url for a dedicated replica set")
+    port = free_port()
+    (run_dir / "db").mkdir()
+    process = start_process(
+        ["mongod", "--replSet", "rs0", "--port", str(port), "--bind_ip", "127.0.0.1", "--dbpath", str(run_dir / "db")],
+        dict(os.environ), run_dir / "mongod.log"
+    )
+    client = AsyncIOMotorClient(f"mongodb://127.0.0.1:{port}/?directConnection=true", serverSelectionTimeoutMS=1000)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            await client.admin.command("ping")
+            break
+        except Exception:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError("mongod did not start; see mongod.log")
+            await asyncio.sleep(0.25)
+    await client.admin.command("replSetInitiate", {"_id": "rs0", "members": [{"_id": 0, "host": f"127.0.0.1:{port}"}]})
+    while not (await client.admin.command("hello")).get("isWritablePrimary"):
+        await asyncio.sleep(0.25)
+    client.close()
+    return process, f"mongodb://127.0.0.1:{port}/?replicaSet=rs0"
+
+
+def server_env(args, mongo_url: str, app_url: str, fakes_url: str) -> dict:
+    unlimited = "1000000/1"
+    env = dict(os.environ)
+    env.update({
+        "MONGO_URL": mongo_url,
+        "BACKEND_URL": app_url,
+        "BASE_URL": app_url,
+        "JWT_SECRET": secrets.token_hex(16),
+        "DEFAULT_ADMIN_EMAIL": ADMIN_EMAIL,
+        "DEFAULT_ADMIN_PASSWORD": ADMIN_PASSWORD,
+        "MPESA_BASE_URL": f"{fakes_url}/safaricom",
+        "MPESA_CONSUMER_KEY": "loadtest",
+        "MPESA_CONSUMER_SECRET": "loadtest",
+        "MPESA_LIPA_NA_MPESA_SHORTCODE": "174379",
+        "MPESA_PASSKEY": "loadtest",
+        "PAYPAL_BASE_URL": f"{fakes_url}/paypal",
+        "PAYSTACK_BASE_URL": f"{fakes_url}/paystack",
+        "PAYSTACK_SECRET_KEY": PAYSTACK_SECRET,
+        "PESAPAL_BASE_URL": f"{fakes_url}/pesapal",
+        "CURRENCY_API_URL": f"{fakes_url}/rates/latest/USD",
+        "MAIL_SERVER": "127.0.0.1",
+        "MAIL_PORT": "1",
+        "MAIL_USERNAME": "loadtest",
+        "MAIL_PASSWORD": "loadtest",
+        "MAIL_FROM": "loadtest@example.com",
+        "METRICS_TOKEN": "",
+        "WEB_CONCURRENCY": str(args.workers),
+    })
+    for policy in ("deposit", "withdrawal", "login", "password_reset", "spin"):
+        env[f"RATE_LIMIT_{policy.upper()}"] = unlimited
+    if args.workers > 1:
+        env.update({"CACHE_BUS_BACKEND": "mongo", "LIVE_EVENTS_BACKEND": "mongo", "RATE_LIMIT_BACKEND": "mongo"})
+    return env
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Lines describing every metric that regressed past `tolerance` against the baseline."""
+    regressions = []
+    for scenario, current in report["scenarios"].items():
+        previous = baseline["scenarios"].get(scenario)
+        if not previous:
+            continue
+        if current["mongo_ops_per_request"] > previous["mongo_ops_per_request"] * (1 + tolerance):
+            regressions.append(f"{scenario}: mongo ops/request {previous['mongo_ops_per_request']} -> {current['mongo_ops_per_request']}")
+        for step, stats in current["steps"].items():
+            before = previous["steps"].get(step)
+            if not before:
+                continue
+            if stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{scenario}/{step}: p95 {before['p95_ms']} ms -> {stats['p95_ms']} ms")
+            if stats["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{scenario}/{step}: throughput {before['throughput_rps']} -> {stats['throughput_rps']} req/s")
+    return regressions
+
+
+def print_report(report: dict):
+    for scenario, result in report["scenarios"].items():
+        print(f"\n== {scenario}: {result['requests']} requests in {result['wall_seconds']}s, "
+              f"{result['mongo_ops_per_request']} mongo ops/request")
+        print(f"  {'step':<24}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for step, stats in result["steps"].items():
+            print(f"  {step:<24}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_rps']:>10}"
+                  f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+        for route, ops in sorted(result.get("mongo_ops_per_route", {}).items(), key=lambda item: -item[1]):
+            print(f"    {ops:>8} mongo ops/request  {route}")
+
+
+async def main(args) -> int:
+    run_dir = Path(tempfile.mkdtemp(prefix="loadtest-"))
+    processes = []
+    try:
+        if args.mongo_url:
+            mongo_url = args.mongo_url
+        else:
+            mongod, mongo_url = await start_mongod(run_dir)
+            processes.append(mongod)
+        mongo = AsyncIOMotorClient(mongo_url)
+        if await mongo.earnplatform.users.estimated_document_count() and not args.reuse_db:
+            raise SystemExit("The earnplatform database already has users; pass --reuse-db if this instance is meant for load tests")
+
+        app_port, fakes_port = free_port(), free_port()
+        app_url, fakes_url = f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{fakes_port}"
+        # Where the providers call back: the API itself, or the webhook ingress in front of the inbox
+        callback_url = f"http://127.0.0.1:{free_port()}" if args.ingress else app_url
+
+        fakes = start_process([
+            sys.executable, str(Path(__file__).resolve().parent / "fake_gateways.py"),
+            "--port", str(fakes_port), "--app-url", callback_url, "--paystack-secret", PAYSTACK_SECRET,
+            "--latency-ms", str(args.gateway_latency_ms), "--jitter-ms", str(args.gateway_jitter_ms),
+            "--callback-delay-ms", str(args.callback_delay_ms), "--fail-rate", str(args.fail_rate)
+        ], dict(os.environ), run_dir / "fakes.log")
+        processes.append(fakes)
+
+        env = server_env(args, mongo_url, app_url, fakes_url)
+        if args.ingress:
+            env.update({"BACKEND_URL": callback_url, "WEBHOOK_INBOX_PROCESSING": "true"})
+            ingress = start_process([
+                sys.executable, "-m", "uvicorn", "webhook_ingress:app",
+                "--host", "127.0.0.1", "--port", callback_url.rsplit(":", 1)[1], "--log-level", "warning"
+            ], env, run_dir / "ingress.log")
+            processes.append(ingress)
+        if args.workers > 1:
+            env["BIND"] = f"127.0.0.1:{app_port}"
+            command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "server:app"]
+        else:
+            command = [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"]
+        server = start_process(command, env, run_dir / "server.log")
+        processes.append(server)
+
+        await wait_until_up(f"{fakes_url}/stats", fakes)
+        await wait_until_up(f"{app_url}/metrics", server)
+        if args.ingress:
+            await wait_until_up(f"{callback_url}/healthz", ingress)
+
+        test = LoadTest(args, app_url, fakes_url, mongo)
+        await test.login_admin()
+        report = {
+            "created_at": datetime.utcnow().isoformat(),
+            "config": {
+                "users": args.users,
+                "concurrency": args.concurrency,
+                "workers": args.workers,
+                "ingress": args.ingress,
+                "duration": args.duration,
+                "gateway_latency_ms": args.gateway_latency_ms,
+                "wave_size": args.wave_size
+            },
+            "scenarios": {}
+        }
+        for name in args.scenarios:
+            print(f"Running {name}...", flush=True)
+            report["scenarios"][name] = await test.run_scenario(name)
+        await test.client.aclose()
+        print_report(report)
+        print(f"\nLogs: {run_dir}")
+
+        status = 0
+        if args.compare:
+            baseline = json.loads((BASELINE_DIR / f"{args.compare}.json").read_text())
+            if baseline["config"] != report["config"]:
+                print(f"Warning: baseline {args.compare} was recorded with {baseline['config']}")
+            regressions = compare(report, baseline, args.tolerance)
+            for line in regressions:
+                print(f"REGRESSION {line}")
+            if regressions:
+                status = 1
+            else:
+                print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+        if args.save_baseline:
+            BASELINE_DIR.mkdir(exist_ok=True)
+            path = BASELINE_DIR / f"{args.save_baseline}.json"
+            path.write_text(json.dumps(report, indent=2) + "\n")
+            print(f"Saved baseline {path}")
+        if args.report:
+            Path(args.report).write_text(json.dumps(report, indent=2) + "\n")
+        return status
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50, help="Virtual users in flight at once")
+    parser.add_argument("--workers", type=int, default=1, help="Server workers; above 1 runs gunicorn with Mongo-backed shared state")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of dashboard polling")
+    parser.add_argument("--think-ms", type=float, default=0, help="Pause between a polling user's rounds")
+    parser.add_argument("--deposit-amount", type=float, default=3000)
+    parser.add_argument("--settle-timeout", type=float, default=120, help="How long to wait for deposit callbacks")
+    parser.add_argument("--wave-size", type=int, default=100, help="Withdrawals per bulk approval")
+    parser.add_argument("--admins", type=int, default=2, help="Bulk approval waves in flight at once")
+    parser.add_argument("--gateway-latency-ms", type=float, default=150)
+    parser.add_argument("--gateway-jitter-ms", type=float, default=100)
+    parser.add_argument("--callback-delay-ms", type=float, default=500)
+    parser.add_argument("--ingress", action="store_true", help="Take callbacks through the webhook ingress and inbox")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of gateway payments that fail")
+    parser.add_argument("--mongo-url", help="Existing replica set to use instead of starting mongod")
+    parser.add_argument("--reuse-db", action="store_true", help="Allow a database that already has users")
+    parser.add_argument("--save-baseline", metavar="NAME", help=f"Save the report as {BASELINE_DIR.name}/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="Compare against a saved baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    parser.add_argument("--report", help="Also write the JSON report here")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    if "register" not in args.scenarios:
+        parser.error("The other scenarios act as the users the register scenario creates; include it")
+    args.scenarios = [name for name in SCENARIOS if name in args.scenarios]
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,263 @@
+"""
+Microbenchmarks for the helpers that run on nearly every request.
+
+Covers json_serializable_doc (single documents and 1,000-document lists),
+validate_and_format_phone, generate_quick_actions, the user-document
+coercion done by get_current_user (coerce_user_fields) and build_team_tree
+over full binary trees. Inputs are synthetic and built before timing;
+build_team_tree reads from an in-memory collection, so no Mongo is needed.
+
+Each case is timed in batches after a warm-up, and the best and median time
+per call are reported. Every run is appended to baselines/microbench.jsonl
+with the commit it ran on, which is the performance history; --compare
+checks the run against the previous entry and exits 1 if any case got
+slower by more than --tolerance.
+
+Usage (from the backend directory):
+    python benchmarks/microbench.py [--filter team_tree] [--repeat 7] [--compare [--tolerance 0.15]] [--no-record]
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bson import ObjectId
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+HISTORY_PATH = Path(__file__).resolve().parent / "baselines" / "microbench.jsonl"
+
+# server.py validates the mail settings at import time; nothing is sent from here
+for name, value in {"MAIL_USERNAME": "bench", "MAIL_PASSWORD": "bench", "MAIL_SERVER": "127.0.0.1", "MAIL_FROM": "bench@example.com"}.items():
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(BACKEND_DIR))
+
+from server import (  # noqa: E402
+    build_team_tree,
+    coerce_user_fields,
+    generate_quick_actions,
+    json_serializable_doc,
+    validate_and_format_phone,
+)
+
+
+class MemoryCollection:
+    """Just enough of a Motor collection for build_team_tree: find_one by equality, exclusion projections."""
+
+    def __init__(self, docs: list, key: str = "user_id"):
+        self.key = key
+        self.docs = {doc[key]: doc for doc in docs}
+
+    async def find_one(self, query: dict, projection: dict = None):
+        doc = self.docs.get(query.get(self.key))
+        if doc is None or any(doc.get(field) != value for field, value in query.items()):
+            return None
+        doc = dict(doc)
+        for field, include in (projection or {}).items():
+            if not include:
+                doc.pop(field, None)
+        return doc
+
+
+class MemoryDatabase:
+    def __init__(self, users: list):
+        self.users = MemoryCollection(users)
+
+
+def make_user(index: int, **overrides) -> dict:
+    """A user document as stored: balances are strings, and it carries the fields the tree query projects away."""
+    created = datetime(2024, 1, 1) + timedelta(minutes=index)
+    user = {
+        "_id": ObjectId(),
+        "user_id": f"user-{index}",
+        "email": f"user{index}@example.com",
+        "full_name": f"User {index}",
+        "phone": f"+2547{10_000_000 + index}",
+        "password": "$2b$12$" + "x" * 53,
+        "role": "user",
+        "is_activated": index % 3 != 0,
+        "preferred_currency": random.choice(["KES", "USD", "UGX"]),
+        "wallet_balance": f"{random.uniform(0, 5000):.2f}",
+        "activation_amount": "500.0",
+        "total_earned": f"{random.uniform(0, 20000):.2f}",
+        "total_withdrawn": f"{random.uniform(0, 10000):.2f}",
+        "referral_earnings": f"{random.uniform(0, 3000):.2f}",
+        "task_earnings": f"{random.uniform(0, 3000):.2f}",
+        "binary_earnings": "0.0",
+        "team_earnings": "0.0",
+        "referral_count": random.randint(0, 12),
+        "left_leg_size": random.randint(0, 50),
+        "right_leg_size": random.randint(0, 50),
+        "payment_methods": [{"type": "mpesa", "phone": f"+2547{10_000_000 + index}", "added_at": created}],
+        "security": {"last_login": created, "failed_logins": 0},
+        "verification": {"email": True, "phone": False, "verified_at": created},
+        "created_at": created,
+        "updated_at": created,
+    }
+    user.update(overrides)
+    return user
+
+
+def make_transactions(count: int) -> list:
+    """Transaction documents with ObjectIds, datetimes and nested gateway details, as history pages return them."""
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "transaction_id": f"txn-{i}",
+            "user_id": f"user-{i % 50}",
+            "type": random.choice(["deposit", "withdrawal", "task_reward", "referral"]),
+            "amount": f"{random.uniform(10, 5000):.2f}",
+            "currency": "KES",
+            "status": random.choice(["completed", "pending", "failed"]),
+            "method": random.choice(["mpesa", "paystack", "pesapal"]),
+            "payment_details": {"mpesa": {"checkout_request_id": f"ws_CO_{i}", "receipt": f"R{i:08d}", "paid_at": start + timedelta(hours=i)}},
+            "gateway_event_ids": [ObjectId() for _ in range(3)],
+            "created_at": start + timedelta(hours=i),
+            "completed_at": start + timedelta(hours=i, minutes=2),
+        }
+        for i in range(count)
+    ]
+
+
+def make_nested(depth: int, breadth: int) -> dict:
+    """A payload nested `depth` levels deep with `breadth` children per level, mixing dicts, lists and ObjectIds."""
+    if depth == 0:
+        return {"_id": ObjectId(), "at": datetime(2024, 1, 1), "value": "leaf"}
+    return {
+        "_id": ObjectId(),
+        "at": datetime(2024, 1, 1),
+        "children": [make_nested(depth - 1, breadth) for _ in range(breadth)],
+        "meta": make_nested(depth - 1, 1) if depth > 1 else {"value": depth},
+    }
+
+
+def make_team(depth: int) -> MemoryDatabase:
+    """A full binary team tree `depth` levels deep, rooted at user-0."""
+    users = []
+    size = 2 ** depth - 1
+    for index in range(size):
+        left, right = 2 * index + 1, 2 * index + 2
+        users.append(make_user(
+            index,
+            left_child_id=f"user-{left}" if left < size else None,
+            right_child_id=f"user-{right}" if right < size else None,
+            position="left" if index % 2 else "right",
+        ))
+    return MemoryDatabase(users)
+
+
+def copies(value, count: int) -> list:
+    return [copy.deepcopy(value) for _ in range(count)]
+
+
+def phone_inputs(count: int) -> list:
+    formats = ["0712 345 678", "+254 (712) 345-678", "254712345678", "+1-202-555-0143", "+44 20 7946 0958"]
+    return [formats[i % len(formats)] for i in range(count)]
+
+
+def dashboard_users(count: int) -> list:
+    return [coerce_user_fields(make_user(i)) for i in range(count)]
+
+
+def team_tree(depth: int):
+    database = make_team(depth)
+    loop = asyncio.new_event_loop()
+    return lambda _: loop.run_until_complete(build_team_tree("user-0", database, max_depth=depth))
+
+
+# name -> (inputs(batch) -> list of arguments, function of one argument, calls per batch)
+CASES = {
+    "json_serializable_doc/user": (lambda n: copies(make_user(1), n), json_serializable_doc, 1000),
+    "json_serializable_doc/1000_transactions": (lambda n: copies(make_transactions(1000), n), json_serializable_doc, 3),
+    "json_serializable_doc/nested_6x3": (lambda n: copies(make_nested(6, 3), n), json_serializable_doc, 10),
+    "validate_and_format_phone": (phone_inputs, validate_and_format_phone, 10000),
+    "generate_quick_actions": (dashboard_users, lambda user: generate_quick_actions(user, 0.0077, "USD"), 10000),
+    "coerce_user_fields": (lambda n: [make_user(i) for i in range(n)], coerce_user_fields, 2000),
+    "build_team_tree/depth_5": (lambda n: [None] * n, team_tree(5), 20),
+    "build_team_tree/depth_8": (lambda n: [None] * n, team_tree(8), 3),
+}
+
+
+def run_case(inputs, func, batch: int, repeat: int) -> dict:
+    """Seconds per call: best and median over `repeat` batches, after one warm-up batch."""
+    timings = []
+    for run in range(repeat + 1):
+        arguments = inputs(batch)
+        started = time.perf_counter()
+        for argument in arguments:
+            func(argument)
+        elapsed = (time.perf_counter() - started) / batch
+        if run:
+            timings.append(elapsed)
+    return {"best_us": round(min(timings) * 1e6, 2), "median_us": round(statistics.median(timings) * 1e6, 2), "calls": batch * repeat}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def previous_run() -> dict:
+    if not HISTORY_PATH.exists():
+        return None
+    lines = [line for line in HISTORY_PATH.read_text().splitlines() if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+
+def main(args) -> int:
+    random.seed(42)
+    previous = previous_run() if args.compare else None
+    results = {}
+    for name, (inputs, func, batch) in CASES.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = run_case(inputs, func, batch, args.repeat)
+        line = f"{name:<42}{results[name]['best_us']:>12} us best{results[name]['median_us']:>12} us median"
+        before = (previous or {}).get("results", {}).get(name)
+        if before:
+            line += f"{(results[name]['median_us'] / before['median_us'] - 1):>+10.1%}"
+        print(line, flush=True)
+
+    status = 0
+    if previous:
+        slower = [
+            name for name, result in results.items()
+            if name in previous["results"] and result["median_us"] > previous["results"][name]["median_us"] * (1 + args.tolerance)
+        ]
+        for name in slower:
+            print(f"REGRESSION {name}: {previous['results'][name]['median_us']} -> {results[name]['median_us']} us "
+                  f"(previous run at {previous['commit'] or 'unknown commit'})")
+        status = 1 if slower else 0
+
+    if not args.no_record:
+        HISTORY_PATH.parent.mkdir(exist_ok=True)
+        with open(HISTORY_PATH, "a") as history:
+            history.write(json.dumps({
+                "created_at": datetime.utcnow().isoformat(),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "machine": platform.node(),
+                "results": results
+            }) + "\n")
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--filter", help="Only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=7, help="Timed batches per case")
+    parser.add_argument("--compare", action="store_true", help="Compare against the last recorded run; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown of the median")
+    parser.add_argument("--no-record", action="store_true", help="Don't append this run to the history")
+    sys.exit(main(parser.parse_args()))
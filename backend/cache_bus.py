@@ -0,0 +1,200 @@
+"""
+In-process caches kept coherent across workers by an invalidation bus.
+
+Every worker holds its own TTLCache objects. Invalidating an entry drops it
+locally and publishes the invalidation. With no collection (the local
+broker) that is all there is to do, since there is only one worker. With a
+collection, the message is written to a small TTL-indexed collection that
+every worker tails with a change stream. While a worker's stream is down
+its caches are cleared and bypassed, so an invalidation it missed can never
+be served from cache.
+
+CollectionWatcher drops entries straight from a source collection's change
+stream, for data written from too many places to publish by hand.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+
+class TTLCache:
+    """
+    Per-process cache with a TTL and LRU eviction beyond max_entries. A ttl of 0 disables it.
+    Values must not be None (get returns None on a miss).
+    """
+
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int = 10_000):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.active = ttl_seconds > 0
+        self.version = 0  # bumped by every invalidation
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if not self.active:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, version: int = None, ttl_seconds: float = None):
+        """
+        Stores `value`. Pass the `version` read before loading it: if an invalidation
+        arrived while the value was being loaded, it may already be stale and is dropped.
+        """
+        if not self.active or (version is not None and version != self.version):
+            return
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Drops one key, or everything when key is None."""
+        self.version += 1
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def suspend(self):
+        self.invalidate()
+        self.active = False
+
+    def resume(self):
+        self.invalidate()
+        self.active = self.ttl_seconds > 0
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self.active,
+            "ttl_seconds": self.ttl_seconds,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class InvalidationBus:
+    """
+    Registry of this worker's caches. `collection` None keeps invalidations in
+    process; otherwise they fan out through it (needs a replica set, already
+    required for transactions, and a TTL index: see ensure_indexes).
+    """
+
+    def __init__(self, collection=None, retention_seconds: int = 300):
+        self.collection = collection
+        self.retention_seconds = retention_seconds
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.connected = collection is None
+        self.caches = {}
+
+    @property
+    def backend(self) -> str:
+        return "local" if self.collection is None else "mongo"
+
+    def register(self, cache: TTLCache) -> TTLCache:
+        self.caches[cache.name] = cache
+        if not self.connected:
+            cache.suspend()
+        return cache
+
+    async def ensure_indexes(self):
+        if self.collection is not None:
+            await self.collection.create_index("created_at", expireAfterSeconds=self.retention_seconds, name="cache_invalidation_created_at_ttl_idx")
+
+    def apply(self, cache_name: str, key=None):
+        cache = self.caches.get(cache_name)
+        if cache:
+            cache.invalidate(key)
+
+    async def invalidate(self, cache_name: str, key=None):
+        """Drops the entry (or the whole cache when key is None) here and in every other worker."""
+        self.apply(cache_name, key)
+        if self.collection is None:
+            return
+        try:
+            await self.collection.insert_one({
+                "cache": cache_name,
+                "key": key,
+                "origin": self.origin,
+                "created_at": datetime.utcnow()
+            })
+        except Exception as e:
+            # Other workers would keep serving the old value; stop caching until the bus recovers
+            logging.error(f"Failed to publish {cache_name} cache invalidation, suspending caches: {e}")
+            self._set_connected(False)
+
+    def _set_connected(self, connected: bool):
+        self.connected = connected
+        for cache in self.caches.values():
+            if connected:
+                cache.resume()
+            else:
+                cache.suspend()
+
+    async def run(self):
+        """Tails invalidations from other workers; caches stay suspended whenever the stream is down."""
+        backoff = 1
+        while True:
+            try:
+                async with self.collection.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                    self._set_connected(True)
+                    backoff = 1
+                    async for change in stream:
+                        message = change["fullDocument"]
+                        if message.get("origin") != self.origin:
+                            self.apply(message["cache"], message.get("key"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Cache invalidation stream failed, caches bypassed; retrying in {backoff}s: {e}")
+            self._set_connected(False)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+class CollectionWatcher:
+    """Invalidates `cache` entries keyed by str(_id) whenever a document in `collection` changes."""
+
+    def __init__(self, collection, cache: TTLCache):
+        self.collection = collection
+        self.cache = cache
+        cache.suspend()
+
+    async def run(self):
+        backoff = 1
+        while True:
+            try:
+                async with self.collection.watch([
+                    {"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}},
+                    {"$project": {"documentKey": 1}}
+                ]) as stream:
+                    self.cache.resume()
+                    backoff = 1
+                    async for change in stream:
+                        self.cache.invalidate(str(change["documentKey"]["_id"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"{self.cache.name} cache watcher failed, cache bypassed; retrying in {backoff}s: {e}")
+            self.cache.suspend()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
@@ -0,0 +1,215 @@
+"""
+Per-gateway circuit breakers with latency budgets.
+
+Each payment provider gets its own breaker. A breaker tracks the outcome and
+latency of the last N calls and opens when the error rate or slow-call rate
+crosses its threshold. While open, calls fail fast with a 503 instead of
+waiting on a degraded provider. After a cool-down a limited number of probe
+calls are let through (half-open); a successful probe closes the breaker,
+a failed one re-opens it.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(HTTPException):
+    """Raised instead of calling a gateway whose breaker is open."""
+
+    def __init__(self, gateway: str, retry_after: float):
+        self.gateway = gateway
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(
+            status_code=503,
+            detail=f"{gateway} is temporarily unavailable. Please try again shortly.",
+            headers={"Retry-After": str(self.retry_after)}
+        )
+
+
+class LatencyBudgetExceeded(HTTPException):
+    """Raised when a gateway call runs past its latency budget."""
+
+    def __init__(self, gateway: str, budget: float):
+        self.gateway = gateway
+        super().__init__(
+            status_code=504,
+            detail=f"{gateway} did not respond within {budget:g}s. Please try again."
+        )
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 15.0,
+        failure_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 5.0,
+        slow_rate_threshold: float = 0.8,
+        window_size: int = 20,
+        min_calls: int = 5,
+        open_seconds: float = 30.0,
+        half_open_max_calls: int = 1
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate_threshold = slow_rate_threshold
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = CLOSED
+        self.opened_at = None
+        self._window = deque(maxlen=window_size)  # (failed, slow) per call
+        self._half_open_inflight = 0
+        self.total_calls = 0
+        self.total_failures = 0
+        self.total_rejected = 0
+
+    def _rates(self):
+        calls = len(self._window)
+        if calls == 0:
+            return 0.0, 0.0
+        failures = sum(1 for failed, _ in self._window if failed)
+        slow = sum(1 for _, slow in self._window if slow)
+        return failures / calls, slow / calls
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        failure_rate, slow_rate = self._rates()
+        logging.warning(
+            f"Circuit breaker for {self.name} opened "
+            f"(failure rate {failure_rate:.0%}, slow rate {slow_rate:.0%}, cool-down {self.open_seconds:g}s)"
+        )
+
+    def _close(self):
+        self.state = CLOSED
+        self.opened_at = None
+        self._window.clear()
+        logging.info(f"Circuit breaker for {self.name} closed")
+
+    def retry_after(self) -> float:
+        if self.state != OPEN or self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def _acquire(self) -> bool:
+        """Admits a call or raises CircuitOpenError. Returns True if the call is a half-open probe."""
+        if self.state == OPEN:
+            if self.retry_after() > 0:
+                self.total_rejected += 1
+                raise CircuitOpenError(self.name, self.retry_after())
+            self.state = HALF_OPEN
+            logging.info(f"Circuit breaker for {self.name} half-open, probing")
+
+        if self.state == HALF_OPEN:
+            if self._half_open_inflight >= self.half_open_max_calls:
+                self.total_rejected += 1
+                raise CircuitOpenError(self.name, 1)
+            self._half_open_inflight += 1
+            return True
+        return False
+
+    def _record(self, failed: bool, elapsed: float, probe: bool):
+        slow = elapsed >= self.slow_call_seconds
+        self.total_calls += 1
+        if failed:
+            self.total_failures += 1
+
+        if probe:
+            self._half_open_inflight -= 1
+            if failed or slow:
+                self._open()
+            else:
+                self._close()
+            return
+
+        if self.state != CLOSED:
+            return
+        self._window.append((failed, slow))
+        if len(self._window) >= self.min_calls:
+            failure_rate, slow_rate = self._rates()
+            if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_rate_threshold:
+                self._open()
+
+    async def call(self, func, *args, success_if=None, **kwargs):
+        """
+        Runs `func(*args, **kwargs)` under this breaker and its latency budget.
+        `success_if` optionally classifies a returned result as success or failure.
+        """
+        probe = self._acquire()
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._record(True, time.monotonic() - start, probe)
+            raise LatencyBudgetExceeded(self.name, self.timeout)
+        except asyncio.CancelledError:
+            # Caller went away; says nothing about the gateway's health
+            if probe:
+                self._half_open_inflight -= 1
+            raise
+        except Exception:
+            self._record(True, time.monotonic() - start, probe)
+            raise
+        failed = success_if is not None and not success_if(result)
+        self._record(failed, time.monotonic() - start, probe)
+        return result
+
+    def snapshot(self) -> dict:
+        failure_rate, slow_rate = self._rates()
+        retry_after = self.retry_after()
+        return {
+            "state": self.state,
+            "failure_rate": round(failure_rate, 3),
+            "slow_call_rate": round(slow_rate, 3),
+            "window_calls": len(self._window),
+            "retry_after_seconds": round(retry_after, 1),
+            "reopens_at": (datetime.utcnow() + timedelta(seconds=retry_after)).isoformat() if retry_after else None,
+            "latency_budget_seconds": self.timeout,
+            "thresholds": {
+                "failure_rate": self.failure_rate_threshold,
+                "slow_call_seconds": self.slow_call_seconds,
+                "slow_call_rate": self.slow_rate_threshold,
+                "min_calls": self.min_calls,
+                "open_seconds": self.open_seconds
+            },
+            "totals": {
+                "calls": self.total_calls,
+                "failures": self.total_failures,
+                "rejected": self.total_rejected
+            }
+        }
+
+
+def breaker_from_env(name: str, default_timeout: float) -> CircuitBreaker:
+    """
+    Builds a breaker configured from GATEWAY_<NAME>_* environment variables,
+    falling back to the shared GATEWAY_BREAKER_* defaults.
+    """
+    def setting(key: str, default, cast=float):
+        value = os.environ.get(f"GATEWAY_{name.upper()}_{key}", os.environ.get(f"GATEWAY_BREAKER_{key}"))
+        return cast(value) if value is not None else default
+
+    return CircuitBreaker(
+        name,
+        timeout=setting("TIMEOUT", default_timeout),
+        failure_rate_threshold=setting("FAILURE_RATE", 0.5),
+        slow_call_seconds=setting("SLOW_CALL_SECONDS", 5.0),
+        slow_rate_threshold=setting("SLOW_RATE", 0.8),
+        window_size=setting("WINDOW", 20, int),
+        min_calls=setting("MIN_CALLS", 5, int),
+        open_seconds=setting("OPEN_SECONDS", 30.0),
+        half_open_max_calls=setting("HALF_OPEN_CALLS", 1, int)
+    )
@@ -0,0 +1,108 @@
+"""
+Metrics and trace spans for outbound calls to payment gateways and the
+exchange-rate API.
+
+Every attempt made by gateway_request is recorded once: latency (time on
+the wire, including connection setup), status code or failure kind, bytes
+sent and received, and whether it was a retry. Each attempt also becomes a
+span: a record on the 'gateway.spans' logger (the whole span is in its
+structured fields when logging as json), kept in a ring buffer for the
+admin API. Spans carry the transaction_id (used as the trace id when
+known) and the route that made the call, so provider latency can be told
+apart from our own during incidents.
+"""
+import logging
+import re
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+from metrics import LATENCY_BUCKETS, Registry, current_route
+
+span_logger = logging.getLogger("gateway.spans")
+
+# Path segments that identify a resource (order ids, tokens) rather than an endpoint
+ID_SEGMENT = re.compile(r"^(?=.*\d)[A-Za-z0-9_-]{12,}$|^[0-9a-fA-F-]{32,36}$")
+
+
+def endpoint_label(url: str) -> str:
+    """host/path with id-like segments replaced by {id}, so endpoints stay a bounded label set."""
+    parsed = urlparse(url)
+    segments = ["{id}" if ID_SEGMENT.match(segment) else segment for segment in parsed.path.split("/")]
+    return parsed.netloc + "/".join(segments)
+
+
+class GatewayInstrumentation:
+    def __init__(self, registry: Registry, span_buffer: int = 1000):
+        labels = ("gateway", "endpoint")
+        self.latency = registry.histogram(
+            "gateway_request_duration_seconds", "Outbound gateway call latency per attempt", labels + ("outcome",), buckets=LATENCY_BUCKETS
+        )
+        self.requests = registry.counter("gateway_requests_total", "Outbound gateway call attempts by status code or failure", labels + ("status",))
+        self.retries = registry.counter("gateway_retries_total", "Outbound gateway calls retried after a connection error", labels)
+        self.timeouts = registry.counter("gateway_timeouts_total", "Outbound gateway calls that ran past their latency budget", labels)
+        self.sent_bytes = registry.counter("gateway_request_bytes_total", "Request body bytes sent to gateways", labels)
+        self.received_bytes = registry.counter("gateway_response_bytes_total", "Response body bytes received from gateways", labels)
+        self.spans = deque(maxlen=span_buffer)
+
+    def record(
+        self,
+        gateway: str,
+        method: str,
+        url: str,
+        started: float,
+        outcome: str,
+        status_code: int = None,
+        transaction_id: str = None,
+        attempt: int = 0,
+        request_bytes: int = 0,
+        response_bytes: int = 0,
+        error: str = None
+    ) -> dict:
+        """
+        Records one attempt. `started` is a time.perf_counter() reading; `outcome` is 'ok'
+        (any HTTP response), 'timeout', 'circuit_open' or 'error'.
+        """
+        duration = time.perf_counter() - started
+        endpoint = endpoint_label(url)
+        self.latency.observe(gateway, endpoint, outcome, value=duration)
+        self.requests.inc(gateway, endpoint, str(status_code) if status_code else outcome)
+        if attempt:
+            self.retries.inc(gateway, endpoint)
+        if outcome == "timeout":
+            self.timeouts.inc(gateway, endpoint)
+        self.sent_bytes.inc(gateway, endpoint, amount=request_bytes)
+        self.received_bytes.inc(gateway, endpoint, amount=response_bytes)
+
+        span = {
+            "trace_id": transaction_id or uuid.uuid4().hex,
+            "span_id": uuid.uuid4().hex[:16],
+            "name": f"{gateway} {method} {endpoint}",
+            "gateway": gateway,
+            "endpoint": endpoint,
+            "method": method,
+            "transaction_id": transaction_id,
+            "route": current_route(),
+            "attempt": attempt,
+            "started_at": (datetime.utcnow() - timedelta(seconds=duration)).isoformat(),
+            "duration_ms": round(duration * 1000, 1),
+            "outcome": outcome,
+            "status_code": status_code,
+            "request_bytes": request_bytes,
+            "response_bytes": response_bytes,
+            "error": error
+        }
+        self.spans.append(span)
+        span_logger.info("%s %s in %s ms", span["name"], outcome, span["duration_ms"], extra={"fields": {"span": span}})
+        return span
+
+    def recent_spans(self, transaction_id: str = None, gateway: str = None, limit: int = 100) -> list:
+        """Newest first, optionally for one transaction or gateway."""
+        spans = [
+            span for span in reversed(self.spans)
+            if (transaction_id is None or span["transaction_id"] == transaction_id)
+            and (gateway is None or span["gateway"] == gateway)
+        ]
+        return spans[:limit]
@@ -0,0 +1,36 @@
+"""
+Gunicorn settings for running the API with several Uvicorn workers:
+
+    gunicorn -c gunicorn.conf.py server:app
+
+Each worker is a separate process with its own caches, rate-limit buckets
+and live-event subscribers. Set CACHE_BUS_BACKEND, LIVE_EVENTS_BACKEND and
+RATE_LIMIT_BACKEND to 'mongo' so that state is shared between them. Index
+creation, seeding and the background jobs run in the worker holding the
+leader lease.
+
+API_ROUTERS limits a pool to some route groups (see routers/__init__.py),
+so gateway callbacks and the admin API can run on their own pools, sized
+independently of user traffic, e.g. API_ROUTERS=callbacks or
+API_ROUTERS=auth,admin. The load balancer routes the matching paths to
+each pool.
+
+For the lightest callback pool, run the webhook ingress app instead:
+
+    gunicorn -c gunicorn.conf.py webhook_ingress:app
+
+It only stores callbacks in the webhook inbox and acknowledges them. An API
+pool with WEBHOOK_INBOX_PROCESSING=true then settles them (see
+webhook_ingress.py).
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", f"0.0.0.0:{os.environ.get('PORT', 8000)}")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = 30
+
+# Each worker must open its own Mongo client after the fork
+preload_app = False
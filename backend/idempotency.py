@@ -0,0 +1,91 @@
+"""
+Idempotency-Key support for money-moving requests.
+
+The first request with a given key is recorded as in progress and its
+response stored when it finishes. Retries with the same key replay that
+stored response instead of running the request again. Records live in a
+TTL-indexed collection, so keys are remembered for `ttl_hours`.
+"""
+import hashlib
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+NEW = "new"
+REPLAY = "replay"
+IN_PROGRESS = "in_progress"
+MISMATCH = "mismatch"
+
+
+def request_fingerprint(method: str, path: str, body: bytes) -> str:
+    return hashlib.sha256(method.encode() + b" " + path.encode() + b"\n" + body).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, collection, ttl_hours: int = 24, lock_seconds: int = 120):
+        self.collection = collection
+        self.ttl = timedelta(hours=ttl_hours)
+        self.lock = timedelta(seconds=lock_seconds)
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0, name="idempotency_expires_at_ttl_idx")
+
+    async def begin(self, record_id: str, fingerprint: str):
+        """
+        Claims `record_id` for a new request. Returns (outcome, record) where outcome is
+        NEW, REPLAY (record holds the stored response), IN_PROGRESS or MISMATCH
+        (same key sent with a different request).
+        """
+        now = datetime.utcnow()
+        record = {
+            "_id": record_id,
+            "fingerprint": fingerprint,
+            "status": IN_PROGRESS,
+            "locked_until": now + self.lock,
+            "created_at": now,
+            "expires_at": now + self.ttl
+        }
+        try:
+            await self.collection.insert_one(record)
+            return NEW, record
+        except DuplicateKeyError:
+            pass
+
+        existing = await self.collection.find_one({"_id": record_id})
+        if existing is None:
+            # Expired between insert and read; try once more
+            return await self.begin(record_id, fingerprint)
+        if existing["fingerprint"] != fingerprint:
+            return MISMATCH, existing
+        if existing["status"] == "completed":
+            return REPLAY, existing
+
+        # The first attempt may have died mid-request; take over once its lock lapses
+        taken = await self.collection.find_one_and_update(
+            {"_id": record_id, "status": IN_PROGRESS, "locked_until": {"$lt": now}},
+            {"$set": {"locked_until": now + self.lock}},
+            return_document=ReturnDocument.AFTER
+        )
+        if taken:
+            return NEW, taken
+        return IN_PROGRESS, existing
+
+    async def complete(self, record_id: str, status_code: int, body: bytes, media_type: str):
+        await self.collection.update_one(
+            {"_id": record_id},
+            {
+                "$set": {
+                    "status": "completed",
+                    "response_status": status_code,
+                    "response_body": body.decode("utf-8"),
+                    "response_media_type": media_type,
+                    "completed_at": datetime.utcnow()
+                },
+                "$unset": {"locked_until": ""}
+            }
+        )
+
+    async def release(self, record_id: str):
+        """Forgets an unfinished or failed attempt so the client may retry with the same key."""
+        await self.collection.delete_one({"_id": record_id, "status": IN_PROGRESS})
@@ -0,0 +1,70 @@
+"""
+Imports deferred until first use, for dependencies few requests need.
+
+`fastapi_mail = LazyImport("fastapi_mail")` binds a placeholder. The real
+module is imported the first time an attribute is read from it, so a cold
+start does not pay for packages (and their settings validation) that a
+worker may never touch. Each load is timed, and logged unless load_all()
+has made loading eager, which makes the cost visible when it does land on
+a request. Async code can take the
+import off the event loop: `await asyncio.to_thread(module.load)`.
+
+With STARTUP_PROFILE=full, server.py calls load_all() at import. That
+restores eager loading, so missing packages and bad settings fail at
+startup rather than on first use.
+"""
+import importlib
+import logging
+import threading
+import time
+
+_registry = []
+_eager = False  # set by load_all(); loads at startup are expected and not worth a log line each
+
+
+class LazyImport:
+    def __init__(self, module_name: str):
+        self._module_name = module_name
+        self._module = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+        _registry.append(self)
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._module_name)
+                    self.load_seconds = time.perf_counter() - started
+                    self._module = module
+                    if not _eager:
+                        logging.info("Lazily imported %s in %.0f ms", self._module_name, self.load_seconds * 1000)
+        return self._module
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)  # our own attributes before __init__ has set them (copy, pickle)
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        return f"<LazyImport {self._module_name} ({'loaded' if self._module is not None else 'not loaded'})>"
+
+
+def load_all():
+    global _eager
+    _eager = True
+    for lazy in _registry:
+        lazy.load()
+
+
+def status() -> dict:
+    """Module name -> milliseconds its import took, or None while it has not been loaded."""
+    return {
+        lazy._module_name: round(lazy.load_seconds * 1000, 1) if lazy.load_seconds is not None else None
+        for lazy in _registry
+    }
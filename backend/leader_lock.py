@@ -0,0 +1,83 @@
+"""
+Leader election through a lease document, so that work which must not be
+duplicated across workers (index creation, seeding, singleton background
+jobs) runs in exactly one of them.
+
+The leader renews its lease every ttl/3. If it dies or stalls past the TTL,
+another worker takes the lease over and starts the duties itself.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class LeaderLease:
+    def __init__(self, collection, name: str, ttl_seconds: int = 30):
+        self.collection = collection
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+
+    async def acquire(self) -> bool:
+        """Takes or renews the lease. False while another live worker holds it."""
+        now = datetime.utcnow()
+        try:
+            lease = await self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.ttl_seconds), "renewed_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return False
+        return lease is not None and lease["owner"] == self.owner
+
+    async def release(self):
+        await self.collection.delete_one({"_id": self.name, "owner": self.owner})
+
+    async def run(self, on_elected):
+        """
+        Campaigns for the lease forever. `on_elected()` is called on each election and
+        returns the tasks it started; they are cancelled if the lease is lost.
+        """
+        duties = []
+        try:
+            while True:
+                try:
+                    held = await self.acquire()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.warning(f"Leader lease {self.name} check failed: {e}")
+                    held = False
+
+                if held and not self.is_leader:
+                    self.is_leader = True
+                    logging.info(f"Worker {self.owner} elected {self.name} leader")
+                    duties = on_elected()
+                elif not held and self.is_leader:
+                    self.is_leader = False
+                    logging.warning(f"Worker {self.owner} lost the {self.name} leader lease, stopping its duties")
+                    for task in duties:
+                        task.cancel()
+                    duties = []
+                await asyncio.sleep(self.ttl_seconds / 3)
+        finally:
+            for task in duties:
+                task.cancel()
+            if self.is_leader:
+                self.is_leader = False
+                try:
+                    await self.release()
+                except Exception as e:
+                    logging.warning(f"Failed to release leader lease {self.name}: {e}")
+
+    def snapshot(self) -> dict:
+        return {"name": self.name, "owner": self.owner, "is_leader": self.is_leader, "ttl_seconds": self.ttl_seconds}
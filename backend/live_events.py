@@ -0,0 +1,104 @@
+"""
+Live events (new notifications, wallet changes) pushed to clients over SSE.
+
+Each worker keeps an in-process hub of subscriber queues keyed by user.
+With a single worker, publishing dispatches straight into the hub. With
+several workers, events are written to a small Mongo collection instead,
+and every worker tails it with a change stream and dispatches locally.
+Writes made inside a transaction only reach the change stream once
+committed, so aborted work never produces events in that mode.
+"""
+import asyncio
+import itertools
+import logging
+from datetime import datetime
+
+BROADCAST = None
+
+
+class LiveEventHub:
+    def __init__(self, queue_size: int = 100, max_connections: int = 1000):
+        self.queue_size = queue_size
+        self.max_connections = max_connections
+        self._subscribers = {}  # user_id -> set of queues
+        self._ids = itertools.count(1)
+
+    @property
+    def connection_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        if self.connection_count >= self.max_connections:
+            raise OverflowError("Too many live event connections")
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def dispatch(self, event: dict):
+        """Hands an event to the subscribers of its user, or to everyone for broadcasts. Never blocks."""
+        event.setdefault("id", next(self._ids))
+        if event.get("user_id") is BROADCAST:
+            targets = [q for queues in self._subscribers.values() for q in queues]
+        else:
+            targets = list(self._subscribers.get(event["user_id"], ()))
+        for queue in targets:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow client: drop its backlog and tell it to refetch instead
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"id": event["id"], "type": "resync", "user_id": event.get("user_id"), "data": {}})
+
+
+class MongoChangeStreamRelay:
+    """
+    Fans events out across workers through `collection`. Needs a replica set
+    (already required for transactions) and a TTL index (see ensure_indexes).
+    """
+
+    def __init__(self, collection, hub: LiveEventHub, retention_seconds: int = 300):
+        self.collection = collection
+        self.hub = hub
+        self.retention_seconds = retention_seconds
+        self._resume_token = None
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("created_at", expireAfterSeconds=self.retention_seconds, name="live_event_created_at_ttl_idx")
+
+    async def publish(self, event: dict):
+        # Never part of a ledger transaction: a failed insert here must not abort the settlement
+        await self.collection.insert_one(dict(event, created_at=datetime.utcnow()))
+
+    async def run(self):
+        """Tails inserts and dispatches them to the local hub, resuming after errors."""
+        backoff = 1
+        while True:
+            try:
+                async with self.collection.watch(
+                    [{"$match": {"operationType": "insert"}}],
+                    resume_after=self._resume_token
+                ) as stream:
+                    backoff = 1
+                    async for change in stream:
+                        self._resume_token = change["_id"]
+                        event = change["fullDocument"]
+                        event.pop("_id", None)
+                        event.pop("created_at", None)
+                        self.hub.dispatch(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if getattr(e, "code", None) in (260, 280, 286):
+                    # Resume point no longer in the oplog; events in the gap are lost, clients resync on reconnect
+                    self._resume_token = None
+                logging.error(f"Live event change stream failed, retrying in {backoff}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
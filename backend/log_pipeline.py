@@ -0,0 +1,182 @@
+"""
+Logging off the request path: records are queued by the calling thread and
+formatted and written by a background listener thread.
+
+Handlers on the root logger used to format and write every record on the
+event loop, so a burst of logging (or a slow stdout) stalled requests. Now
+the calling thread only runs the sampling filter, notes the request's route
+and puts the record on a bounded queue. Records that do not fit are dropped
+and counted rather than blocking. Message arguments are merged in the
+listener thread, so logging with %-style arguments (rather than an f-string)
+defers the formatting too; arguments must not be mutated after the call.
+
+Payloads go through log_payload(), which redacts credentials, masks phone
+numbers and emails, and truncates, again lazily. With json output each
+record is one JSON object; extra={"fields": {...}} adds structured fields.
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import re
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import current_route
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Keys whose values never reach the logs, and keys whose values are masked (compared case-insensitively)
+SECRET_KEYS = {"password", "token", "access_token", "authorization", "securitycredential", "secret", "secret_key", "api_key", "consumer_secret"}
+MASKED_KEYS = {"phone", "phonenumber", "phone_number", "partya", "msisdn", "email", "email_address"}
+EMAIL = re.compile(r"([^@\s]{1,2})[^@\s]*(@[^@\s]+)")
+
+
+def _mask(value) -> str:
+    text = str(value)
+    if "@" in text:
+        return EMAIL.sub(r"\1***\2", text)
+    return text[:4] + "*" * max(0, len(text) - 7) + text[-3:] if len(text) > 7 else "***"
+
+
+def redact(value):
+    """Copy of a payload with secrets removed and phone numbers and emails masked."""
+    if isinstance(value, dict):
+        # M-Pesa callback metadata items are {"Name": ..., "Value": ...} pairs
+        name = str(value.get("Name", "")).lower()
+        if "Value" in value and name in MASKED_KEYS | SECRET_KEYS:
+            return {**value, "Value": "[redacted]" if name in SECRET_KEYS else _mask(value["Value"])}
+        redacted = {}
+        for key, item in value.items():
+            lowered = str(key).lower()
+            if lowered in SECRET_KEYS:
+                redacted[key] = "[redacted]"
+            elif lowered in MASKED_KEYS and item is not None:
+                redacted[key] = _mask(item)
+            else:
+                redacted[key] = redact(item)
+        return redacted
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+class log_payload:
+    """
+    Log argument that renders a redacted, truncated payload only when the record is
+    written: logging.info("Callback received: %s", log_payload(data)).
+    """
+
+    limit = 2000  # characters; set from LOG_PAYLOAD_LIMIT by setup_logging
+
+    def __init__(self, payload, limit: int = None):
+        self.payload = payload
+        self.limit = limit or log_payload.limit
+
+    def __str__(self) -> str:
+        if isinstance(self.payload, (str, bytes)):
+            text = self.payload.decode(errors="replace") if isinstance(self.payload, bytes) else self.payload
+            try:
+                text = json.dumps(redact(json.loads(text)), default=str)
+            except ValueError:
+                pass
+        else:
+            text = json.dumps(redact(self.payload), default=str)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}... ({len(text) - self.limit} more chars)"
+        return text
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """'gateway.spans=0.1,root=0.5' -> {'gateway.spans': 0.1, 'root': 0.5}"""
+    rates = {}
+    for part in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, rate = part.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of INFO and DEBUG records per logger; warnings and errors always pass."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(record.name, self.rates.get("root", 1.0) if record.name == "root" else 1.0)
+        if rate >= 1.0:
+            return True
+        record.sample_rate = rate  # so aggregations can scale counts back up
+        return random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        route = getattr(record, "route", None)
+        if route and route != "background":
+            entry["route"] = route
+        if hasattr(record, "sample_rate"):
+            entry["sample_rate"] = record.sample_rate
+        for key, value in (getattr(record, "fields", None) or {}).items():
+            entry.setdefault(key, value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread; only the request context is taken here
+        record.route = current_route()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str = "INFO", json_format: bool = True, sample_rates: dict = None, queue_size: int = 10_000, payload_limit: int = 2000):
+    """
+    Routes the root logger (and uvicorn's loggers) through a queue to a stdout writer thread.
+    Returns the queue handler, whose `dropped` counts records lost to a full queue.
+    """
+    log_payload.limit = payload_limit
+    log_queue = queue.Queue(maxsize=queue_size)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sample_rates or {}))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    # uvicorn sets up its own stream handlers before importing the app; send those through the queue too
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logger = logging.getLogger(name)
+        if logger.handlers:
+            logger.handlers = [handler]
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # drains what is queued
+    return handler
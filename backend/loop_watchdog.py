@@ -0,0 +1,121 @@
+"""
+Event-loop lag watchdog and blocking-call detector.
+
+A task on the loop sleeps for `interval` over and over; how late each sleep
+wakes up is the loop lag, the time callbacks spent holding the loop. Every
+reading goes into a histogram, and the p50/p99/max of the last `window`
+readings are exported as gauges.
+
+Any reading over `block_threshold` counts as a block. With capture_stacks
+(debug mode), a watcher thread also checks the task's heartbeat. Once the
+loop has been stalled past the threshold, the thread snapshots the loop
+thread's stack: the code that is blocking, caught while it blocks. When the
+loop comes back, the block is logged with that stack and kept for the admin
+API. The thread only reads a timestamp between stalls, so this is cheap
+enough to leave on in staging.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+from metrics import Registry, percentile
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class LoopWatchdog:
+    def __init__(
+        self,
+        registry: Registry,
+        interval: float = 0.1,
+        block_threshold: float = 0.1,
+        capture_stacks: bool = False,
+        window: int = 600,
+        stack_depth: int = 30
+    ):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.capture_stacks = capture_stacks
+        self.stack_depth = stack_depth
+        self.lags = deque(maxlen=window)
+        self.blocks = deque(maxlen=50)  # recent blocks with their stacks (capture_stacks only)
+        self.lag_histogram = registry.histogram("event_loop_lag_seconds", "How late the watchdog's timer fired", buckets=LAG_BUCKETS)
+        self.lag_gauge = registry.gauge("event_loop_lag_recent_seconds", "Event-loop lag over the recent window", ("quantile",))
+        self.blocked = registry.counter("event_loop_blocks_total", "Times the event loop was held longer than the blocking threshold")
+        self.blocked.inc(amount=0)  # exported as 0 before the first block, so rate() works from the start
+        registry.collector(self._collect)
+        self._beat = time.monotonic()
+        self._stalled = None  # stack captured during the current stall, with the heartbeat it belongs to
+
+    def _collect(self):
+        ordered = sorted(self.lags)
+        self.lag_gauge.set("0.5", value=percentile(ordered, 0.5))
+        self.lag_gauge.set("0.99", value=percentile(ordered, 0.99))
+        self.lag_gauge.set("1", value=ordered[-1] if ordered else 0.0)
+
+    def _watch(self, loop_thread: int, stop: threading.Event):
+        """Watcher thread: snapshots the loop thread's stack once per stall."""
+        poll = min(self.block_threshold / 2, 0.05)
+        reported = None
+        while not stop.wait(poll):
+            beat = self._beat
+            if beat == reported or time.monotonic() - beat < self.interval + self.block_threshold:
+                continue
+            frame = sys._current_frames().get(loop_thread)
+            if frame is not None:
+                self._stalled = (beat, "".join(traceback.format_stack(frame)[-self.stack_depth:]))
+            reported = beat
+            del frame
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+        if self.capture_stacks:
+            threading.Thread(target=self._watch, args=(threading.get_ident(), stop), name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                beat = self._beat = time.monotonic()
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - expected)
+                self.lags.append(lag)
+                self.lag_histogram.observe(value=lag)
+                if lag >= self.block_threshold:
+                    self._record_block(lag, beat)
+        finally:
+            stop.set()
+
+    def _record_block(self, lag: float, beat: float):
+        self.blocked.inc()
+        stalled, self._stalled = self._stalled, None
+        if not self.capture_stacks:
+            return
+        stack = stalled[1] if stalled and stalled[0] == beat else None
+        self.blocks.append({"at": datetime.utcnow().isoformat(), "blocked_ms": round(lag * 1000, 1), "stack": stack})
+        logging.warning(
+            f"Event loop blocked for {lag * 1000:.0f} ms"
+            + (f"; stack while blocked:\n{stack}" if stack else " (stack not captured; the block ended before the watcher looked)")
+        )
+
+    def snapshot(self) -> dict:
+        ordered = sorted(self.lags)
+        return {
+            "interval_ms": self.interval * 1000,
+            "block_threshold_ms": self.block_threshold * 1000,
+            "capture_stacks": self.capture_stacks,
+            "lag_ms": {
+                "samples": len(ordered),
+                "p50": round(percentile(ordered, 0.5) * 1000, 2),
+                "p99": round(percentile(ordered, 0.99) * 1000, 2),
+                "max": round(ordered[-1] * 1000, 2) if ordered else 0.0
+            }
+        }
+
+    def recent_blocks(self, limit: int = 20) -> list:
+        """Newest first."""
+        return list(reversed(self.blocks))[:limit]
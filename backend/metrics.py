@@ -0,0 +1,224 @@
+"""
+Prometheus metrics without a client library.
+
+Counters, gauges and histograms keyed by label values, rendered in the
+Prometheus text exposition format for /metrics. Updates are dict operations
+under an uncontended lock (the Mongo command listener records from driver
+threads), so recording a request costs a few microseconds. MetricsMiddleware
+records every HTTP request per route template (not per raw path, which
+would explode label cardinality).
+"""
+import bisect
+import contextvars
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# ASGI scope of the request being served; the router fills in scope["route"] once matched
+request_scope = contextvars.ContextVar("request_scope", default=None)
+
+
+def current_route() -> str:
+    """Route template of the request being served, or 'background' outside requests."""
+    scope = request_scope.get()
+    if scope is None:
+        return "background"
+    return getattr(scope.get("route"), "path", "unmatched")
+
+
+def percentile(ordered: list, q: float) -> float:
+    """Nearest-rank `q` quantile of an already sorted list; 0.0 when it is empty."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+    def _items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def samples(self):
+        for labels, value in self._items():
+            yield self.name, labels, "", value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value: float):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # bucket counts, sum, count
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _items(self):
+        with self._lock:
+            return [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+
+    def samples(self):
+        for labels, (counts, total, count) in self._items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", labels, f'le="{_format_value(bound)}"', cumulative
+            yield f"{self.name}_sum", labels, "", total
+            yield f"{self.name}_count", labels, "", count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def _add(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames=()) -> Gauge:
+        return self._add(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def collector(self, func):
+        """Registers `func()` to refresh gauges from live state just before each render."""
+        self.collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, in-flight requests, status codes and payload sizes per route."""
+
+    def __init__(self, app, registry: Registry, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = set(skip_paths)
+        self.in_flight = registry.gauge("http_requests_in_flight", "Requests currently being served", ("method",))
+        self.requests = registry.counter("http_requests_total", "Requests served", ("method", "route", "status"))
+        self.latency = registry.histogram(
+            "http_request_duration_seconds", "Time to serve a request, including streaming the response", ("method", "route")
+        )
+        self.request_size = registry.histogram(
+            "http_request_size_bytes", "Request body size", ("method", "route"), buckets=SIZE_BUCKETS
+        )
+        self.response_size = registry.histogram(
+            "http_response_size_bytes", "Response body size", ("method", "route"), buckets=SIZE_BUCKETS
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+        request_bytes = 0
+        response_bytes = 0
+
+        async def counting_receive():
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        self.in_flight.inc(method)
+        scope_token = request_scope.set(scope)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_scope.reset(scope_token)
+            self.in_flight.dec(method)
+            # The router records the matched route in the scope; the template keeps cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.requests.inc(method, route, str(status))
+            self.latency.observe(method, route, value=elapsed)
+            self.request_size.observe(method, route, value=request_bytes)
+            self.response_size.observe(method, route, value=response_bytes)
@@ -0,0 +1,27 @@
+"""
+Moves raw gateway payloads embedded in transactions into the gateway_events collection.
+
+Usage (from the backend directory, with the server's .env in place):
+    python migrate_gateway_events.py [--batch-size 500]
+
+Safe to re-run: transactions without embedded payloads are skipped and
+already-copied events are not duplicated.
+"""
+import argparse
+import asyncio
+import logging
+
+from server import db, migrate_raw_gateway_payloads
+
+
+async def main(batch_size: int):
+    await db.gateway_events.create_index("event_id", unique=True, name="gateway_event_id_unique_idx")
+    result = await migrate_raw_gateway_payloads(db, batch_size=batch_size)
+    logging.info(f"Migration complete: {result['transactions']} transactions, {result['events']} gateway events")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
@@ -0,0 +1,27 @@
+"""
+Moves legacy broadcast notifications (stored in notifications with user_id None)
+into the broadcast_notifications collection.
+
+Usage (from the backend directory, with the server's .env in place):
+    python migrate_notifications.py [--batch-size 500]
+
+Safe to re-run. Per-user unread counters are recounted on their next read.
+"""
+import argparse
+import asyncio
+import logging
+
+from server import db, migrate_broadcast_notifications
+
+
+async def main(batch_size: int):
+    await db.broadcast_notifications.create_index("notification_id", unique=True, name="broadcast_notification_id_unique_idx")
+    result = await migrate_broadcast_notifications(db, batch_size=batch_size)
+    logging.info(f"Migration complete: {result['moved']} broadcasts moved, {result['broadcast_total']} broadcasts in total")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
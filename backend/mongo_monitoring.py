@@ -0,0 +1,148 @@
+"""
+MongoDB command monitoring and slow-query log.
+
+CommandMonitor is a pymongo CommandListener registered on the Motor client.
+It records latency per collection and command, the documents each command
+returned or wrote, and which route issued it. Commands slower than
+`slow_ms` are logged with the shape of their filter (values redacted to
+'?'), which is enough to match them to an index without leaking user data.
+
+getMores on change streams and tailable awaitData cursors block on the
+server until data arrives (about a second when idle). That wait is not
+query latency, so they are counted but kept out of the latency histograms
+and the slow-query log.
+
+The driver does not report documents examined; the server's profiler
+(db.setProfilingLevel) is the place for that once a slow shape is known.
+
+Listener callbacks run on Motor's executor threads. Motor copies the
+caller's contextvars into those threads, so metrics.current_route() still
+names the request that issued the command.
+"""
+import json
+import logging
+
+from pymongo import monitoring
+
+from metrics import LATENCY_BUCKETS, Registry, current_route
+
+# Connection handshakes and session bookkeeping, not application queries
+IGNORED_COMMANDS = {"hello", "ismaster", "ping", "saslstart", "saslcontinue", "buildinfo", "endsessions", "killcursors"}
+
+# Where each command keeps its filter
+FILTER_FIELDS = {"find": "filter", "count": "query", "distinct": "query", "findandmodify": "query", "delete": "deletes", "update": "updates"}
+
+
+def redact(value):
+    """Keeps field names and operators, replacing every value with '?'."""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = redact(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return "?"
+
+
+def command_shape(command_name: str, command: dict):
+    """The redacted filter or pipeline of a command, for the slow-query log."""
+    if command_name == "aggregate":
+        return redact(command.get("pipeline", []))
+    field = FILTER_FIELDS.get(command_name)
+    if field in ("deletes", "updates"):
+        return redact([statement.get("q", {}) for statement in command.get(field, [])])
+    if field:
+        return redact(command.get(field, {}))
+    return None
+
+
+def opens_awaiting_cursor(command_name: str, command: dict) -> bool:
+    """Whether the command opens a cursor whose getMores wait for new data (change streams, tailable awaitData finds)."""
+    if command_name == "aggregate":
+        return any("$changeStream" in stage for stage in command.get("pipeline", ()))
+    return command_name == "find" and bool(command.get("tailable") and command.get("awaitData"))
+
+
+def reply_documents(command_name: str, reply: dict) -> int:
+    """Documents a command returned (reads) or wrote (writes), from its reply."""
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+    if command_name == "findandmodify":
+        return 1 if reply.get("value") else 0
+    if command_name == "distinct":
+        return len(reply.get("values", ()))
+    return int(reply.get("n", 0))
+
+
+class CommandMonitor(monitoring.CommandListener):
+    def __init__(self, registry: Registry, slow_ms: float = 100):
+        self.slow_ms = slow_ms
+        self.commands = registry.counter(
+            "mongo_commands_total", "MongoDB commands by collection, command, issuing route and outcome",
+            ("collection", "command", "route", "outcome")
+        )
+        self.latency = registry.histogram(
+            "mongo_command_duration_seconds", "MongoDB command latency", ("collection", "command"), buckets=LATENCY_BUCKETS
+        )
+        self.documents = registry.counter(
+            "mongo_documents_total", "Documents returned or written by MongoDB commands", ("collection", "command")
+        )
+        self.route_seconds = registry.counter(
+            "mongo_route_seconds_total", "Time spent waiting on MongoDB, per issuing route", ("route",)
+        )
+        self.slow_commands = registry.counter(
+            "mongo_slow_commands_total", "MongoDB commands slower than the slow-query threshold", ("collection", "command")
+        )
+        self._pending = {}  # (connection_id, request_id) -> (collection, command name, command, route)
+        self._awaiting_cursors = set()  # ids of open change-stream and tailable awaitData cursors
+
+    def started(self, event):
+        command_name = event.command_name.lower()
+        if command_name == "killcursors":
+            self._awaiting_cursors.difference_update(event.command.get("cursors", ()))
+        if command_name in IGNORED_COMMANDS:
+            return
+        target = event.command.get(event.command_name)
+        collection = event.command.get("collection") if command_name == "getmore" else target
+        if not isinstance(collection, str):
+            collection = event.database_name
+        self._pending[(event.connection_id, event.request_id)] = (collection, command_name, event.command, current_route())
+
+    def _finish(self, event, outcome: str, reply: dict = None):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        collection, command_name, command, route = pending
+        seconds = event.duration_micros / 1_000_000
+        cursor_id = (reply or {}).get("cursor", {}).get("id", 0)
+        awaiting = command_name == "getmore" and command.get("getMore") in self._awaiting_cursors
+        if awaiting and not cursor_id:
+            self._awaiting_cursors.discard(command.get("getMore"))  # exhausted or failed
+        elif cursor_id and opens_awaiting_cursor(command_name, command):
+            self._awaiting_cursors.add(cursor_id)
+
+        self.commands.inc(collection, command_name, route, outcome)
+        if reply is not None:
+            self.documents.inc(collection, command_name, amount=reply_documents(command_name, reply))
+        if awaiting:
+            return
+        self.latency.observe(collection, command_name, value=seconds)
+        self.route_seconds.inc(route, amount=seconds)
+
+        if seconds * 1000 >= self.slow_ms:
+            self.slow_commands.inc(collection, command_name)
+            shape = command_shape(command_name, command)
+            logging.warning(
+                f"Slow MongoDB {command_name} on {collection}: {seconds * 1000:.0f} ms ({outcome}, route {route})"
+                + (f" shape {json.dumps(shape, default=str)}" if shape is not None else "")
+            )
+
+    def succeeded(self, event):
+        self._finish(event, "ok", event.reply)
+
+    def failed(self, event):
+        self._finish(event, "error")
@@ -0,0 +1,122 @@
+"""
+Token-bucket rate limiting.
+
+Each policy is a bucket of `capacity` tokens refilled continuously at
+`capacity / period` tokens per second; every request takes one token.
+Buckets live either in process memory (default) or in a small Mongo
+collection, updated with a single atomic findOneAndUpdate and expired by
+a TTL index. Either way a check is O(1) and never scans user history.
+"""
+import logging
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class RatePolicy:
+    def __init__(self, name: str, capacity: int, period_seconds: float):
+        self.name = name
+        self.capacity = capacity
+        self.period_seconds = period_seconds
+        self.refill_per_second = capacity / period_seconds
+
+    @classmethod
+    def parse(cls, name: str, spec: str) -> "RatePolicy":
+        """Parses a spec like '5/hour' or '10/300' (tokens per period in seconds)."""
+        count, _, period = spec.partition("/")
+        period = period.strip().lower()
+        seconds = PERIODS.get(period.rstrip("s")) or float(period)
+        return cls(name, int(count), seconds)
+
+
+class InMemoryBucketStore:
+    """Per-process buckets. Least recently used keys are evicted beyond max_keys."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, last_refill)
+
+    async def take(self, policy: RatePolicy, key: str):
+        now = time.monotonic()
+        bucket_key = f"{policy.name}:{key}"
+        tokens, last = self._buckets.pop(bucket_key, (policy.capacity, now))
+        tokens = min(policy.capacity, tokens + (now - last) * policy.refill_per_second)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[bucket_key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed, tokens
+
+
+class MongoBucketStore:
+    """
+    Buckets shared across workers in a Mongo collection. The refill-and-take is
+    one pipeline update, so concurrent requests cannot both spend the last token.
+    Needs a TTL index on `expires_at` (see ensure_indexes).
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0, name="rate_limit_expires_at_ttl_idx")
+
+    async def take(self, policy: RatePolicy, key: str):
+        now = datetime.utcnow()
+        elapsed_seconds = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        doc = await self.collection.find_one_and_update(
+            {"_id": f"{policy.name}:{key}"},
+            [
+                {"$set": {
+                    "tokens": {"$min": [
+                        policy.capacity,
+                        {"$add": [
+                            {"$ifNull": ["$tokens", policy.capacity]},
+                            {"$multiply": [elapsed_seconds, policy.refill_per_second]}
+                        ]}
+                    ]},
+                    "updated_at": now,
+                    "expires_at": now + timedelta(seconds=policy.period_seconds)
+                }},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["allowed"], doc["tokens"]
+
+
+class RateLimiter:
+    def __init__(self, policies: dict, store=None):
+        self.policies = policies
+        self.store = store or InMemoryBucketStore()
+
+    async def check(self, policy_name: str, key: str):
+        """Takes a token for `key` under the named policy, raising 429 with Retry-After when empty."""
+        policy = self.policies[policy_name]
+        try:
+            allowed, tokens = await self.store.take(policy, key)
+        except Exception as e:
+            # Fail open: a rate-limit store outage must not block payments or logins
+            logging.warning(f"Rate limit check failed for {policy_name} ({key}), allowing request: {e}")
+            return
+
+        if not allowed:
+            retry_after = math.ceil((1 - tokens) / policy.refill_per_second)
+            logging.info(f"Rate limit exceeded: {policy_name} for {key}")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests. Please try again later.",
+                headers={"Retry-After": str(max(1, retry_after))}
+            )
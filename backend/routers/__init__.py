@@ -0,0 +1,48 @@
+"""
+API routes, in groups that can be served by separate worker pools.
+
+Each group lists its routers as "module:attribute". server.create_app()
+imports a router's module only when one of its groups is included, so a
+callback-only worker (API_ROUTERS=callbacks) never loads the dashboard or
+admin code. Payment gateways have two routers. `router` holds the
+user-facing endpoints, and `callbacks` holds the endpoints the gateway
+itself calls. That lets the callbacks be scaled and deployed on their own.
+
+Router modules take their shared helpers, models and the database handle
+from server, so import server (not a router module) first.
+"""
+import importlib
+
+GROUPS = {
+    "auth": ["auth:router"],
+    "dashboard": ["dashboard:router"],
+    "payments": ["mpesa:router", "paystack:router", "pesapal:router", "paypal:router", "withdrawals:router"],
+    "callbacks": ["mpesa:callbacks", "paystack:callbacks", "pesapal:callbacks"],
+    "team": ["team:router"],
+    "tasks": ["tasks:router"],
+    "notifications": ["notifications:router"],
+    "admin": ["admin:router"],
+}
+
+
+def include_groups(app, groups: list):
+    unknown = [group for group in groups if group not in GROUPS]
+    if unknown:
+        raise ValueError(f"Unknown route groups {unknown}; expected some of {list(GROUPS)}")
+    for group in groups:
+        for spec in GROUPS[group]:
+            module, attribute = spec.split(":")
+            app.include_router(getattr(importlib.import_module(f"{__name__}.{module}"), attribute))
+
+
+# Callback paths the webhook inbox replays (see webhook_inbox.py), and the handler for each
+WEBHOOK_HANDLERS = {
+    "/api/payments/mpesa-callback": "mpesa:mpesa_callback",
+    "/api/payments/paystack/webhook": "paystack:paystack_webhook",
+    "/api/payments/pesapal/ipn": "pesapal:handle_pesapal_ipn",
+}
+
+
+def webhook_handler(path: str):
+    module, attribute = WEBHOOK_HANDLERS[path].split(":")
+    return getattr(importlib.import_module(f"{__name__}.{module}"), attribute)
@@ -0,0 +1,1344 @@
+"""
+Admin routes: platform and worker status, transaction review and payouts, task management.
+"""
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse, Response
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from typing import Optional
+import uuid
+from datetime import datetime, timedelta
+import asyncio
+import json
+import logging
+from sampling_profiler import ProfilerBusy
+import lazy_imports
+from webhook_inbox import inbox_stats
+
+from server import (
+    BULK_APPROVAL_MAX_ITEMS,
+    BulkWithdrawalApproval,
+    GATEWAY_BREAKERS,
+    NotificationBuffer,
+    PROFILE_MAX_SECONDS,
+    PROFILING_ENABLED,
+    STARTUP_PROFILE,
+    TASK_STAT_FIELDS,
+    Task,
+    UpdateTaskStatus,
+    UpdateWithdrawalStatus,
+    WithdrawalApproval,
+    admission_controller,
+    bump_platform_counters,
+    bump_task_stats,
+    bump_task_totals,
+    cache_bus,
+    commit_transaction,
+    count_completed_transaction,
+    create_notification,
+    db,
+    decode_gateway_event,
+    gateway_instrumentation,
+    get_current_admin_user,
+    get_db_instance,
+    json_serializable_doc,
+    leader_lease,
+    loop_watchdog,
+    move_task_stats_type,
+    process_referral_reward,
+    publish_wallet_delta,
+    record_gateway_event,
+    remove_task_stats,
+    sampling_profiler,
+    send_email,
+    send_mpesa_b2c_payment,
+    start_bulk_payouts,
+    trigger_binary_commissions,
+    user_cache,
+    verify_platform_counters,
+    verify_task_stats,
+    webhook_inbox_processor,
+)
+
+router = APIRouter(tags=["admin"])
+
+@router.get("/api/admin/dashboard/stats", dependencies=[Depends(get_current_admin_user)])
+async def get_admin_dashboard_stats():
+    counters = await db.platform_counters.find_one({"_id": "platform"})
+    if not counters or "verified_at" not in counters:
+        # First load after deployment: seed the counters from a full recount
+        await verify_platform_counters()
+        counters = await db.platform_counters.find_one({"_id": "platform"})
+
+    return {
+        "success": True,
+        "stats": json_serializable_doc({
+            "total_users": counters.get("total_users", 0),
+            "activated_users": counters.get("activated_users", 0),
+            "total_deposits": counters.get("total_deposits", 0.0), 
+            "total_withdrawals": counters.get("total_withdrawals", 0.0), 
+            "pending_withdrawals": counters.get("pending_withdrawals", 0),
+            "counters_verified_at": counters.get("verified_at")
+        })
+    }
+
+@router.post("/api/admin/platform-counters/verify", dependencies=[Depends(get_current_admin_user)])
+async def verify_platform_counters_endpoint():
+    """Recounts the platform totals now instead of waiting for the nightly run."""
+    return {"success": True, **json_serializable_doc(await verify_platform_counters())}
+
+@router.get("/api/admin/workers/status", dependencies=[Depends(get_current_admin_user)])
+async def get_worker_status():
+    """This worker's leader lease, event-loop lag, admission control, cache bus connection and cache hit rates."""
+    return {
+        "success": True,
+        "worker": leader_lease.owner,
+        "leader": leader_lease.snapshot(),
+        "event_loop": loop_watchdog.snapshot(),
+        "startup_profile": STARTUP_PROFILE,
+        "lazy_imports": lazy_imports.status(),
+        "admission": admission_controller.snapshot() if admission_controller else None,
+        "cache_bus": {"backend": cache_bus.backend, "connected": cache_bus.connected},
+        "caches": {cache.name: cache.snapshot() for cache in (*cache_bus.caches.values(), user_cache)}
+    }
+
+@router.get("/api/admin/workers/blocking-calls", dependencies=[Depends(get_current_admin_user)])
+async def get_blocking_calls(limit: int = Query(20, ge=1, le=50)):
+    """Recent event-loop blocks in this worker, newest first, with the stack caught while blocked (LOOP_BLOCK_DEBUG)."""
+    return {
+        "success": True,
+        "worker": leader_lease.owner,
+        "capture_stacks": loop_watchdog.capture_stacks,
+        "blocks": loop_watchdog.recent_blocks(limit)
+    }
+
+@router.get("/api/admin/webhooks/inbox", dependencies=[Depends(get_current_admin_user)])
+async def get_webhook_inbox_status():
+    """Stored provider callbacks by status and gateway, and how long the oldest unsettled one has waited."""
+    return {
+        "success": True,
+        "processing_here": webhook_inbox_processor is not None,
+        **json_serializable_doc(await inbox_stats(db.webhook_inbox))
+    }
+
+@router.post("/api/admin/profile", dependencies=[Depends(get_current_admin_user)])
+async def profile_worker(
+    seconds: float = Query(10, gt=0),
+    interval_ms: float = Query(10, ge=1, le=1000),
+    all_threads: bool = False,
+    format: str = Query("json", pattern="^(json|collapsed)$")
+):
+    """
+    Samples the stacks of the worker serving this request for `seconds`. format=collapsed returns
+    the flamegraph file alone; json adds event-loop lag, task counts and the pending tasks.
+    """
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled (set PROFILING_ENABLED=true)")
+    if seconds > PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"Profiles are limited to {PROFILE_MAX_SECONDS:g} seconds")
+
+    logging.info(f"Admin started a {seconds:g}s profile of worker {leader_lease.owner}")
+    try:
+        result = await sampling_profiler.profile(seconds, interval=interval_ms / 1000, all_threads=all_threads)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if format == "collapsed":
+        filename = f"profile-{result['pid']}-{datetime.utcnow():%Y%m%dT%H%M%S}.collapsed"
+        return Response(result["collapsed"], media_type="text/plain", headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    return {"success": True, "worker": leader_lease.owner, **result}
+
+@router.post("/api/admin/caches/{cache_name}/invalidate", dependencies=[Depends(get_current_admin_user)])
+async def invalidate_cache(cache_name: str, key: Optional[str] = None):
+    """Drops a cache entry (or the whole cache) in every worker, e.g. after rotating gateway credentials."""
+    if cache_name not in cache_bus.caches:
+        raise HTTPException(status_code=404, detail=f"Unknown cache. Available: {', '.join(cache_bus.caches)}")
+    await cache_bus.invalidate(cache_name, key)
+    logging.info(f"Admin invalidated cache {cache_name} ({key or 'all keys'})")
+    return {"success": True, "message": f"Cache {cache_name} invalidated"}
+
+@router.get("/api/admin/gateways/spans", dependencies=[Depends(get_current_admin_user)])
+async def get_gateway_spans(
+    transaction_id: Optional[str] = None,
+    gateway: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """Recent outbound gateway call spans in this worker, newest first."""
+    return {
+        "success": True,
+        "spans": gateway_instrumentation.recent_spans(transaction_id=transaction_id, gateway=gateway, limit=limit)
+    }
+
+@router.get("/api/admin/gateways/status", dependencies=[Depends(get_current_admin_user)])
+async def get_gateway_status():
+    """Circuit breaker state, error/slow-call rates and latency budget for each payment gateway."""
+    return {
+        "success": True,
+        "gateways": {name: breaker.snapshot() for name, breaker in GATEWAY_BREAKERS.items()}
+    }
+
+@router.get("/api/admin/transactions/{transaction_id}/gateway-events", dependencies=[Depends(get_current_admin_user)])
+async def get_transaction_gateway_events(transaction_id: str):
+    """Raw provider payloads for one transaction, loaded on demand for the admin detail view."""
+    events = await db.gateway_events.find(
+        {"transaction_id": transaction_id}
+    ).sort("created_at", 1).to_list(100)
+    return {
+        "success": True,
+        "transaction_id": transaction_id,
+        "events": json_serializable_doc([decode_gateway_event(event) for event in events])
+    }
+
+@router.get("/api/admin/users", dependencies=[Depends(get_current_admin_user)])
+async def get_all_users():
+    users = await db.users.find({}, {"password": 0}).to_list(1000) 
+    return {"success": True, "users": json_serializable_doc(users)} 
+
+@router.get("/api/admin/transactions/deposits", dependencies=[Depends(get_current_admin_user)])
+async def get_all_deposits(status: Optional[str] = None):
+    query = {"type": "deposit"}
+    if status:
+        query["status"] = status
+    deposits = await db.transactions.find(query).sort("created_at", -1).to_list(1000)
+    return {"success": True, "deposits": json_serializable_doc(deposits)} 
+
+@router.get("/api/admin/transactions/withdrawals", dependencies=[Depends(get_current_admin_user)])
+async def get_all_withdrawals(status: Optional[str] = None):
+    query = {"type": "withdrawal"}
+    if status:
+        query["status"] = status
+    withdrawals = await db.transactions.find(query).sort("created_at", -1).to_list(1000)
+    return {"success": True, "withdrawals": json_serializable_doc(withdrawals)} 
+
+# Admin manual completion endpoint
+@router.post("/api/admin/manual-complete", dependencies=[Depends(get_current_admin_user)])
+async def manual_complete_transaction(
+    approval_data: WithdrawalApproval,
+    db_instance: AsyncIOMotorClient = Depends(get_db_instance)
+):
+    """
+    Admin manually completes a pending transaction (withdrawal or deposit).
+    Uses 'kes_amount' from transaction. Updates balances, totals, notifications, and emails.
+    """
+    transaction_id = approval_data.transaction_id
+    session = await db_instance.client.start_session()
+
+    try:
+        async with session.start_transaction():
+            notifications = NotificationBuffer(db_instance)
+            # 1. Find transaction
+            transaction = await db_instance.transactions.find_one(
+                {"transaction_id": transaction_id},
+                session=session
+            )
+            if not transaction:
+                raise HTTPException(status_code=404, detail="Transaction not found")
+
+            if transaction['status'] not in ['pending_admin_approval', 'pending', 'failed']:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot manually complete transaction with status: {transaction['status']}"
+                )
+
+            user_id = transaction['user_id']
+            kes_amount = float(transaction.get('kes_amount', '0.0'))
+            transaction_type = transaction['type']
+
+            # 2. Update transaction status
+            await db_instance.transactions.update_one(
+                {"transaction_id": transaction_id},
+                {
+                    "$set": {
+                        "status": "completed",
+                        "completed_at": datetime.utcnow(),
+                        "manually_completed_by": "admin",
+                        "manual_completion_reason": "Admin manually completed transaction"
+                    }
+                },
+                session=session
+            )
+            await count_completed_transaction(transaction, session=session, db_instance=db_instance)
+
+            # 3. Fetch user
+            user = await db_instance.users.find_one({"user_id": user_id}, session=session)
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            # 4. Process based on type
+            if transaction_type == "withdrawal":
+                # Deduct wallet balance
+                current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                new_wallet_balance = current_wallet_balance - kes_amount
+                current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
+                new_total_withdrawn = current_total_withdrawn + kes_amount
+
+                await db_instance.users.update_one(
+                    {"user_id": user_id},
+                    {
+                        "$set": {"wallet_balance": str(new_wallet_balance)},
+                        "$set": {"total_withdrawn": str(new_total_withdrawn)}
+                    },
+                    session=session
+                )
+
+                notification_title = "Withdrawal Completed"
+                notification_message = f"Your withdrawal of KES {kes_amount:,.2f} has been manually completed by admin."
+
+            elif transaction_type == "deposit":
+                # Add to wallet balance
+                current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                new_wallet_balance = current_wallet_balance + kes_amount
+                current_total_earned = float(user.get('total_earned', '0.0'))
+                new_total_earned = current_total_earned + kes_amount
+
+                await db_instance.users.update_one(
+                    {"user_id": user_id},
+                    {
+                        "$set": {"wallet_balance": str(new_wallet_balance)},
+                        "$set": {"total_earned": str(new_total_earned)}
+                    },
+                    session=session
+                )
+
+                # Check activation
+                if not user.get('is_activated') and new_wallet_balance >= float(user.get('activation_amount', '0.0')):
+                    await db_instance.users.update_one(
+                        {"user_id": user_id},
+                        {"$set": {"is_activated": True}},
+                        session=session
+                    )
+                    await bump_platform_counters(session=session, db_instance=db_instance, activated_users=1)
+                    await trigger_binary_commissions(user_id, session=session, notifications=notifications)
+                    if user.get('referred_by'):
+                        await process_referral_reward(
+                            referred_id=user_id,
+                            referrer_id=user['referred_by'],
+                            session=session,
+                            notifications=notifications
+                        )
+                    # Activation notification
+                    await create_notification(
+                        {
+                            "title": "Account Activated!",
+                            "message": f"Congratulations! Your account has been activated. Deposit of KES {kes_amount:,.2f} manually completed.",
+                            "user_id": user_id,
+                            "type": "reward"
+                        },
+                        session=session,
+                        db_instance=db_instance,
+                        buffer=notifications
+                    )
+
+                notification_title = "Deposit Completed"
+                notification_message = f"Your deposit of KES {kes_amount:,.2f} has been manually completed by admin."
+
+            # 5. Send notification
+            await create_notification(
+                {
+                    "title": notification_title,
+                    "message": notification_message,
+                    "user_id": user_id,
+                    "type": "payment"
+                },
+                session=session,
+                db_instance=db_instance,
+                buffer=notifications
+            )
+
+            # 6. Send email
+            await send_email(
+                subject=notification_title,
+                recipient=user['email'],
+                body=f"""
+                <h3>{notification_title}</h3>
+                <p>{notification_message}</p>
+                """
+            )
+
+            await notifications.flush(session=session)
+            await commit_transaction(session)
+
+            return {
+                "success": True,
+                "message": f"Transaction {transaction_id} manually completed successfully."
+            }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        if session.in_transaction:
+            await session.abort_transaction()
+        logging.error(f"Error in manual completion for transaction {transaction_id}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to manually complete transaction: {str(e)}"
+        )
+    finally:
+        if session and session.client:
+            session.end_session()
+
+@router.post("/api/admin/approve", dependencies=[Depends(get_current_admin_user)])
+async def approve_transaction(approval_data: WithdrawalApproval, db_instance: AsyncIOMotorClient = Depends(get_db_instance)):
+    """
+    Admin approves a transaction (deposit or withdrawal).
+    """
+    transaction_id = approval_data.transaction_id
+    session = await db_instance.client.start_session()
+
+    try:
+        async with session.start_transaction():
+            notifications = NotificationBuffer(db_instance)
+            # Find the transaction
+            transaction = await db_instance.transactions.find_one(
+                {"transaction_id": transaction_id},
+                session=session
+            )
+
+            if not transaction:
+                raise HTTPException(status_code=404, detail="Transaction not found")
+
+            # Only allow approval for pending transactions
+            if transaction['status'] != 'pending_admin_approval':
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot approve transaction with status: {transaction['status']}"
+                )
+
+            user_id = transaction['user_id']
+            amount = float(transaction['amount'])
+            transaction_type = transaction['type']
+
+            # Update transaction status
+            await db_instance.transactions.update_one(
+                {"transaction_id": transaction_id},
+                {
+                    "$set": {
+                        "status": "completed",
+                        "completed_at": datetime.utcnow(),
+                        "approved_by": "admin"
+                    }
+                },
+                session=session
+            )
+            await count_completed_transaction(transaction, session=session, db_instance=db_instance)
+
+            # Handle different transaction types
+            if transaction_type == "deposit":
+                user = await db_instance.users.find_one({"user_id": user_id}, session=session)
+                if user:
+                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                    new_wallet_balance = current_wallet_balance + amount
+                    current_total_earned = float(user.get('total_earned', '0.0'))
+                    new_total_earned = current_total_earned + amount
+
+                    await db_instance.users.update_one(
+                        {"user_id": user_id},
+                        {
+                            "$set": {
+                                "wallet_balance": str(new_wallet_balance),
+                                "total_earned": str(new_total_earned)
+                            }
+                        },
+                        session=session
+                    )
+                    await publish_wallet_delta(user_id, amount, new_wallet_balance, "deposit", session=session)
+
+                    # Check if this activates the user
+                    if not user['is_activated'] and new_wallet_balance >= float(user['activation_amount']):
+                        await db_instance.users.update_one(
+                            {"user_id": user_id},
+                            {"$set": {"is_activated": True}},
+                            session=session
+                        )
+                        await bump_platform_counters(session=session, db_instance=db_instance, activated_users=1)
+                        logging.info(f"User {user_id} activated via admin approval.")
+
+                        # Trigger binary commissions
+                        await trigger_binary_commissions(user_id, session=session, notifications=notifications)
+
+                        # Process referral if exists
+                        if user.get("referred_by"):
+                            await process_referral_reward(
+                                referred_id=user_id,
+                                referrer_id=user["referred_by"],
+                                session=session,
+                                notifications=notifications
+                            )
+
+                        # Create activation notification
+                        await create_notification(
+                            {
+                                "title": "Account Activated!",
+                                "message": f"Congratulations! Your account is activated. Deposit of {amount} KES approved.",
+                                "user_id": user_id,
+                                "type": "reward"
+                            },
+                            session=session,
+                            db_instance=db_instance,
+                            buffer=notifications
+                        )
+
+                # Create notification for deposit approval
+                await create_notification(
+                    {
+                        "title": "Deposit Approved",
+                        "message": f"Your deposit of KES {amount:,.2f} has been approved by admin.",
+                        "user_id": user_id,
+                        "type": "payment"
+                    },
+                    session=session,
+                    db_instance=db_instance,
+                    buffer=notifications
+                )
+
+            elif transaction_type == "withdrawal":
+                # For withdrawals, we need to deduct from balance and process payout
+                user = await db_instance.users.find_one({"user_id": user_id}, session=session)
+                if user:
+                    kes_amount = float(transaction.get('kes_amount', amount))
+                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                    new_wallet_balance = current_wallet_balance - kes_amount
+                    current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
+                    new_total_withdrawn = current_total_withdrawn + kes_amount
+
+                    await db_instance.users.update_one(
+                        {"user_id": user_id},
+                        {
+                            "$set": {
+                                "wallet_balance": str(new_wallet_balance),
+                                "total_withdrawn": str(new_total_withdrawn)
+                            }
+                        },
+                        session=session
+                    )
+                    await publish_wallet_delta(user_id, -kes_amount, new_wallet_balance, "withdrawal", session=session)
+
+                # Create notification for withdrawal approval
+                await create_notification(
+                    {
+                        "title": "Withdrawal Approved",
+                        "message": f"Your withdrawal of {transaction.get('original_amount', amount)} {transaction.get('original_currency', 'KES')} has been approved and is being processed.",
+                        "user_id": user_id,
+                        "type": "payment"
+                    },
+                    session=session,
+                    db_instance=db_instance,
+                    buffer=notifications
+                )
+
+            await notifications.flush(session=session)
+            await commit_transaction(session)
+            logging.info(f"Admin approved transaction {transaction_id} for user {user_id}")
+
+            return {
+                "success": True,
+                "message": f"Transaction {transaction_id} approved successfully"
+            }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        if session.in_transaction:
+            await session.abort_transaction()
+        logging.error(f"Error in transaction approval for {transaction_id}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to approve transaction: {str(e)}"
+        )
+    finally:
+        if session and session.client:
+            session.end_session()
+
+@router.post("/api/admin/reject", dependencies=[Depends(get_current_admin_user)])
+async def reject_transaction(approval_data: UpdateWithdrawalStatus, db_instance: AsyncIOMotorClient = Depends(get_db_instance)):
+    """
+    Admin rejects a transaction.
+    """
+    transaction_id = approval_data.status  # Using status field to pass transaction_id
+    session = await db_instance.client.start_session()
+
+    try:
+        async with session.start_transaction():
+            notifications = NotificationBuffer(db_instance)
+            # Find the transaction
+            transaction = await db_instance.transactions.find_one(
+                {"transaction_id": transaction_id},
+                session=session
+            )
+
+            if not transaction:
+                raise HTTPException(status_code=404, detail="Transaction not found")
+
+            # Only allow rejection for pending transactions
+            if transaction['status'] not in ['pending', 'pending_admin_approval']:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot reject transaction with status: {transaction['status']}"
+                )
+
+            user_id = transaction['user_id']
+            amount = float(transaction['amount'])
+            transaction_type = transaction['type']
+
+            # Update transaction status
+            await db_instance.transactions.update_one(
+                {"transaction_id": transaction_id},
+                {
+                    "$set": {
+                        "status": "rejected",
+                        "completed_at": datetime.utcnow(),
+                        "rejected_by": "admin",
+                        "rejection_reason": approval_data.reason or "Rejected by admin"
+                    }
+                },
+                session=session
+            )
+            if transaction_type == "withdrawal" and transaction['status'] == "pending_admin_approval":
+                await bump_platform_counters(session=session, db_instance=db_instance, pending_withdrawals=-1)
+
+            # For deposits, no balance changes needed (funds weren't added)
+            # For withdrawals, no balance changes needed (funds weren't deducted)
+
+            # Create notification for rejection
+            if transaction_type == "deposit":
+                await create_notification(
+                    {
+                        "title": "Deposit Rejected",
+                        "message": f"Your deposit of KES {amount:,.2f} has been rejected. Reason: {approval_data.reason or 'No reason provided'}",
+                        "user_id": user_id,
+                        "type": "payment"
+                    },
+                    session=session,
+                    db_instance=db_instance,
+                    buffer=notifications
+                )
+            elif transaction_type == "withdrawal":
+                await create_notification(
+                    {
+                        "title": "Withdrawal Rejected",
+                        "message": f"Your withdrawal of {transaction.get('original_amount', amount)} {transaction.get('original_currency', 'KES')} has been rejected. Reason: {approval_data.reason or 'No reason provided'}",
+                        "user_id": user_id,
+                        "type": "payment"
+                    },
+                    session=session,
+                    db_instance=db_instance,
+                    buffer=notifications
+                )
+
+            await notifications.flush(session=session)
+            await commit_transaction(session)
+            logging.info(f"Admin rejected transaction {transaction_id} for user {user_id}")
+
+            return {
+                "success": True,
+                "message": f"Transaction {transaction_id} rejected successfully"
+            }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        if session.in_transaction:
+            await session.abort_transaction()
+        logging.error(f"Error in transaction rejection for {transaction_id}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to reject transaction: {str(e)}"
+        )
+    finally:
+        if session and session.client:
+            session.end_session()
+
+@router.post("/api/admin/approve-withdrawal", dependencies=[Depends(get_current_admin_user)])
+async def approve_withdrawal(approval_data: WithdrawalApproval, db_instance: AsyncIOMotorClient = Depends(get_db_instance)):
+    """
+    Admin approves a pending withdrawal request.
+    """
+    transaction_id = approval_data.transaction_id
+    session = await db_instance.client.start_session()
+    try:
+        async with session.start_transaction():
+            notifications = NotificationBuffer(db_instance)
+            # Find and attempt to transition transaction from pending_admin_approval to processing
+            transaction = await db_instance.transactions.find_one_and_update(
+                {"transaction_id": transaction_id, "status": "pending_admin_approval"},
+                {"$set": {"status": "processing", "approved_at": datetime.utcnow()}},
+                return_document=True,
+                session=session
+            )
+
+            if not transaction:
+                logging.warning(f"Attempted to approve non-pending or non-existent transaction: {transaction_id}")
+                raise HTTPException(
+                    status_code=404,
+                    detail="Pending withdrawal request not found or already processed."
+                )
+            await bump_platform_counters(session=session, db_instance=db_instance, pending_withdrawals=-1)
+
+            user_id = transaction['user_id']
+            kes_deduct = float(transaction['kes_amount'])
+            original_amount = transaction['original_amount']
+            original_currency = transaction['original_currency']
+
+            # Fetch user document to check current balance
+            user = await db_instance.users.find_one({"user_id": user_id}, session=session)
+            
+            if not user:
+                logging.error(f"User {user_id} not found for transaction {transaction_id}.")
+                raise HTTPException(status_code=404, detail="User associated with withdrawal not found.")
+            
+            if float(user['wallet_balance']) < kes_deduct:
+                # If balance is insufficient now, revert transaction status to failed.
+                await db_instance.transactions.update_one(
+                    {"_id": transaction["_id"]},
+                    {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": "Insufficient balance at time of approval."}},
+                    session=session
+                )
+                await create_notification(
+                    {
+                        "title": "Withdrawal Failed",
+                        "message": f"Your withdrawal of {original_amount} {original_currency} failed because your wallet balance was insufficient at the time of approval. Funds were not deducted.",
+                        "user_id": user_id,
+                        "type": "payment"
+                    },
+                    session=session,
+                    db_instance=db_instance,
+                    buffer=notifications
+                )
+                await notifications.flush(session=session)
+                await commit_transaction(session)
+                raise HTTPException(
+                    status_code=400,
+                    detail="User's wallet balance is now insufficient. Withdrawal cancelled."
+                )
+            
+            # Deduct from user's balance first and increment total_withdrawn
+            current_balance = float(user['wallet_balance'])
+            new_balance = current_balance - kes_deduct
+            current_total_withdrawn = float(user['total_withdrawn'])
+            new_total_withdrawn = current_total_withdrawn + kes_deduct
+
+            await db_instance.users.update_one(
+                {"user_id": user_id},
+                {
+                    "$set": {
+                        "wallet_balance": str(new_balance),
+                        "total_withdrawn": str(new_total_withdrawn)
+                    }
+                },
+                session=session
+            )
+            await publish_wallet_delta(user_id, -kes_deduct, new_balance, "withdrawal", session=session)
+
+            # Now, initiate the actual payout based on method
+            payout_success = False
+            payout_message = "Payout initiated."
+            withdrawal_method = transaction['method']
+
+            if withdrawal_method == "mpesa":
+                recipient_phone = transaction['phone']
+                payout_amount = float(transaction['kes_amount'])
+                payout_currency = "KES"
+                try:
+                    b2c_payload, b2c_data = await send_mpesa_b2c_payment(
+                        recipient_phone, payout_amount, user['full_name'], transaction_id=transaction['transaction_id']
+                    )
+
+                    if b2c_data.get("ResponseCode") == "0":
+                        b2c_event_ids = [
+                            await record_gateway_event("mpesa", "b2c_request", b2c_payload, transaction_id=transaction_id, session=session, db_instance=db_instance),
+                            await record_gateway_event("mpesa", "b2c_response", b2c_data, transaction_id=transaction_id, session=session, db_instance=db_instance)
+                        ]
+                        await db_instance.transactions.update_one(
+                            {"_id": transaction["_id"]},
+                            {
+                                "$set": {
+                                    "payment_details.mpesa_conversation_id": b2c_data.get("ConversationID"),
+                                    "payment_details.mpesa_originator_conv_id": b2c_data.get("OriginatorConversationID")
+                                },
+                                "$push": {"gateway_event_ids": {"$each": b2c_event_ids}}
+                            },
+                            session=session
+                        )
+                        payout_success = True
+                        payout_message = "M-Pesa B2C initiated."
+                        logging.info(f"M-Pesa B2C initiated for transaction {transaction_id}. ConvID: {b2c_data.get('ConversationID')}")
+                    else:
+                        raise Exception(f"M-Pesa B2C initiation failed: {b2c_data.get('errorMessage', 'Unknown M-Pesa error')}")
+
+                except Exception as e:
+                    logging.error(f"Failed to initiate M-Pesa B2C for {transaction_id}: {str(e)}", exc_info=True)
+                    # Revert user balance if B2C initiation fails
+                    user = await db_instance.users.find_one({"user_id": user_id}, session=session)
+                    if user:
+                        current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                        new_wallet_balance = current_wallet_balance + kes_deduct
+                        current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
+                        new_total_withdrawn = current_total_withdrawn - kes_deduct
+
+                        await db_instance.users.update_one(
+                            {"user_id": user_id},
+                            {
+                                "$set": {
+                                    "wallet_balance": str(new_wallet_balance),
+                                    "total_withdrawn": str(new_total_withdrawn)
+                                }
+                            },
+                            session=session
+                        )
+                        await publish_wallet_delta(user_id, kes_deduct, new_wallet_balance, "withdrawal_reversal", session=session)
+                    await db_instance.transactions.update_one(
+                        {"_id": transaction["_id"]},
+                        {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": f"M-Pesa B2C initiation failed: {e}"}},
+                        session=session
+                    )
+                    await create_notification(
+                        {
+                            "title": "Withdrawal Failed (M-Pesa)",
+                            "message": f"Your M-Pesa withdrawal of {original_amount} {original_currency} failed during initiation. Funds returned to wallet. Reason: {e}",
+                            "user_id": user_id,
+                            "type": "payment"
+                        },
+                        session=session,
+                        db_instance=db_instance,
+                        buffer=notifications
+                    )
+                    payout_success = False
+                    payout_message = f"M-Pesa B2C initiation failed. Funds reverted. {e}"
+
+            elif withdrawal_method == "paypal":
+                recipient_email = transaction['email']
+                payout_amount = float(transaction['original_amount'])
+                payout_currency = original_currency
+                try:
+                    # PayPal payout implementation would go here
+                    # This is a simplified version - actual implementation would use PayPal Payouts API
+                    payout_success = True
+                    payout_message = "PayPal payout initiated (simulated)."
+                    logging.info(f"PayPal payout initiated for transaction {transaction_id}.")
+
+                except Exception as e:
+                    logging.error(f"Failed to initiate PayPal payout for {transaction_id}: {str(e)}", exc_info=True)
+                    # Revert user balance if PayPal payout initiation fails
+                    user = await db_instance.users.find_one({"user_id": user_id}, session=session)
+                    if user:
+                        current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                        new_wallet_balance = current_wallet_balance + kes_deduct
+                        current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
+                        new_total_withdrawn = current_total_withdrawn - kes_deduct
+                        await db_instance.users.update_one(
+                            {"user_id": user_id},
+                            {
+                                "$set": {
+                                    "wallet_balance": str(new_wallet_balance),
+                                    "total_withdrawn": str(new_total_withdrawn)
+                                }
+                            },
+                            session=session
+                        )
+                        await publish_wallet_delta(user_id, kes_deduct, new_wallet_balance, "withdrawal_reversal", session=session)
+                    await db_instance.transactions.update_one(
+                        {"_id": transaction["_id"]},
+                        {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": f"PayPal payout initiation failed: {e}"}},
+                        session=session
+                    )
+                    await create_notification(
+                        {
+                            "title": "Withdrawal Failed (PayPal)",
+                            "message": f"Your PayPal withdrawal of {original_amount} {original_currency} failed during initiation. Funds returned to wallet. Reason: {e}",
+                            "user_id": user_id,
+                            "type": "payment"
+                        },
+                        session=session,
+                        db_instance=db_instance,
+                        buffer=notifications
+                    )
+                    payout_success = False
+                    payout_message = f"PayPal payout initiation failed. Funds reverted. {e}"
+            else:
+                logging.error(f"Unknown withdrawal method for transaction {transaction_id}: {withdrawal_method}")
+                user = await db_instance.users.find_one({"user_id": user_id}, session=session)
+                if user:
+                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                    new_wallet_balance = current_wallet_balance + kes_deduct
+                    await db_instance.users.update_one(
+                        {"user_id": user_id},
+                        {"$set": {"wallet_balance": str(new_wallet_balance)}},
+                        session=session
+                    )
+                    await publish_wallet_delta(user_id, kes_deduct, new_wallet_balance, "withdrawal_reversal", session=session)
+                await db_instance.transactions.update_one(
+                    {"_id": transaction["_id"]},
+                    {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": "Unknown withdrawal method."}},
+                    session=session
+                )
+                payout_success = False
+                payout_message = "Unknown withdrawal method. Funds reverted."
+            
+            if payout_success:
+                await create_notification({
+                    "title": "Withdrawal Approved!",
+                    "message": f"Your withdrawal of {original_amount} {original_currency} has been approved and is being processed.",
+                    "user_id": user_id,
+                    "type": "payment"
+                }, session=session, db_instance=db_instance, buffer=notifications)
+                await notifications.flush(session=session)
+                await commit_transaction(session)
+                return {
+                    "success": True,
+                    "message": f"Withdrawal {transaction_id} approved. {payout_message}"
+                }
+            else:
+                await session.abort_transaction()
+                raise HTTPException(status_code=500, detail=f"Withdrawal failed after approval: {payout_message}")
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        if session.in_transaction:
+            await session.abort_transaction()
+        logging.critical(f"Critical error during withdrawal approval for transaction {transaction_id}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"An unexpected error occurred during withdrawal approval: {str(e)}"
+        )
+    finally:
+        if session and session.in_transaction:
+             await session.abort_transaction()
+        if session and session.client:
+            session.end_session()
+
+@router.post("/api/admin/approve-withdrawals/bulk", dependencies=[Depends(get_current_admin_user)])
+async def bulk_approve_withdrawals(approval_data: BulkWithdrawalApproval, db_instance: AsyncIOMotorClient = Depends(get_db_instance)):
+    """
+    Admin approves many pending withdrawals at once, selected by id list or by filter
+    (method, currency, KES amount range). Balances are validated with one query and
+    debited with one bulk_write; payouts then run concurrently under per-gateway limits,
+    in a background task that outlives the request. Results stream back as
+    newline-delimited JSON, one line per withdrawal.
+    """
+    query = {"type": "withdrawal", "status": "pending_admin_approval"}
+    has_filter = any(
+        value is not None for value in
+        (approval_data.method, approval_data.currency, approval_data.min_amount, approval_data.max_amount)
+    )
+    if approval_data.transaction_ids:
+        query["transaction_id"] = {"$in": approval_data.transaction_ids}
+    elif not has_filter:
+        raise HTTPException(status_code=400, detail="Provide transaction_ids or at least one filter (method, currency, min_amount, max_amount)")
+
+    if approval_data.method:
+        query["method"] = approval_data.method.lower().strip()
+    if approval_data.currency:
+        query["original_currency"] = approval_data.currency.upper().strip()
+    amount_conditions = []
+    if approval_data.min_amount is not None:
+        amount_conditions.append({"$gte": [{"$toDouble": "$kes_amount"}, approval_data.min_amount]})
+    if approval_data.max_amount is not None:
+        amount_conditions.append({"$lte": [{"$toDouble": "$kes_amount"}, approval_data.max_amount]})
+    if amount_conditions:
+        query["$expr"] = {"$and": amount_conditions}
+
+    limit = max(1, min(approval_data.limit, BULK_APPROVAL_MAX_ITEMS))
+    candidates = await db_instance.transactions.find(query, {"transaction_id": 1}).sort("created_at", 1).to_list(limit)
+    if not candidates:
+        return {"success": True, "message": "No pending withdrawals matched", "count": 0}
+
+    # Claim the batch so single approvals (or another bulk run) cannot process the same items
+    batch_id = str(uuid.uuid4())
+    claim_result = await db_instance.transactions.update_many(
+        {"transaction_id": {"$in": [c["transaction_id"] for c in candidates]}, "status": "pending_admin_approval"},
+        {"$set": {"status": "processing", "approved_at": datetime.utcnow(), "bulk_approval_id": batch_id}}
+    )
+    await bump_platform_counters(db_instance=db_instance, pending_withdrawals=-claim_result.modified_count)
+
+    approved = []  # (transaction, user) pairs debited and ready for payout
+    rejected = []  # (transaction, reason) pairs failed during validation
+    session = await db_instance.client.start_session()
+    try:
+        async with session.start_transaction():
+            notifications = NotificationBuffer(db_instance)
+            claimed = await db_instance.transactions.find(
+                {"bulk_approval_id": batch_id}, session=session
+            ).sort("created_at", 1).to_list(None)
+
+            # Validate all balances with a single query
+            user_ids = list({txn["user_id"] for txn in claimed})
+            users = {
+                u["user_id"]: u
+                for u in await db_instance.users.find({"user_id": {"$in": user_ids}}, session=session).to_list(None)
+            }
+            balances = {
+                uid: [float(u.get("wallet_balance", "0.0")), float(u.get("total_withdrawn", "0.0"))]
+                for uid, u in users.items()
+            }
+
+            for txn in claimed:
+                user = users.get(txn["user_id"])
+                kes_deduct = float(txn["kes_amount"])
+                if not user:
+                    rejected.append((txn, "User associated with withdrawal not found."))
+                elif balances[txn["user_id"]][0] < kes_deduct:
+                    rejected.append((txn, "Insufficient balance at time of approval."))
+                else:
+                    balances[txn["user_id"]][0] -= kes_deduct
+                    balances[txn["user_id"]][1] += kes_deduct
+                    approved.append((txn, user))
+
+            # Apply all debits with a single bulk_write
+            debited_users = {user["user_id"] for _, user in approved}
+            if debited_users:
+                await db_instance.users.bulk_write(
+                    [
+                        UpdateOne(
+                            {"user_id": uid},
+                            {"$set": {
+                                "wallet_balance": str(balances[uid][0]),
+                                "total_withdrawn": str(balances[uid][1])
+                            }}
+                        )
+                        for uid in debited_users
+                    ],
+                    ordered=False,
+                    session=session
+                )
+                for uid in debited_users:
+                    debited = float(users[uid].get("wallet_balance", "0.0")) - balances[uid][0]
+                    await publish_wallet_delta(uid, -debited, balances[uid][0], "withdrawal", session=session)
+
+            if approved:
+                # Marks the payouts still to send; recover_bulk_payouts resends any left marked
+                await db_instance.transactions.update_many(
+                    {"_id": {"$in": [txn["_id"] for txn, _ in approved]}},
+                    {"$set": {"payout_pending": True}},
+                    session=session
+                )
+
+            if rejected:
+                await db_instance.transactions.bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": txn["_id"]},
+                            {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": reason}}
+                        )
+                        for txn, reason in rejected
+                    ],
+                    ordered=False,
+                    session=session
+                )
+                for txn, reason in rejected:
+                    await create_notification(
+                        {
+                            "title": "Withdrawal Failed",
+                            "message": f"Your withdrawal of {txn['original_amount']} {txn['original_currency']} failed: {reason} Funds were not deducted.",
+                            "user_id": txn["user_id"],
+                            "type": "payment"
+                        },
+                        session=session,
+                        db_instance=db_instance,
+                        buffer=notifications
+                    )
+
+            await notifications.flush(session=session)
+            await commit_transaction(session)
+
+    except Exception as e:
+        if session.in_transaction:
+            await session.abort_transaction()
+        # Release the claim so the withdrawals can be approved again
+        release_result = await db_instance.transactions.update_many(
+            {"bulk_approval_id": batch_id, "status": "processing"},
+            {"$set": {"status": "pending_admin_approval"}, "$unset": {"bulk_approval_id": "", "approved_at": ""}}
+        )
+        await bump_platform_counters(db_instance=db_instance, pending_withdrawals=release_result.modified_count)
+        logging.critical(f"Critical error during bulk withdrawal approval {batch_id}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"An unexpected error occurred during bulk withdrawal approval: {str(e)}"
+        )
+    finally:
+        if session and session.client:
+            session.end_session()
+
+    logging.info(f"Bulk approval {batch_id}: {len(approved)} debited, {len(rejected)} rejected")
+
+    # Payouts run in the background: a client that disconnects mid-stream does not stop them
+    results = asyncio.Queue()
+    start_bulk_payouts(batch_id, approved, db_instance, on_result=results.put_nowait)
+
+    async def stream_results():
+        for txn, reason in rejected:
+            yield json.dumps({"transaction_id": txn["transaction_id"], "status": "failed", "method": txn.get("method"), "message": reason}) + "\n"
+
+        succeeded = 0
+        for _ in approved:
+            item = await results.get()
+            if item["status"] == "processing":
+                succeeded += 1
+            yield json.dumps(item) + "\n"
+
+        yield json.dumps({
+            "summary": True,
+            "bulk_approval_id": batch_id,
+            "total": len(approved) + len(rejected),
+            "processing": succeeded,
+            "failed": len(approved) + len(rejected) - succeeded
+        }) + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@router.post("/api/admin/tasks", dependencies=[Depends(get_current_admin_user)])
+async def create_task(task_data: Task):
+    task_id = str(uuid.uuid4())
+    task_doc = {
+        "task_id": task_id,
+        "title": task_data.title,
+        "description": task_data.description,
+        "reward": str(task_data.reward),
+        "type": task_data.type,
+        "requirements": task_data.requirements,
+        "media": task_data.media,
+        "survey_questions": task_data.survey_questions,
+        "is_active": task_data.is_active,
+        "created_at": datetime.utcnow()
+    }
+    await db.tasks.insert_one(task_doc)
+    await bump_task_totals(tasks=1, active_tasks=int(bool(task_data.is_active)))
+    await cache_bus.invalidate("tasks")
+    logging.info(f"Admin created task: {task_data.title}")
+    return {"success": True, "message": "Task created successfully", "task": json_serializable_doc(task_doc)}
+
+@router.get("/api/admin/tasks", dependencies=[Depends(get_current_admin_user)])
+async def get_all_tasks(status: Optional[bool] = None, task_type: Optional[str] = None):
+    query = {}
+    if status is not None:
+        query["is_active"] = status
+    if task_type:
+        query["type"] = task_type
+    tasks = await db.tasks.find(query).sort("created_at", -1).to_list(100)
+    return {"success": True, "tasks": json_serializable_doc(tasks)}
+
+@router.put("/api/admin/tasks/{task_id}", dependencies=[Depends(get_current_admin_user)])
+async def update_task(task_id: str, task_data: Task):
+    task = await db.tasks.find_one({"task_id": task_id})
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    update_data = {
+        "title": task_data.title,
+        "description": task_data.description,
+        "reward": str(task_data.reward),
+        "type": task_data.type,
+        "requirements": task_data.requirements,
+        "media": task_data.media,
+        "survey_questions": task_data.survey_questions,
+        "is_active": task_data.is_active,
+        "updated_at": datetime.utcnow()
+    }
+    task = await db.tasks.find_one_and_update(
+        {"task_id": task_id},
+        {"$set": update_data},
+        return_document=ReturnDocument.BEFORE
+    )
+    await cache_bus.invalidate("tasks")
+    if task and bool(task.get("is_active")) != bool(task_data.is_active):
+        await bump_task_totals(active_tasks=1 if task_data.is_active else -1)
+    if task and task.get("type", "general") != task_data.type:
+        await move_task_stats_type(task_id, task.get("type", "general"), task_data.type)
+    logging.info(f"Admin updated task {task_id}")
+    return {"success": True, "message": "Task updated successfully"}
+
+@router.delete("/api/admin/tasks/{task_id}", dependencies=[Depends(get_current_admin_user)])
+async def delete_task(task_id: str):
+    task = await db.tasks.find_one({"task_id": task_id})
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    result = await db.tasks.delete_one({"task_id": task_id})
+    await cache_bus.invalidate("tasks")
+    # Optionally, refund or invalidate related completions
+    await db.task_completions.delete_many({"task_id": task_id})
+    if result.deleted_count:
+        await bump_task_totals(tasks=-1, active_tasks=-int(bool(task.get("is_active"))))
+        await remove_task_stats(task_id)
+    logging.info(f"Admin deleted task {task_id}")
+    return {"success": True, "message": "Task deleted successfully"}
+
+@router.put("/api/admin/tasks/{task_id}/status", dependencies=[Depends(get_current_admin_user)])
+async def update_task_status(task_id: str, update_data: UpdateTaskStatus):
+    task = await db.tasks.find_one({"task_id": task_id})
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    result = await db.tasks.update_one(
+        {"_id": task["_id"], "is_active": {"$ne": update_data.is_active}},
+        {"$set": {"is_active": update_data.is_active}}
+    )
+    if result.modified_count:
+        await bump_task_totals(active_tasks=1 if update_data.is_active else -1)
+        await cache_bus.invalidate("tasks")
+    logging.info(f"Admin updated task {task_id} status to active: {update_data.is_active}")
+    return {"success": True, "message": f"Task status updated to active: {update_data.is_active}"}
+
+@router.get("/api/admin/task-completions", dependencies=[Depends(get_current_admin_user)])
+async def get_all_task_completions(
+    task_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    status: Optional[str] = None,
+    page: int = Query(1, ge=1),
+    limit: int = Query(20, ge=1, le=100)
+):
+    query = {}
+    if task_id:
+        query["task_id"] = task_id
+    if user_id:
+        query["user_id"] = user_id
+    if status:
+        query["status"] = status
+    
+    skip = (page - 1) * limit
+    total = await db.task_completions.count_documents(query)
+    
+    completions = await db.task_completions.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(None)
+    
+    # Optionally join with task details
+    for comp in completions:
+        task = await db.tasks.find_one({"task_id": comp["task_id"]})
+        if task:
+            comp["task_details"] = json_serializable_doc(task)
+    
+    return {
+        "success": True,
+        "completions": json_serializable_doc(completions),
+        "pagination": {
+            "page": page,
+            "limit": limit,
+            "total": total,
+            "pages": (total + limit - 1) // limit if total > 0 else 0
+        }
+    }
+
+@router.put("/api/admin/task-completions/{completion_id}/status", dependencies=[Depends(get_current_admin_user)])
+async def update_completion_status(completion_id: str, update_data: UpdateWithdrawalStatus):
+    completion = await db.task_completions.find_one({"completion_id": completion_id})
+    if not completion:
+        raise HTTPException(status_code=404, detail="Completion not found")
+    
+    update_fields = {"status": update_data.status}
+    if update_data.reason:
+        update_fields["admin_notes"] = update_data.reason
+    update_fields["admin_updated_at"] = datetime.utcnow()
+
+    # The prior status comes back from the same write, so concurrent updates count once
+    completion = await db.task_completions.find_one_and_update(
+        {"completion_id": completion_id},
+        {"$set": update_fields},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not completion:
+        raise HTTPException(status_code=404, detail="Completion not found")
+    was_completed = completion.get("status") == "completed"
+    if was_completed != (update_data.status == "completed"):
+        task = await db.tasks.find_one({"task_id": completion["task_id"]}, {"task_id": 1, "type": 1})
+        if task:
+            sign = 1 if update_data.status == "completed" else -1
+            await bump_task_stats(task, completion["created_at"], completed=sign, earnings=sign * float(completion["reward_amount"]))
+
+    # If rejecting, optionally refund (reverse wallet update)
+    if update_data.status == "rejected":
+        user = await db.users.find_one({"user_id": completion["user_id"]})
+        if user:
+            reward = float(completion["reward_amount"])
+            await db.users.update_one(
+                {"user_id": completion["user_id"]},
+                {
+                    "$inc": {
+                        "wallet_balance": str(reward),
+                        "task_earnings": str(-reward),
+                        "total_earned": str(-reward)
+                    }
+                }
+            )
+            # Create refund transaction
+            await db.transactions.insert_one({
+                "transaction_id": str(uuid.uuid4()),
+                "user_id": completion["user_id"],
+                "type": "task_refund",
+                "amount": str(reward),
+                "currency": "KES",
+                "status": "completed",
+                "description": f"Refund for rejected task completion {completion_id}: {update_data.reason}",
+                "created_at": datetime.utcnow(),
+                "completed_at": datetime.utcnow()
+            })
+    
+    logging.info(f"Admin updated completion {completion_id} status to {update_data.status}")
+    return {"success": True, "message": "Completion status updated"}
+
+@router.get("/api/admin/tasks/stats", dependencies=[Depends(get_current_admin_user)])
+async def get_task_stats(
+    bucket: Optional[str] = None,
+    days: int = Query(30, ge=1, le=366),
+    task_id: Optional[str] = None
+):
+    """
+    Task totals read from the task_stats counters. With `bucket` (day, week or month),
+    completions over the last `days` days are broken down per period and task type.
+    """
+    if bucket and bucket not in ("day", "week", "month"):
+        raise HTTPException(status_code=400, detail="bucket must be one of: day, week, month")
+
+    totals = await db.task_stats.find_one({"_id": "totals"})
+    if not totals or "verified_at" not in totals:
+        # First load after deployment: seed the counters from a full recount
+        await verify_task_stats()
+        totals = await db.task_stats.find_one({"_id": "totals"})
+    by_type = await db.task_stats.find({"scope": "type"}).sort("completed", -1).to_list(None)
+
+    stats = {
+        "total_tasks": totals.get("tasks", 0),
+        "active_tasks": totals.get("active_tasks", 0),
+        "total_completions": totals.get("completions", 0),
+        "completed_completions": totals.get("completed", 0),
+        "total_earnings_distributed": totals.get("earnings", 0.0),
+        "completions_by_type": [
+            {"id": doc["type"], "count": doc.get("completed", 0), "earnings": doc.get("earnings", 0.0)}
+            for doc in by_type
+        ],
+        "counters_verified_at": totals.get("verified_at")
+    }
+
+    if task_id:
+        task_stats = await db.task_stats.find_one({"_id": f"task:{task_id}"}) or {}
+        stats["task"] = {"task_id": task_id, **{field: task_stats.get(field, 0) for field in TASK_STAT_FIELDS}}
+
+    if bucket:
+        since = (datetime.utcnow() - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        query = {"scope": "day", "bucket": {"$gte": since}}
+        if task_id:
+            query["task_id"] = task_id
+        periods = {}
+        async for row in db.task_stats.find(query):
+            day = row["bucket"]
+            if bucket == "week":
+                start = day - timedelta(days=day.weekday())
+            elif bucket == "month":
+                start = day.replace(day=1)
+            else:
+                start = day
+            period = periods.setdefault(start, {"period_start": start, **{field: 0 for field in TASK_STAT_FIELDS}, "by_type": {}})
+            by_period_type = period["by_type"].setdefault(row["type"], {field: 0 for field in TASK_STAT_FIELDS})
+            for field in TASK_STAT_FIELDS:
+                period[field] += row.get(field, 0)
+                by_period_type[field] += row.get(field, 0)
+        stats["breakdown"] = {
+            "bucket": bucket,
+            "since": since,
+            "periods": [periods[start] for start in sorted(periods)]
+        }
+
+    return {"success": True, "stats": json_serializable_doc(stats)}
+
+@router.post("/api/admin/tasks/stats/verify", dependencies=[Depends(get_current_admin_user)])
+async def verify_task_stats_endpoint():
+    """Recounts the task statistics now instead of waiting for the nightly run."""
+    return {"success": True, **json_serializable_doc(await verify_task_stats())}
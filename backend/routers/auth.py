@@ -0,0 +1,420 @@
+"""
+Account routes: registration, login, password reset and the current user.
+"""
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import JSONResponse
+import uuid
+from datetime import datetime, timedelta
+import secrets
+import logging
+
+from server import (
+    BASE_URL,
+    PasswordReset,
+    PasswordResetRequest,
+    UserLogin,
+    UserRegister,
+    bump_platform_counters,
+    create_jwt_token,
+    db,
+    generate_referral_code,
+    get_current_user,
+    hash_password,
+    json_serializable_doc,
+    rate_limit,
+    send_email,
+    update_leg_sizes,
+    validate_and_format_phone,
+    verify_password,
+)
+
+router = APIRouter(tags=["auth"])
+
+@router.post("/api/auth/register")
+async def register(user_data: UserRegister):
+    # Check if user already exists
+    existing_user = await db.users.find_one({"email": user_data.email})
+    if existing_user:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    
+    # Check phone number
+    existing_phone = await db.users.find_one({"phone": validate_and_format_phone(user_data.phone)})
+    if existing_phone:
+        raise HTTPException(status_code=400, detail="Phone number already registered")
+
+    user_id = str(uuid.uuid4())
+    referral_code = generate_referral_code()
+    
+    # Handle referral if provided
+    referred_by = None
+    if user_data.referral_code:
+        referrer = await db.users.find_one({"referral_code": user_data.referral_code})
+        if referrer:
+            referred_by = referrer['user_id']
+    
+    # Create user document
+    user_doc = {
+        "user_id": user_id,
+        "email": user_data.email.lower().strip(),
+        "password": hash_password(user_data.password),
+        "full_name": user_data.full_name.strip(),
+        "phone": validate_and_format_phone(user_data.phone),
+        "referral_code": referral_code,
+        "referred_by": referred_by,
+        "parent_id": referred_by,
+        "position": None,
+        "left_leg_size": 0,
+        "right_leg_size": 0,
+        "binary_earnings": "0.00",
+        "wallet_balance": "0.00",
+        "is_activated": False,
+        "activation_amount": "10.00",
+        "total_earned": "0.00",
+        "total_withdrawn": "0.00",
+        "referral_earnings": "0.00",
+        "task_earnings": "0.00",
+        "referral_count": 0,
+        "has_spun_once": False,
+        "payment_methods": {
+            "mpesa": {"phone": None, "verified": False},
+            "paypal": {"email": None, "verified": False},
+            "pesapal": {"phone": None, "verified": False}
+        },
+        "security": {
+            "two_factor_enabled": False,
+            "last_password_change": datetime.utcnow()
+        },
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+        "last_login": datetime.utcnow(),
+        "notifications_enabled": True,
+        "communication_preferences": {
+            "email": True,
+            "sms": True,
+            "push": True
+        },
+        "theme": "light",
+        "role": user_data.role.lower() if user_data.role else "user",
+        "preferred_currency": user_data.preferred_currency or "KES",
+        "status": "active",
+        "verification": {
+            "email_verified": False,
+            "phone_verified": False,
+            "identity_verified": False
+        },
+        "left_child_id": None,
+        "right_child_id": None,
+        "team_earnings": "0.00",
+        "activation_expense": "300.00",
+        "activation_reward": "0.00",
+        "team_reward_claimed": False
+    }
+
+    try:
+        # Insert user document
+        await db.users.insert_one(user_doc)
+        await bump_platform_counters(total_users=1)
+
+        # Handle referral
+        if referred_by:
+            referral_doc = {
+                "referral_id": str(uuid.uuid4()),
+                "referrer_id": referred_by,
+                "referred_id": user_id,
+                "status": "pending",
+                "created_at": datetime.utcnow(),
+                "activation_date": None,
+                "reward_amount": "50.00",
+                "currency": "KES"
+            }
+            await db.referrals.insert_one(referral_doc)
+
+            # Increment referrer's referral count
+            await db.users.update_one(
+                {"user_id": referred_by},
+                {"$inc": {"referral_count": 1}}
+            )
+
+            # Binary placement logic
+            sponsor = await db.users.find_one({"user_id": referred_by})
+            if sponsor:
+                left_size = sponsor.get("left_leg_size", 0)
+                right_size = sponsor.get("right_leg_size", 0)
+                position = "left" if left_size <= right_size else "right"
+
+                # Update new user's position
+                await db.users.update_one(
+                    {"user_id": user_id},
+                    {"$set": {"position": position}}
+                )
+
+                # Set parent's child_id if first in leg
+                child_update = {}
+                if position == "left" and sponsor.get("left_child_id") is None:
+                    child_update["left_child_id"] = user_id
+                elif position == "right" and sponsor.get("right_child_id") is None:
+                    child_update["right_child_id"] = user_id
+                if child_update:
+                    await db.users.update_one(
+                        {"user_id": referred_by},
+                        {"$set": child_update}
+                    )
+
+                # Update leg sizes up the tree
+                await update_leg_sizes(referred_by, position, 1, db_instance=db)
+
+        # Create initial wallet transaction record
+        transaction_doc = {
+            "transaction_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "type": "account_creation",
+            "amount": "0.00",
+            "currency": "KES",
+            "status": "completed",
+            "description": "Initial account creation",
+            "created_at": datetime.utcnow(),
+            "completed_at": datetime.utcnow()
+        }
+        await db.transactions.insert_one(transaction_doc)
+
+        # Send welcome email
+        welcome_email_body = f"""
+        <h1>Welcome to EarnPlatform, {user_doc['full_name']}!</h1>
+        <p>Thank you for registering. Your account has been created successfully.</p>
+        <p>Please deposit KSH 300 to activate your account and unlock all features. You'll also receive a 300 KES reward!</p>
+        """
+        await send_email(
+            subject="Welcome to EarnPlatform!",
+            recipient=user_doc["email"],
+            body=welcome_email_body
+        )
+
+    except Exception as e:
+        logging.error(f"Registration failed for {user_data.email}: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Registration failed: {str(e)}"
+        )
+
+    # Generate JWT token
+    token = create_jwt_token(
+        user_id=user_id,
+        email=user_data.email,
+        role=user_doc["role"],
+        is_activated=user_doc["is_activated"]
+    )
+
+    # Return response with sanitized user data
+    return {
+        "success": True,
+        "message": "Registration successful! A welcome email has been sent. Please deposit KSH 300 to activate your account.",
+        "token": token,
+        "user": json_serializable_doc({
+            "user_id": user_id,
+            "email": user_data.email,
+            "full_name": user_data.full_name,
+            "referral_code": referral_code,
+            "is_activated": False,
+            "wallet_balance": user_doc["wallet_balance"],
+            "preferred_currency": user_doc["preferred_currency"],
+            "role": user_doc["role"],
+            "has_spun_once": user_doc["has_spun_once"],
+            "has_payment_methods": False,
+            "verification_status": {
+                "email": False,
+                "phone": False
+            }
+        }),
+        "next_steps": [
+            "verify_email",
+            "verify_phone",
+            "add_payment_method",
+            "make_activation_deposit"
+        ]
+    }
+
+@router.post("/api/auth/login", dependencies=[Depends(rate_limit("login"))])
+async def login(user_data: UserLogin):
+    user = await db.users.find_one({"email": user_data.email})
+    if not user or not verify_password(user_data.password, user['password']):
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    
+    # Update last login
+    await db.users.update_one(
+        {"user_id": user['user_id']},
+        {"$set": {"last_login": datetime.utcnow()}}
+    )
+    
+    token = create_jwt_token(user['user_id'], user['email'], user.get('role', 'user'), user.get('is_activated', False)) 
+    
+    # Return serializable user data
+    return {
+        "success": True,
+        "message": "Login successful!",
+        "token": token,
+        "user": json_serializable_doc({
+            "user_id": user['user_id'],
+            "email": user['email'],
+            "full_name": user['full_name'],
+            "referral_code": user['referral_code'],
+            "is_activated": user['is_activated'],
+            "wallet_balance": user['wallet_balance'],
+            "preferred_currency": user.get('preferred_currency', 'KES'),
+            "theme": user.get('theme', 'light'),
+            "role": user.get('role', 'user'),
+            "has_spun_once": user.get('has_spun_once', False)
+        })
+    }
+
+@router.post("/api/auth/request-password-reset", dependencies=[Depends(rate_limit("password_reset"))])
+async def request_password_reset(reset_request: PasswordResetRequest):
+    user = await db.users.find_one({"email": reset_request.email})
+    if not user:
+        # Prevent user enumeration by sending a generic success message
+        return JSONResponse(content={"success": True, "message": "If your email is in our system, you will receive a password reset link."})
+    
+    # Generate a unique, temporary token
+    reset_token = secrets.token_urlsafe(32)
+    token_expiration = datetime.utcnow() + timedelta(hours=1)
+    
+    # Store the token and expiration in the user document
+    await db.users.update_one(
+        {"_id": user["_id"]},
+        {"$set": {"reset_token": reset_token, "reset_token_expires": token_expiration}}
+    )
+    
+    # Construct the reset link and email body
+    reset_link = f"{BASE_URL}/reset-password?token={reset_token}"
+    email_body = f"""
+    <h1>Password Reset Request for EarnPlatform</h1>
+    <p>Hello {user['full_name']},</p>
+    <p>We received a request to reset your password. If you did not make this request, please ignore this email or contact support.</p>
+    <p>To reset your password, click the secure link below:</p>
+    <a href="{reset_link}" style="background-color: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">Reset My Password</a>
+    <p>This link expires in 1 hour for security.</p>
+    <p>If the link doesn't work, copy and paste it into your browser: {reset_link}</p>
+    <p>Best regards,<br>EarnPlatform Team</p>
+    """
+    
+    await send_email(
+        subject="Password Reset for Your EarnPlatform Account",
+        recipient=user["email"],
+        body=email_body
+    )
+    
+    return JSONResponse(content={"success": True, "message": "If your email is in our system, you will receive a password reset link."})
+
+@router.get("/api/auth/verify-reset-token")
+async def verify_reset_token(token: str):
+    """Verify if a reset token is valid before showing the form."""
+    user = await db.users.find_one({
+        "reset_token": token,
+        "reset_token_expires": {"$gt": datetime.utcnow()}
+    })
+    
+    if not user:
+        raise HTTPException(status_code=400, detail="Invalid or expired token")
+    
+    return {
+        "success": True,
+        "valid": True,
+        "expires_at": user["reset_token_expires"].isoformat(),
+        "message": "Token is valid. Proceed to reset password."
+    }
+
+@router.post("/api/auth/reset-password", dependencies=[Depends(rate_limit("password_reset"))])
+async def reset_password(reset_data: PasswordReset):
+    user = await db.users.find_one({
+        "reset_token": reset_data.token,
+        "reset_token_expires": {"$gt": datetime.utcnow()}
+    })
+
+    if not user:
+        raise HTTPException(status_code=400, detail="Invalid or expired token")
+
+    # Validate new password (basic: length, no reuse - extend as needed)
+    if len(reset_data.new_password) < 8:
+        raise HTTPException(status_code=400, detail="New password must be at least 8 characters")
+
+    # Hash the new password and clear the reset token fields
+    hashed_password = hash_password(reset_data.new_password)
+    await db.users.update_one(
+        {"_id": user["_id"]},
+        {
+            "$set": {
+                "password": hashed_password,
+                "last_password_change": datetime.utcnow()
+            },
+            "$unset": {"reset_token": "", "reset_token_expires": ""}
+        }
+    )
+
+    # Send confirmation email
+    confirm_email = f"""
+    <h1>Password Reset Successful</h1>
+    <p>Hello {user['full_name']},</p>
+    <p>Your password has been successfully reset.</p>
+    <p>You can now log in with your new password at {BASE_URL}/login.</p>
+    <p>If you did not request this change, please contact support immediately.</p>
+    <p>Best regards,<br>EarnPlatform Team</p>
+    """
+    await send_email(
+        subject="Password Reset Confirmation",
+        recipient=user["email"],
+        body=confirm_email
+    )
+
+    return {
+        "success": True,
+        "message": "Password has been successfully reset. You can now log in with your new password.",
+        "next_step": "login"
+    }
+
+@router.get("/api/auth/me")
+async def get_current_user_info(current_user: dict = Depends(get_current_user)):
+    """
+    Get current user information.
+    This endpoint returns the authenticated user's profile data.
+    """
+    try:
+        # Convert user data to serializable format
+        user_data = json_serializable_doc({
+            "user_id": current_user['user_id'],
+            "email": current_user['email'],
+            "full_name": current_user['full_name'],
+            "phone": current_user['phone'],
+            "referral_code": current_user['referral_code'],
+            "is_activated": current_user['is_activated'],
+            "wallet_balance": current_user['wallet_balance'],
+            "activation_amount": current_user.get('activation_amount', 300.0),
+            "total_earned": current_user.get('total_earned', 0.0),
+            "total_withdrawn": current_user.get('total_withdrawn', 0.0),
+            "referral_earnings": current_user.get('referral_earnings', 0.0),
+            "task_earnings": current_user.get('task_earnings', 0.0),
+            "binary_earnings": current_user.get('binary_earnings', 0.0),
+            "left_leg_size": current_user.get('left_leg_size', 0),
+            "right_leg_size": current_user.get('right_leg_size', 0),
+            "referral_count": current_user.get('referral_count', 0),
+            "role": current_user.get('role', 'user'),
+            "preferred_currency": current_user.get('preferred_currency', 'KES'),
+            "theme": current_user.get('theme', 'light'),
+            "has_spun_once": current_user.get('has_spun_once', False),
+            "team_earnings": current_user.get('team_earnings', 0.0),
+            "activation_expense": current_user.get('activation_expense', 0.0),
+            "activation_reward": current_user.get('activation_reward', 0.0),
+            "team_reward_claimed": current_user.get('team_reward_claimed', False),
+            "created_at": current_user.get('created_at'),
+            "last_login": current_user.get('last_login')
+        })
+
+        return {
+            "success": True,
+            "user": user_data
+        }
+
+    except Exception as e:
+        logging.error(f"Error fetching current user info: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to fetch user information: {str(e)}"
+        )
@@ -0,0 +1,358 @@
+"""
+Dashboard routes: stats, transaction history and user settings.
+"""
+from fastapi import APIRouter, HTTPException, Depends, Query
+from typing import Optional
+from datetime import datetime, timedelta
+import asyncio
+import logging
+
+from server import (
+    db,
+    fetch_user_notifications,
+    generate_quick_actions,
+    get_current_user,
+    get_exchange_rate,
+    get_unread_notification_count,
+    json_serializable_doc,
+)
+
+router = APIRouter(tags=["dashboard"])
+
+@router.get("/api/dashboard/stats")
+async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
+    user_id = current_user['user_id']
+    preferred = current_user['preferred_currency']
+    
+    if preferred == "KES":
+        rate = 1.0
+    else:
+        try:
+            rate = await get_exchange_rate("KES", preferred)
+        except Exception as e:
+            logging.warning(f"Failed to fetch exchange rate for {preferred}: {e}. Using 1.0")
+            rate = 1.0
+    
+    def convert_amount(amount: float) -> float:
+        return round(amount * rate, 2)
+    
+    try:
+        # Fetch all data in parallel for better performance
+        transactions_task = db.transactions.find(
+            {"user_id": user_id}
+        ).sort("created_at", -1).limit(10).to_list(None)
+        
+        referrals_agg_pipeline = [
+            {"$match": {"referrer_id": user_id}},
+            {"$group": {
+                "_id": "$status",
+                "count": {"$sum": 1},
+                "total_reward_for_status": {"$sum": {"$toDouble": "$reward_amount"}}
+            }},
+            {"$group": {
+                "_id": None,
+                "total_referrals": {"$sum": "$count"},
+                "completed_rewards": {
+                    "$sum": {
+                        "$cond": [
+                            {"$eq": ["$_id", "completed"]},
+                            "$total_reward_for_status",
+                            0
+                        ]
+                    }
+                },
+                "potential_rewards": {
+                    "$sum": {
+                        "$cond": [
+                            {"$eq": ["$_id", "pending"]},
+                            "$total_reward_for_status",
+                            0
+                        ]
+                    }
+                }
+            }},
+            {"$project": {
+                "_id": 0,
+                "total_referrals": 1,
+                "total_earned": "$completed_rewards",
+                "potential_earnings": "$potential_rewards",
+            }}
+        ]
+
+        referrals_task = db.referrals.aggregate(referrals_agg_pipeline).to_list(None)
+                # Calculate daily earnings for last 7 days (for bar graph)
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(days=7)
+
+        # Calculate weekly referral growth
+        weekly_referrals_start = end_date - timedelta(days=7)
+        weekly_referrals_count = await db.referrals.count_documents({
+            "referrer_id": user_id,
+            "created_at": {"$gte": weekly_referrals_start}
+        })
+        
+        notifications_task = fetch_user_notifications(user_id, 10)
+        
+        tasks_task = db.task_completions.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$group": {
+                "_id": "$status",
+                "count": {"$sum": 1},
+                "total_earnings": {"$sum": {"$toDouble": "$reward_amount"}}
+            }}
+        ]).to_list(None)
+        
+        # Execute all queries concurrently
+        transactions, referrals_result, notifications, tasks, unread_notifications = await asyncio.gather(
+            transactions_task,
+            referrals_task,
+            notifications_task,
+            tasks_task,
+            get_unread_notification_count(user_id)
+        )
+        
+        # Process referral result
+        referral_stats = referrals_result[0] if referrals_result else {
+            "total_referrals": 0,
+            "total_earned": 0.0,
+            "potential_earnings": 0.0,
+        }
+        referral_count = referral_stats.get('total_referrals', 0)
+        tier = "gold" if referral_count >= 50 else \
+               "silver" if referral_count >= 20 else "bronze"
+
+        # Weekly growth percentage (referrals added this week vs total)
+        weekly_growth_percentage = 0.0
+        if referral_count > 0:
+            growth = (referral_count - weekly_referrals_count) / referral_count * 100
+            weekly_growth_percentage = round(max(growth, 0), 2)  # Positive or 0%
+        elif weekly_referrals_count > 0:
+            weekly_growth_percentage = 100.0  # New team growth
+
+        referral_stats['tier'] = tier
+        referral_stats['referral_code'] = current_user['referral_code']
+        referral_stats['total_earned'] = convert_amount(referral_stats.get('total_earned', 0.0))
+        referral_stats['potential_earnings'] = convert_amount(referral_stats.get('potential_earnings', 0.0))
+        
+        # Calculate weekly earnings breakdown
+        weekly_breakdown_agg = await db.transactions.aggregate([
+            {"$match": {
+                "user_id": user_id,
+                "type": {"$in": ["task", "referral_reward", "spin_and_win", "binary_commission"]},
+                "status": "completed",
+                "created_at": {
+                    "$gte": datetime.utcnow() - timedelta(days=7)
+                }
+            }},
+            {"$group": {
+                "_id": "$type",
+                "amount": {"$sum": {"$toDouble": "$amount"}}
+            }},
+            {"$group": {
+                "_id": None,
+                "breakdown": {"$push": {
+                    "type": "$_id",
+                    "earnings": "$amount"
+                }},
+                "total": {"$sum": "$amount"}
+            }}
+        ]).to_list(None)
+
+
+        daily_agg = await db.transactions.aggregate([
+            {"$match": {
+                "user_id": user_id,
+                "type": {"$in": ["task", "referral_reward", "spin_and_win", "binary_commission"]},
+                "status": "completed",
+                "created_at": {"$gte": start_date, "$lt": end_date}
+            }},
+            {"$group": {
+                "_id": {
+                    "$dateToString": {
+                        "format": "%Y-%m-%d",
+                        "date": "$created_at",
+                        "timezone": "UTC"
+                    }
+                },
+                "total": {"$sum": {"$toDouble": "$amount"}}
+            }},
+            {"$sort": {"_id": 1}},  # Oldest to newest
+            {"$group": {
+                "_id": None,
+                "daily_totals": {"$push": "$total"},
+                "dates": {"$push": "$_id"}
+            }},
+            {"$project": {
+                "_id": 0,
+                "daily_earnings": "$daily_totals"  # Array of 7 daily sums (pad with 0 if <7 days)
+            }}
+        ]).to_list(None)
+
+        # Pad to 7 days if fewer (assume 0 for missing days)
+        daily_result = daily_agg[0] if daily_agg else {"daily_earnings": [0.0] * 7}
+        daily_earnings = daily_result.get("daily_earnings", [0.0] * 7)
+        # Convert each to preferred currency
+        daily_earnings_converted = [round(d * rate, 2) for d in daily_earnings]
+        
+        weekly_breakdown = {}
+        if weekly_breakdown_agg:
+            data = weekly_breakdown_agg[0]
+            total = data['total']
+            for item in data['breakdown']:
+                weekly_breakdown[item['type']] = float(item['earnings'])
+            weekly_earnings = total
+        else:
+            weekly_earnings = 0.0
+            weekly_breakdown = {
+                "task": 0.0,
+                "referral_reward": 0.0,
+                "spin_and_win": 0.0,
+                "binary_commission": 0.0
+            }
+        
+        # Prepare response
+        response = {
+            "success": True,
+            "currency": preferred,
+            "user": {
+                "full_name": current_user['full_name'],
+                "wallet_balance": convert_amount(current_user['wallet_balance']),
+                "is_activated": current_user['is_activated'],
+                "activation_amount": convert_amount(current_user.get('activation_amount', 300.0)),
+                "activation_expense": convert_amount(current_user.get('activation_expense', 0.0)),
+                "activation_reward": convert_amount(current_user.get('activation_reward', 0.0)),
+                "net_activation": convert_amount(current_user.get('activation_reward', 0.0) - current_user.get('activation_expense', 0.0)),
+                "total_earned": convert_amount(current_user.get('total_earned', 0.0)),
+                "total_withdrawn": convert_amount(current_user.get('total_withdrawn', 0.0)),
+                "referral_earnings": convert_amount(current_user.get('referral_earnings', 0.0)),
+                "task_earnings": convert_amount(current_user.get('task_earnings', 0.0)),
+                "binary_earnings": convert_amount(current_user.get('binary_earnings', 0.0)),
+                "profit": convert_amount(current_user.get('total_earned', 0.0) - current_user.get('activation_expense', 0.0)),
+                "left_leg_size": current_user.get('left_leg_size', 0),
+                "right_leg_size": current_user.get('right_leg_size', 0),
+                "referral_count": current_user.get('referral_count', 0),
+                "referral_code": current_user['referral_code'],
+                "referral_tier": tier,
+                "role": current_user.get('role', 'user'),
+                "has_spun_once": current_user.get('has_spun_once', False),
+                "team_earnings": convert_amount(current_user.get('team_earnings', 0.0))
+            },
+            "analytics": {
+                "weekly_earnings": weekly_earnings,
+                "weekly_breakdown": weekly_breakdown,
+                "daily_earnings": daily_earnings_converted,  # Array for bar graph: [day1, day2, ..., day7] in preferred_currency
+                "referrals": json_serializable_doc(referral_stats),
+                "tasks": {
+                    "completed": next(
+                        (t['count'] for t in tasks if t['_id'] == "completed"), 0),
+                    "pending": next(
+                        (t['count'] for t in tasks if t['_id'] == "pending"), 0),
+                    "total_earnings": convert_amount(next(
+                        (float(t['total_earnings']) for t in tasks if t['_id'] == "completed"), 0.0))
+                },
+                "weekly_growth_percentage": weekly_growth_percentage  # % growth in referrals over last week
+            },
+            "activity": {
+                "transactions": json_serializable_doc(transactions),
+                "notifications": json_serializable_doc(notifications),
+                "unread_notifications": unread_notifications
+            },
+            "quick_actions": generate_quick_actions(current_user, rate, preferred)
+        }
+        
+        # Add display fields to transactions
+        for txn in response["activity"]["transactions"]:
+            if 'amount' in txn:
+                txn['display_amount'] = convert_amount(float(txn['amount']))
+                txn['display_currency'] = preferred
+        
+        return response
+        
+    except Exception as e:
+        logging.error(f"Failed to load dashboard for user {user_id}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to load dashboard: {str(e)}"
+        )
+
+@router.get("/api/transactions/history")
+async def get_transaction_history(
+    type_filter: str = Query("all", description="Filter by type: deposit, withdrawal, or all"),
+    status_filter: Optional[str] = Query(None, description="Filter by status: pending, completed, failed"),
+    page: int = Query(1, ge=1, description="Page number"),
+    limit: int = Query(10, ge=1, le=50, description="Number of transactions per page"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get paginated transaction history for the user.
+    Supports filtering by type (deposit, withdrawal, all) and status.
+    Returns transactions with date, status, method, amount, etc.
+    """
+    user_id = current_user['user_id']
+    skip = (page - 1) * limit
+    
+    # Build query
+    query = {"user_id": user_id}
+    if type_filter != "all":
+        query["type"] = type_filter
+    if status_filter:
+        query["status"] = status_filter
+    
+    # Count total for pagination
+    total = await db.transactions.count_documents(query)
+    
+    # Fetch transactions, sorted by completed_at desc (or created_at if no completed_at)
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"completed_at": -1, "created_at": -1}},
+        {"$skip": skip},
+        {"$limit": limit},
+        {
+            "$project": {
+                "_id": 0,
+                "id": "$transaction_id",
+                "date": {
+                    "$ifNull": ["$completed_at", "$created_at"]
+                },
+                "status": 1,
+                "method": 1,
+                "amount": 1,
+                "currency": 1,
+                "type": 1,
+                "description": 1,
+                "phone": 1,
+                "email": 1  # For PayPal
+            }
+        }
+    ]
+    transactions = await db.transactions.aggregate(pipeline).to_list(limit)
+    
+    # Serialize dates and IDs
+    transactions = json_serializable_doc(transactions)
+    
+    return {
+        "success": True,
+        "transactions": transactions,
+        "pagination": {
+            "page": page,
+            "limit": limit,
+            "total": total,
+            "pages": (total + limit - 1) // limit if total > 0 else 0
+        },
+        "filters": {
+            "type": type_filter,
+            "status": status_filter
+        }
+    }
+
+@router.put("/api/settings/theme")
+async def update_theme(theme: str, current_user: dict = Depends(get_current_user)):
+    if theme not in ['light', 'dark']:
+        raise HTTPException(status_code=400, detail="Invalid theme")
+    
+    await db.users.update_one(
+        {"user_id": current_user['user_id']},
+        {"$set": {"theme": theme}}
+    )
+    logging.info(f"User {current_user['user_id']} updated theme to {theme}")
+    return {"success": True, "message": f"Theme updated to {theme}"}
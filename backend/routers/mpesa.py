@@ -0,0 +1,483 @@
+"""
+M-Pesa routes: STK push deposits, and the STK callback Safaricom posts to.
+"""
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import JSONResponse
+import uuid
+from datetime import datetime, timedelta
+import json
+import httpx
+import re
+import logging
+from log_pipeline import log_payload
+
+from server import (
+    BACKEND_URL,
+    DepositRequest,
+    MPESA_BASE_URL,
+    MPESA_LIPA_NA_MPESA_SHORTCODE,
+    NotificationBuffer,
+    bump_platform_counters,
+    commit_transaction,
+    count_completed_transaction,
+    create_notification,
+    db,
+    gateway_request,
+    generate_mpesa_password,
+    get_current_user,
+    get_mpesa_access_token,
+    mongo_client,
+    process_referral_reward,
+    publish_wallet_delta,
+    rate_limit,
+    record_gateway_event,
+    trigger_binary_commissions,
+)
+
+router = APIRouter(tags=["mpesa"])
+callbacks = APIRouter(tags=["mpesa callbacks"])
+
+@router.post("/api/payments/deposit", dependencies=[Depends(rate_limit("deposit", scope="mpesa"))])
+async def initiate_deposit(
+    deposit_data: DepositRequest, 
+    current_user: dict = Depends(get_current_user),
+    request: Request = None
+):
+    """
+    Initiates an M-Pesa STK Push deposit.
+    """
+    try:
+        # Validate phone number format
+        if not re.match(r'^254\d{9}$', deposit_data.phone):
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid phone format. Use 254 followed by 9 digits (e.g., 254712345678)"
+            )
+
+        # Validate amount
+        amount_float = deposit_data.amount
+        if not (10.00 <= amount_float <= 150000.00):
+            raise HTTPException(
+                status_code=400,
+                detail="Amount must be between KSH 10 and KSH 150,000"
+            )
+
+        # Check for duplicate pending transactions
+        existing_txn = await db.transactions.find_one({
+            "user_id": current_user['user_id'],
+            "phone": deposit_data.phone,
+            "amount": str(amount_float),
+            "status": "pending",
+            "created_at": {"$gt": datetime.utcnow() - timedelta(minutes=15)}
+        })
+
+        if existing_txn:
+            raise HTTPException(
+                status_code=400,
+                detail="Duplicate transaction detected. Please wait for previous request to complete."
+            )
+
+        # Prepare M-Pesa request
+        transaction_id = str(uuid.uuid4())
+        access_token = await get_mpesa_access_token()
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        password = await generate_mpesa_password(timestamp)
+
+        stk_payload = {
+            "BusinessShortCode": MPESA_LIPA_NA_MPESA_SHORTCODE,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": int(amount_float),
+            "PartyA": deposit_data.phone,
+            "PartyB": MPESA_LIPA_NA_MPESA_SHORTCODE,
+            "PhoneNumber": deposit_data.phone,
+            "CallBackURL": f"{BACKEND_URL}/api/payments/mpesa-callback", 
+            "AccountReference": f"USER-{current_user['user_id']}",
+            "TransactionDesc": f"Deposit for {current_user['email']}"
+        }
+
+        # Create transaction record first
+        transaction_doc = {
+            "transaction_id": transaction_id,
+            "user_id": current_user['user_id'],
+            "type": "deposit",
+            "amount": str(amount_float),
+            "currency": "KES",
+            "phone": deposit_data.phone,
+            "status": "pending",
+            "method": "mpesa",
+            "ip_address": request.client.host if request else None,
+            "device_fingerprint": request.headers.get("User-Agent", ""),
+            "payment_details": { 
+                "mpesa": {
+                    "checkout_request_id": None,
+                    "receipt_number": None
+                }
+            },
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+
+        # Atomic operation
+        async with await mongo_client.start_session() as session:
+            try:
+                async with session.start_transaction():
+                    # Insert transaction first
+                    await db.transactions.insert_one(
+                        transaction_doc,
+                        session=session
+                    )
+
+                    request_event_id = await record_gateway_event(
+                        "mpesa", "stk_push_request", stk_payload, transaction_id=transaction_id, session=session
+                    )
+
+                    # Make M-Pesa API call
+                    headers = {
+                        "Authorization": f"Bearer {access_token}",
+                        "Content-Type": "application/json"
+                    }
+                    
+                    response = await gateway_request(
+                        "mpesa", "POST",
+                        f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest",
+                        transaction_id=transaction_id,
+                        marks_side_effect=True,
+                        json=stk_payload,
+                        headers=headers
+                    )
+                    response.raise_for_status()
+                    mpesa_data = response.json()
+                    response_event_id = await record_gateway_event(
+                        "mpesa", "stk_push_response", mpesa_data, transaction_id=transaction_id, session=session
+                    )
+
+                    if mpesa_data.get("ResponseCode") != "0":
+                        # M-Pesa initiated failed, update transaction status
+                        await db.transactions.update_one(
+                            {"transaction_id": transaction_id},
+                            {
+                                "$set": {
+                                    "status": "failed",
+                                    "completed_at": datetime.utcnow(),
+                                    "error_message": mpesa_data.get("CustomerMessage", "M-Pesa request failed at initiation")
+                                },
+                                "$push": {"gateway_event_ids": {"$each": [request_event_id, response_event_id]}}
+                            },
+                            session=session
+                        )
+                        raise HTTPException(
+                            status_code=400,
+                            detail=mpesa_data.get("CustomerMessage", "M-Pesa request failed")
+                        )
+
+                    # Update transaction with checkout ID
+                    await db.transactions.update_one(
+                        {"transaction_id": transaction_id},
+                        {
+                            "$set": {
+                                "payment_details.mpesa.checkout_request_id": mpesa_data.get("CheckoutRequestID")
+                            },
+                            "$push": {"gateway_event_ids": {"$each": [request_event_id, response_event_id]}}
+                        },
+                        session=session
+                    )
+
+                    await commit_transaction(session)
+
+                    # Return success response
+                    return {
+                        "success": True,
+                        "message": f"Payment request of KSH {deposit_data.amount} sent to {deposit_data.phone}",
+                        "transaction_id": transaction_id,
+                        "checkout_request_id": mpesa_data.get("CheckoutRequestID"),
+                        "user_message": mpesa_data.get("CustomerMessage")
+                    }
+
+            except HTTPException:
+                if session.in_transaction:
+                    await session.abort_transaction()
+                raise
+
+            except httpx.HTTPStatusError as e:
+                await session.abort_transaction()
+                logging.error("M-Pesa API Error: %s - %s", e.response.status_code, log_payload(e.response.text))
+                raise HTTPException(
+                    status_code=502,
+                    detail="Payment service temporarily unavailable"
+                )
+
+            except Exception as e:
+                await session.abort_transaction()
+                logging.error(f"Deposit processing error: {str(e)}", exc_info=True)
+                raise HTTPException(
+                    status_code=500,
+                    detail="Failed to process payment request"
+                )
+
+    except HTTPException:
+        raise  
+    except Exception as e:
+        logging.critical(f"Unexpected error in deposit: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An unexpected error occurred"
+        )
+
+@callbacks.post("/api/payments/mpesa-callback")
+async def mpesa_callback(request: Request):
+    """
+    M-Pesa Callback Handler
+    """
+    try:
+        data = await request.json()
+        logging.info("MPesa Callback Received: %s", log_payload(data))
+
+        if not data.get("Body", {}).get("stkCallback"):
+            logging.error("Invalid M-Pesa callback format: Missing Body.stkCallback")
+            return JSONResponse(
+                {"ResultCode": 1, "ResultDesc": "Invalid callback format"},
+                status_code=400
+            )
+
+        callback = data["Body"]["stkCallback"]
+        
+        checkout_id = callback.get("CheckoutRequestID")
+        result_code = int(callback.get("ResultCode", 1))
+        result_desc = callback.get("ResultDesc", "Unknown error")
+
+        if not checkout_id:
+            logging.error("Missing CheckoutRequestID in M-Pesa callback: %s", log_payload(callback))
+            return JSONResponse(
+                {"ResultCode": 1, "ResultDesc": "Missing CheckoutRequestID"},
+                status_code=400
+            )
+
+        async with await mongo_client.start_session() as session:
+            try:
+                async with session.start_transaction():
+                    notifications = NotificationBuffer(db)
+                    # Find transaction
+                    transaction = await db.transactions.find_one(
+                        {
+                            "payment_details.mpesa.checkout_request_id": checkout_id,
+                            "status": "pending"
+                        },
+                        session=session
+                    )
+
+                    if not transaction:
+                        logging.warning(f"Transaction not found or already processed for CheckoutRequestID: {checkout_id}")
+                        await notifications.flush(session=session)
+                        await commit_transaction(session)
+                        return JSONResponse(
+                            {"ResultCode": 0, "ResultDesc": "Transaction not found or already processed"}
+                        )
+
+                    callback_event_id = await record_gateway_event(
+                        "mpesa", "stk_callback", data, transaction_id=transaction["transaction_id"], session=session
+                    )
+
+                    # Handle success/failure
+                    if result_code == 0:  # Success
+                        metadata_items = callback.get("CallbackMetadata", {}).get("Item", [])
+                        metadata = {item["Name"]: item["Value"] for item in metadata_items if "Name" in item}
+                        
+                        callback_amount_raw = metadata.get("Amount")
+                        mpesa_receipt_number = metadata.get("MpesaReceiptNumber")
+                        phone_number = metadata.get("PhoneNumber")
+
+                        if not callback_amount_raw or not mpesa_receipt_number or not phone_number:
+                            logging.error("Missing essential metadata for successful M-Pesa callback: %s", log_payload(callback))
+                            await db.transactions.update_one(
+                                {"_id": transaction["_id"]},
+                                {
+                                    "$set": {
+                                        "status": "failed",
+                                        "completed_at": datetime.utcnow(),
+                                        "metadata.error": "Missing essential callback metadata"
+                                    },
+                                    "$push": {"gateway_event_ids": callback_event_id}
+                                },
+                                session=session
+                            )
+                            await create_notification(
+                                {
+                                    "title": "Deposit Failed (Data Missing)",
+                                    "message": f"Your deposit of KES {transaction['amount']} failed due to missing transaction details. Contact support.",
+                                    "user_id": transaction["user_id"],
+                                    "type": "payment"
+                                },
+                                session=session,
+                                db_instance=db,
+                                buffer=notifications
+                            )
+                            await notifications.flush(session=session)
+                            await commit_transaction(session)
+                            return JSONResponse({"ResultCode": 1, "ResultDesc": "Missing callback metadata"})
+
+                        callback_amount = float(callback_amount_raw)
+                        
+                        # Ensure the amounts match to prevent fraud
+                        if not (float(transaction["amount"]) - 0.01 <= callback_amount <= float(transaction["amount"]) + 0.01):
+                            logging.warning(f"Amount mismatch for {checkout_id}. Expected {transaction['amount']}, got {callback_amount}. Marking as failed.")
+                            await db.transactions.update_one(
+                                {"_id": transaction["_id"]},
+                                {
+                                    "$set": {
+                                        "status": "failed",
+                                        "completed_at": datetime.utcnow(),
+                                        "metadata.error": "Amount mismatch"
+                                    },
+                                    "$push": {"gateway_event_ids": callback_event_id}
+                                },
+                                session=session
+                            )
+                            await create_notification(
+                                {
+                                    "title": "Deposit Failed (Amount Mismatch)",
+                                    "message": f"Your deposit of KES {transaction['amount']} failed due to amount mismatch.",
+                                    "user_id": transaction["user_id"],
+                                    "type": "payment"
+                                },
+                                session=session,
+                                db_instance=db,
+                                buffer=notifications
+                            )
+                            await notifications.flush(session=session)
+                            await commit_transaction(session)
+                            return JSONResponse({"ResultCode": 1, "ResultDesc": "Amount Mismatch"})
+
+
+                        amount_to_credit = callback_amount
+
+                        # Update transaction
+                        await db.transactions.update_one(
+                            {"_id": transaction["_id"]},
+                            {
+                                "$set": {
+                                    "status": "completed",
+                                    "completed_at": datetime.utcnow(),
+                                    "payment_details.mpesa.receipt_number": mpesa_receipt_number,
+                                    "amount": str(amount_to_credit),
+                                    "phone": phone_number
+                                },
+                                "$push": {"gateway_event_ids": callback_event_id}
+                            },
+                            session=session
+                        )
+                        await count_completed_transaction(transaction, amount=amount_to_credit, session=session)
+
+                        # Update user balance and total earned
+                        user = await db.users.find_one({"user_id": transaction["user_id"]}, session=session)
+                        if user:
+                            current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                            new_wallet_balance = current_wallet_balance + amount_to_credit
+                            current_total_earned = float(user.get('total_earned', '0.0'))
+                            new_total_earned = current_total_earned + amount_to_credit
+
+                            await db.users.update_one(
+                                {"user_id": transaction["user_id"]},
+                                {
+                                    "$set": {
+                                        "wallet_balance": str(new_wallet_balance),
+                                        "total_earned": str(new_total_earned),
+                                        "payment_methods.mpesa.phone": phone_number,
+                                        "payment_methods.mpesa.verified": True
+                                    }
+                                },
+                                session=session
+                            )
+                            await publish_wallet_delta(transaction["user_id"], amount_to_credit, new_wallet_balance, "deposit", session=session)
+                        user = await db.users.find_one({"user_id": transaction["user_id"]}, session=session)
+
+                        # Check activation and process referrals
+                        if user and not user["is_activated"] and float(user["wallet_balance"]) >= float(user["activation_amount"]):
+                            await db.users.update_one(
+                                {"user_id": user["user_id"]},
+                                {"$set": {"is_activated": True}},
+                                session=session
+                            )
+                            await bump_platform_counters(session=session, activated_users=1)
+                            logging.info(f"User {user['user_id']} activated via M-Pesa deposit.")
+                            
+                            # Trigger binary commissions
+                            await trigger_binary_commissions(user["user_id"], session=session, notifications=notifications)
+                            
+                            if user.get("referred_by"):
+                                await process_referral_reward(
+                                    referred_id=user["user_id"],
+                                    referrer_id=user["referred_by"],
+                                    session=session,
+                                    notifications=notifications
+                                )
+
+                        # Create notification
+                        await create_notification(
+                            {
+                                "title": "Deposit Received",
+                                "message": f"KES {amount_to_credit:,.2f} deposited to your account. Receipt: {mpesa_receipt_number}",
+                                "user_id": transaction["user_id"],
+                                "type": "payment"
+                            },
+                            session=session,
+                            db_instance=db,
+                            buffer=notifications
+                        )
+
+                        logging.info(f"✅ Successful M-Pesa deposit: {transaction['user_id']} - KES {amount_to_credit}")
+
+                    else:  # Failure or Cancellation
+                        await db.transactions.update_one(
+                            {"_id": transaction["_id"]},
+                            {
+                                "$set": {
+                                    "status": "failed",
+                                    "completed_at": datetime.utcnow(),
+                                    "error_message": result_desc
+                                },
+                                "$push": {"gateway_event_ids": callback_event_id}
+                            },
+                            session=session
+                        )
+
+                        await create_notification(
+                            {
+                                "title": "Deposit Failed",
+                                "message": f"M-Pesa deposit of KES {transaction['amount']} failed: {result_desc}",
+                                "user_id": transaction["user_id"],
+                                "type": "payment"
+                            },
+                            session=session,
+                            db_instance=db,
+                            buffer=notifications
+                        )
+
+                        logging.warning(f"❌ Failed M-Pesa deposit: {transaction['user_id']} - {result_desc}")
+
+                    await notifications.flush(session=session)
+                    await commit_transaction(session)
+
+            except Exception as e:
+                await session.abort_transaction()
+                logging.error(f"Error in M-Pesa callback transaction for CheckoutRequestID {checkout_id}: {str(e)}", exc_info=True)
+                return JSONResponse(
+                    {"ResultCode": 1, "ResultDesc": "Internal Server Error"},
+                    status_code=500 
+                )
+
+        return JSONResponse({"ResultCode": 0, "ResultDesc": "Success"}) 
+
+    except json.JSONDecodeError:
+        logging.error("Invalid JSON received in M-Pesa callback")
+        return JSONResponse(
+            {"ResultCode": 1, "ResultDesc": "Invalid JSON"},
+            status_code=400
+        )
+    except Exception as e:
+        logging.critical(f"Critical error processing M-Pesa callback: {str(e)}", exc_info=True)
+        return JSONResponse(
+            {"ResultCode": 1, "ResultDesc": "Internal server error"},
+            status_code=500
+        )
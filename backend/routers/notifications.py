@@ -0,0 +1,169 @@
+"""
+Notification routes and the live event stream.
+"""
+from fastapi import APIRouter, HTTPException, Depends, Request, Query
+from fastapi.responses import StreamingResponse
+from pymongo.errors import DuplicateKeyError
+from typing import Optional
+from datetime import datetime
+import asyncio
+import json
+from bson import ObjectId
+import logging
+
+from server import (
+    LIVE_EVENTS_HEARTBEAT_SECONDS,
+    NotificationCreate,
+    create_notification,
+    db,
+    fetch_user_notifications,
+    get_current_admin_user,
+    get_current_user,
+    get_unread_notification_count,
+    json_serializable_doc,
+    live_event_hub,
+    verify_jwt_token,
+)
+
+router = APIRouter(tags=["notifications"])
+
+@router.post("/api/notifications/create")
+async def create_notification_endpoint(notification_data: NotificationCreate, current_user: dict = Depends(get_current_admin_user)): 
+    """Admin endpoint to create notifications"""
+    await create_notification(notification_data.dict(), db_instance=db)
+    return {"success": True, "message": "Notification created"}
+
+@router.get("/api/notifications")
+async def get_notifications(current_user: dict = Depends(get_current_user)):
+    # Fetch notifications for the specific user AND broadcast notifications
+    notifications, unread_count = await asyncio.gather(
+        fetch_user_notifications(current_user['user_id'], 20),
+        get_unread_notification_count(current_user['user_id'])
+    )
+    return {"success": True, "notifications": json_serializable_doc(notifications), "unread_count": unread_count}
+
+@router.get("/api/notifications/unread-count")
+async def get_notifications_unread_count(current_user: dict = Depends(get_current_user)):
+    return {"success": True, "unread_count": await get_unread_notification_count(current_user['user_id'])}
+
+@router.put("/api/notifications/read-all")
+async def mark_all_notifications_read(current_user: dict = Depends(get_current_user)):
+    """Marks every personal notification read and moves the broadcast read cursor to now."""
+    user_id = current_user['user_id']
+    now = datetime.utcnow()
+    await db.notifications.update_many({"user_id": user_id, "is_read": False}, {"$set": {"is_read": True, "read_at": now}})
+    broadcasts = await db.notification_counters.find_one({"_id": "broadcasts"})
+    await db.notification_state.update_one(
+        {"_id": user_id},
+        {"$set": {
+            "unread": 0,
+            "broadcasts_read": broadcasts.get("total", 0) if broadcasts else 0,
+            "broadcasts_read_through": now,
+            "initialized": True
+        }},
+        upsert=True
+    )
+    logging.info(f"All notifications marked as read by user {user_id}")
+    return {"success": True, "message": "All notifications marked as read"}
+
+@router.put("/api/notifications/{notification_id}/read")
+async def mark_notification_read(notification_id: str, current_user: dict = Depends(get_current_user)):
+    try:
+        object_id_to_find = ObjectId(notification_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid notification ID format")
+
+    user_id = current_user['user_id']
+    result = await db.notifications.update_one(
+        {"_id": object_id_to_find, "user_id": user_id, "is_read": False},
+        {"$set": {"is_read": True, "read_at": datetime.utcnow()}}
+    )
+    if result.modified_count:
+        await db.notification_state.update_one({"_id": user_id, "unread": {"$gt": 0}}, {"$inc": {"unread": -1}})
+        logging.info(f"Notification {notification_id} marked as read by user {user_id}")
+        return {"success": True, "message": "Notification marked as read"}
+
+    notification = await db.notifications.find_one({"_id": object_id_to_find}, {"user_id": 1})
+    if notification:
+        # Ensure the user has access to mark this notification as read
+        if notification['user_id'] != user_id:
+            raise HTTPException(status_code=403, detail="Not authorized to mark this notification as read")
+        return {"success": True, "message": "Notification marked as read"}
+
+    broadcast = await db.broadcast_notifications.find_one({"_id": object_id_to_find}, {"notification_id": 1, "created_at": 1})
+    if not broadcast:
+        raise HTTPException(status_code=404, detail="Notification not found")
+
+    state = await db.notification_state.find_one({"_id": user_id}, {"broadcasts_read_through": 1})
+    read_through = (state or {}).get("broadcasts_read_through")
+    if not (read_through and broadcast["created_at"] <= read_through):
+        try:
+            await db.notification_receipts.insert_one({
+                "user_id": user_id,
+                "notification_id": broadcast["notification_id"],
+                "read_at": datetime.utcnow()
+            })
+            await db.notification_state.update_one({"_id": user_id}, {"$inc": {"broadcasts_read": 1}}, upsert=True)
+        except DuplicateKeyError:
+            pass  # Already read
+
+    logging.info(f"Broadcast notification {notification_id} marked as read by user {user_id}")
+    return {"success": True, "message": "Notification marked as read"}
+
+@router.get("/api/events/stream")
+async def stream_live_events(request: Request, token: Optional[str] = Query(None)):
+    """
+    Server-Sent Events stream of the user's new notifications and wallet changes.
+    EventSource cannot send headers, so the JWT may also be passed as ?token=.
+    Starts with a snapshot (balance, unread count); a `resync` event means events
+    were dropped and the client should refetch.
+    """
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else (auth or token)
+    if not token:
+        raise HTTPException(status_code=401, detail="No token provided")
+    user_id = verify_jwt_token(token)['user_id']
+
+    user = await db.users.find_one({"user_id": user_id}, {"wallet_balance": 1})
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    try:
+        queue = live_event_hub.subscribe(user_id)
+    except OverflowError:
+        raise HTTPException(status_code=503, detail="Live updates are busy. Please try again shortly.", headers={"Retry-After": "10"})
+
+    # Subscribed first so nothing published while the snapshot is built is missed
+    try:
+        snapshot = {
+            "balance": round(float(user.get("wallet_balance", "0.0")), 2),
+            "currency": "KES",
+            "unread_count": await get_unread_notification_count(user_id)
+        }
+    except BaseException:
+        # The stream never starts, so its finally would not unsubscribe
+        live_event_hub.unsubscribe(user_id, queue)
+        raise
+
+    def format_event(event_id, event_type: str, data: dict) -> str:
+        return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    async def event_stream():
+        try:
+            yield f"retry: 5000\n{format_event(0, 'snapshot', snapshot)}"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=LIVE_EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event["id"], event["type"], event["data"])
+        finally:
+            live_event_hub.unsubscribe(user_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,121 @@
+"""
+PayPal routes: order creation for deposits.
+"""
+from fastapi import APIRouter, HTTPException, Depends
+import uuid
+from datetime import datetime
+import httpx
+import logging
+from log_pipeline import log_payload
+
+from server import (
+    BASE_URL,
+    PAYPAL_BASE_URL,
+    PAYPAL_CURRENCY,
+    PayPalDepositRequest,
+    db,
+    gateway_request,
+    get_current_user,
+    get_paypal_access_token,
+    rate_limit,
+    record_gateway_event,
+)
+
+router = APIRouter(tags=["paypal"])
+
+@router.post("/api/payments/paypal/create-order", dependencies=[Depends(rate_limit("deposit", scope="paypal"))])
+async def create_paypal_order_endpoint(
+    deposit_data: PayPalDepositRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create a PayPal order for deposit"""
+    try:
+        user_id = current_user['user_id']
+        # Convert KES to USD
+        KSH_TO_USD_RATE = 0.0077 
+        amount_float = deposit_data.amount
+        usd_amount = round(amount_float * KSH_TO_USD_RATE, 2)
+        
+        # Validate amount
+        if usd_amount < 1.00: 
+            raise HTTPException(status_code=400, detail="Minimum PayPal deposit is KSH 150 (approx. $1 USD)")
+        
+        headers = {
+            "Authorization": f"Bearer {await get_paypal_access_token()}",
+            "Content-Type": "application/json",
+            "Prefer": "return=representation"
+        }
+        
+        payload = {
+            "intent": "CAPTURE",
+            "purchase_units": [{
+                "reference_id": user_id,
+                "description": f"Deposit to EarnPlatform from {current_user['email']}",
+                "amount": {
+                    "currency_code": PAYPAL_CURRENCY,
+                    "value": f"{usd_amount:.2f}"
+                }
+            }],
+            "application_context": {
+                "return_url": f"{BASE_URL}/pages/success/?paypal_return=success", 
+                "cancel_url": f"{BASE_URL}/pages/failure/?paypal_return=cancel",
+                "brand_name": "EarnPlatform",
+                "user_action": "PAY_NOW",
+                "shipping_preference": "NO_SHIPPING"
+            }
+        }
+        
+        paypal_url = f"{PAYPAL_BASE_URL}/v2/checkout/orders"
+        response = await gateway_request("paypal", "POST", paypal_url, marks_side_effect=True, headers=headers, json=payload)
+        response.raise_for_status()
+        order = response.json()
+        
+        # Create transaction record
+        transaction_id = str(uuid.uuid4())
+
+        transaction_doc = {
+            "transaction_id": transaction_id,
+            "user_id": user_id,
+            "type": "deposit",
+            "amount": str(amount_float),
+            "currency": "KES",
+            "converted_amount": str(usd_amount),
+            "converted_currency": PAYPAL_CURRENCY,
+            "status": "pending",
+            "method": "paypal",
+            "payment_details": { 
+                "paypal_order_id": order['id']
+            },
+            "gateway_event_ids": [
+                await record_gateway_event("paypal", "create_order_response", order, transaction_id=transaction_id)
+            ],
+            "created_at": datetime.utcnow(),
+            "completed_at": None
+        }
+        await db.transactions.insert_one(transaction_doc)
+        
+        # Find the approval link
+        approval_link = next(
+            (link['href'] for link in order['links'] if link['rel'] == 'approve'),
+            None
+        )
+        
+        if not approval_link:
+            raise HTTPException(status_code=500, detail="No approval link found in PayPal response")
+        
+        logging.info(f"PayPal order created for user {user_id}, amount KES {deposit_data.amount}. Order ID: {order['id']}")
+        return {
+            "success": True,
+            "message": "PayPal order created",
+            "order_id": order['id'],
+            "approval_url": approval_link,
+            "transaction_id": transaction_id
+        }
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        logging.error("PayPal create order HTTP error: %s - %s", e.response.status_code, log_payload(e.response.text), exc_info=True)
+        raise HTTPException(status_code=e.response.status_code, detail=f"PayPal order creation failed: {e.response.text}")
+    except Exception as e:
+        logging.error(f"PayPal order creation error for user {current_user['user_id']}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Could not create PayPal order: {str(e)}")
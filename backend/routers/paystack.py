@@ -0,0 +1,248 @@
+"""
+Paystack routes: deposit initialization, and the webhook Paystack posts to.
+"""
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import JSONResponse
+import uuid
+from datetime import datetime
+import httpx
+import logging
+from log_pipeline import log_payload
+
+from server import (
+    BASE_URL,
+    NotificationBuffer,
+    PAYSTACK_BASE_URL,
+    PAYSTACK_SECRET_KEY,
+    PaystackDepositRequest,
+    bump_platform_counters,
+    count_completed_transaction,
+    create_notification,
+    db,
+    gateway_request,
+    get_current_user,
+    process_referral_reward,
+    publish_wallet_delta,
+    rate_limit,
+    record_gateway_event,
+    trigger_binary_commissions,
+)
+
+router = APIRouter(tags=["paystack"])
+callbacks = APIRouter(tags=["paystack callbacks"])
+
+# Paystack payment initialization endpoint
+@router.post("/api/payments/paystack/deposit", dependencies=[Depends(rate_limit("deposit", scope="paystack"))])
+async def initiate_paystack_deposit(
+    deposit_data: PaystackDepositRequest,
+    current_user: dict = Depends(get_current_user),
+    request: Request = None
+):
+    """
+    Initiates a Paystack payment.
+    """
+    try:
+        amount_kobo = int(deposit_data.amount * 100)  # Paystack expects amount in kobo
+        email = deposit_data.email
+
+        # Create unique transaction ID
+        transaction_id = str(uuid.uuid4())
+
+        # Prepare Paystack initialization payload
+        paystack_payload = {
+            "email": email,
+            "amount": amount_kobo,
+            "callback_url": f"{BASE_URL}/pages/success?payment=paystack&status=completed",
+            "metadata": {
+                "user_id": current_user['user_id'],
+                "transaction_id": transaction_id
+            }
+        }
+
+        headers = {
+            "Authorization": f"Bearer {PAYSTACK_SECRET_KEY}",
+            "Content-Type": "application/json"
+        }
+
+        response = await gateway_request(
+            "paystack", "POST",
+            f"{PAYSTACK_BASE_URL}/transaction/initialize",
+            transaction_id=transaction_id,
+            marks_side_effect=True,
+            json=paystack_payload,
+            headers=headers
+        )
+        response.raise_for_status()
+        data = response.json()
+
+        if not data.get("status") or not data.get("data"):
+            raise HTTPException(status_code=500, detail="Failed to initialize Paystack transaction")
+
+        authorization_url = data["data"].get("authorization_url")
+        paystack_reference = data["data"].get("reference")
+
+        if not authorization_url or not paystack_reference:
+            raise HTTPException(status_code=500, detail="Invalid Paystack response")
+
+        # Create transaction record
+        transaction_doc = {
+            "transaction_id": transaction_id,
+            "user_id": current_user['user_id'],
+            "type": "deposit",
+            "amount": str(deposit_data.amount),
+            "currency": "KES",  # Changed to KES for consistency with other endpoints
+            "email": email,
+            "status": "pending",
+            "method": "paystack",
+            "payment_details": {
+                "paystack_reference": paystack_reference,
+                "authorization_url": authorization_url
+            },
+            "gateway_event_ids": [
+                await record_gateway_event("paystack", "initialize_response", data, transaction_id=transaction_id)
+            ],
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+
+        await db.transactions.insert_one(transaction_doc)
+
+        return {
+            "success": True,
+            "message": "Paystack payment initialized",
+            "authorization_url": authorization_url,
+            "transaction_id": transaction_id
+        }
+
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        logging.error("Paystack initialization HTTP error: %s - %s", e.response.status_code, log_payload(e.response.text))
+        raise HTTPException(status_code=502, detail="Payment service temporarily unavailable")
+    except Exception as e:
+        logging.error(f"Paystack initialization error: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Failed to initialize Paystack payment")
+
+@callbacks.post("/api/payments/paystack/webhook")
+async def paystack_webhook(request: Request):
+    """
+    Handles Paystack webhook events.
+    """
+    try:
+        # Verify Paystack signature
+        paystack_signature = request.headers.get("x-paystack-signature")
+        body = await request.body()
+
+        import hmac
+        import hashlib
+
+        secret = PAYSTACK_SECRET_KEY.encode()
+        computed_signature = hmac.new(secret, body, hashlib.sha512).hexdigest()
+
+        if computed_signature != paystack_signature:
+            logging.warning("Invalid Paystack webhook signature")
+            return JSONResponse(status_code=400, content={"message": "Invalid signature"})
+
+        payload = await request.json()
+        event = payload.get("event")
+        data = payload.get("data", {})
+
+        if event == "charge.success":
+            reference = data.get("reference")
+            amount = data.get("amount")  # in kobo
+            email = data.get("customer", {}).get("email")
+            metadata = data.get("metadata", {})
+            user_id = metadata.get("user_id")
+            transaction_id = metadata.get("transaction_id")
+
+            if not reference or not user_id or not transaction_id:
+                logging.error("Missing reference or user_id or transaction_id in Paystack webhook")
+                return JSONResponse(status_code=400, content={"message": "Missing data"})
+
+            # Find transaction
+            transaction = await db.transactions.find_one({"transaction_id": transaction_id, "status": "pending", "payment_details.paystack_reference": reference})
+
+            if not transaction:
+                logging.warning(f"Transaction not found or already processed for Paystack reference: {reference}")
+                return JSONResponse(status_code=200, content={"message": "Transaction not found or already processed"})
+
+            amount_float = amount / 100.0  # convert kobo to ksh
+
+            webhook_event_id = await record_gateway_event("paystack", "webhook", payload, transaction_id=transaction_id)
+
+            # Update transaction status
+            await db.transactions.update_one(
+                {"_id": transaction["_id"]},
+                {
+                    "$set": {
+                        "status": "completed",
+                        "completed_at": datetime.utcnow(),
+                        "amount": str(amount_float),
+                        "email": email
+                    },
+                    "$push": {"gateway_event_ids": webhook_event_id}
+                }
+            )
+            await count_completed_transaction(transaction, amount=amount_float)
+
+            # Update user wallet balance and total earned
+            user = await db.users.find_one({"user_id": user_id})
+            if user:
+                current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                new_wallet_balance = current_wallet_balance + amount_float
+                current_total_earned = float(user.get('total_earned', '0.0'))
+                new_total_earned = current_total_earned + amount_float
+
+                await db.users.update_one(
+                    {"user_id": user_id},
+                    {
+                        "$set": {
+                            "wallet_balance": str(new_wallet_balance),
+                            "total_earned": str(new_total_earned),
+                            "payment_methods.paystack.email": email,
+                            "payment_methods.paystack.verified": True
+                        }
+                    }
+                )
+                await publish_wallet_delta(user_id, amount_float, new_wallet_balance, "deposit")
+
+                notifications = NotificationBuffer(db)
+
+                # Check activation and process referrals
+                if not user.get("is_activated", False) and new_wallet_balance >= float(user.get("activation_amount", 500.0)):
+                    await db.users.update_one(
+                        {"user_id": user_id},
+                        {"$set": {"is_activated": True}}
+                    )
+                    await bump_platform_counters(activated_users=1)
+                    logging.info(f"User {user_id} activated via Paystack deposit.")
+
+                    # Trigger binary commissions
+                    await trigger_binary_commissions(user_id, notifications=notifications)
+
+                    if user.get("referred_by"):
+                        await process_referral_reward(
+                            referred_id=user_id,
+                            referrer_id=user.get("referred_by"),
+                            notifications=notifications
+                        )
+
+                # Create notification
+                await create_notification(
+                    {
+                        "title": "Deposit Received",
+                        "message": f"KSH {amount_float:,.2f} deposited to your account via Paystack",
+                        "user_id": user_id,
+                        "type": "payment"
+                    },
+                    buffer=notifications
+                )
+                await notifications.flush()
+
+            logging.info(f"✅ Successful Paystack deposit: {user_id} - NGN {amount_float}")
+
+        return JSONResponse(status_code=200, content={"message": "Webhook received"})
+
+    except Exception as e:
+        logging.error(f"Paystack webhook error: {str(e)}", exc_info=True)
+        return JSONResponse(status_code=500, content={"message": "Internal server error"})
@@ -0,0 +1,527 @@
+"""
+Pesapal routes: order submission and status, and the IPN and redirect Pesapal calls.
+"""
+from fastapi import APIRouter, HTTPException, Depends, Request, Query
+from fastapi.responses import JSONResponse, RedirectResponse
+import uuid
+from datetime import datetime
+import httpx
+import logging
+from log_pipeline import log_payload
+
+from server import (
+    BASE_URL,
+    NotificationBuffer,
+    PESAPAL_ORDER_URL,
+    PESAPAL_STATUS_URL,
+    PesapalDepositRequest,
+    bump_platform_counters,
+    count_completed_transaction,
+    create_notification,
+    db,
+    gateway_request,
+    get_current_user,
+    get_pesapal_access_token,
+    process_referral_reward,
+    publish_wallet_delta,
+    rate_limit,
+    record_gateway_event,
+    register_pesapal_ipn,
+    send_email,
+    trigger_binary_commissions,
+)
+
+router = APIRouter(tags=["pesapal"])
+callbacks = APIRouter(tags=["pesapal callbacks"])
+
+@router.post("/api/payments/pesapal/deposit", dependencies=[Depends(rate_limit("deposit", scope="pesapal"))])
+async def initiate_pesapal_deposit(
+    deposit_data: PesapalDepositRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Initiates a Pesapal payment request.
+    """
+    try:
+        # Validate amount
+        amount_float = deposit_data.amount
+        if amount_float < 10.00:
+            raise HTTPException(
+                status_code=400,
+                detail="Minimum deposit amount is KSH 10.00"
+            )
+
+        # Get Pesapal access token
+        access_token = await get_pesapal_access_token()
+        if not access_token:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to authenticate with Pesapal"
+            )
+
+        # Register IPN if not already registered
+        ipn_id = await register_pesapal_ipn()
+        if not ipn_id:
+            logging.warning("Failed to register Pesapal IPN, proceeding without IPN")
+
+        # Create unique transaction ID
+        transaction_id = str(uuid.uuid4())
+        description = f"Deposit for {current_user['full_name']}"
+
+        # Prepare Pesapal order request
+        order_payload = {
+            "id": transaction_id,
+            "currency": "KES",
+            "amount": amount_float,
+            "description": description,
+            "callback_url": f"{BASE_URL}/pages/success?payment=pesapal&status=completed",
+            "notification_id": ipn_id,
+            "billing_address": {
+                "email_address": deposit_data.email,
+                "phone_number": deposit_data.phone,
+                "country_code": "KE",
+                "first_name": deposit_data.first_name,
+                "last_name": deposit_data.last_name
+            }
+        }
+
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+
+        # Submit order to Pesapal
+        response = await gateway_request("pesapal", "POST", PESAPAL_ORDER_URL, transaction_id=transaction_id, marks_side_effect=True, json=order_payload, headers=headers)
+
+        if response.status_code != 200:
+            logging.error("Pesapal order submission failed: %s - %s", response.status_code, log_payload(response.text))
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to create Pesapal order"
+            )
+
+        order_response = response.json()
+        redirect_url = order_response.get("redirect_url")
+        order_tracking_id = order_response.get("order_tracking_id")
+
+        if not redirect_url:
+            raise HTTPException(
+                status_code=500,
+                detail="No redirect URL received from Pesapal"
+            )
+
+        # Create transaction record
+        transaction_doc = {
+            "transaction_id": transaction_id,
+            "user_id": current_user['user_id'],
+            "type": "deposit",
+            "amount": str(amount_float),
+            "currency": "KES",
+            "phone": deposit_data.phone,
+            "status": "pending",
+            "method": "pesapal",
+            "payment_details": {
+                "pesapal": {
+                    "order_tracking_id": order_tracking_id,
+                    "redirect_url": redirect_url,
+                    "ipn_id": ipn_id
+                }
+            },
+            "gateway_event_ids": [
+                await record_gateway_event("pesapal", "order_request", order_payload, transaction_id=transaction_id),
+                await record_gateway_event("pesapal", "order_response", order_response, transaction_id=transaction_id)
+            ],
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+
+        await db.transactions.insert_one(transaction_doc)
+
+        return {
+            "success": True,
+            "message": "Pesapal payment initiated",
+            "transaction_id": transaction_id,
+            "redirect_url": redirect_url,
+            "order_tracking_id": order_tracking_id
+        }
+
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        logging.error("Pesapal HTTP error: %s - %s", e.response.status_code, log_payload(e.response.text))
+        raise HTTPException(
+            status_code=500,
+            detail="Payment service temporarily unavailable"
+        )
+    except Exception as e:
+        logging.error(f"Pesapal deposit error: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An unexpected error occurred"
+        )
+
+@router.get("/api/payments/pesapal/status/{order_tracking_id}")
+async def check_pesapal_status(
+    order_tracking_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Check the status of a Pesapal transaction.
+    """
+    try:
+        # Find the transaction
+        transaction = await db.transactions.find_one({
+            "payment_details.pesapal.order_tracking_id": order_tracking_id,
+            "user_id": current_user['user_id']
+        })
+
+        if not transaction:
+            raise HTTPException(status_code=404, detail="Transaction not found")
+
+        # Get Pesapal access token
+        access_token = await get_pesapal_access_token()
+        if not access_token:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to authenticate with Pesapal"
+            )
+
+        # Check status with Pesapal
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+
+        params = {
+            "orderTrackingId": order_tracking_id
+        }
+
+        response = await gateway_request(
+            "pesapal", "GET", PESAPAL_STATUS_URL,
+            transaction_id=transaction["transaction_id"], retries=1, params=params, headers=headers
+        )
+
+        if response.status_code != 200:
+            logging.error("Pesapal status check failed: %s - %s", response.status_code, log_payload(response.text))
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to check payment status"
+            )
+
+        status_data = response.json()
+        payment_status = status_data.get("status")
+        payment_method = status_data.get("payment_method")
+
+        # Update transaction status if it has changed
+        if payment_status != transaction['status']:
+            status_event_id = await record_gateway_event(
+                "pesapal", "status_response", status_data, transaction_id=transaction['transaction_id']
+            )
+            await db.transactions.update_one(
+                {"_id": transaction["_id"]},
+                {
+                    "$set": {
+                        "status": payment_status.lower(),
+                        "updated_at": datetime.utcnow()
+                    },
+                    "$push": {"gateway_event_ids": status_event_id}
+                }
+            )
+
+            # If payment is completed, update user balance
+            if payment_status.upper() == "COMPLETED":
+                amount_float = float(transaction['amount'])
+                await count_completed_transaction(transaction, amount=amount_float)
+                
+                # Update user balance
+                await db.users.update_one(
+                    {"user_id": current_user['user_id']},
+                    {
+                        "$inc": {
+                            "wallet_balance": str(amount_float),
+                            "total_earned": str(amount_float)
+                        },
+                        "$set": {
+                            "payment_methods.pesapal.phone": transaction['phone'],
+                            "payment_methods.pesapal.verified": True
+                        }
+                    }
+                )
+
+                # Check if this activates the user
+                user = await db.users.find_one({"user_id": current_user['user_id']})
+                if user and not user['is_activated'] and float(user['wallet_balance']) >= float(user['activation_amount']):
+                    activation_kes = float(user["activation_amount"])
+                    reward_kes = 30.0
+                    net_balance = float(user["wallet_balance"]) - activation_kes + reward_kes
+
+                    await db.users.update_one(
+                        {"user_id": current_user['user_id']},
+                        {
+                            "$inc": {
+                                "wallet_balance": -activation_kes + reward_kes,
+                                "activation_expense": activation_kes,
+                                "activation_reward": reward_kes
+                            },
+                            "$set": {"is_activated": True}
+                        }
+                    )
+                    await bump_platform_counters(activated_users=1)
+                    logging.info(f"User {current_user['user_id']} activated via Pesapal. Expense: {activation_kes} KES, Reward: {reward_kes} KES")
+
+                    # Trigger binary commissions
+                    await trigger_binary_commissions(current_user['user_id'])
+                    
+                    # Process referral if exists
+                    if user.get("referred_by"):
+                        await process_referral_reward(
+                            referred_id=user["user_id"],
+                            referrer_id=user["referred_by"]
+                        )
+
+                    # Notification and email
+                    await create_notification(
+                        {
+                            "title": "Account Activated!",
+                            "message": f"Congratulations! Your account is activated. Activation expense: {activation_kes} KES deducted, reward: {reward_kes} KES added. Net: {reward_kes} KES.",
+                            "user_id": current_user['user_id'],
+                            "type": "reward"
+                        },
+                        db_instance=db
+                    )
+
+                    await send_email(
+                        subject="Account Activated - Welcome Reward!",
+                        recipient=user["email"],
+                        body=f"""
+                        <h1>Congratulations, {user['full_name']}!</h1>
+                        <p>Your account has been successfully activated.</p>
+                        <p>Activation expense of {activation_kes} KES was deducted from your deposit, and a {reward_kes} KES reward has been added to your wallet.</p>
+                        <p>Net balance after activation: {reward_kes} KES.</p>
+                        <p>You can now access all features, including tasks and commissions!</p>
+                        """
+                    )
+
+                # Create notification
+                await create_notification({
+                    "title": "Deposit Received",
+                    "message": f"KES {amount_float:,.2f} deposited to your account via Pesapal",
+                    "user_id": current_user['user_id'],
+                    "type": "payment"
+                })
+
+        return {
+            "success": True,
+            "status": payment_status,
+            "payment_method": payment_method,
+            "transaction_id": transaction['transaction_id']
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Pesapal status check error: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to check payment status"
+        )
+
+@callbacks.post("/api/payments/pesapal/ipn")
+async def handle_pesapal_ipn(request: Request):
+    """
+    Handle Pesapal IPN (Instant Payment Notification) callbacks.
+    Fixed to update balances as strings instead of using $inc.
+    """
+    try:
+        # Parse JSON payload (Pesapal v3)
+        body = await request.json()
+        logging.info("Pesapal IPN received: %s", log_payload(body))
+
+        order_tracking_id = body.get("OrderTrackingId")
+        order_notification_type = body.get("OrderNotificationType")
+        order_merchant_reference = body.get("OrderMerchantReference")
+
+        if order_notification_type in ["CHANGE", "IPNCHANGE"]:
+            transaction = await db.transactions.find_one({
+                "payment_details.pesapal.order_tracking_id": order_tracking_id
+            })
+
+            if transaction:
+                access_token = await get_pesapal_access_token()
+                if access_token:
+                    headers = {
+                        "Authorization": f"Bearer {access_token}",
+                        "Content-Type": "application/json",
+                        "Accept": "application/json"
+                    }
+                    params = {"orderTrackingId": order_tracking_id}
+
+                    response = await gateway_request(
+                        "pesapal", "GET", PESAPAL_STATUS_URL,
+                        transaction_id=transaction["transaction_id"], retries=1, params=params, headers=headers
+                    )
+
+                    if response.status_code == 200:
+                        status_data = response.json()
+                        logging.info("Pesapal status raw response: %s", log_payload(status_data))
+
+                        payment_status = (
+                            status_data.get("payment_status_description")
+                            or status_data.get("payment_status_code")
+                            or ""
+                        ).lower()
+                        logging.info(f"Parsed payment status: {payment_status}")
+
+                        event_ids = [
+                            await record_gateway_event("pesapal", "ipn", body, transaction_id=transaction["transaction_id"]),
+                            await record_gateway_event("pesapal", "status_response", status_data, transaction_id=transaction["transaction_id"])
+                        ]
+
+                        # Update transaction record
+                        await db.transactions.update_one(
+                            {"payment_details.pesapal.order_tracking_id": order_tracking_id},
+                            {
+                                "$set": {
+                                    "status": payment_status,
+                                    "updated_at": datetime.utcnow()
+                                },
+                                "$push": {"gateway_event_ids": {"$each": event_ids}}
+                            }
+                        )
+
+                        # If payment completed
+                        if payment_status == "completed":
+                            user_id = transaction["user_id"]
+                            amount_float = float(transaction["amount"])
+                            await count_completed_transaction(transaction, amount=amount_float)
+
+                            user = await db.users.find_one({"user_id": user_id})
+                            if user:
+                                # Update balances (string-safe like Paystack)
+                                current_wallet_balance = float(user.get("wallet_balance", "0.0"))
+                                new_wallet_balance = current_wallet_balance + amount_float
+
+                                current_total_earned = float(user.get("total_earned", "0.0"))
+                                new_total_earned = current_total_earned + amount_float
+
+                                await db.users.update_one(
+                                    {"user_id": user_id},
+                                    {
+                                        "$set": {
+                                            "wallet_balance": str(new_wallet_balance),
+                                            "total_earned": str(new_total_earned),
+                                            "payment_methods.pesapal.email": status_data.get("payment_account"),
+                                            "payment_methods.pesapal.verified": True
+                                        }
+                                    }
+                                )
+                                await publish_wallet_delta(user_id, amount_float, new_wallet_balance, "deposit")
+
+                                notifications = NotificationBuffer(db)
+
+                                # Activation logic
+                                if not user.get("is_activated", False) and new_wallet_balance >= float(user.get("activation_amount", 500.0)):
+                                    activation_kes = float(user["activation_amount"])
+                                    reward_kes = 30.0
+                                    final_balance = new_wallet_balance - activation_kes + reward_kes
+
+                                    await db.users.update_one(
+                                        {"user_id": user_id},
+                                        {
+                                            "$set": {
+                                                "wallet_balance": str(final_balance),
+                                                "activation_expense": str(activation_kes),
+                                                "activation_reward": str(reward_kes),
+                                                "is_activated": True
+                                            }
+                                        }
+                                    )
+                                    await bump_platform_counters(activated_users=1)
+                                    await publish_wallet_delta(user_id, reward_kes - activation_kes, final_balance, "activation")
+
+                                    logging.info(
+                                        f"User {user_id} activated via Pesapal IPN. "
+                                        f"Expense: {activation_kes} KES, Reward: {reward_kes} KES"
+                                    )
+
+                                    # Trigger commissions
+                                    await trigger_binary_commissions(user_id, notifications=notifications)
+
+                                    if user.get("referred_by"):
+                                        await process_referral_reward(
+                                            referred_id=user["user_id"],
+                                            referrer_id=user["referred_by"],
+                                            notifications=notifications
+                                        )
+
+                                    await create_notification(
+                                        {
+                                            "title": "Account Activated!",
+                                            "message": f"Congratulations! Your account is activated. "
+                                                       f"Expense: {activation_kes} KES, Reward: {reward_kes} KES.",
+                                            "user_id": user_id,
+                                            "type": "reward"
+                                        },
+                                        db_instance=db,
+                                        buffer=notifications
+                                    )
+
+                                    await send_email(
+                                        subject="Account Activated - Welcome Reward!",
+                                        recipient=user["email"],
+                                        body=f"""
+                                        <h1>Congratulations, {user['full_name']}!</h1>
+                                        <p>Your account has been successfully activated.</p>
+                                        <p>Activation expense of {activation_kes} KES was deducted, and a {reward_kes} KES reward has been added.</p>
+                                        <p>Net balance: {final_balance} KES.</p>
+                                        """
+                                    )
+
+                                # Deposit notification
+                                await create_notification({
+                                    "title": "Deposit Received",
+                                    "message": f"KES {amount_float:,.2f} deposited to your account via Pesapal",
+                                    "user_id": user_id,
+                                    "type": "payment"
+                                }, buffer=notifications)
+                                await notifications.flush()
+
+        # Always respond success to Pesapal
+        return JSONResponse(content={"status": "success"})
+
+    except Exception as e:
+        logging.error(f"Pesapal IPN processing error: {str(e)}", exc_info=True)
+        return JSONResponse(content={"status": "success"})
+
+@callbacks.get("/api/payments/pesapal/callback")
+async def handle_pesapal_callback(
+    order_tracking_id: str = Query(...),
+    order_merchant_reference: str = Query(...),
+    order_notification_type: str = Query(...)
+):
+    """
+    Handle Pesapal payment callback (user redirect).
+    """
+    try:
+        # Find the transaction
+        transaction = await db.transactions.find_one({
+            "payment_details.pesapal.order_tracking_id": order_tracking_id
+        })
+
+        if not transaction:
+            logging.warning(f"Transaction not found for order_tracking_id: {order_tracking_id}")
+            return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=error")
+
+        # Redirect user based on payment status
+        if order_notification_type == "CHANGE":
+            # Payment was successful
+            return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=success&amount={transaction['amount']}")
+        else:
+            # Payment failed or was cancelled
+            return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=cancelled")
+
+    except Exception as e:
+        logging.error(f"Pesapal callback error: {str(e)}", exc_info=True)
+        return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=error")
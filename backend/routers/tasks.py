@@ -0,0 +1,272 @@
+"""
+Task routes: available tasks, completions and spin-and-win.
+"""
+from fastapi import APIRouter, HTTPException, Depends
+import uuid
+from datetime import datetime
+import copy
+import logging
+
+from server import (
+    SpinAndWinRequest,
+    TaskCompletion,
+    bump_task_stats,
+    commit_transaction,
+    create_notification,
+    db,
+    get_active_tasks,
+    get_current_user,
+    json_serializable_doc,
+    mongo_client,
+    publish_wallet_delta,
+    rate_limit,
+)
+
+router = APIRouter(tags=["tasks"])
+
+@router.post("/api/spin-and-win", dependencies=[Depends(rate_limit("spin"))])
+async def spin_and_win(
+    spin_data: SpinAndWinRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Handles the one-time spin and win feature.
+    Awards a random amount to the user's wallet.
+    """
+    user_id = current_user['user_id']
+    winning_amount = spin_data.winning_amount
+
+    # Check if user has already spun
+    if current_user.get('has_spun_once', False):
+        raise HTTPException(
+            status_code=400,
+            detail="You have already used your spin and win bonus."
+        )
+    
+    # Validate winning amount
+    if not (10.00 <= winning_amount <= 100.00):
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid winning amount provided. Amount must be between KSH 10 and KSH 100."
+        )
+
+    async with await mongo_client.start_session() as session:
+        try:
+            async with session.start_transaction():
+                # Update user's wallet and set has_spun_once
+                user = await db.users.find_one({"user_id": user_id}, session=session)
+                if user:
+                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                    new_wallet_balance = current_wallet_balance + winning_amount
+                    current_total_earned = float(user.get('total_earned', '0.0'))
+                    new_total_earned = current_total_earned + winning_amount
+
+                    await db.users.update_one(
+                        {"user_id": user_id},
+                        {
+                            "$set": {
+                                "wallet_balance": str(new_wallet_balance),
+                                "total_earned": str(new_total_earned),
+                                "has_spun_once": True
+                            }
+                        },
+                        session=session
+                    )
+                    await publish_wallet_delta(user_id, winning_amount, new_wallet_balance, "spin_reward", session=session)
+                # Re-fetch the updated user document to return
+                updated_user_result = await db.users.find_one({"user_id": user_id}, session=session)
+                
+                if not updated_user_result:
+                    raise HTTPException(status_code=404, detail="User not found during spin update.")
+
+                # Create a transaction record for the spin reward
+                transaction_doc = {
+                    "transaction_id": str(uuid.uuid4()),
+                    "user_id": user_id,
+                    "type": "spin_and_win",
+                    "amount": str(winning_amount),
+                    "currency": "KES",
+                    "status": "completed",
+                    "description": "One-time Spin & Win bonus",
+                    "created_at": datetime.utcnow(),
+                    "completed_at": datetime.utcnow()
+                }
+                await db.transactions.insert_one(transaction_doc, session=session)
+
+                # Create notification for the user
+                await create_notification({
+                    "title": "Spin & Win Bonus!",
+                    "message": f"Congratulations! You won KES {winning_amount:,.2f} from Spin & Win!",
+                    "user_id": user_id,
+                    "type": "reward"
+                }, session=session, db_instance=db)
+                
+                await commit_transaction(session)
+
+            logging.info(f"User {user_id} won KES {winning_amount} from spin and win.")
+            return {
+                "success": True,
+                "message": f"Congratulations! You won KES {winning_amount}.",
+                "winning_amount": winning_amount,
+                "user": json_serializable_doc(updated_user_result)
+            }
+
+        except HTTPException:
+            await session.abort_transaction()
+            raise
+        except Exception as e:
+            await session.abort_transaction()
+            logging.error(f"Error processing spin and win for user {user_id}: {str(e)}", exc_info=True)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to process spin and win: {str(e)}"
+            )
+
+@router.get("/api/tasks/available")
+async def get_available_tasks(current_user: dict = Depends(get_current_user)):
+    if not current_user['is_activated']:
+        raise HTTPException(status_code=400, detail="Account must be activated to access tasks")
+    
+    # Get completed task IDs for this user
+    completed_tasks = await db.task_completions.find(
+        {"user_id": current_user['user_id']}
+    ).distinct("task_id")
+    
+    # Get available tasks (not completed by user and active)
+    completed_tasks = set(completed_tasks)
+    tasks = [copy.deepcopy(task) for task in await get_active_tasks() if task["task_id"] not in completed_tasks][:20]
+    
+    return {
+        "success": True,
+        "tasks": json_serializable_doc(tasks) 
+    }
+
+@router.post("/api/tasks/complete")
+async def complete_task(completion_data: TaskCompletion, current_user: dict = Depends(get_current_user)):
+    if not current_user['is_activated']:
+        raise HTTPException(status_code=400, detail="Account must be activated to complete tasks")
+    
+    # Check if task exists and is active
+    task = next((task for task in await get_active_tasks() if task["task_id"] == completion_data.task_id), None)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found or inactive")
+    
+    # Check if user already completed this task
+    existing_completion = await db.task_completions.find_one({
+        "user_id": current_user['user_id'],
+        "task_id": completion_data.task_id
+    })
+    if existing_completion:
+        raise HTTPException(status_code=400, detail="Task already completed")
+    
+    # Validate completion data based on task type
+    comp_data = completion_data.completion_data
+    task_type = task.get('type', 'general')
+    requirements = task.get('requirements', {})
+    media = task.get('media', {})
+    survey_questions = task.get('survey_questions') or []
+    
+    if task_type == 'survey':
+        answers = comp_data.get('answers', [])
+        if len(answers) != len(survey_questions):
+            raise HTTPException(status_code=400, detail=f"Survey requires {len(survey_questions)} answers. Provided: {len(answers)}")
+        if any(len(answer) < 5 for answer in answers):  # Basic validation: min length
+            raise HTTPException(status_code=400, detail="Each survey answer must be at least 5 characters long")
+    
+    elif task_type == 'video' or task_type == 'ad':
+        watched_duration = comp_data.get('watched_duration', 0)
+        required_duration = requirements.get('duration', 30)
+        if watched_duration < required_duration:
+            raise HTTPException(status_code=400, detail=f"Must watch full {required_duration}s. Watched: {watched_duration}s")
+        if media.get('youtube_id') and 'youtube_timestamp' not in comp_data:
+            raise HTTPException(status_code=400, detail="Provide YouTube timestamp for verification")
+        if media.get('video_url') and 'screenshot_url' not in comp_data:
+            raise HTTPException(status_code=400, detail="Provide screenshot URL for video task")
+    
+    elif task_type == 'image' or task_type == 'upload':
+        image_url = comp_data.get('image_url')
+        if not image_url or not image_url.startswith(('http://', 'https://')):
+            raise HTTPException(status_code=400, detail="Valid image URL required for upload tasks")
+        # Basic URL check (extend with regex if needed)
+    
+    elif task_type == 'writing':
+        content = comp_data.get('content', '')
+        min_words = requirements.get('min_words', 100)
+        word_count = len(content.split())
+        if word_count < min_words:
+            raise HTTPException(status_code=400, detail=f"Content must have at least {min_words} words. Provided: {word_count}")
+    
+    elif task_type == 'social':
+        share_urls = comp_data.get('share_urls', [])
+        required_platforms = requirements.get('platforms', [])
+        if len(share_urls) < len(required_platforms):
+            raise HTTPException(status_code=400, detail=f"Share on {len(required_platforms)} platforms required. Provided: {len(share_urls)} URLs")
+        for url in share_urls:
+            if not url.startswith(('http://', 'https://')):
+                raise HTTPException(status_code=400, detail="All share URLs must be valid")
+    
+    # General media support: If task has media, ensure completion references it if required
+    if media and requirements.get('verify_media', False):
+        if 'media_proof' not in comp_data:
+            raise HTTPException(status_code=400, detail="Proof of media interaction (e.g., screenshot) required")
+    
+    # Record task completion
+    reward_amount = float(task['reward'])
+    completion_doc = {
+        "completion_id": str(uuid.uuid4()),
+        "user_id": current_user['user_id'],
+        "task_id": completion_data.task_id,
+        "completion_data": completion_data.completion_data,
+        "reward_amount": str(reward_amount),
+        "status": "completed",
+        "created_at": datetime.utcnow()
+    }
+    
+    # Use session for atomic update
+    async with await mongo_client.start_session() as session:
+        try:
+            async with session.start_transaction():
+                await db.task_completions.insert_one(completion_doc, session=session)
+                
+                # Update user wallet and earnings
+                user = await db.users.find_one({"user_id": current_user['user_id']}, session=session)
+                if user:
+                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+                    new_wallet_balance = current_wallet_balance + reward_amount
+                    current_task_earnings = float(user.get('task_earnings', '0.0'))
+                    new_task_earnings = current_task_earnings + reward_amount
+                    current_total_earned = float(user.get('total_earned', '0.0'))
+                    new_total_earned = current_total_earned + reward_amount
+
+                    await db.users.update_one(
+                        {"user_id": current_user['user_id']},
+                        {
+                            "$set": {
+                                "wallet_balance": str(new_wallet_balance),
+                                "task_earnings": str(new_task_earnings),
+                                "total_earned": str(new_total_earned)
+                            }
+                        },
+                        session=session
+                    )
+                    await publish_wallet_delta(current_user['user_id'], reward_amount, new_wallet_balance, "task_reward", session=session)
+                await bump_task_stats(task, completion_doc["created_at"], session=session, completions=1, completed=1, earnings=reward_amount)
+                await commit_transaction(session)
+        except Exception as e:
+            await session.abort_transaction()
+            logging.error(f"Task completion transaction failed: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Task completion failed: {str(e)}")
+
+    # Create notification
+    await create_notification({
+        "title": "Task Completed!",
+        "message": f"You earned KSH {reward_amount:,.2f} for completing '{task['title']}'",
+        "user_id": current_user['user_id']
+    }, db_instance=db)
+    
+    return {
+        "success": True,
+        "message": f"Task completed! You earned KSH {reward_amount}",
+        "reward": reward_amount,
+        "validated_type": task_type
+    }
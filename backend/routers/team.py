@@ -0,0 +1,219 @@
+"""
+Team and referral routes: the binary tree, referral stats and reward claims.
+"""
+from fastapi import APIRouter, HTTPException, Depends
+import uuid
+from datetime import datetime
+import logging
+
+from server import (
+    ClaimTeamReward,
+    build_team_tree,
+    commit_transaction,
+    create_notification,
+    db,
+    get_current_user,
+    get_exchange_rate,
+    json_serializable_doc,
+    mongo_client,
+    publish_wallet_delta,
+)
+
+router = APIRouter(tags=["team"])
+
+@router.get("/api/team/tree")
+async def get_team_tree(current_user: dict = Depends(get_current_user)):
+    """Get team tree structure with progress for 100-member reward"""
+    total_team_size = current_user.get('left_leg_size', 0) + current_user.get('right_leg_size', 0)
+    progress_percentage = min((total_team_size / 100.0) * 100, 100.0)
+    eligible = total_team_size >= 100
+    claimed = current_user.get('team_reward_claimed', False)
+
+    # Build tree (limited depth for performance)
+    tree = await build_team_tree(current_user['user_id'])
+
+    # Reward amount in preferred currency
+    rate = await get_exchange_rate("KES", current_user['preferred_currency'])
+    reward_amount = round(50 * rate, 2)
+
+    return {
+        "success": True,
+        "tree": tree or {},  # Empty dict if no tree
+        "total_team_size": total_team_size,
+        "progress_percentage": progress_percentage,
+        "eligible_for_reward": eligible,
+        "reward_claimed": claimed,
+        "reward_amount": reward_amount,
+        "currency": current_user['preferred_currency']
+    }
+
+@router.post("/api/team/claim-reward")
+async def claim_team_reward(
+    request: ClaimTeamReward,
+    current_user: dict = Depends(get_current_user)
+):
+    total_team_size = current_user.get('left_leg_size', 0) + current_user.get('right_leg_size', 0)
+    if total_team_size < 100:
+        raise HTTPException(status_code=400, detail="Team size must reach 100 members to claim reward")
+    if current_user.get('team_reward_claimed', False):
+        raise HTTPException(status_code=400, detail="Team reward already claimed")
+
+    reward_kes = 50.0
+
+    async with await mongo_client.start_session() as session:
+        async with session.start_transaction():
+            # Update balance
+            current_balance = float(current_user['wallet_balance'])
+            new_balance = current_balance + reward_kes
+            current_total_earned = float(current_user['total_earned'])
+            new_total_earned = current_total_earned + reward_kes
+
+            await db.users.update_one(
+                {"user_id": current_user['user_id']},
+                {
+                    "$set": {
+                        "wallet_balance": str(new_balance),
+                        "total_earned": str(new_total_earned),
+                        "team_reward_claimed": True,
+                        "team_reward_claimed_at": datetime.utcnow()
+                    }
+                },
+                session=session
+            )
+            await publish_wallet_delta(current_user['user_id'], reward_kes, new_balance, "team_reward", session=session)
+
+            # Transaction record
+            txn_id = str(uuid.uuid4())
+            await db.transactions.insert_one({
+                "transaction_id": txn_id,
+                "user_id": current_user['user_id'],
+                "type": "team_reward",
+                "amount": str(reward_kes),
+                "currency": "KES",
+                "status": "completed",
+                "description": "Team milestone reward - 100 downline members",
+                "created_at": datetime.utcnow(),
+                "completed_at": datetime.utcnow()
+            }, session=session)
+
+            # Notification
+            await create_notification({
+                "title": "Team Milestone Reward Claimed!",
+                "message": f"Congratulations! Your team reached 100 members. 50 KES added to your wallet.",
+                "user_id": current_user['user_id'],
+                "type": "reward"
+            }, session=session, db_instance=db)
+            await commit_transaction(session)
+
+    # Converted response
+    converted_reward = round(reward_kes * rate, 2)
+    return {
+        "success": True,
+        "message": f"Team reward claimed! 50 KES ({converted_reward} {current_user['preferred_currency']}) added to wallet.",
+        "reward_amount": converted_reward,
+        "currency": current_user['preferred_currency']
+    }
+
+@router.get("/api/referrals/stats")
+async def get_referral_stats(current_user: dict = Depends(get_current_user)):
+    """
+    Enhanced Referral Statistics
+    """
+    try:
+        stats_pipeline = [
+            {"$match": {"referrer_id": current_user['user_id']}},
+            {"$group": {
+                "_id": "$status",
+                "count": {"$sum": 1},
+                "total_reward_for_status": {"$sum": {"$toDouble": "$reward_amount"}}
+            }},
+            {"$group": {
+                "_id": None,
+                "total_referrals": {"$sum": "$count"},
+                "completed_rewards": {
+                    "$sum": {
+                        "$cond": [
+                            {"$eq": ["$_id", "completed"]},
+                            "$total_reward_for_status",
+                            0
+                        ]
+                    }
+                },
+                "potential_rewards": {
+                    "$sum": {
+                        "$cond": [
+                            {"$eq": ["$_id", "pending"]},
+                            "$total_reward_for_status",
+                            0
+                        ]
+                    }
+                }
+            }},
+            {"$project": {
+                "_id": 0,
+                "total_referrals": 1,
+                "total_earned": "$completed_rewards",
+                "potential_earnings": "$potential_rewards",
+            }}
+        ]
+        
+        stats = await db.referrals.aggregate(stats_pipeline).to_list(1)
+
+        # Process referral result
+        referral_stats = stats[0] if stats else {
+            "total_referrals": 0,
+            "total_earned": 0.0,
+            "potential_earnings": 0.0,
+        }
+        
+        referral_count = referral_stats.get('total_referrals', 0)
+        tier = "gold" if referral_count >= 50 else \
+               "silver" if referral_count >= 20 else "bronze"
+
+        referral_stats['tier'] = tier
+        referral_stats['referral_code'] = current_user['referral_code']
+
+        # Get recent referrals with pagination
+        recent_referrals = await db.referrals.find(
+            {"referrer_id": current_user['user_id']},
+            {"_id": 0, "referred_id": 1, "status": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(5).to_list(5)
+
+        return {
+            "success": True,
+            "stats": json_serializable_doc(referral_stats),
+            "recent_referrals": json_serializable_doc(recent_referrals)
+        }
+
+    except Exception as e:
+        logging.error(f"Failed to fetch referral stats for user {current_user['user_id']}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to fetch referral stats: {str(e)}"
+        )
+
+@router.get("/api/referrals/binary-stats")
+async def get_binary_stats(current_user: dict = Depends(get_current_user)):
+    """
+    Get binary referral tree statistics.
+    """
+    try:
+        left_leg = current_user.get('left_leg_size', 0)
+        right_leg = current_user.get('right_leg_size', 0)
+        total_downline = left_leg + right_leg
+        leg_balance = left_leg - right_leg  # Positive if left heavier
+        
+        return {
+            "success": True,
+            "binary": {
+                "left_leg_size": left_leg,
+                "right_leg_size": right_leg,
+                "total_downline": total_downline,
+                "binary_earnings": current_user.get('binary_earnings', 0.0),
+                "leg_balance": leg_balance,
+                "recommendation": "Balance your legs" if abs(leg_balance) > 5 else "Good balance"
+            }
+        }
+    except Exception as e:
+        logging.error(f"Failed to fetch binary stats: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to fetch binary stats")
@@ -0,0 +1,134 @@
+"""
+Withdrawal requests; payouts are made when an admin approves them.
+"""
+from fastapi import APIRouter, HTTPException, Depends
+import uuid
+from datetime import datetime
+import logging
+
+from server import (
+    WithdrawalRequest,
+    bump_platform_counters,
+    db,
+    get_current_user,
+    rate_limit,
+    validate_and_format_phone,
+)
+
+router = APIRouter(tags=["withdrawals"])
+
+# ✅ Fixed Withdrawal Route (uses global_rates doc)
+@router.post("/api/payments/withdraw", dependencies=[Depends(rate_limit("withdrawal"))])
+async def request_withdrawal(
+    withdrawal_data: WithdrawalRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Handles user withdrawal requests across multiple currencies.
+    Converts everything to KES equivalent for consistency using global_rates doc.
+    """
+    user_id = current_user["user_id"]
+    amount = float(withdrawal_data.amount)
+    currency = withdrawal_data.currency.upper().strip()
+
+    PESAPAL_SUPPORTED_CURRENCIES = ["UGX", "TZS"]
+    WITHDRAWAL_CURRENCIES = ["KES", "USD"] + PESAPAL_SUPPORTED_CURRENCIES
+
+    if currency not in WITHDRAWAL_CURRENCIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported currency {currency}. Supported: {', '.join(WITHDRAWAL_CURRENCIES)}"
+        )
+
+    # --- Convert amount to KES ---
+    if currency == "KES":
+        kes_amount = amount
+    else:
+        try:
+            rate_doc = await db.rates.find_one({"_id": "global_rates"})
+            if not rate_doc:
+                raise ValueError("Rates document not found")
+
+            usd_rates = rate_doc["rates"]
+
+            if currency not in usd_rates or "KES" not in usd_rates:
+                raise ValueError("Missing rate in DB")
+
+            from_rate = usd_rates[currency]  # USD → currency
+            to_rate = usd_rates["KES"]       # USD → KES
+
+            # Convert: amount (currency) → USD → KES
+            kes_amount = (amount / from_rate) * to_rate
+
+        except Exception as e:
+            logging.warning(f"Falling back for {currency} → KES conversion: {str(e)}")
+            if currency == "USD":
+                kes_amount = amount * 130.0
+            elif currency == "UGX":
+                kes_amount = amount / 37.0
+            elif currency == "TZS":
+                kes_amount = amount / 23.0
+            else:
+                raise HTTPException(500, "Conversion rate unavailable")
+
+    # --- Validate minimum & balance ---
+    if kes_amount < 1000.0:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Minimum withdrawal amount is 1000 KES equivalent ({kes_amount:.2f} KES)"
+        )
+
+    if kes_amount > float(current_user.get("wallet_balance", 0.0)):
+        raise HTTPException(status_code=400, detail="Insufficient wallet balance.")
+
+    # --- Choose method ---
+    if currency == "KES":
+        if not withdrawal_data.phone:
+            raise HTTPException(400, "Phone number required for KES withdrawals (M-Pesa).")
+        method = "mpesa"
+        recipient_field = "phone"
+        recipient_value = validate_and_format_phone(withdrawal_data.phone)
+
+    elif currency == "USD":
+        if not withdrawal_data.email:
+            raise HTTPException(400, "Email required for USD withdrawals (PayPal).")
+        method = "paypal"
+        recipient_field = "email"
+        recipient_value = withdrawal_data.email
+
+    else:  # UGX / TZS → Pesapal
+        if not withdrawal_data.phone:
+            raise HTTPException(400, f"Phone number required for {currency} withdrawals (Pesapal).")
+        method = "pesapal"
+        recipient_field = "phone"
+        recipient_value = validate_and_format_phone(withdrawal_data.phone)
+
+    # --- Save transaction ---
+    transaction_doc = {
+        "transaction_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "type": "withdrawal",
+        "original_amount": str(amount),
+        "original_currency": currency,
+        "kes_amount": str(round(kes_amount, 2)),
+        "method": method,
+        recipient_field: recipient_value,
+        "status": "pending_admin_approval",
+        "description": f"{method} withdrawal request pending approval (KES eq: {kes_amount:.2f})",
+        "created_at": datetime.utcnow(),
+    }
+
+    await db.transactions.insert_one(transaction_doc)
+    await bump_platform_counters(pending_withdrawals=1)
+    logging.info(
+        f"Withdrawal request created: {user_id} {amount} {currency} → {kes_amount:.2f} KES [{method}]"
+    )
+
+    return {
+        "success": True,
+        "message": (
+            f"{method} withdrawal request for {amount} {currency} "
+            f"(KES eq: {kes_amount:.2f}) submitted for approval."
+        ),
+        "transaction_id": transaction_doc["transaction_id"],
+    }
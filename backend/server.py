@@ -1,7 +1,9 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, Form, UploadFile, File, Query
+from fastapi import FastAPI, HTTPException, Depends, Request, Form, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, Response
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReplaceOne, UpdateMany, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List, Dict, Any
 import os
@@ -12,23 +14,57 @@ from datetime import datetime, timedelta
 import base64
 import secrets
 import asyncio
+import functools
+import time
 from urllib.parse import urlparse, quote
 import json
+import copy
+import weakref
+from collections import Counter
+import zlib
 import httpx 
-from bson import ObjectId 
+from bson import ObjectId, Binary
 import re 
 import logging 
-from email_validator import validate_email, EmailNotValidError 
-import xml.etree.ElementTree as ET
-
-# Added for email functionality
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
+from circuit_breaker import breaker_from_env, CircuitOpenError, LatencyBudgetExceeded
+from rate_limit import RateLimiter, RatePolicy, InMemoryBucketStore, MongoBucketStore
+import idempotency
+from live_events import LiveEventHub, MongoChangeStreamRelay
+from idempotency import IdempotencyStore, request_fingerprint
+from cache_bus import TTLCache, InvalidationBus, CollectionWatcher
+from leader_lock import LeaderLease
+from metrics import Registry, MetricsMiddleware, request_scope
+from admission_control import AdmissionController, AdmissionMiddleware, RouteClass
+from mongo_monitoring import CommandMonitor
+from gateway_instrumentation import GatewayInstrumentation
+from sampling_profiler import SamplingProfiler
+from loop_watchdog import LoopWatchdog
+from log_pipeline import setup_logging, parse_sample_rates, log_payload
+import webhook_inbox
+from webhook_inbox import WebhookInboxProcessor
+import lazy_imports
+import routers
+
+# Added for email functionality; imported on first use (see STARTUP_PROFILE)
+fastapi_mail = lazy_imports.LazyImport("fastapi_mail")
 
 from dotenv import load_dotenv
 load_dotenv()   # ensures .env values are loaded
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Logging: records are queued and written by a background thread; 'json' for one object per line, 'text' for the old format
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+# Share of INFO records kept per logger, e.g. "gateway.spans=0.1,root=0.5"; warnings and errors are always kept
+LOG_SAMPLE_RATES = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_PAYLOAD_LIMIT = int(os.environ.get('LOG_PAYLOAD_LIMIT', '2000'))  # characters of a logged payload before truncation
+log_queue_handler = setup_logging(
+    LOG_LEVEL,
+    json_format=LOG_FORMAT == 'json',
+    sample_rates=LOG_SAMPLE_RATES,
+    queue_size=LOG_QUEUE_SIZE,
+    payload_limit=LOG_PAYLOAD_LIMIT
+)
 
 # Environment variables
 
@@ -48,12 +84,16 @@ MPESA_LIPA_NA_MPESA_SHORTCODE = os.environ.get('MPESA_LIPA_NA_MPESA_SHORTCODE',
 MPESA_B2C_SHORTCODE = os.environ.get('MPESA_B2C_SHORTCODE', '600991') 
 MPESA_INITIATOR_NAME = os.environ.get('MPESA_INITIATOR_NAME', 'testapi') 
 MPESA_SECURITY_CREDENTIAL = os.environ.get('MPESA_SECURITY_CREDENTIAL', '')
+MPESA_BASE_URL = os.environ.get('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke')
 
 # PayPal environment variables
 PAYPAL_CLIENT_ID = os.environ.get('PAYPAL_CLIENT_ID', '')
 PAYPAL_CLIENT_SECRET = os.environ.get('PAYPAL_CLIENT_SECRET', '')
 PAYPAL_MODE = os.environ.get('PAYPAL_MODE', 'live')  # or 'live'
 PAYPAL_CURRENCY = os.environ.get('PAYPAL_CURRENCY', 'USD') 
+PAYPAL_BASE_URL = os.environ.get(
+    'PAYPAL_BASE_URL', "https://api-m.sandbox.paypal.com" if PAYPAL_MODE == "sandbox" else "https://api-m.paypal.com"
+)
 
 # Pesapal environment variables
 PESAPAL_CONSUMER_KEY = os.environ.get('PESAPAL_CONSUMER_KEY', '')
@@ -63,10 +103,13 @@ PESAPAL_ENVIRONMENT = os.environ.get('PESAPAL_ENVIRONMENT', 'live')  # or 'live'
 # Paystack environment variables
 PAYSTACK_SECRET_KEY = os.environ.get('PAYSTACK_SECRET_KEY', 'sk_test_0e11b4ffbd6f589362259934e6f55ae5cf665845')
 PAYSTACK_PUBLIC_KEY = os.environ.get('PAYSTACK_PUBLIC_KEY', 'pk_test_6641f25de958f6aef729daf79c9b0f66d453d7de')
+PAYSTACK_BASE_URL = os.environ.get('PAYSTACK_BASE_URL', 'https://api.paystack.co')
 
 # Set Pesapal URLs based on environment
 # Set Pesapal URLs based on environment
-if PESAPAL_ENVIRONMENT == 'live':
+if os.environ.get('PESAPAL_BASE_URL'):
+    PESAPAL_BASE_URL = os.environ['PESAPAL_BASE_URL']
+elif PESAPAL_ENVIRONMENT == 'live':
     PESAPAL_BASE_URL = "https://pay.pesapal.com/v3"
 else:
     PESAPAL_BASE_URL = "https://cybqa.pesapal.com/pesapalv3"
@@ -79,38 +122,225 @@ PESAPAL_STATUS_URL = f"{PESAPAL_BASE_URL}/api/Transactions/GetTransactionStatus"
 
 BACKEND_URL = os.environ.get("BACKEND_URL", "https://official-paypal.onrender.com")
 
+# Per-gateway circuit breakers; latency budgets (seconds) overridable via GATEWAY_<NAME>_TIMEOUT
+GATEWAY_BREAKERS = {
+    "mpesa": breaker_from_env("mpesa", 20.0),
+    "paypal": breaker_from_env("paypal", 15.0),
+    "pesapal": breaker_from_env("pesapal", 15.0),
+    "paystack": breaker_from_env("paystack", 15.0),
+    "exchange_rates": breaker_from_env("exchange_rates", 10.0),
+}
+
+# Rate limiting (token buckets): "<tokens>/<second|minute|hour|day or seconds>" per route policy
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # 'memory' or 'mongo'
+# Proxies in front of the app that append to X-Forwarded-For (1 for the hosting load balancer); the client
+# IP is the hop the outermost of them added. 0 ignores the header and uses the connection's address.
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 1))
+RATE_LIMIT_POLICIES = {
+    name: RatePolicy.parse(name, os.environ.get(f"RATE_LIMIT_{name.upper()}", default))
+    for name, default in {
+        "deposit": "5/hour",  # per gateway
+        "withdrawal": "5/hour",
+        "login": "10/300",
+        "password_reset": "5/hour",
+        "spin": "5/minute",
+    }.items()
+}
+
+# Idempotency-Key: how long keys are remembered, and the routes that honour them
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENT_ROUTES = {
+    "/api/payments/deposit",
+    "/api/payments/paystack/deposit",
+    "/api/payments/pesapal/deposit",
+    "/api/payments/paypal/create-order",
+    "/api/payments/withdraw",
+}
+
+# Live events over SSE: 'memory' (single worker) or 'mongo' (change-stream fan-out across workers)
+LIVE_EVENTS_BACKEND = os.environ.get('LIVE_EVENTS_BACKEND', 'memory')
+LIVE_EVENTS_MAX_CONNECTIONS = int(os.environ.get('LIVE_EVENTS_MAX_CONNECTIONS', 1000))
+LIVE_EVENTS_HEARTBEAT_SECONDS = int(os.environ.get('LIVE_EVENTS_HEARTBEAT_SECONDS', 15))
+
+# Multi-worker mode: 'local' keeps cache invalidations in process (one worker), 'mongo' fans them out over a change stream
+CACHE_BUS_BACKEND = os.environ.get('CACHE_BUS_BACKEND', 'local')
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 30))  # read-only requests only; 0 disables
+RATES_CACHE_TTL_SECONDS = int(os.environ.get('RATES_CACHE_TTL_SECONDS', 300))
+TASKS_CACHE_TTL_SECONDS = int(os.environ.get('TASKS_CACHE_TTL_SECONDS', 60))
+GATEWAY_TOKEN_CACHE_SECONDS = int(os.environ.get('GATEWAY_TOKEN_CACHE_SECONDS', 3000))
+LEADER_LEASE_SECONDS = int(os.environ.get('LEADER_LEASE_SECONDS', 30))
+
+# Admission control: per route class "<in-flight limit>/<queue timeout ms>/<share of ADMISSION_MAX_IN_FLIGHT>",
+# most important class first; under overload the lower classes are shed with 503 first (see admission_control.py)
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'true').lower() == 'true'
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 100))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', 2))
+ADMISSION_CLASSES = [
+    RouteClass.parse(name, os.environ.get(f"ADMISSION_{name.upper()}", default))
+    for name, default in {
+        "webhook": "100/5000/1.0",
+        "payment": "50/2000/0.9",
+        "auth": "40/2000/0.8",
+        "dashboard": "70/500/0.7",
+        "admin": "10/250/0.4",
+    }.items()
+]
+
+# Prometheus metrics: when set, GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# MongoDB command monitoring: commands at or above this many milliseconds are logged with their filter shape
+MONGO_COMMAND_MONITORING = os.environ.get('MONGO_COMMAND_MONITORING', 'true').lower() == 'true'
+MONGO_SLOW_QUERY_MS = float(os.environ.get('MONGO_SLOW_QUERY_MS', 100))
+
+# Admin sampling profiler (POST /api/admin/profile): off unless enabled, and capped in length
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 60))
+
+# Event-loop watchdog: lag is sampled every interval; holds past the threshold count as blocks,
+# and with LOOP_BLOCK_DEBUG the blocking code's stack is captured and logged
+LOOP_WATCHDOG_INTERVAL_MS = float(os.environ.get('LOOP_WATCHDOG_INTERVAL_MS', 100))
+LOOP_BLOCK_THRESHOLD_MS = float(os.environ.get('LOOP_BLOCK_THRESHOLD_MS', 100))
+LOOP_BLOCK_DEBUG = os.environ.get('LOOP_BLOCK_DEBUG', 'false').lower() == 'true'
+
+# Route groups this worker serves (see routers/__init__.py): 'all', or e.g. 'callbacks' or 'auth,admin'
+# for dedicated callback and admin worker pools
+API_ROUTERS = [group.strip() for group in os.environ.get('API_ROUTERS', 'all').split(',') if group.strip()]
+
+# Startup profile: 'full' imports everything and validates the mail settings at import; 'slim' defers
+# rarely used dependencies (mail) to first use, for faster cold starts
+STARTUP_PROFILE = os.environ.get('STARTUP_PROFILE', 'full').lower()
+
+# Webhook inbox: callbacks stored by the ingress pool (webhook_ingress.py) are settled by workers with processing on
+WEBHOOK_INBOX_PROCESSING = os.environ.get('WEBHOOK_INBOX_PROCESSING', 'false').lower() == 'true'
+WEBHOOK_INBOX_CONCURRENCY = int(os.environ.get('WEBHOOK_INBOX_CONCURRENCY', 4))
+WEBHOOK_INBOX_POLL_MS = float(os.environ.get('WEBHOOK_INBOX_POLL_MS', 200))
+WEBHOOK_INBOX_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_INBOX_MAX_ATTEMPTS', 8))
+WEBHOOK_INBOX_RETENTION_DAYS = int(os.environ.get('WEBHOOK_INBOX_RETENTION_DAYS', 30))  # 0 keeps processed entries forever
+
+# Notification retention: days until a notification expires and is archived, per notification type
+NOTIFICATION_RETENTION_DAYS = {
+    name: int(os.environ.get(f"NOTIFICATION_RETENTION_{name.upper()}", default))
+    for name, default in {"payment": 90, "reward": 60, "system": 30}.items()
+}
+NOTIFICATION_RETENTION_DEFAULT_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DEFAULT', 30))
+NOTIFICATION_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('NOTIFICATION_ARCHIVE_INTERVAL_SECONDS', 3600))
+NOTIFICATION_ARCHIVE_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_ARCHIVE_RETENTION_DAYS', 365))  # 0 keeps archives forever
+
+# Platform counters: hour (UTC) of the nightly recount that corrects drift
+PLATFORM_COUNTERS_VERIFY_HOUR = int(os.environ.get('PLATFORM_COUNTERS_VERIFY_HOUR', 2))
+
+# Raw gateway payloads (gateway_events): 'none' or 'zlib', applied to payloads of at least N bytes
+GATEWAY_EVENT_COMPRESSION = os.environ.get('GATEWAY_EVENT_COMPRESSION', 'none')
+GATEWAY_EVENT_COMPRESS_MIN_BYTES = int(os.environ.get('GATEWAY_EVENT_COMPRESS_MIN_BYTES', 1024))
+
+# Bulk withdrawal approval: max items per request and concurrent payouts per gateway
+BULK_APPROVAL_MAX_ITEMS = int(os.environ.get('BULK_APPROVAL_MAX_ITEMS', 500))
+PAYOUT_CONCURRENCY = {
+    "mpesa": int(os.environ.get('PAYOUT_CONCURRENCY_MPESA', 5)),
+    "paypal": int(os.environ.get('PAYOUT_CONCURRENCY_PAYPAL', 5)),
+}
+# Debited bulk withdrawals whose payout was never sent (worker stopped) are resent after this long
+BULK_PAYOUT_RECOVERY_AFTER_SECONDS = int(os.environ.get('BULK_PAYOUT_RECOVERY_AFTER_SECONDS', 300))
+BULK_PAYOUT_RECOVERY_INTERVAL_SECONDS = int(os.environ.get('BULK_PAYOUT_RECOVERY_INTERVAL_SECONDS', 300))
+
+
+
+
+# Email configuration, built on first use
+_mail_conf = None
+
+def mail_config():
+    global _mail_conf
+    if _mail_conf is None:
+        _mail_conf = fastapi_mail.ConnectionConfig(
+            MAIL_USERNAME=os.environ.get("MAIL_USERNAME"),
+            MAIL_PASSWORD=os.environ.get("MAIL_PASSWORD"),
+            MAIL_FROM=os.environ.get("MAIL_FROM"),
+            MAIL_PORT=int(os.environ.get("MAIL_PORT",587)),
+            MAIL_SERVER=os.environ.get("MAIL_SERVER"),
+            MAIL_FROM_NAME=os.environ.get("MAIL_FROM_NAME"),
+            MAIL_STARTTLS=True,
+            MAIL_SSL_TLS=False,
+            USE_CREDENTIALS=True,
+            VALIDATE_CERTS=True
+        )
+    return _mail_conf
 
+if STARTUP_PROFILE == 'full':
+    lazy_imports.load_all()
+    mail_config()
 
+# Metrics registry, shared by the request middleware and the MongoDB command listener
+metrics_registry = Registry()
 
-# Email configuration
-conf = ConnectionConfig(
-    MAIL_USERNAME=os.environ.get("MAIL_USERNAME"),
-    MAIL_PASSWORD=os.environ.get("MAIL_PASSWORD"),
-    MAIL_FROM=os.environ.get("MAIL_FROM"),
-    MAIL_PORT=int(os.environ.get("MAIL_PORT",587)),
-    MAIL_SERVER=os.environ.get("MAIL_SERVER"),
-    MAIL_FROM_NAME=os.environ.get("MAIL_FROM_NAME"),
-    MAIL_STARTTLS=True,
-    MAIL_SSL_TLS=False,
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True
-)
-
-app = FastAPI(title="EarnPlatform API", version="1.0.0")
-
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], 
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+gateway_instrumentation = GatewayInstrumentation(metrics_registry)
+loop_watchdog = LoopWatchdog(
+    metrics_registry,
+    interval=LOOP_WATCHDOG_INTERVAL_MS / 1000,
+    block_threshold=LOOP_BLOCK_THRESHOLD_MS / 1000,
+    capture_stacks=LOOP_BLOCK_DEBUG
 )
+gateway_circuit_state_gauge = metrics_registry.gauge("gateway_circuit_open", "1 while a gateway's circuit breaker is open or half-open", ("gateway",))
 
 # MongoDB connection
-mongo_client = AsyncIOMotorClient(MONGO_URL)
+mongo_client = AsyncIOMotorClient(
+    MONGO_URL,
+    event_listeners=[CommandMonitor(metrics_registry, slow_ms=MONGO_SLOW_QUERY_MS)] if MONGO_COMMAND_MONITORING else []
+)
 db = mongo_client.earnplatform
 
+rate_limiter = RateLimiter(
+    RATE_LIMIT_POLICIES,
+    store=MongoBucketStore(db.rate_limits) if RATE_LIMIT_BACKEND == "mongo" else InMemoryBucketStore()
+)
+idempotency_store = IdempotencyStore(db.idempotency_keys, ttl_hours=IDEMPOTENCY_TTL_HOURS)
+live_event_hub = LiveEventHub(max_connections=LIVE_EVENTS_MAX_CONNECTIONS)
+live_event_relay = MongoChangeStreamRelay(db.live_events, live_event_hub) if LIVE_EVENTS_BACKEND == "mongo" else None
+
+# Per-worker caches; see cache_bus.py for how they stay coherent across workers
+cache_bus = InvalidationBus(db.cache_invalidations if CACHE_BUS_BACKEND == "mongo" else None)
+rates_cache = cache_bus.register(TTLCache("rates", RATES_CACHE_TTL_SECONDS, max_entries=1))
+tasks_cache = cache_bus.register(TTLCache("tasks", TASKS_CACHE_TTL_SECONDS, max_entries=1))
+gateway_token_cache = cache_bus.register(TTLCache("gateway_tokens", GATEWAY_TOKEN_CACHE_SECONDS, max_entries=16))
+user_cache = TTLCache("users", USER_CACHE_TTL_SECONDS)  # keyed by str(_id), invalidated from the users change stream
+user_doc_ids = TTLCache("user_ids", 86400, max_entries=100_000)  # user_id -> _id; never changes
+user_cache_watcher = CollectionWatcher(db.users, user_cache) if USER_CACHE_TTL_SECONDS > 0 else None
+leader_lease = LeaderLease(db.leader_leases, "startup", ttl_seconds=LEADER_LEASE_SECONDS)
+sampling_profiler = SamplingProfiler()
+admission_controller = AdmissionController(
+    ADMISSION_CLASSES, ADMISSION_MAX_IN_FLIGHT, metrics_registry, retry_after=ADMISSION_RETRY_AFTER_SECONDS
+) if ADMISSION_CONTROL else None
+
+async def dispatch_webhook(doc: dict) -> int:
+    """Replays a stored callback through its route handler and returns the response status."""
+    handler = routers.webhook_handler(doc["path"])
+    try:
+        response = await handler(webhook_inbox.replay_request(doc))
+    except HTTPException as e:
+        return e.status_code
+    return response.status_code
+
+webhook_inbox_processor = WebhookInboxProcessor(
+    db.webhook_inbox,
+    dispatch_webhook,
+    metrics_registry,
+    concurrency=WEBHOOK_INBOX_CONCURRENCY,
+    poll_interval=WEBHOOK_INBOX_POLL_MS / 1000,
+    max_attempts=WEBHOOK_INBOX_MAX_ATTEMPTS
+) if WEBHOOK_INBOX_PROCESSING else None
+
+if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+    per_process = [
+        name for name, backend in (
+            ("CACHE_BUS_BACKEND", CACHE_BUS_BACKEND),
+            ("LIVE_EVENTS_BACKEND", LIVE_EVENTS_BACKEND),
+            ("RATE_LIMIT_BACKEND", RATE_LIMIT_BACKEND)
+        ) if backend != "mongo"
+    ]
+    if per_process:
+        logging.warning(f"Running several workers with per-process {', '.join(per_process)}; set them to 'mongo' to share state")
+
 # Pydantic models
 class UserRegister(BaseModel):
     email: str
@@ -186,6 +416,14 @@ class UpdateTaskStatus(BaseModel):
 class WithdrawalApproval(BaseModel):
     transaction_id: str
 
+class BulkWithdrawalApproval(BaseModel):
+    transaction_ids: Optional[List[str]] = None
+    method: Optional[str] = None
+    currency: Optional[str] = None
+    min_amount: Optional[float] = None  # KES equivalent
+    max_amount: Optional[float] = None  # KES equivalent
+    limit: int = 100
+
 class SpinAndWinRequest(BaseModel):
     winning_amount: float
 
@@ -218,6 +456,296 @@ def verify_jwt_token(token: str) -> dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def gateway_request(
+    gateway: str,
+    method: str,
+    url: str,
+    transaction_id: str = None,
+    retries: int = 0,
+    marks_side_effect: bool = False,
+    **kwargs
+) -> httpx.Response:
+    """
+    Sends an outbound request to a payment gateway through its circuit breaker.
+    Fails fast with 503 while the breaker is open and with 504 past the latency budget.
+    5xx and 429 responses count as gateway failures; other responses are returned as-is.
+    `retries` re-sends after connection errors only, so use it for idempotent calls.
+    Every attempt is recorded in the gateway metrics and as a span tied to `transaction_id`.
+    Pass `marks_side_effect` for calls that move money (not token or rate lookups): once one
+    is sent, idempotency_middleware keeps the request's outcome instead of allowing a retry.
+    """
+    breaker = GATEWAY_BREAKERS[gateway]
+    sent = {}
+
+    async def send():
+        scope = request_scope.get()
+        if marks_side_effect and scope is not None:
+            # From here the provider may act on the request; see idempotency_middleware
+            scope["gateway_called"] = True
+        async with httpx.AsyncClient(timeout=breaker.timeout) as client:
+            response = await client.request(method, url, **kwargs)
+            sent["bytes"] = len(response.request.content)
+            return response
+
+    for attempt in range(retries + 1):
+        sent.clear()
+        call = {"gateway": gateway, "method": method, "url": url, "started": time.perf_counter(), "transaction_id": transaction_id, "attempt": attempt}
+        try:
+            response = await breaker.call(
+                send,
+                success_if=lambda response: response.status_code < 500 and response.status_code != 429
+            )
+        except LatencyBudgetExceeded:
+            gateway_instrumentation.record(**call, outcome="timeout")
+            raise
+        except CircuitOpenError:
+            gateway_instrumentation.record(**call, outcome="circuit_open")
+            raise
+        except Exception as e:
+            gateway_instrumentation.record(**call, outcome="error", error=f"{type(e).__name__}: {e}")
+            if attempt < retries and isinstance(e, httpx.TransportError) and not isinstance(e, httpx.TimeoutException):
+                continue
+            raise
+        gateway_instrumentation.record(
+            **call,
+            outcome="ok",
+            status_code=response.status_code,
+            request_bytes=sent.get("bytes", 0),
+            response_bytes=len(response.content)
+        )
+        return response
+
+async def record_gateway_event(
+    gateway: str,
+    event_type: str,
+    payload,
+    transaction_id: str = None,
+    session=None,
+    db_instance=None
+) -> str:
+    """
+    Appends a raw provider request/response/callback to the gateway_events collection
+    and returns its event_id. Transactions keep only the id (in gateway_event_ids), so
+    the hot transactions collection stays small.
+    """
+    if db_instance is None:
+        db_instance = db
+
+    event_doc = build_gateway_event(str(uuid.uuid4()), gateway, event_type, payload, transaction_id)
+    await db_instance.gateway_events.insert_one(event_doc, session=session)
+    return event_doc["event_id"]
+
+def build_gateway_event(event_id: str, gateway: str, event_type: str, payload, transaction_id: str = None, created_at: datetime = None) -> dict:
+    """Builds a gateway_events document, zlib-compressing large payloads when enabled."""
+    event_doc = {
+        "event_id": event_id,
+        "transaction_id": transaction_id,
+        "gateway": gateway,
+        "event_type": event_type,
+        "encoding": "json",
+        "payload": payload,
+        "created_at": created_at or datetime.utcnow()
+    }
+    if GATEWAY_EVENT_COMPRESSION == "zlib":
+        raw = json.dumps(payload, default=str).encode('utf-8')
+        if len(raw) >= GATEWAY_EVENT_COMPRESS_MIN_BYTES:
+            event_doc["encoding"] = "zlib"
+            event_doc["payload"] = Binary(zlib.compress(raw))
+    return event_doc
+
+def decode_gateway_event(event_doc: dict) -> dict:
+    """Inflates a compressed gateway event payload back to JSON."""
+    if event_doc.get("encoding") == "zlib":
+        event_doc["payload"] = json.loads(zlib.decompress(event_doc["payload"]).decode('utf-8'))
+        event_doc["encoding"] = "json"
+    return event_doc
+
+# Raw payload fields that used to be embedded in transactions, with the gateway event each becomes
+LEGACY_RAW_PAYLOAD_FIELDS = {
+    "payment_details.mpesa.request_payload": ("mpesa", "stk_push_request"),
+    "payment_details.mpesa.raw_response": ("mpesa", "stk_push_response"),
+    "payment_details.mpesa.raw_callback": ("mpesa", "stk_callback"),
+    "payment_details.raw_response": ("paystack", "initialize_response"),
+    "payment_details.paystack_webhook": ("paystack", "webhook"),
+    "payment_details.pesapal.order_payload": ("pesapal", "order_request"),
+    "payment_details.pesapal.ipn_data": ("pesapal", "ipn"),
+    "payment_details.pesapal.status_response": ("pesapal", "status_response"),
+    "payment_details.raw_order_response": ("paypal", "create_order_response"),
+    "payment_details.raw_b2c_request": ("mpesa", "b2c_request"),
+    "payment_details.raw_b2c_response": ("mpesa", "b2c_response"),
+}
+
+async def migrate_raw_gateway_payloads(db_instance=None, batch_size: int = 500) -> dict:
+    """
+    Moves raw payloads embedded in existing transactions into gateway_events and
+    replaces them with event ids. Event ids are derived from the transaction and
+    field, so an interrupted run can simply be repeated.
+    """
+    if db_instance is None:
+        db_instance = db
+
+    query = {"$or": [{field: {"$exists": True}} for field in LEGACY_RAW_PAYLOAD_FIELDS]}
+    projection = {"transaction_id": 1, "created_at": 1, **{field: 1 for field in LEGACY_RAW_PAYLOAD_FIELDS}}
+    migrated_transactions = 0
+    migrated_events = 0
+
+    while True:
+        batch = await db_instance.transactions.find(query, projection).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        events = []
+        updates = []
+        for txn in batch:
+            event_ids = []
+            for field, (gateway, event_type) in LEGACY_RAW_PAYLOAD_FIELDS.items():
+                value = txn
+                for part in field.split("."):
+                    value = value.get(part) if isinstance(value, dict) else None
+                if value is None:
+                    continue
+                event_id = f"legacy:{txn['transaction_id']}:{event_type}"
+                events.append(build_gateway_event(event_id, gateway, event_type, value, txn["transaction_id"], txn.get("created_at")))
+                event_ids.append(event_id)
+            updates.append(UpdateOne(
+                {"_id": txn["_id"]},
+                {
+                    "$unset": {field: "" for field in LEGACY_RAW_PAYLOAD_FIELDS},
+                    "$addToSet": {"gateway_event_ids": {"$each": event_ids}}
+                }
+            ))
+
+        if events:
+            try:
+                await db_instance.gateway_events.insert_many(events, ordered=False)
+            except BulkWriteError as e:
+                # Events already copied by an earlier, interrupted run
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+        await db_instance.transactions.bulk_write(updates, ordered=False)
+
+        migrated_transactions += len(batch)
+        migrated_events += len(events)
+        logging.info(f"Gateway payload migration: {migrated_transactions} transactions, {migrated_events} events moved")
+
+    return {"transactions": migrated_transactions, "events": migrated_events}
+
+# Session -> live events produced inside its open transaction, sent by commit_transaction
+deferred_live_events = weakref.WeakKeyDictionary()
+
+async def send_live_event(event: dict):
+    try:
+        if live_event_relay:
+            await live_event_relay.publish(event)
+        else:
+            live_event_hub.dispatch(event)
+    except Exception as e:
+        logging.warning(f"Failed to publish {event['type']} live event for {event['user_id'] or 'all users'}: {e}")
+
+async def publish_live_event(user_id: Optional[str], event_type: str, data: dict, session=None):
+    """
+    Pushes an event to the user's live streams (user_id None for everyone). Best effort:
+    failures are logged, never raised into the ledger path that produced the event.
+    Inside a transaction the event is held until commit_transaction, so clients never
+    see a balance from a settlement that was rolled back.
+    """
+    event = {"type": event_type, "user_id": user_id, "data": json_serializable_doc(copy.deepcopy(data))}
+    if session is not None and session.in_transaction:
+        deferred_live_events.setdefault(session, []).append(event)
+        return
+    await send_live_event(event)
+
+async def commit_transaction(session):
+    """Commits the session's transaction, then sends the live events it held back (dropped if the commit fails)."""
+    deferred = deferred_live_events.pop(session, [])
+    await session.commit_transaction()
+    for event in deferred:
+        await send_live_event(event)
+
+async def publish_wallet_delta(user_id: str, delta: float, balance: float, reason: str, session=None):
+    """Live event for a wallet balance change (KES)."""
+    await publish_live_event(
+        user_id,
+        "wallet",
+        {"delta": round(delta, 2), "balance": round(balance, 2), "currency": "KES", "reason": reason},
+        session=session
+    )
+
+async def bump_platform_counters(session=None, db_instance=None, **deltas):
+    """Atomically adjusts the platform_counters totals read by the admin dashboard."""
+    if db_instance is None:
+        db_instance = db
+    await db_instance.platform_counters.update_one(
+        {"_id": "platform"},
+        {"$inc": deltas, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True,
+        session=session
+    )
+
+async def count_completed_transaction(transaction: dict, amount: float = None, session=None, db_instance=None):
+    """Adds a deposit or withdrawal that just reached 'completed' to the platform totals."""
+    if amount is None:
+        amount = float(transaction.get("amount") or transaction.get("kes_amount") or 0.0)
+    if transaction["type"] == "deposit":
+        await bump_platform_counters(session=session, db_instance=db_instance, total_deposits=amount)
+    elif transaction["type"] == "withdrawal":
+        deltas = {"total_withdrawals": amount}
+        if transaction.get("status") == "pending_admin_approval":
+            deltas["pending_withdrawals"] = -1
+        await bump_platform_counters(session=session, db_instance=db_instance, **deltas)
+
+TASK_STAT_FIELDS = ("completions", "completed", "earnings")
+
+async def bump_task_stats(task: dict, created_at: datetime, session=None, **deltas):
+    """
+    Applies completion deltas (completions, completed, earnings) to the task_stats
+    counters for the task, its type, its day bucket and the overall totals.
+    """
+    now = datetime.utcnow()
+    task_type = task.get("type", "general")
+    day = created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+    labels = {"task_id": task["task_id"], "type": task_type, "updated_at": now}
+    await db.task_stats.bulk_write([
+        UpdateOne({"_id": "totals"}, {"$inc": deltas, "$set": {"updated_at": now}}, upsert=True),
+        UpdateOne({"_id": f"task:{task['task_id']}"}, {"$inc": deltas, "$set": {"scope": "task", **labels}}, upsert=True),
+        UpdateOne({"_id": f"type:{task_type}"}, {"$inc": deltas, "$set": {"scope": "type", "type": task_type, "updated_at": now}}, upsert=True),
+        UpdateOne(
+            {"_id": f"day:{day:%Y-%m-%d}:{task['task_id']}"},
+            {"$inc": deltas, "$set": {"scope": "day", "bucket": day, **labels}},
+            upsert=True
+        )
+    ], ordered=False, session=session)
+
+async def bump_task_totals(**deltas):
+    """Adjusts the task counts (tasks, active_tasks) kept on the task_stats totals document."""
+    await db.task_stats.update_one(
+        {"_id": "totals"},
+        {"$inc": deltas, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def move_task_stats_type(task_id: str, old_type: str, new_type: str):
+    """Re-attributes a task's counters and day buckets after an admin changes its type."""
+    stats = await db.task_stats.find_one_and_update({"_id": f"task:{task_id}"}, {"$set": {"type": new_type}})
+    if stats:
+        moved = {field: stats.get(field, 0) for field in TASK_STAT_FIELDS}
+        await db.task_stats.bulk_write([
+            UpdateOne({"_id": f"type:{old_type}"}, {"$inc": {field: -value for field, value in moved.items()}}),
+            UpdateOne({"_id": f"type:{new_type}"}, {"$inc": moved, "$set": {"scope": "type", "type": new_type}}, upsert=True)
+        ])
+    await db.task_stats.update_many({"scope": "day", "task_id": task_id}, {"$set": {"type": new_type}})
+
+async def remove_task_stats(task_id: str):
+    """Drops a deleted task's counters and takes them out of its type and the totals."""
+    stats = await db.task_stats.find_one_and_delete({"_id": f"task:{task_id}"})
+    if stats:
+        removed = {field: -stats.get(field, 0) for field in TASK_STAT_FIELDS}
+        await db.task_stats.bulk_write([
+            UpdateOne({"_id": f"type:{stats['type']}"}, {"$inc": removed}),
+            UpdateOne({"_id": "totals"}, {"$inc": removed})
+        ])
+    await db.task_stats.delete_many({"scope": "day", "task_id": task_id})
+
 def generate_referral_code() -> str:
     return secrets.token_urlsafe(8).upper()
 
@@ -274,7 +802,7 @@ async def update_leg_sizes(current_id: str, leg_position: str, delta: int = 1, d
         if parent_position:
             await update_leg_sizes(parent_id, parent_position, delta, db_instance)
 
-async def trigger_binary_commissions(user_id: str, session=None, db_instance=None):
+async def trigger_binary_commissions(user_id: str, session=None, db_instance=None, notifications=None):
     """
     Triggers binary commissions up the tree when a user activates.
     Awards commissions to activated uplines up to 5 levels.
@@ -325,6 +853,7 @@ async def trigger_binary_commissions(user_id: str, session=None, db_instance=Non
                 },
                 session=session
             )
+            await publish_wallet_delta(parent_id, comm, new_balance, "binary_commission", session=session)
             
             # Create transaction record
             await db_instance.transactions.insert_one(
@@ -352,7 +881,8 @@ async def trigger_binary_commissions(user_id: str, session=None, db_instance=Non
                     "type": "reward"
                 },
                 session=session,
-                db_instance=db_instance
+                db_instance=db_instance,
+                buffer=notifications
             )
         
         current = parent
@@ -383,7 +913,12 @@ async def get_exchange_rate(from_currency: str, to_currency: str) -> float:
         return 1.0
     
     cache_id = "global_rates"
-    rates_doc = await db.rates.find_one({"_id": cache_id})
+    rates_doc = rates_cache.get(cache_id)
+    if rates_doc is None:
+        version = rates_cache.version
+        rates_doc = await db.rates.find_one({"_id": cache_id})
+        if rates_doc:
+            rates_cache.set(cache_id, rates_doc, version=version)
     now = datetime.utcnow()
     cache_valid = rates_doc and (now - rates_doc.get('updated_at', datetime.min)) < timedelta(days=30)
     
@@ -396,9 +931,8 @@ async def get_exchange_rate(from_currency: str, to_currency: str) -> float:
     else:
         if not cache_valid:
             try:
-                async with httpx.AsyncClient(timeout=10.0) as client:
-                    response = await client.get(CURRENCY_API_URL)
-                    response.raise_for_status()
+                response = await gateway_request("exchange_rates", "GET", CURRENCY_API_URL, retries=1)
+                response.raise_for_status()
                 data = response.json()
                 
                 # Use the correct key for rates from API response
@@ -414,6 +948,8 @@ async def get_exchange_rate(from_currency: str, to_currency: str) -> float:
                     "updated_at": now
                 }
                 await db.rates.replace_one({"_id": cache_id}, rates_doc, upsert=True)
+                await cache_bus.invalidate("rates")
+                rates_cache.set(cache_id, rates_doc)
                 logging.info("Exchange rates refreshed from API")
                 
                 if from_currency in rates and to_currency in rates:
@@ -437,20 +973,28 @@ async def get_exchange_rate(from_currency: str, to_currency: str) -> float:
 
 # M-Pesa Utility Functions
 async def get_mpesa_access_token():
-    """Fetches M-Pesa API access token."""
+    """Fetches M-Pesa API access token, reusing a cached one until shortly before it expires."""
+    token = gateway_token_cache.get("mpesa")
+    if token:
+        return token
+    version = gateway_token_cache.version
     try:
         consumer_key_secret = f"{MPESA_CONSUMER_KEY}:{MPESA_CONSUMER_SECRET}"
         encoded_auth = base64.b64encode(consumer_key_secret.encode('utf-8')).decode('utf-8')
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials",
-                headers={"Authorization": f"Basic {encoded_auth}"}
-            )
-            response.raise_for_status() 
-            return response.json()["access_token"]
+        response = await gateway_request(
+            "mpesa", "GET",
+            f"{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
+            headers={"Authorization": f"Basic {encoded_auth}"}
+        )
+        response.raise_for_status() 
+        data = response.json()
+        gateway_token_cache.set("mpesa", data["access_token"], version=version, ttl_seconds=int(data.get("expires_in", 3599)) - 60)
+        return data["access_token"]
+    except HTTPException:
+        raise
     except httpx.HTTPStatusError as e:
-        logging.error(f"M-Pesa Auth HTTP error: {e.response.status_code} - {e.response.text}")
+        logging.error("M-Pesa Auth HTTP error: %s - %s", e.response.status_code, log_payload(e.response.text))
         raise HTTPException(status_code=500, detail=f"M-Pesa authentication failed: {e.response.text}")
     except Exception as e:
         logging.error(f"M-Pesa Auth error: {e}")
@@ -464,26 +1008,34 @@ async def generate_mpesa_password(timestamp: str):
 
 # PayPal Utility Functions
 async def get_paypal_access_token():
-    """Fetches PayPal API access token."""
+    """Fetches PayPal API access token, reusing a cached one until shortly before it expires."""
+    token = gateway_token_cache.get("paypal")
+    if token:
+        return token
+    version = gateway_token_cache.version
     try:
         client_id_secret = f"{PAYPAL_CLIENT_ID}:{PAYPAL_CLIENT_SECRET}"
         encoded_auth = base64.b64encode(client_id_secret.encode('utf-8')).decode('utf-8')
         
-        paypal_auth_url = "https://api-m.sandbox.paypal.com/v1/oauth2/token" if PAYPAL_MODE == "sandbox" else "https://api-m.paypal.com/v1/oauth2/token"
+        paypal_auth_url = f"{PAYPAL_BASE_URL}/v1/oauth2/token"
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                paypal_auth_url,
-                headers={
-                    "Authorization": f"Basic {encoded_auth}",
-                    "Content-Type": "application/x-www-form-urlencoded"
-                },
-                data="grant_type=client_credentials"
-            )
-            response.raise_for_status()
-            return response.json()["access_token"]
+        response = await gateway_request(
+            "paypal", "POST",
+            paypal_auth_url,
+            headers={
+                "Authorization": f"Basic {encoded_auth}",
+                "Content-Type": "application/x-www-form-urlencoded"
+            },
+            content="grant_type=client_credentials"
+        )
+        response.raise_for_status()
+        data = response.json()
+        gateway_token_cache.set("paypal", data["access_token"], version=version, ttl_seconds=int(data.get("expires_in", 3600)) - 60)
+        return data["access_token"]
+    except HTTPException:
+        raise
     except httpx.HTTPStatusError as e:
-        logging.error(f"PayPal Auth HTTP error: {e.response.status_code} - {e.response.text}")
+        logging.error("PayPal Auth HTTP error: %s - %s", e.response.status_code, log_payload(e.response.text))
         raise HTTPException(status_code=500, detail=f"PayPal authentication failed: {e.response.text}")
     except Exception as e:
         logging.error(f"PayPal Auth error: {e}")
@@ -491,7 +1043,11 @@ async def get_paypal_access_token():
 
 # Pesapal Utility Functions
 async def get_pesapal_access_token():
-    """Fetches Pesapal API access token."""
+    """Fetches Pesapal API access token, reusing a cached one until shortly before it expires."""
+    token = gateway_token_cache.get("pesapal")
+    if token:
+        return token
+    version = gateway_token_cache.version
     try:
         headers = {
             "Content-Type": "application/json",
@@ -503,22 +1059,22 @@ async def get_pesapal_access_token():
             "consumer_secret": PESAPAL_CONSUMER_SECRET
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                PESAPAL_AUTH_URL,
-                json=payload,
-                headers=headers
-            )
+        response = await gateway_request("pesapal", "POST", PESAPAL_AUTH_URL, json=payload, headers=headers)
+        
+        if response.status_code != 200:
+            logging.error("Pesapal Auth failed: %s - %s", response.status_code, log_payload(response.text))
+            raise HTTPException(status_code=500, detail="Pesapal authentication failed")
             
-            if response.status_code != 200:
-                logging.error(f"Pesapal Auth failed: {response.status_code} - {response.text}")
-                raise HTTPException(status_code=500, detail="Pesapal authentication failed")
-                
-            data = response.json()
-            return data.get("token")
+        data = response.json()
+        if data.get("token"):
+            # Pesapal tokens last five minutes
+            gateway_token_cache.set("pesapal", data["token"], version=version, ttl_seconds=240)
+        return data.get("token")
             
+    except HTTPException:
+        raise
     except httpx.HTTPStatusError as e:
-        logging.error(f"Pesapal Auth HTTP error: {e.response.status_code} - {e.response.text}")
+        logging.error("Pesapal Auth HTTP error: %s - %s", e.response.status_code, log_payload(e.response.text))
         raise HTTPException(status_code=500, detail=f"Pesapal authentication failed: {e.response.text}")
     except Exception as e:
         logging.error(f"Pesapal Auth error: {e}")
@@ -540,19 +1096,14 @@ async def register_pesapal_ipn():
             "ipn_notification_type": "POST"
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                PESAPAL_IPN_URL,
-                json=payload,
-                headers=headers
-            )
+        response = await gateway_request("pesapal", "POST", PESAPAL_IPN_URL, json=payload, headers=headers)
+        
+        if response.status_code != 200:
+            logging.error("Pesapal IPN registration failed: %s - %s", response.status_code, log_payload(response.text))
+            return None
             
-            if response.status_code != 200:
-                logging.error(f"Pesapal IPN registration failed: {response.status_code} - {response.text}")
-                return None
-                
-            data = response.json()
-            return data.get("ipn_id")
+        data = response.json()
+        return data.get("ipn_id")
             
     except Exception as e:
         logging.error(f"Pesapal IPN registration error: {e}")
@@ -561,14 +1112,16 @@ async def register_pesapal_ipn():
 # New utility function for sending emails
 async def send_email(subject: str, recipient: str, body: str):
     """Sends a generic email using the configured mail server."""
-    message = MessageSchema(
-        subject=subject,
-        recipients=[recipient],
-        body=body,
-        subtype="html"
-    )
-    fm = FastMail(conf)
     try:
+        if not fastapi_mail.loaded:
+            await asyncio.to_thread(fastapi_mail.load)  # first email in a slim worker; keep the import off the loop
+        message = fastapi_mail.MessageSchema(
+            subject=subject,
+            recipients=[recipient],
+            body=body,
+            subtype="html"
+        )
+        fm = fastapi_mail.FastMail(mail_config())
         await fm.send_message(message)
         logging.info(f"Email sent successfully to {recipient}")
     except Exception as e:
@@ -579,20 +1132,175 @@ async def get_db_instance():
     """Dependency to provide the MongoDB database instance."""
     return db
 
-# Dependency to get current user
-async def get_current_user(request: Request, db: AsyncIOMotorClient = Depends(get_db_instance)):
-    token = request.headers.get('Authorization')
-    if not token:
-        raise HTTPException(status_code=401, detail="No token provided")
-    
+def token_user_id(request: Request) -> Optional[str]:
+    """The user_id from a valid bearer token, without a DB lookup; None when absent or invalid."""
+    token = request.headers.get('Authorization', '')
     if token.startswith('Bearer '):
         token = token[7:]
-    
-    payload = verify_jwt_token(token)
-    user = await db.users.find_one({"user_id": payload['user_id']})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=['HS256'])['user_id']
+    except Exception:
+        return None
+
+def client_ip(request: Request) -> str:
+    """
+    The client's address. Hops left of those our TRUSTED_PROXY_COUNT proxies appended are
+    whatever the client sent, so only the hop the outermost trusted proxy added is used.
+    """
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if TRUSTED_PROXY_COUNT > 0 and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+        if hops:
+            return hops[-min(TRUSTED_PROXY_COUNT, len(hops))]
+    return request.client.host if request.client else 'unknown'
+
+def rate_limit_key(request: Request) -> str:
+    """Rate-limit identity: the token's user_id when present (no DB lookup), otherwise the client IP."""
+    user_id = token_user_id(request)
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{client_ip(request)}"
+
+def rate_limit(policy_name: str, scope: str = None):
+    """
+    Dependency factory enforcing the named token-bucket policy on a route. Routes given a
+    scope get their own buckets under the policy, e.g. one deposit bucket per gateway.
+    """
+    async def enforce_rate_limit(request: Request):
+        key = rate_limit_key(request)
+        await rate_limiter.check(policy_name, f"{key}:{scope}" if scope else key)
+    return enforce_rate_limit
+
+async def store_idempotent_response(record_id: str, status_code: int, body: bytes, media_type: str):
+    try:
+        await idempotency_store.complete(record_id, status_code, body, media_type)
+    except Exception as e:
+        logging.error(f"Failed to store idempotent response for {record_id}: {e}")
+
+async def idempotency_middleware(request: Request, call_next):
+    """
+    Honours the Idempotency-Key header on deposit and withdrawal initiation. The first
+    response per user, route and key is stored; retries get it back verbatim without
+    re-running validation or calling a gateway. Server errors, conflicts and rate-limit
+    rejections from before any money-moving gateway call (token and rate lookups do not
+    count) are not stored, so the client can retry them with the same key. Once such a call
+    is sent the provider may have acted, so the outcome is stored whatever it is (a 504 past
+    the latency budget included).
+    """
+    key = request.headers.get("Idempotency-Key")
+    if not key or request.method != "POST" or request.url.path not in IDEMPOTENT_ROUTES:
+        return await call_next(request)
+
+    user_id = token_user_id(request)
+    if not user_id:
+        # Let get_current_user reject it as usual
+        return await call_next(request)
+    if len(key) > 255:
+        return JSONResponse(status_code=400, content={"detail": "Idempotency-Key must be at most 255 characters"})
+
+    record_id = f"{user_id}:{request.url.path}:{key}"
+    body = await request.body()
+    try:
+        outcome, record = await idempotency_store.begin(record_id, request_fingerprint(request.method, request.url.path, body))
+    except Exception as e:
+        logging.error(f"Idempotency store unavailable for {request.url.path}: {e}")
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Service temporarily unavailable. Please try again shortly."},
+            headers={"Retry-After": "5"}
+        )
+
+    if outcome == idempotency.REPLAY:
+        logging.info(f"Replaying stored response for Idempotency-Key on {request.url.path} (user {user_id})")
+        return Response(
+            content=record["response_body"],
+            status_code=record["response_status"],
+            media_type=record.get("response_media_type", "application/json"),
+            headers={"Idempotent-Replayed": "true"}
+        )
+    if outcome == idempotency.IN_PROGRESS:
+        return JSONResponse(
+            status_code=409,
+            content={"detail": "A request with this Idempotency-Key is still being processed."},
+            headers={"Retry-After": "2"}
+        )
+    if outcome == idempotency.MISMATCH:
+        return JSONResponse(
+            status_code=422,
+            content={"detail": "This Idempotency-Key was already used for a different request."}
+        )
+
+    try:
+        response = await call_next(request)
+    except Exception:
+        if not request.scope.get("gateway_called"):
+            await idempotency_store.release(record_id)
+            raise
+        # The provider may have acted on it, so retries with this key must not run it again
+        logging.error(f"Request for {record_id} failed after a gateway call", exc_info=True)
+        response = JSONResponse(
+            status_code=502,
+            content={"detail": "The payment provider may have received this request. Check your transactions before retrying with a new Idempotency-Key."}
+        )
+        await store_idempotent_response(record_id, response.status_code, response.body, response.media_type)
+        return response
+
+    if not request.scope.get("gateway_called") and (response.status_code >= 500 or response.status_code in (409, 429)):
+        await idempotency_store.release(record_id)
+        return response
+
+    response_body = b"".join([chunk async for chunk in response.body_iterator])
+    await store_idempotent_response(record_id, response.status_code, response_body, response.headers.get("content-type", "application/json"))
+    stored = Response(content=response_body, status_code=response.status_code)
+    # raw_headers keeps repeated headers such as Set-Cookie, which a dict would merge
+    stored.raw_headers = [header for header in response.raw_headers if header[0] != b"content-length"] + [
+        header for header in stored.raw_headers if header[0] == b"content-length"
+    ]
+    return stored
+
+live_event_connections_gauge = metrics_registry.gauge("live_event_connections", "Open SSE live event streams in this worker")
+cache_entries_gauge = metrics_registry.gauge("cache_entries", "Entries held per cache in this worker", ("cache",))
+log_queue_depth_gauge = metrics_registry.gauge("log_queue_depth", "Log records waiting for the writer thread")
+log_dropped_gauge = metrics_registry.gauge("log_records_dropped", "Log records dropped because the log queue was full, since the worker started")
+
+@metrics_registry.collector
+def collect_worker_gauges():
+    live_event_connections_gauge.set(value=live_event_hub.connection_count)
+    for name, breaker in GATEWAY_BREAKERS.items():
+        gateway_circuit_state_gauge.set(name, value=int(breaker.state != "closed"))
+    for cache in (*cache_bus.caches.values(), user_cache):
+        cache_entries_gauge.set(cache.name, value=len(cache))
+    log_queue_depth_gauge.set(value=log_queue_handler.queue.qsize())
+    log_dropped_gauge.set(value=log_queue_handler.dropped)
+
+async def get_metrics(request: Request):
+    """This worker's metrics in Prometheus text format."""
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def load_user(user_id: str, db_instance, cached: bool = False) -> Optional[dict]:
+    """
+    The user's document, from user_cache when `cached`. Only read-only requests may use
+    the cache: write handlers compute new balances from the document they are given.
+    """
+    doc_id = user_doc_ids.get(user_id)
+    if cached and doc_id is not None:
+        user = user_cache.get(doc_id)
+        if user is not None:
+            return copy.deepcopy(user)
+
+    version = user_cache.version
+    user = await db_instance.users.find_one({"user_id": user_id})
+    if user:
+        user_doc_ids.set(user_id, str(user["_id"]))
+        user_cache.set(str(user["_id"]), copy.deepcopy(user), version=version)
+    return user
+
+def coerce_user_fields(user: dict) -> dict:
+    """Fills defaults and converts the string-stored balances of a user document to numbers, in place."""
     user['preferred_currency'] = user.get('preferred_currency', 'KES')
     
     # Convert string numbers from DB back to float for use in application logic
@@ -617,3707 +1325,917 @@ async def get_current_user(request: Request, db: AsyncIOMotorClient = Depends(ge
 
     return user
 
+# Dependency to get current user
+async def get_current_user(request: Request, db: AsyncIOMotorClient = Depends(get_db_instance)):
+    token = request.headers.get('Authorization')
+    if not token:
+        raise HTTPException(status_code=401, detail="No token provided")
+    
+    if token.startswith('Bearer '):
+        token = token[7:]
+    
+    payload = verify_jwt_token(token)
+    user = await load_user(payload['user_id'], db, cached=request.method in ("GET", "HEAD"))
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return coerce_user_fields(user)
+
 # Dependency to get current admin user
 async def get_current_admin_user(current_user: dict = Depends(get_current_user)):
     if current_user.get('role') != 'admin':
         raise HTTPException(status_code=403, detail="Not authorized. Admin access required.")
     return current_user
 
-# Auth routes
-@app.post("/api/auth/register")
-async def register(user_data: UserRegister):
-    # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_data.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
+def generate_quick_actions(user: dict, rate: float = 1.0, preferred: str = "KES") -> list:
+    """Generate context-aware quick actions"""
+    def convert(amount: float) -> float:
+        return round(amount * rate, 2)
     
-    # Check phone number
-    existing_phone = await db.users.find_one({"phone": validate_and_format_phone(user_data.phone)})
-    if existing_phone:
-        raise HTTPException(status_code=400, detail="Phone number already registered")
-
-    user_id = str(uuid.uuid4())
-    referral_code = generate_referral_code()
+    actions = []
+    
+    if not user['is_activated']:
+        actions.append({
+            "title": "Activate Account",
+            "description": f"Deposit {convert(user.get('activation_amount', 500.0)):.2f} {preferred} to activate",
+            "action": "deposit",
+            "priority": "high"
+        })
     
-    # Handle referral if provided
-    referred_by = None
-    if user_data.referral_code:
-        referrer = await db.users.find_one({"referral_code": user_data.referral_code})
-        if referrer:
-            referred_by = referrer['user_id']
+    if user.get('referral_count', 0) < 5:
+        actions.append({
+            "title": "Earn More",
+            "description": "Invite friends to earn bonuses",
+            "action": "invite",
+            "priority": "medium"
+        })
     
-    # Create user document
-    user_doc = {
-        "user_id": user_id,
-        "email": user_data.email.lower().strip(),
-        "password": hash_password(user_data.password),
-        "full_name": user_data.full_name.strip(),
-        "phone": validate_and_format_phone(user_data.phone),
-        "referral_code": referral_code,
-        "referred_by": referred_by,
-        "parent_id": referred_by,
-        "position": None,
-        "left_leg_size": 0,
-        "right_leg_size": 0,
-        "binary_earnings": "0.00",
-        "wallet_balance": "0.00",
-        "is_activated": False,
-        "activation_amount": "10.00",
-        "total_earned": "0.00",
-        "total_withdrawn": "0.00",
-        "referral_earnings": "0.00",
-        "task_earnings": "0.00",
-        "referral_count": 0,
-        "has_spun_once": False,
-        "payment_methods": {
-            "mpesa": {"phone": None, "verified": False},
-            "paypal": {"email": None, "verified": False},
-            "pesapal": {"phone": None, "verified": False}
-        },
-        "security": {
-            "two_factor_enabled": False,
-            "last_password_change": datetime.utcnow()
-        },
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
-        "last_login": datetime.utcnow(),
-        "notifications_enabled": True,
-        "communication_preferences": {
-            "email": True,
-            "sms": True,
-            "push": True
+    if user['wallet_balance'] >= 200.00:
+        converted_balance = convert(user['wallet_balance'])
+        actions.append({
+            "title": "Withdraw Earnings",
+            "description": f"Cash out your balance ({converted_balance:.2f} {preferred})",
+            "action": "withdraw",
+            "priority": "medium"
+        })
+    
+    # Add default actions
+    actions.extend([
+        {
+            "title": "Complete Tasks",
+            "description": "Earn money by completing tasks",
+            "action": "tasks",
+            "priority": "low"
         },
-        "theme": "light",
-        "role": user_data.role.lower() if user_data.role else "user",
-        "preferred_currency": user_data.preferred_currency or "KES",
-        "status": "active",
-        "verification": {
-            "email_verified": False,
-            "phone_verified": False,
-            "identity_verified": False
+        {
+            "title": "View Tutorial",
+            "description": "Learn how to maximize earnings",
+            "action": "tutorial",
+            "priority": "low"
         },
-        "left_child_id": None,
-        "right_child_id": None,
-        "team_earnings": "0.00",
-        "activation_expense": "300.00",
-        "activation_reward": "0.00",
-        "team_reward_claimed": False
-    }
+        {
+            "title": "Transaction History",
+            "description": "View your deposits and withdrawals",
+            "action": "history",
+            "priority": "low"
+        }
+    ])
+    
+    return actions
 
-    try:
-        # Insert user document
-        await db.users.insert_one(user_doc)
-
-        # Handle referral
-        if referred_by:
-            referral_doc = {
-                "referral_id": str(uuid.uuid4()),
-                "referrer_id": referred_by,
-                "referred_id": user_id,
-                "status": "pending",
-                "created_at": datetime.utcnow(),
-                "activation_date": None,
-                "reward_amount": "50.00",
-                "currency": "KES"
-            }
-            await db.referrals.insert_one(referral_doc)
+async def build_team_tree(user_id: str, db_instance=None, max_depth=5, current_depth=0):
+    """Recursively build team tree structure up to max_depth"""
+    if db_instance is None:
+        db_instance = db
+    if current_depth >= max_depth:
+        return None
 
-            # Increment referrer's referral count
-            await db.users.update_one(
-                {"user_id": referred_by},
-                {"$inc": {"referral_count": 1}}
-            )
+    user = await db_instance.users.find_one({"user_id": user_id}, {"password": 0, "payment_methods": 0, "security": 0, "verification": 0})
+    if not user:
+        return None
 
-            # Binary placement logic
-            sponsor = await db.users.find_one({"user_id": referred_by})
-            if sponsor:
-                left_size = sponsor.get("left_leg_size", 0)
-                right_size = sponsor.get("right_leg_size", 0)
-                position = "left" if left_size <= right_size else "right"
+    # Recurse for children
+    left_child = await build_team_tree(user.get("left_child_id"), db_instance, max_depth, current_depth + 1) if user.get("left_child_id") else None
+    right_child = await build_team_tree(user.get("right_child_id"), db_instance, max_depth, current_depth + 1) if user.get("right_child_id") else None
 
-                # Update new user's position
-                await db.users.update_one(
-                    {"user_id": user_id},
-                    {"$set": {"position": position}}
-                )
+    # Build node
+    tree_node = json_serializable_doc({
+        "user_id": user["user_id"],
+        "full_name": user["full_name"],
+        "email": user["email"],  # For tree view
+        "left_leg_size": user.get("left_leg_size", 0),
+        "right_leg_size": user.get("right_leg_size", 0),
+        "position": user.get("position"),
+        "is_activated": user.get("is_activated", False),
+        "left_child": left_child,
+        "right_child": right_child
+    })
 
-                # Set parent's child_id if first in leg
-                child_update = {}
-                if position == "left" and sponsor.get("left_child_id") is None:
-                    child_update["left_child_id"] = user_id
-                elif position == "right" and sponsor.get("right_child_id") is None:
-                    child_update["right_child_id"] = user_id
-                if child_update:
-                    await db.users.update_one(
-                        {"user_id": referred_by},
-                        {"$set": child_update}
-                    )
+    return tree_node
 
-                # Update leg sizes up the tree
-                await update_leg_sizes(referred_by, position, 1, db_instance=db)
+# Payment routes
 
-        # Create initial wallet transaction record
-        transaction_doc = {
-            "transaction_id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "type": "account_creation",
-            "amount": "0.00",
-            "currency": "KES",
-            "status": "completed",
-            "description": "Initial account creation",
-            "created_at": datetime.utcnow(),
-            "completed_at": datetime.utcnow()
-        }
-        await db.transactions.insert_one(transaction_doc)
-
-        # Send welcome email
-        welcome_email_body = f"""
-        <h1>Welcome to EarnPlatform, {user_doc['full_name']}!</h1>
-        <p>Thank you for registering. Your account has been created successfully.</p>
-        <p>Please deposit KSH 300 to activate your account and unlock all features. You'll also receive a 300 KES reward!</p>
-        """
-        await send_email(
-            subject="Welcome to EarnPlatform!",
-            recipient=user_doc["email"],
-            body=welcome_email_body
+async def process_referral_reward(referred_id: str, referrer_id: str, session=None, notifications=None):
+    """Process referral reward with fraud checks"""
+    try:
+        # Get referral record
+        referral = await db.referrals.find_one(
+            {
+                "referred_id": referred_id,
+                "referrer_id": referrer_id,
+                "status": "pending"
+            },
+            session=session
         )
 
-    except Exception as e:
-        logging.error(f"Registration failed for {user_data.email}: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Registration failed: {str(e)}"
-        )
-
-    # Generate JWT token
-    token = create_jwt_token(
-        user_id=user_id,
-        email=user_data.email,
-        role=user_doc["role"],
-        is_activated=user_doc["is_activated"]
-    )
-
-    # Return response with sanitized user data
-    return {
-        "success": True,
-        "message": "Registration successful! A welcome email has been sent. Please deposit KSH 300 to activate your account.",
-        "token": token,
-        "user": json_serializable_doc({
-            "user_id": user_id,
-            "email": user_data.email,
-            "full_name": user_data.full_name,
-            "referral_code": referral_code,
-            "is_activated": False,
-            "wallet_balance": user_doc["wallet_balance"],
-            "preferred_currency": user_doc["preferred_currency"],
-            "role": user_doc["role"],
-            "has_spun_once": user_doc["has_spun_once"],
-            "has_payment_methods": False,
-            "verification_status": {
-                "email": False,
-                "phone": False
-            }
-        }),
-        "next_steps": [
-            "verify_email",
-            "verify_phone",
-            "add_payment_method",
-            "make_activation_deposit"
-        ]
-    }
-@app.post("/api/auth/login")
-async def login(user_data: UserLogin):
-    user = await db.users.find_one({"email": user_data.email})
-    if not user or not verify_password(user_data.password, user['password']):
-        raise HTTPException(status_code=401, detail="Invalid email or password")
-    
-    # Update last login
-    await db.users.update_one(
-        {"user_id": user['user_id']},
-        {"$set": {"last_login": datetime.utcnow()}}
-    )
-    
-    token = create_jwt_token(user['user_id'], user['email'], user.get('role', 'user'), user.get('is_activated', False)) 
-    
-    # Return serializable user data
-    return {
-        "success": True,
-        "message": "Login successful!",
-        "token": token,
-        "user": json_serializable_doc({
-            "user_id": user['user_id'],
-            "email": user['email'],
-            "full_name": user['full_name'],
-            "referral_code": user['referral_code'],
-            "is_activated": user['is_activated'],
-            "wallet_balance": user['wallet_balance'],
-            "preferred_currency": user.get('preferred_currency', 'KES'),
-            "theme": user.get('theme', 'light'),
-            "role": user.get('role', 'user'),
-            "has_spun_once": user.get('has_spun_once', False)
-        })
-    }
-
-@app.post("/api/auth/request-password-reset")
-async def request_password_reset(reset_request: PasswordResetRequest):
-    user = await db.users.find_one({"email": reset_request.email})
-    if not user:
-        # Prevent user enumeration by sending a generic success message
-        return JSONResponse(content={"success": True, "message": "If your email is in our system, you will receive a password reset link."})
-    
-    # Generate a unique, temporary token
-    reset_token = secrets.token_urlsafe(32)
-    token_expiration = datetime.utcnow() + timedelta(hours=1)
-    
-    # Store the token and expiration in the user document
-    await db.users.update_one(
-        {"_id": user["_id"]},
-        {"$set": {"reset_token": reset_token, "reset_token_expires": token_expiration}}
-    )
-    
-    # Construct the reset link and email body
-    reset_link = f"{BASE_URL}/reset-password?token={reset_token}"
-    email_body = f"""
-    <h1>Password Reset Request for EarnPlatform</h1>
-    <p>Hello {user['full_name']},</p>
-    <p>We received a request to reset your password. If you did not make this request, please ignore this email or contact support.</p>
-    <p>To reset your password, click the secure link below:</p>
-    <a href="{reset_link}" style="background-color: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">Reset My Password</a>
-    <p>This link expires in 1 hour for security.</p>
-    <p>If the link doesn't work, copy and paste it into your browser: {reset_link}</p>
-    <p>Best regards,<br>EarnPlatform Team</p>
-    """
-    
-    await send_email(
-        subject="Password Reset for Your EarnPlatform Account",
-        recipient=user["email"],
-        body=email_body
-    )
-    
-    return JSONResponse(content={"success": True, "message": "If your email is in our system, you will receive a password reset link."})
-
-@app.get("/api/auth/verify-reset-token")
-async def verify_reset_token(token: str):
-    """Verify if a reset token is valid before showing the form."""
-    user = await db.users.find_one({
-        "reset_token": token,
-        "reset_token_expires": {"$gt": datetime.utcnow()}
-    })
-    
-    if not user:
-        raise HTTPException(status_code=400, detail="Invalid or expired token")
-    
-    return {
-        "success": True,
-        "valid": True,
-        "expires_at": user["reset_token_expires"].isoformat(),
-        "message": "Token is valid. Proceed to reset password."
-    }
-
-@app.post("/api/auth/reset-password")
-async def reset_password(reset_data: PasswordReset):
-    user = await db.users.find_one({
-        "reset_token": reset_data.token,
-        "reset_token_expires": {"$gt": datetime.utcnow()}
-    })
-
-    if not user:
-        raise HTTPException(status_code=400, detail="Invalid or expired token")
-
-    # Validate new password (basic: length, no reuse - extend as needed)
-    if len(reset_data.new_password) < 8:
-        raise HTTPException(status_code=400, detail="New password must be at least 8 characters")
-
-    # Hash the new password and clear the reset token fields
-    hashed_password = hash_password(reset_data.new_password)
-    await db.users.update_one(
-        {"_id": user["_id"]},
-        {
-            "$set": {
-                "password": hashed_password,
-                "last_password_change": datetime.utcnow()
-            },
-            "$unset": {"reset_token": "", "reset_token_expires": ""}
-        }
-    )
-
-    # Send confirmation email
-    confirm_email = f"""
-    <h1>Password Reset Successful</h1>
-    <p>Hello {user['full_name']},</p>
-    <p>Your password has been successfully reset.</p>
-    <p>You can now log in with your new password at {BASE_URL}/login.</p>
-    <p>If you did not request this change, please contact support immediately.</p>
-    <p>Best regards,<br>EarnPlatform Team</p>
-    """
-    await send_email(
-        subject="Password Reset Confirmation",
-        recipient=user["email"],
-        body=confirm_email
-    )
-
-    return {
-        "success": True,
-        "message": "Password has been successfully reset. You can now log in with your new password.",
-        "next_step": "login"
-    }
-
-@app.get("/api/auth/me")
-async def get_current_user_info(current_user: dict = Depends(get_current_user)):
-    """
-    Get current user information.
-    This endpoint returns the authenticated user's profile data.
-    """
-    try:
-        # Convert user data to serializable format
-        user_data = json_serializable_doc({
-            "user_id": current_user['user_id'],
-            "email": current_user['email'],
-            "full_name": current_user['full_name'],
-            "phone": current_user['phone'],
-            "referral_code": current_user['referral_code'],
-            "is_activated": current_user['is_activated'],
-            "wallet_balance": current_user['wallet_balance'],
-            "activation_amount": current_user.get('activation_amount', 300.0),
-            "total_earned": current_user.get('total_earned', 0.0),
-            "total_withdrawn": current_user.get('total_withdrawn', 0.0),
-            "referral_earnings": current_user.get('referral_earnings', 0.0),
-            "task_earnings": current_user.get('task_earnings', 0.0),
-            "binary_earnings": current_user.get('binary_earnings', 0.0),
-            "left_leg_size": current_user.get('left_leg_size', 0),
-            "right_leg_size": current_user.get('right_leg_size', 0),
-            "referral_count": current_user.get('referral_count', 0),
-            "role": current_user.get('role', 'user'),
-            "preferred_currency": current_user.get('preferred_currency', 'KES'),
-            "theme": current_user.get('theme', 'light'),
-            "has_spun_once": current_user.get('has_spun_once', False),
-            "team_earnings": current_user.get('team_earnings', 0.0),
-            "activation_expense": current_user.get('activation_expense', 0.0),
-            "activation_reward": current_user.get('activation_reward', 0.0),
-            "team_reward_claimed": current_user.get('team_reward_claimed', False),
-            "created_at": current_user.get('created_at'),
-            "last_login": current_user.get('last_login')
-        })
-
-        return {
-            "success": True,
-            "user": user_data
-        }
-
-    except Exception as e:
-        logging.error(f"Error fetching current user info: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to fetch user information: {str(e)}"
-        )
-
-# Dashboard routes
-@app.get("/api/dashboard/stats")
-async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
-    user_id = current_user['user_id']
-    preferred = current_user['preferred_currency']
-    
-    if preferred == "KES":
-        rate = 1.0
-    else:
-        try:
-            rate = await get_exchange_rate("KES", preferred)
-        except Exception as e:
-            logging.warning(f"Failed to fetch exchange rate for {preferred}: {e}. Using 1.0")
-            rate = 1.0
-    
-    def convert_amount(amount: float) -> float:
-        return round(amount * rate, 2)
-    
-    try:
-        # Fetch all data in parallel for better performance
-        transactions_task = db.transactions.find(
-            {"user_id": user_id}
-        ).sort("created_at", -1).limit(10).to_list(None)
-        
-        referrals_agg_pipeline = [
-            {"$match": {"referrer_id": user_id}},
-            {"$group": {
-                "_id": "$status",
-                "count": {"$sum": 1},
-                "total_reward_for_status": {"$sum": {"$toDouble": "$reward_amount"}}
-            }},
-            {"$group": {
-                "_id": None,
-                "total_referrals": {"$sum": "$count"},
-                "completed_rewards": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$_id", "completed"]},
-                            "$total_reward_for_status",
-                            0
-                        ]
-                    }
-                },
-                "potential_rewards": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$_id", "pending"]},
-                            "$total_reward_for_status",
-                            0
-                        ]
-                    }
-                }
-            }},
-            {"$project": {
-                "_id": 0,
-                "total_referrals": 1,
-                "total_earned": "$completed_rewards",
-                "potential_earnings": "$potential_rewards",
-            }}
-        ]
-
-        referrals_task = db.referrals.aggregate(referrals_agg_pipeline).to_list(None)
-                # Calculate daily earnings for last 7 days (for bar graph)
-        end_date = datetime.utcnow()
-        start_date = end_date - timedelta(days=7)
-
-        # Calculate weekly referral growth
-        weekly_referrals_start = end_date - timedelta(days=7)
-        weekly_referrals_count = await db.referrals.count_documents({
-            "referrer_id": user_id,
-            "created_at": {"$gte": weekly_referrals_start}
-        })
-        
-        notifications_task = db.notifications.find(
-            {"$or": [
-                {"user_id": user_id},
-                {"user_id": None}
-            ]}
-        ).sort("created_at", -1).limit(10).to_list(None)
-        
-        tasks_task = db.task_completions.aggregate([
-            {"$match": {"user_id": user_id}},
-            {"$group": {
-                "_id": "$status",
-                "count": {"$sum": 1},
-                "total_earnings": {"$sum": {"$toDouble": "$reward_amount"}}
-            }}
-        ]).to_list(None)
-        
-        # Execute all queries concurrently
-        transactions, referrals_result, notifications, tasks = await asyncio.gather(
-            transactions_task,
-            referrals_task,
-            notifications_task,
-            tasks_task
-        )
-        
-        # Process referral result
-        referral_stats = referrals_result[0] if referrals_result else {
-            "total_referrals": 0,
-            "total_earned": 0.0,
-            "potential_earnings": 0.0,
-        }
-        referral_count = referral_stats.get('total_referrals', 0)
-        tier = "gold" if referral_count >= 50 else \
-               "silver" if referral_count >= 20 else "bronze"
-
-        # Weekly growth percentage (referrals added this week vs total)
-        weekly_growth_percentage = 0.0
-        if referral_count > 0:
-            growth = (referral_count - weekly_referrals_count) / referral_count * 100
-            weekly_growth_percentage = round(max(growth, 0), 2)  # Positive or 0%
-        elif weekly_referrals_count > 0:
-            weekly_growth_percentage = 100.0  # New team growth
-
-        referral_stats['tier'] = tier
-        referral_stats['referral_code'] = current_user['referral_code']
-        referral_stats['total_earned'] = convert_amount(referral_stats.get('total_earned', 0.0))
-        referral_stats['potential_earnings'] = convert_amount(referral_stats.get('potential_earnings', 0.0))
-        
-        # Calculate weekly earnings breakdown
-        weekly_breakdown_agg = await db.transactions.aggregate([
-            {"$match": {
-                "user_id": user_id,
-                "type": {"$in": ["task", "referral_reward", "spin_and_win", "binary_commission"]},
-                "status": "completed",
-                "created_at": {
-                    "$gte": datetime.utcnow() - timedelta(days=7)
-                }
-            }},
-            {"$group": {
-                "_id": "$type",
-                "amount": {"$sum": {"$toDouble": "$amount"}}
-            }},
-            {"$group": {
-                "_id": None,
-                "breakdown": {"$push": {
-                    "type": "$_id",
-                    "earnings": "$amount"
-                }},
-                "total": {"$sum": "$amount"}
-            }}
-        ]).to_list(None)
-
-
-        daily_agg = await db.transactions.aggregate([
-            {"$match": {
-                "user_id": user_id,
-                "type": {"$in": ["task", "referral_reward", "spin_and_win", "binary_commission"]},
-                "status": "completed",
-                "created_at": {"$gte": start_date, "$lt": end_date}
-            }},
-            {"$group": {
-                "_id": {
-                    "$dateToString": {
-                        "format": "%Y-%m-%d",
-                        "date": "$created_at",
-                        "timezone": "UTC"
-                    }
-                },
-                "total": {"$sum": {"$toDouble": "$amount"}}
-            }},
-            {"$sort": {"_id": 1}},  # Oldest to newest
-            {"$group": {
-                "_id": None,
-                "daily_totals": {"$push": "$total"},
-                "dates": {"$push": "$_id"}
-            }},
-            {"$project": {
-                "_id": 0,
-                "daily_earnings": "$daily_totals"  # Array of 7 daily sums (pad with 0 if <7 days)
-            }}
-        ]).to_list(None)
-
-        # Pad to 7 days if fewer (assume 0 for missing days)
-        daily_result = daily_agg[0] if daily_agg else {"daily_earnings": [0.0] * 7}
-        daily_earnings = daily_result.get("daily_earnings", [0.0] * 7)
-        # Convert each to preferred currency
-        daily_earnings_converted = [round(d * rate, 2) for d in daily_earnings]
-        
-        weekly_breakdown = {}
-        if weekly_breakdown_agg:
-            data = weekly_breakdown_agg[0]
-            total = data['total']
-            for item in data['breakdown']:
-                weekly_breakdown[item['type']] = float(item['earnings'])
-            weekly_earnings = total
-        else:
-            weekly_earnings = 0.0
-            weekly_breakdown = {
-                "task": 0.0,
-                "referral_reward": 0.0,
-                "spin_and_win": 0.0,
-                "binary_commission": 0.0
-            }
-        
-        # Prepare response
-        response = {
-            "success": True,
-            "currency": preferred,
-            "user": {
-                "full_name": current_user['full_name'],
-                "wallet_balance": convert_amount(current_user['wallet_balance']),
-                "is_activated": current_user['is_activated'],
-                "activation_amount": convert_amount(current_user.get('activation_amount', 300.0)),
-                "activation_expense": convert_amount(current_user.get('activation_expense', 0.0)),
-                "activation_reward": convert_amount(current_user.get('activation_reward', 0.0)),
-                "net_activation": convert_amount(current_user.get('activation_reward', 0.0) - current_user.get('activation_expense', 0.0)),
-                "total_earned": convert_amount(current_user.get('total_earned', 0.0)),
-                "total_withdrawn": convert_amount(current_user.get('total_withdrawn', 0.0)),
-                "referral_earnings": convert_amount(current_user.get('referral_earnings', 0.0)),
-                "task_earnings": convert_amount(current_user.get('task_earnings', 0.0)),
-                "binary_earnings": convert_amount(current_user.get('binary_earnings', 0.0)),
-                "profit": convert_amount(current_user.get('total_earned', 0.0) - current_user.get('activation_expense', 0.0)),
-                "left_leg_size": current_user.get('left_leg_size', 0),
-                "right_leg_size": current_user.get('right_leg_size', 0),
-                "referral_count": current_user.get('referral_count', 0),
-                "referral_code": current_user['referral_code'],
-                "referral_tier": tier,
-                "role": current_user.get('role', 'user'),
-                "has_spun_once": current_user.get('has_spun_once', False),
-                "team_earnings": convert_amount(current_user.get('team_earnings', 0.0))
-            },
-            "analytics": {
-                "weekly_earnings": weekly_earnings,
-                "weekly_breakdown": weekly_breakdown,
-                "daily_earnings": daily_earnings_converted,  # Array for bar graph: [day1, day2, ..., day7] in preferred_currency
-                "referrals": json_serializable_doc(referral_stats),
-                "tasks": {
-                    "completed": next(
-                        (t['count'] for t in tasks if t['_id'] == "completed"), 0),
-                    "pending": next(
-                        (t['count'] for t in tasks if t['_id'] == "pending"), 0),
-                    "total_earnings": convert_amount(next(
-                        (float(t['total_earnings']) for t in tasks if t['_id'] == "completed"), 0.0))
-                },
-                "weekly_growth_percentage": weekly_growth_percentage  # % growth in referrals over last week
-            },
-            "activity": {
-                "transactions": json_serializable_doc(transactions),
-                "notifications": json_serializable_doc(notifications)
-            },
-            "quick_actions": generate_quick_actions(current_user, rate, preferred)
-        }
-        
-        # Add display fields to transactions
-        for txn in response["activity"]["transactions"]:
-            if 'amount' in txn:
-                txn['display_amount'] = convert_amount(float(txn['amount']))
-                txn['display_currency'] = preferred
-        
-        return response
-        
-    except Exception as e:
-        logging.error(f"Failed to load dashboard for user {user_id}: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to load dashboard: {str(e)}"
-        )
-
-@app.get("/api/transactions/history")
-async def get_transaction_history(
-    type_filter: str = Query("all", description="Filter by type: deposit, withdrawal, or all"),
-    status_filter: Optional[str] = Query(None, description="Filter by status: pending, completed, failed"),
-    page: int = Query(1, ge=1, description="Page number"),
-    limit: int = Query(10, ge=1, le=50, description="Number of transactions per page"),
-    current_user: dict = Depends(get_current_user)
-):
-    """
-    Get paginated transaction history for the user.
-    Supports filtering by type (deposit, withdrawal, all) and status.
-    Returns transactions with date, status, method, amount, etc.
-    """
-    user_id = current_user['user_id']
-    skip = (page - 1) * limit
-    
-    # Build query
-    query = {"user_id": user_id}
-    if type_filter != "all":
-        query["type"] = type_filter
-    if status_filter:
-        query["status"] = status_filter
-    
-    # Count total for pagination
-    total = await db.transactions.count_documents(query)
-    
-    # Fetch transactions, sorted by completed_at desc (or created_at if no completed_at)
-    pipeline = [
-        {"$match": query},
-        {"$sort": {"completed_at": -1, "created_at": -1}},
-        {"$skip": skip},
-        {"$limit": limit},
-        {
-            "$project": {
-                "_id": 0,
-                "id": "$transaction_id",
-                "date": {
-                    "$ifNull": ["$completed_at", "$created_at"]
-                },
-                "status": 1,
-                "method": 1,
-                "amount": 1,
-                "currency": 1,
-                "type": 1,
-                "description": 1,
-                "phone": 1,
-                "email": 1  # For PayPal
-            }
-        }
-    ]
-    transactions = await db.transactions.aggregate(pipeline).to_list(limit)
-    
-    # Serialize dates and IDs
-    transactions = json_serializable_doc(transactions)
-    
-    return {
-        "success": True,
-        "transactions": transactions,
-        "pagination": {
-            "page": page,
-            "limit": limit,
-            "total": total,
-            "pages": (total + limit - 1) // limit if total > 0 else 0
-        },
-        "filters": {
-            "type": type_filter,
-            "status": status_filter
-        }
-    }
-
-def generate_quick_actions(user: dict, rate: float = 1.0, preferred: str = "KES") -> list:
-    """Generate context-aware quick actions"""
-    def convert(amount: float) -> float:
-        return round(amount * rate, 2)
-    
-    actions = []
-    
-    if not user['is_activated']:
-        actions.append({
-            "title": "Activate Account",
-            "description": f"Deposit {convert(user.get('activation_amount', 500.0)):.2f} {preferred} to activate",
-            "action": "deposit",
-            "priority": "high"
-        })
-    
-    if user.get('referral_count', 0) < 5:
-        actions.append({
-            "title": "Earn More",
-            "description": "Invite friends to earn bonuses",
-            "action": "invite",
-            "priority": "medium"
-        })
-    
-    if user['wallet_balance'] >= 200.00:
-        converted_balance = convert(user['wallet_balance'])
-        actions.append({
-            "title": "Withdraw Earnings",
-            "description": f"Cash out your balance ({converted_balance:.2f} {preferred})",
-            "action": "withdraw",
-            "priority": "medium"
-        })
-    
-    # Add default actions
-    actions.extend([
-        {
-            "title": "Complete Tasks",
-            "description": "Earn money by completing tasks",
-            "action": "tasks",
-            "priority": "low"
-        },
-        {
-            "title": "View Tutorial",
-            "description": "Learn how to maximize earnings",
-            "action": "tutorial",
-            "priority": "low"
-        },
-        {
-            "title": "Transaction History",
-            "description": "View your deposits and withdrawals",
-            "action": "history",
-            "priority": "low"
-        }
-    ])
-    
-    return actions
-
-async def build_team_tree(user_id: str, db_instance=None, max_depth=5, current_depth=0):
-    """Recursively build team tree structure up to max_depth"""
-    if db_instance is None:
-        db_instance = db
-    if current_depth >= max_depth:
-        return None
-
-    user = await db_instance.users.find_one({"user_id": user_id}, {"password": 0, "payment_methods": 0, "security": 0, "verification": 0})
-    if not user:
-        return None
-
-    # Recurse for children
-    left_child = await build_team_tree(user.get("left_child_id"), db_instance, max_depth, current_depth + 1) if user.get("left_child_id") else None
-    right_child = await build_team_tree(user.get("right_child_id"), db_instance, max_depth, current_depth + 1) if user.get("right_child_id") else None
-
-    # Build node
-    tree_node = json_serializable_doc({
-        "user_id": user["user_id"],
-        "full_name": user["full_name"],
-        "email": user["email"],  # For tree view
-        "left_leg_size": user.get("left_leg_size", 0),
-        "right_leg_size": user.get("right_leg_size", 0),
-        "position": user.get("position"),
-        "is_activated": user.get("is_activated", False),
-        "left_child": left_child,
-        "right_child": right_child
-    })
-
-    return tree_node
-
-# Payment routes
-
-@app.post("/api/payments/deposit")
-async def initiate_deposit(
-    deposit_data: DepositRequest, 
-    current_user: dict = Depends(get_current_user),
-    request: Request = None
-):
-    """
-    Initiates an M-Pesa STK Push deposit.
-    """
-    try:
-        # Validate phone number format
-        if not re.match(r'^254\d{9}$', deposit_data.phone):
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid phone format. Use 254 followed by 9 digits (e.g., 254712345678)"
-            )
-
-        # Validate amount
-        amount_float = deposit_data.amount
-        if not (10.00 <= amount_float <= 150000.00):
-            raise HTTPException(
-                status_code=400,
-                detail="Amount must be between KSH 10 and KSH 150,000"
-            )
-
-        # Check for duplicate pending transactions
-        existing_txn = await db.transactions.find_one({
-            "user_id": current_user['user_id'],
-            "phone": deposit_data.phone,
-            "amount": str(amount_float),
-            "status": "pending",
-            "created_at": {"$gt": datetime.utcnow() - timedelta(minutes=15)}
-        })
-
-        if existing_txn:
-            raise HTTPException(
-                status_code=400,
-                detail="Duplicate transaction detected. Please wait for previous request to complete."
-            )
-
-        # Rate limiting check
-        txn_count = await db.transactions.count_documents({
-            "user_id": current_user['user_id'],
-            "created_at": {"$gt": datetime.utcnow() - timedelta(hours=1)}
-        })
-
-        if txn_count >= 5:
-            raise HTTPException(
-                status_code=429,
-                detail="Too many requests. Please try again later."
-            )
-
-        # Prepare M-Pesa request
-        transaction_id = str(uuid.uuid4())
-        access_token = await get_mpesa_access_token()
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        password = await generate_mpesa_password(timestamp)
-
-        stk_payload = {
-            "BusinessShortCode": MPESA_LIPA_NA_MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(amount_float),
-            "PartyA": deposit_data.phone,
-            "PartyB": MPESA_LIPA_NA_MPESA_SHORTCODE,
-            "PhoneNumber": deposit_data.phone,
-            "CallBackURL": f"{BACKEND_URL}/api/payments/mpesa-callback", 
-            "AccountReference": f"USER-{current_user['user_id']}",
-            "TransactionDesc": f"Deposit for {current_user['email']}"
-        }
-
-        # Create transaction record first
-        transaction_doc = {
-            "transaction_id": transaction_id,
-            "user_id": current_user['user_id'],
-            "type": "deposit",
-            "amount": str(amount_float),
-            "currency": "KES",
-            "phone": deposit_data.phone,
-            "status": "pending",
-            "method": "mpesa",
-            "ip_address": request.client.host if request else None,
-            "device_fingerprint": request.headers.get("User-Agent", ""),
-            "payment_details": { 
-                "mpesa": {
-                    "checkout_request_id": None,
-                    "receipt_number": None,
-                    "request_payload": stk_payload
-                }
-            },
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
-
-        # Atomic operation
-        async with await mongo_client.start_session() as session:
-            try:
-                async with session.start_transaction():
-                    # Insert transaction first
-                    await db.transactions.insert_one(
-                        transaction_doc,
-                        session=session
-                    )
-
-                    # Make M-Pesa API call
-                    async with httpx.AsyncClient(timeout=30.0) as client:
-                        headers = {
-                            "Authorization": f"Bearer {access_token}",
-                            "Content-Type": "application/json"
-                        }
-                        
-                        response = await client.post(
-                            "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest",
-                            json=stk_payload,
-                            headers=headers
-                        )
-                        response.raise_for_status()
-                        mpesa_data = response.json()
-
-                        if mpesa_data.get("ResponseCode") != "0":
-                            # M-Pesa initiated failed, update transaction status
-                            await db.transactions.update_one(
-                                {"transaction_id": transaction_id},
-                                {
-                                    "$set": {
-                                        "status": "failed",
-                                        "completed_at": datetime.utcnow(),
-                                        "error_message": mpesa_data.get("CustomerMessage", "M-Pesa request failed at initiation"),
-                                        "payment_details.mpesa.raw_response": mpesa_data
-                                    }
-                                },
-                                session=session
-                            )
-                            raise HTTPException(
-                                status_code=400,
-                                detail=mpesa_data.get("CustomerMessage", "M-Pesa request failed")
-                            )
-
-                        # Update transaction with checkout ID
-                        await db.transactions.update_one(
-                            {"transaction_id": transaction_id},
-                            {
-                                "$set": {
-                                    "payment_details.mpesa.checkout_request_id": mpesa_data.get("CheckoutRequestID"),
-                                    "payment_details.mpesa.raw_response": mpesa_data
-                                }
-                            },
-                            session=session
-                        )
-
-                    await session.commit_transaction()
-
-                    # Return success response
-                    return {
-                        "success": True,
-                        "message": f"Payment request of KSH {deposit_data.amount} sent to {deposit_data.phone}",
-                        "transaction_id": transaction_id,
-                        "checkout_request_id": mpesa_data.get("CheckoutRequestID"),
-                        "user_message": mpesa_data.get("CustomerMessage")
-                    }
-
-            except httpx.HTTPStatusError as e:
-                await session.abort_transaction()
-                error_detail = f"M-Pesa API Error: {e.response.status_code} - {e.response.text}"
-                logging.error(error_detail)
-                raise HTTPException(
-                    status_code=502,
-                    detail="Payment service temporarily unavailable"
-                )
-
-            except Exception as e:
-                await session.abort_transaction()
-                logging.error(f"Deposit processing error: {str(e)}", exc_info=True)
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to process payment request"
-                )
-
-    except HTTPException:
-        raise  
-    except Exception as e:
-        logging.critical(f"Unexpected error in deposit: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail="An unexpected error occurred"
-        )
-
-# Paystack payment initialization endpoint
-@app.post("/api/payments/paystack/deposit")
-async def initiate_paystack_deposit(
-    deposit_data: PaystackDepositRequest,
-    current_user: dict = Depends(get_current_user),
-    request: Request = None
-):
-    """
-    Initiates a Paystack payment.
-    """
-    try:
-        amount_kobo = int(deposit_data.amount * 100)  # Paystack expects amount in kobo
-        email = deposit_data.email
-
-        # Create unique transaction ID
-        transaction_id = str(uuid.uuid4())
-
-        # Prepare Paystack initialization payload
-        paystack_payload = {
-            "email": email,
-            "amount": amount_kobo,
-            "callback_url": f"{BASE_URL}/pages/success?payment=paystack&status=completed",
-            "metadata": {
-                "user_id": current_user['user_id'],
-                "transaction_id": transaction_id
-            }
-        }
-
-        headers = {
-            "Authorization": f"Bearer {PAYSTACK_SECRET_KEY}",
-            "Content-Type": "application/json"
-        }
-
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.paystack.co/transaction/initialize",
-                json=paystack_payload,
-                headers=headers
-            )
-            response.raise_for_status()
-            data = response.json()
-
-        if not data.get("status") or not data.get("data"):
-            raise HTTPException(status_code=500, detail="Failed to initialize Paystack transaction")
-
-        authorization_url = data["data"].get("authorization_url")
-        paystack_reference = data["data"].get("reference")
-
-        if not authorization_url or not paystack_reference:
-            raise HTTPException(status_code=500, detail="Invalid Paystack response")
-
-        # Create transaction record
-        transaction_doc = {
-            "transaction_id": transaction_id,
-            "user_id": current_user['user_id'],
-            "type": "deposit",
-            "amount": str(deposit_data.amount),
-            "currency": "KES",  # Changed to KES for consistency with other endpoints
-            "email": email,
-            "status": "pending",
-            "method": "paystack",
-            "payment_details": {
-                "paystack_reference": paystack_reference,
-                "authorization_url": authorization_url,
-                "raw_response": data
-            },
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
-
-        await db.transactions.insert_one(transaction_doc)
-
-        return {
-            "success": True,
-            "message": "Paystack payment initialized",
-            "authorization_url": authorization_url,
-            "transaction_id": transaction_id
-        }
-
-    except httpx.HTTPStatusError as e:
-        logging.error(f"Paystack initialization HTTP error: {e.response.status_code} - {e.response.text}")
-        raise HTTPException(status_code=502, detail="Payment service temporarily unavailable")
-    except Exception as e:
-        logging.error(f"Paystack initialization error: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Failed to initialize Paystack payment")
-
-# Paystack webhook endpoint
-
-@app.post("/api/payments/paystack/webhook")
-async def paystack_webhook(request: Request):
-    """
-    Handles Paystack webhook events.
-    """
-    try:
-        # Verify Paystack signature
-        paystack_signature = request.headers.get("x-paystack-signature")
-        body = await request.body()
-
-        import hmac
-        import hashlib
-
-        secret = PAYSTACK_SECRET_KEY.encode()
-        computed_signature = hmac.new(secret, body, hashlib.sha512).hexdigest()
-
-        if computed_signature != paystack_signature:
-            logging.warning("Invalid Paystack webhook signature")
-            return JSONResponse(status_code=400, content={"message": "Invalid signature"})
-
-        payload = await request.json()
-        event = payload.get("event")
-        data = payload.get("data", {})
-
-        if event == "charge.success":
-            reference = data.get("reference")
-            amount = data.get("amount")  # in kobo
-            email = data.get("customer", {}).get("email")
-            metadata = data.get("metadata", {})
-            user_id = metadata.get("user_id")
-            transaction_id = metadata.get("transaction_id")
-
-            if not reference or not user_id or not transaction_id:
-                logging.error("Missing reference or user_id or transaction_id in Paystack webhook")
-                return JSONResponse(status_code=400, content={"message": "Missing data"})
-
-            # Find transaction
-            transaction = await db.transactions.find_one({"transaction_id": transaction_id, "status": "pending", "payment_details.paystack_reference": reference})
-
-            if not transaction:
-                logging.warning(f"Transaction not found or already processed for Paystack reference: {reference}")
-                return JSONResponse(status_code=200, content={"message": "Transaction not found or already processed"})
-
-            amount_float = amount / 100.0  # convert kobo to ksh
-
-            # Update transaction status
-            await db.transactions.update_one(
-                {"_id": transaction["_id"]},
-                {
-                    "$set": {
-                        "status": "completed",
-                        "completed_at": datetime.utcnow(),
-                        "amount": str(amount_float),
-                        "email": email,
-                        "payment_details.paystack_webhook": payload
-                    }
-                }
-            )
-
-            # Update user wallet balance and total earned
-            user = await db.users.find_one({"user_id": user_id})
-            if user:
-                current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                new_wallet_balance = current_wallet_balance + amount_float
-                current_total_earned = float(user.get('total_earned', '0.0'))
-                new_total_earned = current_total_earned + amount_float
-
-                await db.users.update_one(
-                    {"user_id": user_id},
-                    {
-                        "$set": {
-                            "wallet_balance": str(new_wallet_balance),
-                            "total_earned": str(new_total_earned),
-                            "payment_methods.paystack.email": email,
-                            "payment_methods.paystack.verified": True
-                        }
-                    }
-                )
-
-                # Check activation and process referrals
-                if not user.get("is_activated", False) and new_wallet_balance >= float(user.get("activation_amount", 500.0)):
-                    await db.users.update_one(
-                        {"user_id": user_id},
-                        {"$set": {"is_activated": True}}
-                    )
-                    logging.info(f"User {user_id} activated via Paystack deposit.")
-
-                    # Trigger binary commissions
-                    await trigger_binary_commissions(user_id)
-
-                    if user.get("referred_by"):
-                        await process_referral_reward(
-                            referred_id=user_id,
-                            referrer_id=user.get("referred_by")
-                        )
-
-                # Create notification
-                await create_notification(
-                    {
-                        "title": "Deposit Received",
-                        "message": f"KSH {amount_float:,.2f} deposited to your account via Paystack",
-                        "user_id": user_id,
-                        "type": "payment"
-                    }
-                )
-
-            logging.info(f"✅ Successful Paystack deposit: {user_id} - NGN {amount_float}")
-
-        return JSONResponse(status_code=200, content={"message": "Webhook received"})
-
-    except Exception as e:
-        logging.error(f"Paystack webhook error: {str(e)}", exc_info=True)
-        return JSONResponse(status_code=500, content={"message": "Internal server error"})
-
-@app.post("/api/payments/mpesa-callback")
-async def mpesa_callback(request: Request):
-    """
-    M-Pesa Callback Handler
-    """
-    try:
-        data = await request.json()
-        logging.info(f"MPesa Callback Received: {json.dumps(data)}")
-
-        if not data.get("Body", {}).get("stkCallback"):
-            logging.error("Invalid M-Pesa callback format: Missing Body.stkCallback")
-            return JSONResponse(
-                {"ResultCode": 1, "ResultDesc": "Invalid callback format"},
-                status_code=400
-            )
-
-        callback = data["Body"]["stkCallback"]
-        
-        checkout_id = callback.get("CheckoutRequestID")
-        result_code = int(callback.get("ResultCode", 1))
-        result_desc = callback.get("ResultDesc", "Unknown error")
-
-        if not checkout_id:
-            logging.error(f"Missing CheckoutRequestID in M-Pesa callback: {callback}")
-            return JSONResponse(
-                {"ResultCode": 1, "ResultDesc": "Missing CheckoutRequestID"},
-                status_code=400
-            )
-
-        async with await mongo_client.start_session() as session:
-            try:
-                async with session.start_transaction():
-                    # Find transaction
-                    transaction = await db.transactions.find_one(
-                        {
-                            "payment_details.mpesa.checkout_request_id": checkout_id,
-                            "status": "pending"
-                        },
-                        session=session
-                    )
-
-                    if not transaction:
-                        logging.warning(f"Transaction not found or already processed for CheckoutRequestID: {checkout_id}")
-                        await session.commit_transaction()
-                        return JSONResponse(
-                            {"ResultCode": 0, "ResultDesc": "Transaction not found or already processed"}
-                        )
-
-                    # Handle success/failure
-                    if result_code == 0:  # Success
-                        metadata_items = callback.get("CallbackMetadata", {}).get("Item", [])
-                        metadata = {item["Name"]: item["Value"] for item in metadata_items if "Name" in item}
-                        
-                        callback_amount_raw = metadata.get("Amount")
-                        mpesa_receipt_number = metadata.get("MpesaReceiptNumber")
-                        phone_number = metadata.get("PhoneNumber")
-
-                        if not callback_amount_raw or not mpesa_receipt_number or not phone_number:
-                            logging.error(f"Missing essential metadata for successful M-Pesa callback: {callback}")
-                            await db.transactions.update_one(
-                                {"_id": transaction["_id"]},
-                                {
-                                    "$set": {
-                                        "status": "failed",
-                                        "completed_at": datetime.utcnow(),
-                                        "metadata.error": "Missing essential callback metadata",
-                                        "payment_details.mpesa.raw_callback": data 
-                                    }
-                                },
-                                session=session
-                            )
-                            await create_notification(
-                                {
-                                    "title": "Deposit Failed (Data Missing)",
-                                    "message": f"Your deposit of KES {transaction['amount']} failed due to missing transaction details. Contact support.",
-                                    "user_id": transaction["user_id"],
-                                    "type": "payment"
-                                },
-                                session=session,
-                                db_instance=db
-                            )
-                            await session.commit_transaction()
-                            return JSONResponse({"ResultCode": 1, "ResultDesc": "Missing callback metadata"})
-
-                        callback_amount = float(callback_amount_raw)
-                        
-                        # Ensure the amounts match to prevent fraud
-                        if not (float(transaction["amount"]) - 0.01 <= callback_amount <= float(transaction["amount"]) + 0.01):
-                            logging.warning(f"Amount mismatch for {checkout_id}. Expected {transaction['amount']}, got {callback_amount}. Marking as failed.")
-                            await db.transactions.update_one(
-                                {"_id": transaction["_id"]},
-                                {
-                                    "$set": {
-                                        "status": "failed",
-                                        "completed_at": datetime.utcnow(),
-                                        "metadata.error": "Amount mismatch",
-                                        "payment_details.mpesa.raw_callback": data 
-                                    }
-                                },
-                                session=session
-                            )
-                            await create_notification(
-                                {
-                                    "title": "Deposit Failed (Amount Mismatch)",
-                                    "message": f"Your deposit of KES {transaction['amount']} failed due to amount mismatch.",
-                                    "user_id": transaction["user_id"],
-                                    "type": "payment"
-                                },
-                                session=session,
-                                db_instance=db
-                            )
-                            await session.commit_transaction()
-                            return JSONResponse({"ResultCode": 1, "ResultDesc": "Amount Mismatch"})
-
-
-                        amount_to_credit = callback_amount
-
-                        # Update transaction
-                        await db.transactions.update_one(
-                            {"_id": transaction["_id"]},
-                            {
-                                "$set": {
-                                    "status": "completed",
-                                    "completed_at": datetime.utcnow(),
-                                    "payment_details.mpesa.receipt_number": mpesa_receipt_number,
-                                    "amount": str(amount_to_credit),
-                                    "phone": phone_number, 
-                                    "payment_details.mpesa.raw_callback": data 
-                                }
-                            },
-                            session=session
-                        )
-
-                        # Update user balance and total earned
-                        user = await db.users.find_one({"user_id": transaction["user_id"]}, session=session)
-                        if user:
-                            current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                            new_wallet_balance = current_wallet_balance + amount_to_credit
-                            current_total_earned = float(user.get('total_earned', '0.0'))
-                            new_total_earned = current_total_earned + amount_to_credit
-
-                            await db.users.update_one(
-                                {"user_id": transaction["user_id"]},
-                                {
-                                    "$set": {
-                                        "wallet_balance": str(new_wallet_balance),
-                                        "total_earned": str(new_total_earned),
-                                        "payment_methods.mpesa.phone": phone_number,
-                                        "payment_methods.mpesa.verified": True
-                                    }
-                                },
-                                session=session
-                            )
-                        user = await db.users.find_one({"user_id": transaction["user_id"]}, session=session)
-
-                        # Check activation and process referrals
-                        if user and not user["is_activated"] and float(user["wallet_balance"]) >= float(user["activation_amount"]):
-                            await db.users.update_one(
-                                {"user_id": user["user_id"]},
-                                {"$set": {"is_activated": True}},
-                                session=session
-                            )
-                            logging.info(f"User {user['user_id']} activated via M-Pesa deposit.")
-                            
-                            # Trigger binary commissions
-                            await trigger_binary_commissions(user["user_id"], session=session)
-                            
-                            if user.get("referred_by"):
-                                await process_referral_reward(
-                                    referred_id=user["user_id"],
-                                    referrer_id=user["referred_by"],
-                                    session=session
-                                )
-
-                        # Create notification
-                        await create_notification(
-                            {
-                                "title": "Deposit Received",
-                                "message": f"KES {amount_to_credit:,.2f} deposited to your account. Receipt: {mpesa_receipt_number}",
-                                "user_id": transaction["user_id"],
-                                "type": "payment"
-                            },
-                            session=session,
-                            db_instance=db
-                        )
-
-                        logging.info(f"✅ Successful M-Pesa deposit: {transaction['user_id']} - KES {amount_to_credit}")
-
-                    else:  # Failure or Cancellation
-                        await db.transactions.update_one(
-                            {"_id": transaction["_id"]},
-                            {
-                                "$set": {
-                                    "status": "failed",
-                                    "completed_at": datetime.utcnow(),
-                                    "error_message": result_desc,
-                                    "payment_details.mpesa.raw_callback": data 
-                                }
-                            },
-                            session=session
-                        )
-
-                        await create_notification(
-                            {
-                                "title": "Deposit Failed",
-                                "message": f"M-Pesa deposit of KES {transaction['amount']} failed: {result_desc}",
-                                "user_id": transaction["user_id"],
-                                "type": "payment"
-                            },
-                            session=session,
-                            db_instance=db
-                        )
-
-                        logging.warning(f"❌ Failed M-Pesa deposit: {transaction['user_id']} - {result_desc}")
-
-                    await session.commit_transaction()
-
-            except Exception as e:
-                await session.abort_transaction()
-                logging.error(f"Error in M-Pesa callback transaction for CheckoutRequestID {checkout_id}: {str(e)}", exc_info=True)
-                return JSONResponse(
-                    {"ResultCode": 1, "ResultDesc": "Internal Server Error"},
-                    status_code=500 
-                )
-
-        return JSONResponse({"ResultCode": 0, "ResultDesc": "Success"}) 
-
-    except json.JSONDecodeError:
-        logging.error("Invalid JSON received in M-Pesa callback")
-        return JSONResponse(
-            {"ResultCode": 1, "ResultDesc": "Invalid JSON"},
-            status_code=400
-        )
-    except Exception as e:
-        logging.critical(f"Critical error processing M-Pesa callback: {str(e)}", exc_info=True)
-        return JSONResponse(
-            {"ResultCode": 1, "ResultDesc": "Internal server error"},
-            status_code=500
-        )
-
-async def process_referral_reward(referred_id: str, referrer_id: str, session=None):
-    """Process referral reward with fraud checks"""
-    try:
-        # Get referral record
-        referral = await db.referrals.find_one(
-            {
-                "referred_id": referred_id,
-                "referrer_id": referrer_id,
-                "status": "pending"
-            },
-            session=session
-        )
-
-        if not referral:
-            logging.info(f"No pending referral found for referred_id: {referred_id}, referrer_id: {referrer_id}")
-            return False
-
-        reward_amount = float(referral["reward_amount"])
-
-        # Reward referrer
-        user = await db.users.find_one({"user_id": referrer_id}, session=session)
-        if user:
-            current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-            new_wallet_balance = current_wallet_balance + reward_amount
-            current_referral_earnings = float(user.get('referral_earnings', '0.0'))
-            new_referral_earnings = current_referral_earnings + reward_amount
-            current_total_earned = float(user.get('total_earned', '0.0'))
-            new_total_earned = current_total_earned + reward_amount
-
-            await db.users.update_one(
-                {"user_id": referrer_id},
-                {
-                    "$set": {
-                        "wallet_balance": str(new_wallet_balance),
-                        "referral_earnings": str(new_referral_earnings),
-                        "total_earned": str(new_total_earned)
-                    }
-                },
-                session=session
-            )
-
-        # Update referral status
-        await db.referrals.update_one(
-            {"_id": referral["_id"]},
-            {
-                "$set": {
-                    "status": "completed",
-                    "completed_at": datetime.utcnow()
-                }
-            },
-            session=session
-        )
-
-        # Create reward transaction
-        await db.transactions.insert_one(
-            {
-                "transaction_id": str(uuid.uuid4()),
-                "user_id": referrer_id,
-                "type": "referral_reward",
-                "amount": str(reward_amount),
-                "currency": "KES",
-                "status": "completed",
-                "metadata": {
-                    "referred_user_id": referred_id,
-                    "referral_id": referral["referral_id"]
-                },
-                "created_at": datetime.utcnow(),
-                "completed_at": datetime.utcnow()
-            },
-            session=session
-        )
-
-        # Create notification for referrer
-        await create_notification(
-            {
-                "title": "Referral Reward!",
-                "message": f"You earned KES {reward_amount:,.2f} from a successful referral!",
-                "user_id": referrer_id,
-                "type": "reward"
-            },
-            session=session,
-            db_instance=db
-        )
-
-        logging.info(f"🎉 Referral reward processed: {referrer_id} -> {referred_id} for KES {reward_amount}")
-        return True
-
-    except Exception as e:
-        logging.error(f"Referral processing error for {referred_id} by {referrer_id}: {str(e)}", exc_info=True)
-        return False
-
-async def create_notification(
-    notification_data: dict,
-    session=None,
-    db_instance: AsyncIOMotorClient = None
-):
-    """Enhanced notification system"""
-    try:
-        if db_instance is None:
-            db_instance = db
-
-        notification_doc = {
-            "notification_id": str(uuid.uuid4()),
-            "title": notification_data['title'],
-            "message": notification_data['message'],
-            "user_id": notification_data.get('user_id'), 
-            "type": notification_data.get('type', 'system'),
-            "priority": notification_data.get('priority', 'medium'),
-            "is_read": False,
-            "action_url": notification_data.get('action_url'),
-            "expires_at": datetime.utcnow() + timedelta(days=30),
-            "metadata": notification_data.get('metadata', {}),
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
-
-        if session:
-            await db_instance.notifications.insert_one(notification_doc, session=session)
-        else:
-            await db_instance.notifications.insert_one(notification_doc)
-
-        logging.info(f"Notification created for user {notification_data.get('user_id', 'All')}: {notification_data['title']}")
-        return notification_doc
-
-    except Exception as e:
-        logging.error(f"Notification creation failed: {str(e)}", exc_info=True)
-        raise
-
-# Pesapal Payment Routes
-@app.post("/api/payments/pesapal/deposit")
-async def initiate_pesapal_deposit(
-    deposit_data: PesapalDepositRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """
-    Initiates a Pesapal payment request.
-    """
-    try:
-        # Validate amount
-        amount_float = deposit_data.amount
-        if amount_float < 10.00:
-            raise HTTPException(
-                status_code=400,
-                detail="Minimum deposit amount is KSH 10.00"
-            )
-
-        # Get Pesapal access token
-        access_token = await get_pesapal_access_token()
-        if not access_token:
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to authenticate with Pesapal"
-            )
-
-        # Register IPN if not already registered
-        ipn_id = await register_pesapal_ipn()
-        if not ipn_id:
-            logging.warning("Failed to register Pesapal IPN, proceeding without IPN")
-
-        # Create unique transaction ID
-        transaction_id = str(uuid.uuid4())
-        description = f"Deposit for {current_user['full_name']}"
-
-        # Prepare Pesapal order request
-        order_payload = {
-            "id": transaction_id,
-            "currency": "KES",
-            "amount": amount_float,
-            "description": description,
-            "callback_url": f"{BASE_URL}/pages/success?payment=pesapal&status=completed",
-            "notification_id": ipn_id,
-            "billing_address": {
-                "email_address": deposit_data.email,
-                "phone_number": deposit_data.phone,
-                "country_code": "KE",
-                "first_name": deposit_data.first_name,
-                "last_name": deposit_data.last_name
-            }
-        }
-
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-
-        # Submit order to Pesapal
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                PESAPAL_ORDER_URL,
-                json=order_payload,
-                headers=headers
-            )
-
-            if response.status_code != 200:
-                logging.error(f"Pesapal order submission failed: {response.status_code} - {response.text}")
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to create Pesapal order"
-                )
-
-            order_response = response.json()
-            redirect_url = order_response.get("redirect_url")
-            order_tracking_id = order_response.get("order_tracking_id")
-
-            if not redirect_url:
-                raise HTTPException(
-                    status_code=500,
-                    detail="No redirect URL received from Pesapal"
-                )
-
-        # Create transaction record
-        transaction_doc = {
-            "transaction_id": transaction_id,
-            "user_id": current_user['user_id'],
-            "type": "deposit",
-            "amount": str(amount_float),
-            "currency": "KES",
-            "phone": deposit_data.phone,
-            "status": "pending",
-            "method": "pesapal",
-            "payment_details": {
-                "pesapal": {
-                    "order_tracking_id": order_tracking_id,
-                    "redirect_url": redirect_url,
-                    "ipn_id": ipn_id,
-                    "order_payload": order_payload
-                }
-            },
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
-
-        await db.transactions.insert_one(transaction_doc)
-
-        return {
-            "success": True,
-            "message": "Pesapal payment initiated",
-            "transaction_id": transaction_id,
-            "redirect_url": redirect_url,
-            "order_tracking_id": order_tracking_id
-        }
-
-    except httpx.HTTPStatusError as e:
-        logging.error(f"Pesapal HTTP error: {e.response.status_code} - {e.response.text}")
-        raise HTTPException(
-            status_code=500,
-            detail="Payment service temporarily unavailable"
-        )
-    except Exception as e:
-        logging.error(f"Pesapal deposit error: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail="An unexpected error occurred"
-        )
-
-@app.get("/api/payments/pesapal/status/{order_tracking_id}")
-async def check_pesapal_status(
-    order_tracking_id: str,
-    current_user: dict = Depends(get_current_user)
-):
-    """
-    Check the status of a Pesapal transaction.
-    """
-    try:
-        # Find the transaction
-        transaction = await db.transactions.find_one({
-            "payment_details.pesapal.order_tracking_id": order_tracking_id,
-            "user_id": current_user['user_id']
-        })
-
-        if not transaction:
-            raise HTTPException(status_code=404, detail="Transaction not found")
-
-        # Get Pesapal access token
-        access_token = await get_pesapal_access_token()
-        if not access_token:
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to authenticate with Pesapal"
-            )
-
-        # Check status with Pesapal
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-
-        params = {
-            "orderTrackingId": order_tracking_id
-        }
-
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                PESAPAL_STATUS_URL,
-                params=params,
-                headers=headers
-            )
-
-            if response.status_code != 200:
-                logging.error(f"Pesapal status check failed: {response.status_code} - {response.text}")
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to check payment status"
-                )
-
-            status_data = response.json()
-            payment_status = status_data.get("status")
-            payment_method = status_data.get("payment_method")
-
-            # Update transaction status if it has changed
-            if payment_status != transaction['status']:
-                await db.transactions.update_one(
-                    {"_id": transaction["_id"]},
-                    {
-                        "$set": {
-                            "status": payment_status.lower(),
-                            "updated_at": datetime.utcnow(),
-                            "payment_details.pesapal.status_response": status_data
-                        }
-                    }
-                )
-
-                # If payment is completed, update user balance
-                if payment_status.upper() == "COMPLETED":
-                    amount_float = float(transaction['amount'])
-                    
-                    # Update user balance
-                    await db.users.update_one(
-                        {"user_id": current_user['user_id']},
-                        {
-                            "$inc": {
-                                "wallet_balance": str(amount_float),
-                                "total_earned": str(amount_float)
-                            },
-                            "$set": {
-                                "payment_methods.pesapal.phone": transaction['phone'],
-                                "payment_methods.pesapal.verified": True
-                            }
-                        }
-                    )
-
-                    # Check if this activates the user
-                    user = await db.users.find_one({"user_id": current_user['user_id']})
-                    if user and not user['is_activated'] and float(user['wallet_balance']) >= float(user['activation_amount']):
-                        activation_kes = float(user["activation_amount"])
-                        reward_kes = 30.0
-                        net_balance = float(user["wallet_balance"]) - activation_kes + reward_kes
-
-                        await db.users.update_one(
-                            {"user_id": current_user['user_id']},
-                            {
-                                "$inc": {
-                                    "wallet_balance": -activation_kes + reward_kes,
-                                    "activation_expense": activation_kes,
-                                    "activation_reward": reward_kes
-                                },
-                                "$set": {"is_activated": True}
-                            }
-                        )
-                        logging.info(f"User {current_user['user_id']} activated via Pesapal. Expense: {activation_kes} KES, Reward: {reward_kes} KES")
-
-                        # Trigger binary commissions
-                        await trigger_binary_commissions(current_user['user_id'])
-                        
-                        # Process referral if exists
-                        if user.get("referred_by"):
-                            await process_referral_reward(
-                                referred_id=user["user_id"],
-                                referrer_id=user["referred_by"]
-                            )
-
-                        # Notification and email
-                        await create_notification(
-                            {
-                                "title": "Account Activated!",
-                                "message": f"Congratulations! Your account is activated. Activation expense: {activation_kes} KES deducted, reward: {reward_kes} KES added. Net: {reward_kes} KES.",
-                                "user_id": current_user['user_id'],
-                                "type": "reward"
-                            },
-                            db_instance=db
-                        )
-
-                        await send_email(
-                            subject="Account Activated - Welcome Reward!",
-                            recipient=user["email"],
-                            body=f"""
-                            <h1>Congratulations, {user['full_name']}!</h1>
-                            <p>Your account has been successfully activated.</p>
-                            <p>Activation expense of {activation_kes} KES was deducted from your deposit, and a {reward_kes} KES reward has been added to your wallet.</p>
-                            <p>Net balance after activation: {reward_kes} KES.</p>
-                            <p>You can now access all features, including tasks and commissions!</p>
-                            """
-                        )
-
-                    # Create notification
-                    await create_notification({
-                        "title": "Deposit Received",
-                        "message": f"KES {amount_float:,.2f} deposited to your account via Pesapal",
-                        "user_id": current_user['user_id'],
-                        "type": "payment"
-                    })
-
-        return {
-            "success": True,
-            "status": payment_status,
-            "payment_method": payment_method,
-            "transaction_id": transaction['transaction_id']
-        }
-
-    except Exception as e:
-        logging.error(f"Pesapal status check error: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to check payment status"
-        )
-
-@app.post("/api/payments/pesapal/ipn")
-async def handle_pesapal_ipn(request: Request):
-    """
-    Handle Pesapal IPN (Instant Payment Notification) callbacks.
-    Fixed to update balances as strings instead of using $inc.
-    """
-    try:
-        # Parse JSON payload (Pesapal v3)
-        body = await request.json()
-        logging.info(f"Pesapal IPN received: {body}")
-
-        order_tracking_id = body.get("OrderTrackingId")
-        order_notification_type = body.get("OrderNotificationType")
-        order_merchant_reference = body.get("OrderMerchantReference")
-
-        if order_notification_type in ["CHANGE", "IPNCHANGE"]:
-            transaction = await db.transactions.find_one({
-                "payment_details.pesapal.order_tracking_id": order_tracking_id
-            })
-
-            if transaction:
-                access_token = await get_pesapal_access_token()
-                if access_token:
-                    headers = {
-                        "Authorization": f"Bearer {access_token}",
-                        "Content-Type": "application/json",
-                        "Accept": "application/json"
-                    }
-                    params = {"orderTrackingId": order_tracking_id}
-
-                    async with httpx.AsyncClient() as client:
-                        response = await client.get(
-                            PESAPAL_STATUS_URL,
-                            params=params,
-                            headers=headers
-                        )
-
-                    if response.status_code == 200:
-                        status_data = response.json()
-                        logging.info(f"Pesapal status raw response: {status_data}")
-
-                        payment_status = (
-                            status_data.get("payment_status_description")
-                            or status_data.get("payment_status_code")
-                            or ""
-                        ).lower()
-                        logging.info(f"Parsed payment status: {payment_status}")
-
-                        # Update transaction record
-                        await db.transactions.update_one(
-                            {"payment_details.pesapal.order_tracking_id": order_tracking_id},
-                            {
-                                "$set": {
-                                    "status": payment_status,
-                                    "updated_at": datetime.utcnow(),
-                                    "payment_details.pesapal.ipn_data": body,
-                                    "payment_details.pesapal.status_response": status_data
-                                }
-                            }
-                        )
-
-                        # If payment completed
-                        if payment_status == "completed":
-                            user_id = transaction["user_id"]
-                            amount_float = float(transaction["amount"])
-
-                            user = await db.users.find_one({"user_id": user_id})
-                            if user:
-                                # Update balances (string-safe like Paystack)
-                                current_wallet_balance = float(user.get("wallet_balance", "0.0"))
-                                new_wallet_balance = current_wallet_balance + amount_float
-
-                                current_total_earned = float(user.get("total_earned", "0.0"))
-                                new_total_earned = current_total_earned + amount_float
-
-                                await db.users.update_one(
-                                    {"user_id": user_id},
-                                    {
-                                        "$set": {
-                                            "wallet_balance": str(new_wallet_balance),
-                                            "total_earned": str(new_total_earned),
-                                            "payment_methods.pesapal.email": status_data.get("payment_account"),
-                                            "payment_methods.pesapal.verified": True
-                                        }
-                                    }
-                                )
-
-                                # Activation logic
-                                if not user.get("is_activated", False) and new_wallet_balance >= float(user.get("activation_amount", 500.0)):
-                                    activation_kes = float(user["activation_amount"])
-                                    reward_kes = 30.0
-                                    final_balance = new_wallet_balance - activation_kes + reward_kes
-
-                                    await db.users.update_one(
-                                        {"user_id": user_id},
-                                        {
-                                            "$set": {
-                                                "wallet_balance": str(final_balance),
-                                                "activation_expense": str(activation_kes),
-                                                "activation_reward": str(reward_kes),
-                                                "is_activated": True
-                                            }
-                                        }
-                                    )
-
-                                    logging.info(
-                                        f"User {user_id} activated via Pesapal IPN. "
-                                        f"Expense: {activation_kes} KES, Reward: {reward_kes} KES"
-                                    )
-
-                                    # Trigger commissions
-                                    await trigger_binary_commissions(user_id)
-
-                                    if user.get("referred_by"):
-                                        await process_referral_reward(
-                                            referred_id=user["user_id"],
-                                            referrer_id=user["referred_by"]
-                                        )
-
-                                    await create_notification(
-                                        {
-                                            "title": "Account Activated!",
-                                            "message": f"Congratulations! Your account is activated. "
-                                                       f"Expense: {activation_kes} KES, Reward: {reward_kes} KES.",
-                                            "user_id": user_id,
-                                            "type": "reward"
-                                        },
-                                        db_instance=db
-                                    )
-
-                                    await send_email(
-                                        subject="Account Activated - Welcome Reward!",
-                                        recipient=user["email"],
-                                        body=f"""
-                                        <h1>Congratulations, {user['full_name']}!</h1>
-                                        <p>Your account has been successfully activated.</p>
-                                        <p>Activation expense of {activation_kes} KES was deducted, and a {reward_kes} KES reward has been added.</p>
-                                        <p>Net balance: {final_balance} KES.</p>
-                                        """
-                                    )
-
-                                # Deposit notification
-                                await create_notification({
-                                    "title": "Deposit Received",
-                                    "message": f"KES {amount_float:,.2f} deposited to your account via Pesapal",
-                                    "user_id": user_id,
-                                    "type": "payment"
-                                })
-
-        # Always respond success to Pesapal
-        return JSONResponse(content={"status": "success"})
-
-    except Exception as e:
-        logging.error(f"Pesapal IPN processing error: {str(e)}", exc_info=True)
-        return JSONResponse(content={"status": "success"})
-
-
-@app.get("/api/payments/pesapal/callback")
-async def handle_pesapal_callback(
-    order_tracking_id: str = Query(...),
-    order_merchant_reference: str = Query(...),
-    order_notification_type: str = Query(...)
-):
-    """
-    Handle Pesapal payment callback (user redirect).
-    """
-    try:
-        # Find the transaction
-        transaction = await db.transactions.find_one({
-            "payment_details.pesapal.order_tracking_id": order_tracking_id
-        })
-
-        if not transaction:
-            logging.warning(f"Transaction not found for order_tracking_id: {order_tracking_id}")
-            return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=error")
-
-        # Redirect user based on payment status
-        if order_notification_type == "CHANGE":
-            # Payment was successful
-            return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=success&amount={transaction['amount']}")
-        else:
-            # Payment failed or was cancelled
-            return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=cancelled")
-
-    except Exception as e:
-        logging.error(f"Pesapal callback error: {str(e)}", exc_info=True)
-        return RedirectResponse(url=f"{BASE_URL}/dashboard?payment=error")
-
-# ✅ Fixed Withdrawal Route (uses global_rates doc)
-@app.post("/api/payments/withdraw")
-async def request_withdrawal(
-    withdrawal_data: WithdrawalRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """
-    Handles user withdrawal requests across multiple currencies.
-    Converts everything to KES equivalent for consistency using global_rates doc.
-    """
-    user_id = current_user["user_id"]
-    amount = float(withdrawal_data.amount)
-    currency = withdrawal_data.currency.upper().strip()
-
-    PESAPAL_SUPPORTED_CURRENCIES = ["UGX", "TZS"]
-    WITHDRAWAL_CURRENCIES = ["KES", "USD"] + PESAPAL_SUPPORTED_CURRENCIES
-
-    if currency not in WITHDRAWAL_CURRENCIES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported currency {currency}. Supported: {', '.join(WITHDRAWAL_CURRENCIES)}"
-        )
-
-    # --- Convert amount to KES ---
-    if currency == "KES":
-        kes_amount = amount
-    else:
-        try:
-            rate_doc = await db.rates.find_one({"_id": "global_rates"})
-            if not rate_doc:
-                raise ValueError("Rates document not found")
-
-            usd_rates = rate_doc["rates"]
-
-            if currency not in usd_rates or "KES" not in usd_rates:
-                raise ValueError("Missing rate in DB")
-
-            from_rate = usd_rates[currency]  # USD → currency
-            to_rate = usd_rates["KES"]       # USD → KES
-
-            # Convert: amount (currency) → USD → KES
-            kes_amount = (amount / from_rate) * to_rate
-
-        except Exception as e:
-            logging.warning(f"Falling back for {currency} → KES conversion: {str(e)}")
-            if currency == "USD":
-                kes_amount = amount * 130.0
-            elif currency == "UGX":
-                kes_amount = amount / 37.0
-            elif currency == "TZS":
-                kes_amount = amount / 23.0
-            else:
-                raise HTTPException(500, "Conversion rate unavailable")
-
-    # --- Validate minimum & balance ---
-    if kes_amount < 1000.0:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Minimum withdrawal amount is 1000 KES equivalent ({kes_amount:.2f} KES)"
-        )
-
-    if kes_amount > float(current_user.get("wallet_balance", 0.0)):
-        raise HTTPException(status_code=400, detail="Insufficient wallet balance.")
-
-    # --- Choose method ---
-    if currency == "KES":
-        if not withdrawal_data.phone:
-            raise HTTPException(400, "Phone number required for KES withdrawals (M-Pesa).")
-        method = "mpesa"
-        recipient_field = "phone"
-        recipient_value = validate_and_format_phone(withdrawal_data.phone)
-
-    elif currency == "USD":
-        if not withdrawal_data.email:
-            raise HTTPException(400, "Email required for USD withdrawals (PayPal).")
-        method = "paypal"
-        recipient_field = "email"
-        recipient_value = withdrawal_data.email
-
-    else:  # UGX / TZS → Pesapal
-        if not withdrawal_data.phone:
-            raise HTTPException(400, f"Phone number required for {currency} withdrawals (Pesapal).")
-        method = "pesapal"
-        recipient_field = "phone"
-        recipient_value = validate_and_format_phone(withdrawal_data.phone)
-
-    # --- Save transaction ---
-    transaction_doc = {
-        "transaction_id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "type": "withdrawal",
-        "original_amount": str(amount),
-        "original_currency": currency,
-        "kes_amount": str(round(kes_amount, 2)),
-        "method": method,
-        recipient_field: recipient_value,
-        "status": "pending_admin_approval",
-        "description": f"{method} withdrawal request pending approval (KES eq: {kes_amount:.2f})",
-        "created_at": datetime.utcnow(),
-    }
-
-    await db.transactions.insert_one(transaction_doc)
-    logging.info(
-        f"Withdrawal request created: {user_id} {amount} {currency} → {kes_amount:.2f} KES [{method}]"
-    )
-
-    return {
-        "success": True,
-        "message": (
-            f"{method} withdrawal request for {amount} {currency} "
-            f"(KES eq: {kes_amount:.2f}) submitted for approval."
-        ),
-        "transaction_id": transaction_doc["transaction_id"],
-    }
-
-
-@app.get("/api/team/tree")
-async def get_team_tree(current_user: dict = Depends(get_current_user)):
-    """Get team tree structure with progress for 100-member reward"""
-    total_team_size = current_user.get('left_leg_size', 0) + current_user.get('right_leg_size', 0)
-    progress_percentage = min((total_team_size / 100.0) * 100, 100.0)
-    eligible = total_team_size >= 100
-    claimed = current_user.get('team_reward_claimed', False)
-
-    # Build tree (limited depth for performance)
-    tree = await build_team_tree(current_user['user_id'])
-
-    # Reward amount in preferred currency
-    rate = await get_exchange_rate("KES", current_user['preferred_currency'])
-    reward_amount = round(50 * rate, 2)
-
-    return {
-        "success": True,
-        "tree": tree or {},  # Empty dict if no tree
-        "total_team_size": total_team_size,
-        "progress_percentage": progress_percentage,
-        "eligible_for_reward": eligible,
-        "reward_claimed": claimed,
-        "reward_amount": reward_amount,
-        "currency": current_user['preferred_currency']
-    }
-
-@app.post("/api/team/claim-reward")
-async def claim_team_reward(
-    request: ClaimTeamReward,
-    current_user: dict = Depends(get_current_user)
-):
-    total_team_size = current_user.get('left_leg_size', 0) + current_user.get('right_leg_size', 0)
-    if total_team_size < 100:
-        raise HTTPException(status_code=400, detail="Team size must reach 100 members to claim reward")
-    if current_user.get('team_reward_claimed', False):
-        raise HTTPException(status_code=400, detail="Team reward already claimed")
+        if not referral:
+            logging.info(f"No pending referral found for referred_id: {referred_id}, referrer_id: {referrer_id}")
+            return False
 
-    reward_kes = 50.0
+        reward_amount = float(referral["reward_amount"])
 
-    async with await mongo_client.start_session() as session:
-        async with session.start_transaction():
-            # Update balance
-            current_balance = float(current_user['wallet_balance'])
-            new_balance = current_balance + reward_kes
-            current_total_earned = float(current_user['total_earned'])
-            new_total_earned = current_total_earned + reward_kes
+        # Reward referrer
+        user = await db.users.find_one({"user_id": referrer_id}, session=session)
+        if user:
+            current_wallet_balance = float(user.get('wallet_balance', '0.0'))
+            new_wallet_balance = current_wallet_balance + reward_amount
+            current_referral_earnings = float(user.get('referral_earnings', '0.0'))
+            new_referral_earnings = current_referral_earnings + reward_amount
+            current_total_earned = float(user.get('total_earned', '0.0'))
+            new_total_earned = current_total_earned + reward_amount
 
             await db.users.update_one(
-                {"user_id": current_user['user_id']},
+                {"user_id": referrer_id},
                 {
                     "$set": {
-                        "wallet_balance": str(new_balance),
-                        "total_earned": str(new_total_earned),
-                        "team_reward_claimed": True,
-                        "team_reward_claimed_at": datetime.utcnow()
+                        "wallet_balance": str(new_wallet_balance),
+                        "referral_earnings": str(new_referral_earnings),
+                        "total_earned": str(new_total_earned)
                     }
                 },
                 session=session
             )
+            await publish_wallet_delta(referrer_id, reward_amount, new_wallet_balance, "referral_reward", session=session)
+
+        # Update referral status
+        await db.referrals.update_one(
+            {"_id": referral["_id"]},
+            {
+                "$set": {
+                    "status": "completed",
+                    "completed_at": datetime.utcnow()
+                }
+            },
+            session=session
+        )
 
-            # Transaction record
-            txn_id = str(uuid.uuid4())
-            await db.transactions.insert_one({
-                "transaction_id": txn_id,
-                "user_id": current_user['user_id'],
-                "type": "team_reward",
-                "amount": str(reward_kes),
+        # Create reward transaction
+        await db.transactions.insert_one(
+            {
+                "transaction_id": str(uuid.uuid4()),
+                "user_id": referrer_id,
+                "type": "referral_reward",
+                "amount": str(reward_amount),
                 "currency": "KES",
                 "status": "completed",
-                "description": "Team milestone reward - 100 downline members",
+                "metadata": {
+                    "referred_user_id": referred_id,
+                    "referral_id": referral["referral_id"]
+                },
                 "created_at": datetime.utcnow(),
                 "completed_at": datetime.utcnow()
-            }, session=session)
-
-            # Notification
-            await create_notification({
-                "title": "Team Milestone Reward Claimed!",
-                "message": f"Congratulations! Your team reached 100 members. 50 KES added to your wallet.",
-                "user_id": current_user['user_id'],
-                "type": "reward"
-            }, session=session, db_instance=db)
-
-    # Converted response
-    converted_reward = round(reward_kes * rate, 2)
-    return {
-        "success": True,
-        "message": f"Team reward claimed! 50 KES ({converted_reward} {current_user['preferred_currency']}) added to wallet.",
-        "reward_amount": converted_reward,
-        "currency": current_user['preferred_currency']
-    }
-
-# PayPal routes (similar structure)
-@app.post("/api/payments/paypal/create-order")
-async def create_paypal_order_endpoint(
-    deposit_data: PayPalDepositRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Create a PayPal order for deposit"""
-    try:
-        user_id = current_user['user_id']
-        # Convert KES to USD
-        KSH_TO_USD_RATE = 0.0077 
-        amount_float = deposit_data.amount
-        usd_amount = round(amount_float * KSH_TO_USD_RATE, 2)
-        
-        # Validate amount
-        if usd_amount < 1.00: 
-            raise HTTPException(status_code=400, detail="Minimum PayPal deposit is KSH 150 (approx. $1 USD)")
-        
-        headers = {
-            "Authorization": f"Bearer {await get_paypal_access_token()}",
-            "Content-Type": "application/json",
-            "Prefer": "return=representation"
-        }
-        
-        payload = {
-            "intent": "CAPTURE",
-            "purchase_units": [{
-                "reference_id": user_id,
-                "description": f"Deposit to EarnPlatform from {current_user['email']}",
-                "amount": {
-                    "currency_code": PAYPAL_CURRENCY,
-                    "value": f"{usd_amount:.2f}"
-                }
-            }],
-            "application_context": {
-                "return_url": f"{BASE_URL}/pages/success/?paypal_return=success", 
-                "cancel_url": f"{BASE_URL}/pages/failure/?paypal_return=cancel",
-                "brand_name": "EarnPlatform",
-                "user_action": "PAY_NOW",
-                "shipping_preference": "NO_SHIPPING"
-            }
-        }
-        
-        async with httpx.AsyncClient() as client:
-            paypal_url = "https://api-m.sandbox.paypal.com/v2/checkout/orders" if PAYPAL_MODE == "sandbox" else "https://api-m.paypal.com/v2/checkout/orders"
-            response = await client.post(paypal_url, headers=headers, json=payload)
-            response.raise_for_status()
-            order = response.json()
-        
-        # Create transaction record
-        transaction_id = str(uuid.uuid4())
-
-        transaction_doc = {
-            "transaction_id": transaction_id,
-            "user_id": user_id,
-            "type": "deposit",
-            "amount": str(amount_float),
-            "currency": "KES",
-            "converted_amount": str(usd_amount),
-            "converted_currency": PAYPAL_CURRENCY,
-            "status": "pending",
-            "method": "paypal",
-            "payment_details": { 
-                "paypal_order_id": order['id'],
-                "raw_order_response": order
             },
-            "created_at": datetime.utcnow(),
-            "completed_at": None
-        }
-        await db.transactions.insert_one(transaction_doc)
-        
-        # Find the approval link
-        approval_link = next(
-            (link['href'] for link in order['links'] if link['rel'] == 'approve'),
-            None
+            session=session
         )
-        
-        if not approval_link:
-            raise HTTPException(status_code=500, detail="No approval link found in PayPal response")
-        
-        logging.info(f"PayPal order created for user {user_id}, amount KES {deposit_data.amount}. Order ID: {order['id']}")
-        return {
-            "success": True,
-            "message": "PayPal order created",
-            "order_id": order['id'],
-            "approval_url": approval_link,
-            "transaction_id": transaction_id
-        }
-    except httpx.HTTPStatusError as e:
-        logging.error(f"PayPal create order HTTP error: {e.response.status_code} - {e.response.text}", exc_info=True)
-        raise HTTPException(status_code=e.response.status_code, detail=f"PayPal order creation failed: {e.response.text}")
-    except Exception as e:
-        logging.error(f"PayPal order creation error for user {current_user['user_id']}: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Could not create PayPal order: {str(e)}")
-
-# Spin & Win
-@app.post("/api/spin-and-win")
-async def spin_and_win(
-    spin_data: SpinAndWinRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """
-    Handles the one-time spin and win feature.
-    Awards a random amount to the user's wallet.
-    """
-    user_id = current_user['user_id']
-    winning_amount = spin_data.winning_amount
 
-    # Check if user has already spun
-    if current_user.get('has_spun_once', False):
-        raise HTTPException(
-            status_code=400,
-            detail="You have already used your spin and win bonus."
-        )
-    
-    # Validate winning amount
-    if not (10.00 <= winning_amount <= 100.00):
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid winning amount provided. Amount must be between KSH 10 and KSH 100."
+        # Create notification for referrer
+        await create_notification(
+            {
+                "title": "Referral Reward!",
+                "message": f"You earned KES {reward_amount:,.2f} from a successful referral!",
+                "user_id": referrer_id,
+                "type": "reward"
+            },
+            session=session,
+            db_instance=db,
+            buffer=notifications
         )
 
-    async with await mongo_client.start_session() as session:
-        try:
-            async with session.start_transaction():
-                # Update user's wallet and set has_spun_once
-                user = await db.users.find_one({"user_id": user_id}, session=session)
-                if user:
-                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                    new_wallet_balance = current_wallet_balance + winning_amount
-                    current_total_earned = float(user.get('total_earned', '0.0'))
-                    new_total_earned = current_total_earned + winning_amount
-
-                    await db.users.update_one(
-                        {"user_id": user_id},
-                        {
-                            "$set": {
-                                "wallet_balance": str(new_wallet_balance),
-                                "total_earned": str(new_total_earned),
-                                "has_spun_once": True
-                            }
-                        },
-                        session=session
-                    )
-                # Re-fetch the updated user document to return
-                updated_user_result = await db.users.find_one({"user_id": user_id}, session=session)
-                
-                if not updated_user_result:
-                    raise HTTPException(status_code=404, detail="User not found during spin update.")
-
-                # Create a transaction record for the spin reward
-                transaction_doc = {
-                    "transaction_id": str(uuid.uuid4()),
-                    "user_id": user_id,
-                    "type": "spin_and_win",
-                    "amount": str(winning_amount),
-                    "currency": "KES",
-                    "status": "completed",
-                    "description": "One-time Spin & Win bonus",
-                    "created_at": datetime.utcnow(),
-                    "completed_at": datetime.utcnow()
-                }
-                await db.transactions.insert_one(transaction_doc, session=session)
-
-                # Create notification for the user
-                await create_notification({
-                    "title": "Spin & Win Bonus!",
-                    "message": f"Congratulations! You won KES {winning_amount:,.2f} from Spin & Win!",
-                    "user_id": user_id,
-                    "type": "reward"
-                }, session=session, db_instance=db)
-                
-                await session.commit_transaction()
-
-            logging.info(f"User {user_id} won KES {winning_amount} from spin and win.")
-            return {
-                "success": True,
-                "message": f"Congratulations! You won KES {winning_amount}.",
-                "winning_amount": winning_amount,
-                "user": json_serializable_doc(updated_user_result)
-            }
-
-        except HTTPException:
-            await session.abort_transaction()
-            raise
-        except Exception as e:
-            await session.abort_transaction()
-            logging.error(f"Error processing spin and win for user {user_id}: {str(e)}", exc_info=True)
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to process spin and win: {str(e)}"
-            )
+        logging.info(f"🎉 Referral reward processed: {referrer_id} -> {referred_id} for KES {reward_amount}")
+        return True
 
-# Task system
-@app.get("/api/tasks/available")
-async def get_available_tasks(current_user: dict = Depends(get_current_user)):
-    if not current_user['is_activated']:
-        raise HTTPException(status_code=400, detail="Account must be activated to access tasks")
-    
-    # Get completed task IDs for this user
-    completed_tasks = await db.task_completions.find(
-        {"user_id": current_user['user_id']}
-    ).distinct("task_id")
-    
-    # Get available tasks (not completed by user and active)
-    tasks = await db.tasks.find(
-        {"task_id": {"$nin": completed_tasks}, "is_active": True}
-    ).to_list(20)
-    
-    return {
-        "success": True,
-        "tasks": json_serializable_doc(tasks) 
-    }
+    except Exception as e:
+        logging.error(f"Referral processing error for {referred_id} by {referrer_id}: {str(e)}", exc_info=True)
+        return False
 
-@app.post("/api/tasks/complete")
-async def complete_task(completion_data: TaskCompletion, current_user: dict = Depends(get_current_user)):
-    if not current_user['is_activated']:
-        raise HTTPException(status_code=400, detail="Account must be activated to complete tasks")
-    
-    # Check if task exists and is active
-    task = await db.tasks.find_one({"task_id": completion_data.task_id, "is_active": True})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found or inactive")
-    
-    # Check if user already completed this task
-    existing_completion = await db.task_completions.find_one({
-        "user_id": current_user['user_id'],
-        "task_id": completion_data.task_id
-    })
-    if existing_completion:
-        raise HTTPException(status_code=400, detail="Task already completed")
-    
-    # Validate completion data based on task type
-    comp_data = completion_data.completion_data
-    task_type = task.get('type', 'general')
-    requirements = task.get('requirements', {})
-    media = task.get('media', {})
-    survey_questions = task.get('survey_questions') or []
-    
-    if task_type == 'survey':
-        answers = comp_data.get('answers', [])
-        if len(answers) != len(survey_questions):
-            raise HTTPException(status_code=400, detail=f"Survey requires {len(survey_questions)} answers. Provided: {len(answers)}")
-        if any(len(answer) < 5 for answer in answers):  # Basic validation: min length
-            raise HTTPException(status_code=400, detail="Each survey answer must be at least 5 characters long")
-    
-    elif task_type == 'video' or task_type == 'ad':
-        watched_duration = comp_data.get('watched_duration', 0)
-        required_duration = requirements.get('duration', 30)
-        if watched_duration < required_duration:
-            raise HTTPException(status_code=400, detail=f"Must watch full {required_duration}s. Watched: {watched_duration}s")
-        if media.get('youtube_id') and 'youtube_timestamp' not in comp_data:
-            raise HTTPException(status_code=400, detail="Provide YouTube timestamp for verification")
-        if media.get('video_url') and 'screenshot_url' not in comp_data:
-            raise HTTPException(status_code=400, detail="Provide screenshot URL for video task")
-    
-    elif task_type == 'image' or task_type == 'upload':
-        image_url = comp_data.get('image_url')
-        if not image_url or not image_url.startswith(('http://', 'https://')):
-            raise HTTPException(status_code=400, detail="Valid image URL required for upload tasks")
-        # Basic URL check (extend with regex if needed)
-    
-    elif task_type == 'writing':
-        content = comp_data.get('content', '')
-        min_words = requirements.get('min_words', 100)
-        word_count = len(content.split())
-        if word_count < min_words:
-            raise HTTPException(status_code=400, detail=f"Content must have at least {min_words} words. Provided: {word_count}")
-    
-    elif task_type == 'social':
-        share_urls = comp_data.get('share_urls', [])
-        required_platforms = requirements.get('platforms', [])
-        if len(share_urls) < len(required_platforms):
-            raise HTTPException(status_code=400, detail=f"Share on {len(required_platforms)} platforms required. Provided: {len(share_urls)} URLs")
-        for url in share_urls:
-            if not url.startswith(('http://', 'https://')):
-                raise HTTPException(status_code=400, detail="All share URLs must be valid")
-    
-    # General media support: If task has media, ensure completion references it if required
-    if media and requirements.get('verify_media', False):
-        if 'media_proof' not in comp_data:
-            raise HTTPException(status_code=400, detail="Proof of media interaction (e.g., screenshot) required")
-    
-    # Record task completion
-    reward_amount = float(task['reward'])
-    completion_doc = {
-        "completion_id": str(uuid.uuid4()),
-        "user_id": current_user['user_id'],
-        "task_id": completion_data.task_id,
-        "completion_data": completion_data.completion_data,
-        "reward_amount": str(reward_amount),
-        "status": "completed",
-        "created_at": datetime.utcnow()
-    }
-    
-    # Use session for atomic update
-    async with await mongo_client.start_session() as session:
-        try:
-            async with session.start_transaction():
-                await db.task_completions.insert_one(completion_doc, session=session)
-                
-                # Update user wallet and earnings
-                user = await db.users.find_one({"user_id": current_user['user_id']}, session=session)
-                if user:
-                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                    new_wallet_balance = current_wallet_balance + reward_amount
-                    current_task_earnings = float(user.get('task_earnings', '0.0'))
-                    new_task_earnings = current_task_earnings + reward_amount
-                    current_total_earned = float(user.get('total_earned', '0.0'))
-                    new_total_earned = current_total_earned + reward_amount
-
-                    await db.users.update_one(
-                        {"user_id": current_user['user_id']},
-                        {
-                            "$set": {
-                                "wallet_balance": str(new_wallet_balance),
-                                "task_earnings": str(new_task_earnings),
-                                "total_earned": str(new_total_earned)
-                            }
-                        },
-                        session=session
-                    )
-                await session.commit_transaction()
-        except Exception as e:
-            await session.abort_transaction()
-            logging.error(f"Task completion transaction failed: {e}", exc_info=True)
-            raise HTTPException(status_code=500, detail=f"Task completion failed: {str(e)}")
-
-    # Create notification
-    await create_notification({
-        "title": "Task Completed!",
-        "message": f"You earned KSH {reward_amount:,.2f} for completing '{task['title']}'",
-        "user_id": current_user['user_id']
-    }, db_instance=db)
-    
+def build_notification_doc(notification_data: dict) -> dict:
     return {
-        "success": True,
-        "message": f"Task completed! You earned KSH {reward_amount}",
-        "reward": reward_amount,
-        "validated_type": task_type
+        "notification_id": str(uuid.uuid4()),
+        "title": notification_data['title'],
+        "message": notification_data['message'],
+        "user_id": notification_data.get('user_id'), 
+        "type": notification_data.get('type', 'system'),
+        "priority": notification_data.get('priority', 'medium'),
+        "is_read": False,
+        "action_url": notification_data.get('action_url'),
+        "expires_at": datetime.utcnow() + timedelta(days=NOTIFICATION_RETENTION_DAYS.get(
+            notification_data.get('type', 'system'), NOTIFICATION_RETENTION_DEFAULT_DAYS
+        )),
+        "metadata": notification_data.get('metadata', {}),
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
     }
 
-# Referral system
-@app.get("/api/referrals/stats")
-async def get_referral_stats(current_user: dict = Depends(get_current_user)):
+async def write_notifications(notification_docs: list, session=None, db_instance=None):
     """
-    Enhanced Referral Statistics
+    Stores notifications with one insert_many per collection, bumps the unread counters
+    once per user and publishes them as live events.
     """
-    try:
-        stats_pipeline = [
-            {"$match": {"referrer_id": current_user['user_id']}},
-            {"$group": {
-                "_id": "$status",
-                "count": {"$sum": 1},
-                "total_reward_for_status": {"$sum": {"$toDouble": "$reward_amount"}}
-            }},
-            {"$group": {
-                "_id": None,
-                "total_referrals": {"$sum": "$count"},
-                "completed_rewards": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$_id", "completed"]},
-                            "$total_reward_for_status",
-                            0
-                        ]
-                    }
-                },
-                "potential_rewards": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$_id", "pending"]},
-                            "$total_reward_for_status",
-                            0
-                        ]
-                    }
-                }
-            }},
-            {"$project": {
-                "_id": 0,
-                "total_referrals": 1,
-                "total_earned": "$completed_rewards",
-                "potential_earnings": "$potential_rewards",
-            }}
-        ]
-        
-        stats = await db.referrals.aggregate(stats_pipeline).to_list(1)
+    if db_instance is None:
+        db_instance = db
 
-        # Process referral result
-        referral_stats = stats[0] if stats else {
-            "total_referrals": 0,
-            "total_earned": 0.0,
-            "potential_earnings": 0.0,
-        }
-        
-        referral_count = referral_stats.get('total_referrals', 0)
-        tier = "gold" if referral_count >= 50 else \
-               "silver" if referral_count >= 20 else "bronze"
-
-        referral_stats['tier'] = tier
-        referral_stats['referral_code'] = current_user['referral_code']
-
-        # Get recent referrals with pagination
-        recent_referrals = await db.referrals.find(
-            {"referrer_id": current_user['user_id']},
-            {"_id": 0, "referred_id": 1, "status": 1, "created_at": 1}
-        ).sort("created_at", -1).limit(5).to_list(5)
-
-        return {
-            "success": True,
-            "stats": json_serializable_doc(referral_stats),
-            "recent_referrals": json_serializable_doc(recent_referrals)
-        }
+    personal = [doc for doc in notification_docs if doc["user_id"] is not None]
+    # Broadcasts are stored once; read state lives in per-user receipts
+    broadcasts = [
+        {k: v for k, v in doc.items() if k not in ("user_id", "is_read")}
+        for doc in notification_docs if doc["user_id"] is None
+    ]
 
-    except Exception as e:
-        logging.error(f"Failed to fetch referral stats for user {current_user['user_id']}: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to fetch referral stats: {str(e)}"
+    if personal:
+        await db_instance.notifications.insert_many(personal, session=session)
+        await db_instance.notification_state.bulk_write(
+            [
+                UpdateOne({"_id": uid}, {"$inc": {"unread": count}}, upsert=True)
+                for uid, count in Counter(doc["user_id"] for doc in personal).items()
+            ],
+            ordered=False,
+            session=session
         )
+    if broadcasts:
+        await db_instance.broadcast_notifications.insert_many(broadcasts, session=session)
+        await db_instance.notification_counters.update_one(
+            {"_id": "broadcasts"}, {"$inc": {"total": len(broadcasts)}}, upsert=True, session=session
+        )
+        for doc, stored in zip([d for d in notification_docs if d["user_id"] is None], broadcasts):
+            doc["_id"] = stored["_id"]
+
+    for doc in notification_docs:
+        await publish_live_event(doc["user_id"], "notification", doc, session=session)
 
-@app.get("/api/referrals/binary-stats")
-async def get_binary_stats(current_user: dict = Depends(get_current_user)):
+class NotificationBuffer:
     """
-    Get binary referral tree statistics.
+    Collects the notifications of one unit of work (typically a settlement transaction)
+    and writes them together at flush, just before commit. Identical messages to the
+    same user are only stored once.
     """
-    try:
-        left_leg = current_user.get('left_leg_size', 0)
-        right_leg = current_user.get('right_leg_size', 0)
-        total_downline = left_leg + right_leg
-        leg_balance = left_leg - right_leg  # Positive if left heavier
-        
-        return {
-            "success": True,
-            "binary": {
-                "left_leg_size": left_leg,
-                "right_leg_size": right_leg,
-                "total_downline": total_downline,
-                "binary_earnings": current_user.get('binary_earnings', 0.0),
-                "leg_balance": leg_balance,
-                "recommendation": "Balance your legs" if abs(leg_balance) > 5 else "Good balance"
-            }
-        }
-    except Exception as e:
-        logging.error(f"Failed to fetch binary stats: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to fetch binary stats")
-
-# Enhanced Notification System
-@app.post("/api/notifications/create")
-async def create_notification_endpoint(notification_data: NotificationCreate, current_user: dict = Depends(get_current_admin_user)): 
-    """Admin endpoint to create notifications"""
-    await create_notification(notification_data.dict(), db_instance=db)
-    return {"success": True, "message": "Notification created"}
-
-@app.get("/api/notifications")
-async def get_notifications(current_user: dict = Depends(get_current_user)):
-    # Fetch notifications for the specific user AND broadcast notifications
-    notifications = await db.notifications.find(
-        {"$or": [{"user_id": current_user['user_id']}, {"user_id": None}]}
-    ).sort("created_at", -1).limit(20).to_list(20)
-    
-    return {"success": True, "notifications": json_serializable_doc(notifications)} 
 
-@app.put("/api/notifications/{notification_id}/read")
-async def mark_notification_read(notification_id: str, current_user: dict = Depends(get_current_user)):
-    try:
-        object_id_to_find = ObjectId(notification_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid notification ID format")
+    def __init__(self, db_instance=None):
+        self.db_instance = db_instance if db_instance is not None else db
+        self._docs = []
+        self._keys = set()
 
-    notification = await db.notifications.find_one({"_id": object_id_to_find})
-    if not notification:
-        raise HTTPException(status_code=404, detail="Notification not found")
-
-    # Ensure the user has access to mark this notification as read
-    if notification.get('user_id') is not None and notification['user_id'] != current_user['user_id']:
-        raise HTTPException(status_code=403, detail="Not authorized to mark this notification as read")
+    def add(self, notification_doc: dict) -> dict:
+        key = (notification_doc["user_id"], notification_doc["type"], notification_doc["title"], notification_doc["message"])
+        if key not in self._keys:
+            self._keys.add(key)
+            self._docs.append(notification_doc)
+        return notification_doc
 
-    await db.notifications.update_one(
-        {"_id": object_id_to_find}, 
-        {"$set": {"is_read": True}}
-    )
-    logging.info(f"Notification {notification_id} marked as read by user {current_user['user_id']}")
-    return {"success": True, "message": "Notification marked as read"}
-
-# Settings
-@app.put("/api/settings/theme")
-async def update_theme(theme: str, current_user: dict = Depends(get_current_user)):
-    if theme not in ['light', 'dark']:
-        raise HTTPException(status_code=400, detail="Invalid theme")
-    
-    await db.users.update_one(
-        {"user_id": current_user['user_id']},
-        {"$set": {"theme": theme}}
-    )
-    logging.info(f"User {current_user['user_id']} updated theme to {theme}")
-    return {"success": True, "message": f"Theme updated to {theme}"}
-
-# --- Admin Endpoints ---
-@app.get("/api/admin/dashboard/stats", dependencies=[Depends(get_current_admin_user)])
-async def get_admin_dashboard_stats():
-    total_users = await db.users.count_documents({})
-    activated_users = await db.users.count_documents({"is_activated": True})
-    
-    # Calculate total deposits
-    total_deposits_agg = await db.transactions.aggregate([
-        {"$match": {"type": "deposit", "status": "completed"}},
-        {"$group": {"_id": None, "total_amount": {"$sum": {"$toDouble": "$amount"}}}}
-    ]).to_list(1)
-    total_deposits = total_deposits_agg[0]['total_amount'] if total_deposits_agg else 0.0
-
-    # Calculate total withdrawals
-    total_withdrawals_agg = await db.transactions.aggregate([
-        {"$match": {"type": "withdrawal", "status": "completed"}},
-        {"$group": {"_id": None, "total_amount": {"$sum": {"$toDouble": "$amount"}}}}
-    ]).to_list(1)
-    total_withdrawals = total_withdrawals_agg[0]['total_amount'] if total_withdrawals_agg else 0.0
-
-    pending_withdrawals = await db.transactions.count_documents({"type": "withdrawal", "status": "pending_admin_approval"})
-    
-    return {
-        "success": True,
-        "stats": json_serializable_doc({
-            "total_users": total_users,
-            "activated_users": activated_users,
-            "total_deposits": total_deposits, 
-            "total_withdrawals": total_withdrawals, 
-            "pending_withdrawals": pending_withdrawals
-        })
-    }
+    async def flush(self, session=None):
+        if not self._docs:
+            return
+        docs, self._docs, self._keys = self._docs, [], set()
+        await write_notifications(docs, session=session, db_instance=self.db_instance)
+        logging.info(f"Notifications created: {len(docs)} in one batch")
 
-@app.get("/api/admin/users", dependencies=[Depends(get_current_admin_user)])
-async def get_all_users():
-    users = await db.users.find({}, {"password": 0}).to_list(1000) 
-    return {"success": True, "users": json_serializable_doc(users)} 
-
-@app.get("/api/admin/transactions/deposits", dependencies=[Depends(get_current_admin_user)])
-async def get_all_deposits(status: Optional[str] = None):
-    query = {"type": "deposit"}
-    if status:
-        query["status"] = status
-    deposits = await db.transactions.find(query).sort("created_at", -1).to_list(1000)
-    return {"success": True, "deposits": json_serializable_doc(deposits)} 
-
-@app.get("/api/admin/transactions/withdrawals", dependencies=[Depends(get_current_admin_user)])
-async def get_all_withdrawals(status: Optional[str] = None):
-    query = {"type": "withdrawal"}
-    if status:
-        query["status"] = status
-    withdrawals = await db.transactions.find(query).sort("created_at", -1).to_list(1000)
-    return {"success": True, "withdrawals": json_serializable_doc(withdrawals)} 
-
-# Admin manual completion endpoint
-@app.post("/api/admin/manual-complete", dependencies=[Depends(get_current_admin_user)])
-async def manual_complete_transaction(
-    approval_data: WithdrawalApproval,
-    db_instance: AsyncIOMotorClient = Depends(get_db_instance)
+async def create_notification(
+    notification_data: dict,
+    session=None,
+    db_instance: AsyncIOMotorClient = None,
+    buffer: NotificationBuffer = None
 ):
-    """
-    Admin manually completes a pending transaction (withdrawal or deposit).
-    Uses 'kes_amount' from transaction. Updates balances, totals, notifications, and emails.
-    """
-    transaction_id = approval_data.transaction_id
-    session = await db_instance.client.start_session()
-
+    """Enhanced notification system. With a buffer, the notification is written when the buffer is flushed."""
     try:
-        async with session.start_transaction():
-            # 1. Find transaction
-            transaction = await db_instance.transactions.find_one(
-                {"transaction_id": transaction_id},
-                session=session
-            )
-            if not transaction:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-
-            if transaction['status'] not in ['pending_admin_approval', 'pending', 'failed']:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Cannot manually complete transaction with status: {transaction['status']}"
-                )
-
-            user_id = transaction['user_id']
-            kes_amount = float(transaction.get('kes_amount', '0.0'))
-            transaction_type = transaction['type']
-
-            # 2. Update transaction status
-            await db_instance.transactions.update_one(
-                {"transaction_id": transaction_id},
-                {
-                    "$set": {
-                        "status": "completed",
-                        "completed_at": datetime.utcnow(),
-                        "manually_completed_by": "admin",
-                        "manual_completion_reason": "Admin manually completed transaction"
-                    }
-                },
-                session=session
-            )
-
-            # 3. Fetch user
-            user = await db_instance.users.find_one({"user_id": user_id}, session=session)
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            # 4. Process based on type
-            if transaction_type == "withdrawal":
-                # Deduct wallet balance
-                current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                new_wallet_balance = current_wallet_balance - kes_amount
-                current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
-                new_total_withdrawn = current_total_withdrawn + kes_amount
-
-                await db_instance.users.update_one(
-                    {"user_id": user_id},
-                    {
-                        "$set": {"wallet_balance": str(new_wallet_balance)},
-                        "$set": {"total_withdrawn": str(new_total_withdrawn)}
-                    },
-                    session=session
-                )
-
-                notification_title = "Withdrawal Completed"
-                notification_message = f"Your withdrawal of KES {kes_amount:,.2f} has been manually completed by admin."
-
-            elif transaction_type == "deposit":
-                # Add to wallet balance
-                current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                new_wallet_balance = current_wallet_balance + kes_amount
-                current_total_earned = float(user.get('total_earned', '0.0'))
-                new_total_earned = current_total_earned + kes_amount
-
-                await db_instance.users.update_one(
-                    {"user_id": user_id},
-                    {
-                        "$set": {"wallet_balance": str(new_wallet_balance)},
-                        "$set": {"total_earned": str(new_total_earned)}
-                    },
-                    session=session
-                )
-
-                # Check activation
-                if not user.get('is_activated') and new_wallet_balance >= float(user.get('activation_amount', '0.0')):
-                    await db_instance.users.update_one(
-                        {"user_id": user_id},
-                        {"$set": {"is_activated": True}},
-                        session=session
-                    )
-                    await trigger_binary_commissions(user_id, session=session)
-                    if user.get('referred_by'):
-                        await process_referral_reward(
-                            referred_id=user_id,
-                            referrer_id=user['referred_by'],
-                            session=session
-                        )
-                    # Activation notification
-                    await create_notification(
-                        {
-                            "title": "Account Activated!",
-                            "message": f"Congratulations! Your account has been activated. Deposit of KES {kes_amount:,.2f} manually completed.",
-                            "user_id": user_id,
-                            "type": "reward"
-                        },
-                        session=session,
-                        db_instance=db_instance
-                    )
+        notification_doc = build_notification_doc(notification_data)
+        if buffer is not None:
+            return buffer.add(notification_doc)
 
-                notification_title = "Deposit Completed"
-                notification_message = f"Your deposit of KES {kes_amount:,.2f} has been manually completed by admin."
+        await write_notifications([notification_doc], session=session, db_instance=db_instance)
 
-            # 5. Send notification
-            await create_notification(
-                {
-                    "title": notification_title,
-                    "message": notification_message,
-                    "user_id": user_id,
-                    "type": "payment"
-                },
-                session=session,
-                db_instance=db_instance
-            )
+        logging.info(f"Notification created for user {notification_data.get('user_id', 'All')}: {notification_data['title']}")
+        return notification_doc
 
-            # 6. Send email
-            await send_email(
-                subject=notification_title,
-                recipient=user['email'],
-                body=f"""
-                <h3>{notification_title}</h3>
-                <p>{notification_message}</p>
-                """
-            )
+    except Exception as e:
+        logging.error(f"Notification creation failed: {str(e)}", exc_info=True)
+        raise
 
-            await session.commit_transaction()
+# Task system
+async def get_active_tasks() -> list:
+    """Active tasks, served from tasks_cache. Callers must copy a task before modifying it."""
+    tasks = tasks_cache.get("active")
+    if tasks is None:
+        version = tasks_cache.version
+        tasks = await db.tasks.find({"is_active": True}).sort("created_at", 1).to_list(None)
+        tasks_cache.set("active", tasks, version=version)
+    return tasks
+
+async def initialize_notification_state(user_id: str, db_instance=None) -> dict:
+    """
+    Counts a user's unread notifications and read broadcasts once, then relies on the maintained
+    counters. Broadcasts count as read when they are at or before the user's mark-all cursor, or
+    later and have a receipt, the same rule the read paths and the archiver use.
+    """
+    if db_instance is None:
+        db_instance = db
+    state, receipt_ids = await asyncio.gather(
+        db_instance.notification_state.find_one({"_id": user_id}, {"broadcasts_read_through": 1}),
+        db_instance.notification_receipts.distinct("notification_id", {"user_id": user_id})
+    )
+    read_through = (state or {}).get("broadcasts_read_through")
+    by_receipt = {"notification_id": {"$in": receipt_ids}}
+    if read_through:
+        by_receipt["created_at"] = {"$gt": read_through}
+    unread, broadcasts_read = await asyncio.gather(
+        db_instance.notifications.count_documents({"user_id": user_id, "is_read": False}),
+        db_instance.broadcast_notifications.count_documents(by_receipt)
+    )
+    if read_through:
+        broadcasts_read += await db_instance.broadcast_notifications.count_documents({"created_at": {"$lte": read_through}})
+    return await db_instance.notification_state.find_one_and_update(
+        {"_id": user_id},
+        {"$set": {"unread": unread, "broadcasts_read": broadcasts_read, "initialized": True}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
 
-            return {
-                "success": True,
-                "message": f"Transaction {transaction_id} manually completed successfully."
-            }
+async def get_unread_notification_count(user_id: str, db_instance=None) -> int:
+    """Unread personal notifications plus unread broadcasts, read from two counter documents."""
+    if db_instance is None:
+        db_instance = db
+    state, broadcasts = await asyncio.gather(
+        db_instance.notification_state.find_one({"_id": user_id}),
+        db_instance.notification_counters.find_one({"_id": "broadcasts"})
+    )
+    if not state or not state.get("initialized"):
+        state = await initialize_notification_state(user_id, db_instance)
+    broadcast_total = broadcasts.get("total", 0) if broadcasts else 0
+    return max(0, state.get("unread", 0)) + max(0, broadcast_total - state.get("broadcasts_read", 0))
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        if session.in_transaction:
-            await session.abort_transaction()
-        logging.error(f"Error in manual completion for transaction {transaction_id}: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to manually complete transaction: {str(e)}"
-        )
-    finally:
-        if session and session.client:
-            session.end_session()
+async def fetch_user_notifications(user_id: str, limit: int, db_instance=None) -> list:
+    """
+    Latest `limit` notifications for a user: their own and broadcasts, each read with an
+    indexed newest-first query and merged by created_at. Broadcast read state comes from
+    the user's receipts and mark-all-read cursor.
+    """
+    if db_instance is None:
+        db_instance = db
+    active = {"expires_at": {"$gt": datetime.utcnow()}}
+    personal, broadcasts, state = await asyncio.gather(
+        db_instance.notifications.find({"user_id": user_id, **active}).sort("created_at", -1).limit(limit).to_list(limit),
+        db_instance.broadcast_notifications.find(active).sort("created_at", -1).limit(limit).to_list(limit),
+        db_instance.notification_state.find_one({"_id": user_id}, {"broadcasts_read_through": 1})
+    )
+
+    if broadcasts:
+        read_through = (state or {}).get("broadcasts_read_through")
+        receipts = await db_instance.notification_receipts.find(
+            {"user_id": user_id, "notification_id": {"$in": [b["notification_id"] for b in broadcasts]}},
+            {"notification_id": 1}
+        ).to_list(None)
+        read_ids = {r["notification_id"] for r in receipts}
+        for broadcast in broadcasts:
+            broadcast["user_id"] = None
+            broadcast["is_read"] = broadcast["notification_id"] in read_ids or bool(
+                read_through and broadcast["created_at"] <= read_through
+            )
+
+    return sorted(personal + broadcasts, key=lambda n: n["created_at"], reverse=True)[:limit]
 
-@app.post("/api/admin/approve", dependencies=[Depends(get_current_admin_user)])
-async def approve_transaction(approval_data: WithdrawalApproval, db_instance: AsyncIOMotorClient = Depends(get_db_instance)):
+async def migrate_broadcast_notifications(db_instance=None, batch_size: int = 500) -> dict:
     """
-    Admin approves a transaction (deposit or withdrawal).
+    Moves legacy broadcasts (user_id None in notifications) into broadcast_notifications,
+    keeping their _id, and resets the broadcast total. The shared is_read flag is dropped.
+    Safe to re-run.
     """
-    transaction_id = approval_data.transaction_id
-    session = await db_instance.client.start_session()
+    if db_instance is None:
+        db_instance = db
 
-    try:
-        async with session.start_transaction():
-            # Find the transaction
-            transaction = await db_instance.transactions.find_one(
-                {"transaction_id": transaction_id},
-                session=session
-            )
+    moved = 0
+    while True:
+        batch = await db_instance.notifications.find({"user_id": None}).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        for doc in batch:
+            doc.pop("user_id", None)
+            doc.pop("is_read", None)
+        await db_instance.broadcast_notifications.bulk_write(
+            [UpdateOne({"_id": doc["_id"]}, {"$setOnInsert": doc}, upsert=True) for doc in batch],
+            ordered=False
+        )
+        await db_instance.notifications.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        moved += len(batch)
+        logging.info(f"Broadcast notification migration: {moved} moved")
 
-            if not transaction:
-                raise HTTPException(status_code=404, detail="Transaction not found")
+    total = await db_instance.broadcast_notifications.count_documents({})
+    await db_instance.notification_counters.update_one({"_id": "broadcasts"}, {"$set": {"total": total}}, upsert=True)
+    # Force unread counters to be recounted on next read
+    await db_instance.notification_state.update_many({}, {"$set": {"initialized": False}})
+    return {"moved": moved, "broadcast_total": total}
 
-            # Only allow approval for pending transactions
-            if transaction['status'] != 'pending_admin_approval':
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Cannot approve transaction with status: {transaction['status']}"
-                )
+async def claim_expired_notifications(collection, batch_size: int):
+    """
+    Claims a batch of expired rows so concurrent archivers (one per worker) never process the
+    same row twice. Returns the claim id, or None when nothing is left to archive.
+    """
+    now = datetime.utcnow()
+    unclaimed = {"$or": [
+        {"archive_claim": {"$exists": False}},
+        {"archive_claimed_at": {"$lt": now - timedelta(hours=1)}}  # claimant died mid-batch
+    ]}
+    candidates = await collection.find({"expires_at": {"$lte": now}, **unclaimed}, {"_id": 1}).limit(batch_size).to_list(batch_size)
+    if not candidates:
+        return None
+    claim = str(uuid.uuid4())
+    await collection.update_many(
+        {"_id": {"$in": [c["_id"] for c in candidates]}, **unclaimed},
+        {"$set": {"archive_claim": claim, "archive_claimed_at": now}}
+    )
+    return claim
 
-            user_id = transaction['user_id']
-            amount = float(transaction['amount'])
-            transaction_type = transaction['type']
+def broadcasts_read_decrement(created_ats: list, cursor_covers: bool) -> list:
+    """
+    Pipeline update lowering broadcasts_read by the archived broadcasts a user had read:
+    those at or before their mark-all cursor (`cursor_covers`), or else those after it.
+    """
+    cursor = {"$ifNull": ["$broadcasts_read_through", datetime.min]}
+    covered = {"$lte": ["$$created_at", cursor]} if cursor_covers else {"$gt": ["$$created_at", cursor]}
+    return [{"$set": {"broadcasts_read": {"$subtract": [{"$ifNull": ["$broadcasts_read", 0]}, {"$size": {
+        "$filter": {"input": created_ats, "as": "created_at", "cond": covered}
+    }}]}}}]
 
-            # Update transaction status
-            await db_instance.transactions.update_one(
-                {"transaction_id": transaction_id},
-                {
-                    "$set": {
-                        "status": "completed",
-                        "completed_at": datetime.utcnow(),
-                        "approved_by": "admin"
-                    }
-                },
+async def archive_notification_batch(db_instance, source: str, collection, claim: str) -> int:
+    """
+    Archives one claimed batch. The archive copies, counter decrements and deletes commit
+    in one transaction, so a crash mid-batch leaves the counters untouched and the batch is
+    archived in full once its claim lapses.
+    """
+    async with await db_instance.client.start_session() as session:
+        async with session.start_transaction():
+            batch = await collection.find({"archive_claim": claim}, session=session).to_list(None)
+            if not batch:
+                return 0
+
+            archived_at = datetime.utcnow()
+            await db_instance.notifications_archive.bulk_write(
+                [
+                    ReplaceOne(
+                        {"_id": doc["_id"]},
+                        {**{k: v for k, v in doc.items() if k not in ("archive_claim", "archive_claimed_at")}, "source": source, "archived_at": archived_at},
+                        upsert=True
+                    )
+                    for doc in batch
+                ],
                 session=session
             )
 
-            # Handle different transaction types
-            if transaction_type == "deposit":
-                user = await db_instance.users.find_one({"user_id": user_id}, session=session)
-                if user:
-                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                    new_wallet_balance = current_wallet_balance + amount
-                    current_total_earned = float(user.get('total_earned', '0.0'))
-                    new_total_earned = current_total_earned + amount
-
-                    await db_instance.users.update_one(
-                        {"user_id": user_id},
-                        {
-                            "$set": {
-                                "wallet_balance": str(new_wallet_balance),
-                                "total_earned": str(new_total_earned)
-                            }
-                        },
+            if source == "personal":
+                unread = Counter(doc["user_id"] for doc in batch if not doc.get("is_read"))
+                if unread:
+                    await db_instance.notification_state.bulk_write(
+                        [UpdateOne({"_id": uid}, {"$inc": {"unread": -count}}) for uid, count in unread.items()],
                         session=session
                     )
-
-                    # Check if this activates the user
-                    if not user['is_activated'] and new_wallet_balance >= float(user['activation_amount']):
-                        await db_instance.users.update_one(
-                            {"user_id": user_id},
-                            {"$set": {"is_activated": True}},
-                            session=session
-                        )
-                        logging.info(f"User {user_id} activated via admin approval.")
-
-                        # Trigger binary commissions
-                        await trigger_binary_commissions(user_id, session=session)
-
-                        # Process referral if exists
-                        if user.get("referred_by"):
-                            await process_referral_reward(
-                                referred_id=user_id,
-                                referrer_id=user["referred_by"],
-                                session=session
-                            )
-
-                        # Create activation notification
-                        await create_notification(
-                            {
-                                "title": "Account Activated!",
-                                "message": f"Congratulations! Your account is activated. Deposit of {amount} KES approved.",
-                                "user_id": user_id,
-                                "type": "reward"
-                            },
-                            session=session,
-                            db_instance=db_instance
-                        )
-
-                # Create notification for deposit approval
-                await create_notification(
-                    {
-                        "title": "Deposit Approved",
-                        "message": f"Your deposit of KES {amount:,.2f} has been approved by admin.",
-                        "user_id": user_id,
-                        "type": "payment"
-                    },
-                    session=session,
-                    db_instance=db_instance
+            else:
+                created_at = {doc["notification_id"]: doc["created_at"] for doc in batch}
+                receipts = await db_instance.notification_receipts.find(
+                    {"notification_id": {"$in": list(created_at)}}, {"user_id": 1, "notification_id": 1}, session=session
+                ).to_list(None)
+                read_by = {}
+                for receipt in receipts:
+                    read_by.setdefault(receipt["user_id"], set()).add(receipt["notification_id"])
+                # Readers by mark-all cursor, then readers by receipt of broadcasts after their cursor
+                await db_instance.notification_state.bulk_write(
+                    [UpdateMany(
+                        {"broadcasts_read_through": {"$gte": min(created_at.values())}},
+                        broadcasts_read_decrement(list(created_at.values()), cursor_covers=True)
+                    )] + [
+                        UpdateOne({"_id": uid}, broadcasts_read_decrement([created_at[nid] for nid in read], cursor_covers=False))
+                        for uid, read in read_by.items()
+                    ],
+                    session=session
                 )
+                await db_instance.notification_receipts.delete_many({"notification_id": {"$in": list(created_at)}}, session=session)
+                await db_instance.notification_counters.update_one({"_id": "broadcasts"}, {"$inc": {"total": -len(batch)}}, session=session)
 
-            elif transaction_type == "withdrawal":
-                # For withdrawals, we need to deduct from balance and process payout
-                user = await db_instance.users.find_one({"user_id": user_id}, session=session)
-                if user:
-                    kes_amount = float(transaction.get('kes_amount', amount))
-                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                    new_wallet_balance = current_wallet_balance - kes_amount
-                    current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
-                    new_total_withdrawn = current_total_withdrawn + kes_amount
-
-                    await db_instance.users.update_one(
-                        {"user_id": user_id},
-                        {
-                            "$set": {
-                                "wallet_balance": str(new_wallet_balance),
-                                "total_withdrawn": str(new_total_withdrawn)
-                            }
-                        },
-                        session=session
-                    )
+            await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}}, session=session)
+            await commit_transaction(session)
+    return len(batch)
 
-                # Create notification for withdrawal approval
-                await create_notification(
-                    {
-                        "title": "Withdrawal Approved",
-                        "message": f"Your withdrawal of {transaction.get('original_amount', amount)} {transaction.get('original_currency', 'KES')} has been approved and is being processed.",
-                        "user_id": user_id,
-                        "type": "payment"
-                    },
-                    session=session,
-                    db_instance=db_instance
-                )
+async def archive_expired_notifications(db_instance=None, batch_size: int = 500) -> dict:
+    """
+    Moves notifications past expires_at into notifications_archive and keeps the unread
+    counters in step: unread personal rows decrement their owner's counter, and archived
+    broadcasts leave the broadcast total and the read counts of users who had read them.
+    A plain TTL index on the live collections would delete rows behind the counters' back.
+    """
+    if db_instance is None:
+        db_instance = db
 
-            await session.commit_transaction()
-            logging.info(f"Admin approved transaction {transaction_id} for user {user_id}")
+    archived = {"personal": 0, "broadcast": 0}
+    for source, collection in (("personal", db_instance.notifications), ("broadcast", db_instance.broadcast_notifications)):
+        while True:
+            claim = await claim_expired_notifications(collection, batch_size)
+            if claim is None:
+                break
+            archived[source] += await archive_notification_batch(db_instance, source, collection, claim)
+
+    if archived["personal"] or archived["broadcast"]:
+        logging.info(f"Archived expired notifications: {archived['personal']} personal, {archived['broadcast']} broadcast")
+    return archived
+
+async def run_notification_archiver():
+    """Background loop archiving expired notifications every NOTIFICATION_ARCHIVE_INTERVAL_SECONDS."""
+    while True:
+        try:
+            await archive_expired_notifications()
+        except Exception as e:
+            logging.error(f"Notification archival failed: {e}", exc_info=True)
+        await asyncio.sleep(NOTIFICATION_ARCHIVE_INTERVAL_SECONDS)
 
-            return {
-                "success": True,
-                "message": f"Transaction {transaction_id} approved successfully"
-            }
+async def compute_platform_counters(db_instance=None) -> dict:
+    """Full recount of the dashboard totals from users and transactions."""
+    if db_instance is None:
+        db_instance = db
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        if session.in_transaction:
-            await session.abort_transaction()
-        logging.error(f"Error in transaction approval for {transaction_id}: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to approve transaction: {str(e)}"
-        )
-    finally:
-        if session and session.client:
-            session.end_session()
+    def completed_total(transaction_type: str):
+        return db_instance.transactions.aggregate([
+            {"$match": {"type": transaction_type, "status": "completed"}},
+            {"$group": {"_id": None, "total_amount": {"$sum": {"$toDouble": {"$ifNull": ["$amount", "$kes_amount"]}}}}}
+        ]).to_list(1)
+
+    total_users, activated_users, deposits, withdrawals, pending_withdrawals = await asyncio.gather(
+        db_instance.users.count_documents({}),
+        db_instance.users.count_documents({"is_activated": True}),
+        completed_total("deposit"),
+        completed_total("withdrawal"),
+        db_instance.transactions.count_documents({"type": "withdrawal", "status": "pending_admin_approval"})
+    )
+    return {
+        "total_users": total_users,
+        "activated_users": activated_users,
+        "total_deposits": deposits[0]['total_amount'] if deposits else 0.0,
+        "total_withdrawals": withdrawals[0]['total_amount'] if withdrawals else 0.0,
+        "pending_withdrawals": pending_withdrawals
+    }
 
-@app.post("/api/admin/reject", dependencies=[Depends(get_current_admin_user)])
-async def reject_transaction(approval_data: UpdateWithdrawalStatus, db_instance: AsyncIOMotorClient = Depends(get_db_instance)):
+def unchanged_since(stored: dict, keys) -> dict:
+    """Filter matching a counters document only if none of `keys` moved since `stored` was read."""
+    return {key: stored[key] if key in stored else {"$exists": False} for key in keys}
+
+async def verify_platform_counters(db_instance=None, attempts: int = 3) -> dict:
     """
-    Admin rejects a transaction.
+    Recounts the totals and corrects any drift in platform_counters. The recount is written
+    only if no counter moved while it ran (the update is guarded on the values read before
+    it), so an update landing during the recount is never counted twice; the recount is
+    then retried, up to `attempts` times.
     """
-    transaction_id = approval_data.status  # Using status field to pass transaction_id
-    session = await db_instance.client.start_session()
+    if db_instance is None:
+        db_instance = db
 
-    try:
-        async with session.start_transaction():
-            # Find the transaction
-            transaction = await db_instance.transactions.find_one(
-                {"transaction_id": transaction_id},
-                session=session
+    for _ in range(attempts):
+        stored = await db_instance.platform_counters.find_one({"_id": "platform"}) or {}
+        actual = await compute_platform_counters(db_instance)
+        drift = {
+            key: value - stored.get(key, 0)
+            for key, value in actual.items()
+            if abs(value - stored.get(key, 0)) > 0.005
+        }
+        try:
+            result = await db_instance.platform_counters.update_one(
+                {"_id": "platform", **unchanged_since(stored, actual)},
+                {"$set": {**actual, "verified_at": datetime.utcnow()}},
+                upsert=not stored
             )
+        except DuplicateKeyError:
+            continue  # created by an update during the first recount
+        if result.matched_count or result.upserted_id is not None:
+            if drift and "verified_at" in stored:
+                logging.warning(f"Platform counters drifted, corrected: {drift}")
+            return {"counters": actual, "drift": drift, "applied": True}
+
+    logging.warning(f"Platform counters changed during each of {attempts} recounts; correction left for the next run")
+    return {"counters": actual, "drift": drift, "applied": False}
+
+async def run_platform_counter_verifier():
+    """Background loop running verify_platform_counters and verify_task_stats daily at PLATFORM_COUNTERS_VERIFY_HOUR (UTC)."""
+    while True:
+        now = datetime.utcnow()
+        next_run = now.replace(hour=PLATFORM_COUNTERS_VERIFY_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await verify_platform_counters()
+            await verify_task_stats()
+        except Exception as e:
+            logging.error(f"Platform counter verification failed: {e}", exc_info=True)
 
-            if not transaction:
-                raise HTTPException(status_code=404, detail="Transaction not found")
+async def send_mpesa_b2c_payment(recipient_phone: str, amount: float, full_name: str, access_token: str = None, transaction_id: str = None):
+    """Sends an M-Pesa B2C payment request. Returns the (request payload, response data) pair."""
+    if access_token is None:
+        access_token = await get_mpesa_access_token()
 
-            # Only allow rejection for pending transactions
-            if transaction['status'] not in ['pending', 'pending_admin_approval']:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Cannot reject transaction with status: {transaction['status']}"
-                )
+    b2c_payload = {
+        "InitiatorName": MPESA_INITIATOR_NAME,
+        "SecurityCredential": MPESA_SECURITY_CREDENTIAL,
+        "CommandID": "BusinessPayment",
+        "Amount": int(amount),
+        "PartyA": MPESA_B2C_SHORTCODE,
+        "PartyB": recipient_phone,
+        "Remarks": f"Withdrawal for {full_name} (EarnPlatform)",
+        "QueueTimeOutURL": f"{BACKEND_URL}/api/payments/mpesa-b2c-timeout",
+        "ResultURL": f"{BACKEND_URL}/api/payments/mpesa-b2c-result",
+        "Occasion": "User Withdrawal"
+    }
+    logging.info("M-Pesa B2C Payload: %s", log_payload(b2c_payload))
+
+    mpesa_b2c_response = await gateway_request(
+        "mpesa", "POST",
+        f"{MPESA_BASE_URL}/mpesa/b2c/v1/paymentrequest",
+        transaction_id=transaction_id,
+        marks_side_effect=True,
+        json=b2c_payload,
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+    )
+    mpesa_b2c_response.raise_for_status()
+    b2c_data = mpesa_b2c_response.json()
+
+    return b2c_payload, b2c_data
 
-            user_id = transaction['user_id']
-            amount = float(transaction['amount'])
-            transaction_type = transaction['type']
+async def settle_bulk_withdrawal_payout(transaction: dict, user: dict, db_instance, mpesa_access_token: str = None) -> dict:
+    """
+    Dispatches the payout for a withdrawal already debited by the bulk approval.
+    On failure the transaction is marked failed and the debit reverted, in one transaction.
+    Returns a per-item result for the bulk response stream.
+    """
+    transaction_id = transaction['transaction_id']
+    user_id = transaction['user_id']
+    method = transaction['method']
+    kes_amount = float(transaction['kes_amount'])
+    original_amount = transaction['original_amount']
+    original_currency = transaction['original_currency']
+
+    # Take the payout before calling the gateway, so the recovery sweep and the batch never both send it
+    taken = await db_instance.transactions.update_one(
+        {"_id": transaction["_id"], "status": "processing", "payout_pending": True},
+        {"$unset": {"payout_pending": ""}, "$set": {"payout_started_at": datetime.utcnow()}}
+    )
+    if not taken.modified_count:
+        return {"transaction_id": transaction_id, "status": "skipped", "method": method, "message": "Payout already sent or no longer pending."}
 
-            # Update transaction status
+    try:
+        if method == "mpesa":
+            b2c_payload, b2c_data = await send_mpesa_b2c_payment(
+                transaction['phone'], kes_amount, user['full_name'], access_token=mpesa_access_token, transaction_id=transaction_id
+            )
+            if b2c_data.get("ResponseCode") != "0":
+                raise Exception(f"M-Pesa B2C initiation failed: {b2c_data.get('errorMessage', 'Unknown M-Pesa error')}")
+            b2c_event_ids = [
+                await record_gateway_event("mpesa", "b2c_request", b2c_payload, transaction_id=transaction_id, db_instance=db_instance),
+                await record_gateway_event("mpesa", "b2c_response", b2c_data, transaction_id=transaction_id, db_instance=db_instance)
+            ]
             await db_instance.transactions.update_one(
-                {"transaction_id": transaction_id},
+                {"_id": transaction["_id"]},
                 {
                     "$set": {
-                        "status": "rejected",
-                        "completed_at": datetime.utcnow(),
-                        "rejected_by": "admin",
-                        "rejection_reason": approval_data.reason or "Rejected by admin"
-                    }
-                },
-                session=session
-            )
-
-            # For deposits, no balance changes needed (funds weren't added)
-            # For withdrawals, no balance changes needed (funds weren't deducted)
-
-            # Create notification for rejection
-            if transaction_type == "deposit":
-                await create_notification(
-                    {
-                        "title": "Deposit Rejected",
-                        "message": f"Your deposit of KES {amount:,.2f} has been rejected. Reason: {approval_data.reason or 'No reason provided'}",
-                        "user_id": user_id,
-                        "type": "payment"
-                    },
-                    session=session,
-                    db_instance=db_instance
-                )
-            elif transaction_type == "withdrawal":
-                await create_notification(
-                    {
-                        "title": "Withdrawal Rejected",
-                        "message": f"Your withdrawal of {transaction.get('original_amount', amount)} {transaction.get('original_currency', 'KES')} has been rejected. Reason: {approval_data.reason or 'No reason provided'}",
-                        "user_id": user_id,
-                        "type": "payment"
+                        "payment_details.mpesa_conversation_id": b2c_data.get("ConversationID"),
+                        "payment_details.mpesa_originator_conv_id": b2c_data.get("OriginatorConversationID")
                     },
-                    session=session,
-                    db_instance=db_instance
-                )
-
-            await session.commit_transaction()
-            logging.info(f"Admin rejected transaction {transaction_id} for user {user_id}")
-
-            return {
-                "success": True,
-                "message": f"Transaction {transaction_id} rejected successfully"
-            }
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        if session.in_transaction:
-            await session.abort_transaction()
-        logging.error(f"Error in transaction rejection for {transaction_id}: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to reject transaction: {str(e)}"
-        )
-    finally:
-        if session and session.client:
-            session.end_session()
-
-@app.post("/api/admin/approve-withdrawal", dependencies=[Depends(get_current_admin_user)])
-async def approve_withdrawal(approval_data: WithdrawalApproval, db_instance: AsyncIOMotorClient = Depends(get_db_instance)):
-    """
-    Admin approves a pending withdrawal request.
-    """
-    transaction_id = approval_data.transaction_id
-    session = await db_instance.client.start_session()
-    try:
-        async with session.start_transaction():
-            # Find and attempt to transition transaction from pending_admin_approval to processing
-            transaction = await db_instance.transactions.find_one_and_update(
-                {"transaction_id": transaction_id, "status": "pending_admin_approval"},
-                {"$set": {"status": "processing", "approved_at": datetime.utcnow()}},
-                return_document=True,
-                session=session
+                    "$push": {"gateway_event_ids": {"$each": b2c_event_ids}}
+                }
             )
+            payout_message = "M-Pesa B2C initiated."
+        elif method == "paypal":
+            # PayPal payout implementation would go here (simulated, as in approve_withdrawal)
+            payout_message = "PayPal payout initiated (simulated)."
+        else:
+            raise Exception(f"Unknown withdrawal method: {method}")
 
-            if not transaction:
-                logging.warning(f"Attempted to approve non-pending or non-existent transaction: {transaction_id}")
-                raise HTTPException(
-                    status_code=404,
-                    detail="Pending withdrawal request not found or already processed."
+    except Exception as e:
+        logging.error(f"Bulk payout failed for {transaction_id}: {str(e)}", exc_info=True)
+        # The failed transition and the refund commit together, and only the transition from processing refunds
+        async with await db_instance.client.start_session() as session:
+            async with session.start_transaction():
+                failed = await db_instance.transactions.update_one(
+                    {"_id": transaction["_id"], "status": "processing"},
+                    {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": f"Payout initiation failed: {e}"}},
+                    session=session
                 )
-
-            user_id = transaction['user_id']
-            kes_deduct = float(transaction['kes_amount'])
-            original_amount = transaction['original_amount']
-            original_currency = transaction['original_currency']
-
-            # Fetch user document to check current balance
-            user = await db_instance.users.find_one({"user_id": user_id}, session=session)
-            
-            if not user:
-                logging.error(f"User {user_id} not found for transaction {transaction_id}.")
-                raise HTTPException(status_code=404, detail="User associated with withdrawal not found.")
-            
-            if float(user['wallet_balance']) < kes_deduct:
-                # If balance is insufficient now, revert transaction status to failed.
-                await db_instance.transactions.update_one(
-                    {"_id": transaction["_id"]},
-                    {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": "Insufficient balance at time of approval."}},
+                if not failed.modified_count:
+                    return {"transaction_id": transaction_id, "status": "error", "method": method, "message": f"Payout initiation failed and the withdrawal was settled elsewhere; no refund made. {e}"}
+                # Revert the debit server-side so concurrent refunds to the same user cannot overwrite each other
+                refunded_user = await db_instance.users.find_one_and_update(
+                    {"user_id": user_id},
+                    [{"$set": {
+                        "wallet_balance": {"$toString": {"$add": [{"$toDouble": "$wallet_balance"}, kes_amount]}},
+                        "total_withdrawn": {"$toString": {"$subtract": [{"$toDouble": "$total_withdrawn"}, kes_amount]}}
+                    }}],
+                    projection={"wallet_balance": 1},
+                    return_document=ReturnDocument.AFTER,
                     session=session
                 )
+                if refunded_user:
+                    await publish_wallet_delta(user_id, kes_amount, float(refunded_user["wallet_balance"]), "withdrawal_reversal", session=session)
                 await create_notification(
                     {
                         "title": "Withdrawal Failed",
-                        "message": f"Your withdrawal of {original_amount} {original_currency} failed because your wallet balance was insufficient at the time of approval. Funds were not deducted.",
+                        "message": f"Your withdrawal of {original_amount} {original_currency} failed during initiation. Funds returned to wallet.",
                         "user_id": user_id,
                         "type": "payment"
                     },
                     session=session,
                     db_instance=db_instance
                 )
-                await session.commit_transaction()
-                raise HTTPException(
-                    status_code=400,
-                    detail="User's wallet balance is now insufficient. Withdrawal cancelled."
-                )
-            
-            # Deduct from user's balance first and increment total_withdrawn
-            current_balance = float(user['wallet_balance'])
-            new_balance = current_balance - kes_deduct
-            current_total_withdrawn = float(user['total_withdrawn'])
-            new_total_withdrawn = current_total_withdrawn + kes_deduct
+                await commit_transaction(session)
+        return {"transaction_id": transaction_id, "status": "failed", "method": method, "message": f"Payout initiation failed. Funds reverted. {e}"}
 
-            await db_instance.users.update_one(
-                {"user_id": user_id},
-                {
-                    "$set": {
-                        "wallet_balance": str(new_balance),
-                        "total_withdrawn": str(new_total_withdrawn)
-                    }
-                },
-                session=session
-            )
+    await create_notification(
+        {
+            "title": "Withdrawal Approved!",
+            "message": f"Your withdrawal of {original_amount} {original_currency} has been approved and is being processed.",
+            "user_id": user_id,
+            "type": "payment"
+        },
+        db_instance=db_instance
+    )
+    return {"transaction_id": transaction_id, "status": "processing", "method": method, "message": payout_message}
 
-            # Now, initiate the actual payout based on method
-            payout_success = False
-            payout_message = "Payout initiated."
-            withdrawal_method = transaction['method']
-
-            if withdrawal_method == "mpesa":
-                recipient_phone = transaction['phone']
-                payout_amount = float(transaction['kes_amount'])
-                payout_currency = "KES"
-                try:
-                    access_token = await get_mpesa_access_token()
-                    
-                    b2c_payload = {
-                        "InitiatorName": MPESA_INITIATOR_NAME,
-                        "SecurityCredential": MPESA_SECURITY_CREDENTIAL,
-                        "CommandID": "BusinessPayment",
-                        "Amount": int(payout_amount),
-                        "PartyA": MPESA_B2C_SHORTCODE,
-                        "PartyB": recipient_phone,
-                        "Remarks": f"Withdrawal for {user['full_name']} (EarnPlatform)",
-                        "QueueTimeOutURL": f"{BACKEND_URL}/api/payments/mpesa-b2c-timeout",
-                        "ResultURL": f"{BACKEND_URL}/api/payments/mpesa-b2c-result",
-                        "Occasion": "User Withdrawal"
-                    }
-                    logging.info(f"M-Pesa B2C Payload: {json.dumps(b2c_payload, indent=2)}")
-
-                    async with httpx.AsyncClient(timeout=30.0) as client:
-                        mpesa_b2c_response = await client.post(
-                            "https://sandbox.safaricom.co.ke/mpesa/b2c/v1/paymentrequest",
-                            json=b2c_payload,
-                            headers={
-                                "Authorization": f"Bearer {access_token}",
-                                "Content-Type": "application/json"
-                            }
-                        )
-                        mpesa_b2c_response.raise_for_status()
-                        b2c_data = mpesa_b2c_response.json()
-
-                    if b2c_data.get("ResponseCode") == "0":
-                        await db_instance.transactions.update_one(
-                            {"_id": transaction["_id"]},
-                            {"$set": {
-                                "payment_details.mpesa_conversation_id": b2c_data.get("ConversationID"),
-                                "payment_details.mpesa_originator_conv_id": b2c_data.get("OriginatorConversationID"),
-                                "payment_details.raw_b2c_request": b2c_payload,
-                                "payment_details.raw_b2c_response": b2c_data
-                            }},
-                            session=session
-                        )
-                        payout_success = True
-                        payout_message = "M-Pesa B2C initiated."
-                        logging.info(f"M-Pesa B2C initiated for transaction {transaction_id}. ConvID: {b2c_data.get('ConversationID')}")
-                    else:
-                        raise Exception(f"M-Pesa B2C initiation failed: {b2c_data.get('errorMessage', 'Unknown M-Pesa error')}")
-
-                except Exception as e:
-                    logging.error(f"Failed to initiate M-Pesa B2C for {transaction_id}: {str(e)}", exc_info=True)
-                    # Revert user balance if B2C initiation fails
-                    user = await db_instance.users.find_one({"user_id": user_id}, session=session)
-                    if user:
-                        current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                        new_wallet_balance = current_wallet_balance + kes_deduct
-                        current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
-                        new_total_withdrawn = current_total_withdrawn - kes_deduct
-
-                        await db_instance.users.update_one(
-                            {"user_id": user_id},
-                            {
-                                "$set": {
-                                    "wallet_balance": str(new_wallet_balance),
-                                    "total_withdrawn": str(new_total_withdrawn)
-                                }
-                            },
-                            session=session
-                        )
-                    await db_instance.transactions.update_one(
-                        {"_id": transaction["_id"]},
-                        {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": f"M-Pesa B2C initiation failed: {e}"}},
-                        session=session
-                    )
-                    await create_notification(
-                        {
-                            "title": "Withdrawal Failed (M-Pesa)",
-                            "message": f"Your M-Pesa withdrawal of {original_amount} {original_currency} failed during initiation. Funds returned to wallet. Reason: {e}",
-                            "user_id": user_id,
-                            "type": "payment"
-                        },
-                        session=session,
-                        db_instance=db_instance
-                    )
-                    payout_success = False
-                    payout_message = f"M-Pesa B2C initiation failed. Funds reverted. {e}"
-
-            elif withdrawal_method == "paypal":
-                recipient_email = transaction['email']
-                payout_amount = float(transaction['original_amount'])
-                payout_currency = original_currency
-                try:
-                    # PayPal payout implementation would go here
-                    # This is a simplified version - actual implementation would use PayPal Payouts API
-                    payout_success = True
-                    payout_message = "PayPal payout initiated (simulated)."
-                    logging.info(f"PayPal payout initiated for transaction {transaction_id}.")
-
-                except Exception as e:
-                    logging.error(f"Failed to initiate PayPal payout for {transaction_id}: {str(e)}", exc_info=True)
-                    # Revert user balance if PayPal payout initiation fails
-                    user = await db_instance.users.find_one({"user_id": user_id}, session=session)
-                    if user:
-                        current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                        new_wallet_balance = current_wallet_balance + kes_deduct
-                        current_total_withdrawn = float(user.get('total_withdrawn', '0.0'))
-                        new_total_withdrawn = current_total_withdrawn - kes_deduct
-                        await db_instance.users.update_one(
-                            {"user_id": user_id},
-                            {
-                                "$set": {
-                                    "wallet_balance": str(new_wallet_balance),
-                                    "total_withdrawn": str(new_total_withdrawn)
-                                }
-                            },
-                            session=session
-                        )
-                    await db_instance.transactions.update_one(
-                        {"_id": transaction["_id"]},
-                        {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": f"PayPal payout initiation failed: {e}"}},
-                        session=session
-                    )
-                    await create_notification(
-                        {
-                            "title": "Withdrawal Failed (PayPal)",
-                            "message": f"Your PayPal withdrawal of {original_amount} {original_currency} failed during initiation. Funds returned to wallet. Reason: {e}",
-                            "user_id": user_id,
-                            "type": "payment"
-                        },
-                        session=session,
-                        db_instance=db_instance
-                    )
-                    payout_success = False
-                    payout_message = f"PayPal payout initiation failed. Funds reverted. {e}"
-            else:
-                logging.error(f"Unknown withdrawal method for transaction {transaction_id}: {withdrawal_method}")
-                user = await db_instance.users.find_one({"user_id": user_id}, session=session)
-                if user:
-                    current_wallet_balance = float(user.get('wallet_balance', '0.0'))
-                    new_wallet_balance = current_wallet_balance + kes_deduct
-                    await db_instance.users.update_one(
-                        {"user_id": user_id},
-                        {"$set": {"wallet_balance": str(new_wallet_balance)}},
-                        session=session
-                    )
-                await db_instance.transactions.update_one(
-                    {"_id": transaction["_id"]},
-                    {"$set": {"status": "failed", "completed_at": datetime.utcnow(), "error_message": "Unknown withdrawal method."}},
-                    session=session
-                )
-                payout_success = False
-                payout_message = "Unknown withdrawal method. Funds reverted."
-            
-            if payout_success:
-                await create_notification({
-                    "title": "Withdrawal Approved!",
-                    "message": f"Your withdrawal of {original_amount} {original_currency} has been approved and is being processed.",
-                    "user_id": user_id,
-                    "type": "payment"
-                }, session=session, db_instance=db_instance)
-                await session.commit_transaction()
-                return {
-                    "success": True,
-                    "message": f"Withdrawal {transaction_id} approved. {payout_message}"
-                }
-            else:
-                await session.abort_transaction()
-                raise HTTPException(status_code=500, detail=f"Withdrawal failed after approval: {payout_message}")
+bulk_payout_tasks = set()  # referenced until done, so a running batch is not garbage-collected
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        if session.in_transaction:
-            await session.abort_transaction()
-        logging.critical(f"Critical error during withdrawal approval for transaction {transaction_id}: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"An unexpected error occurred during withdrawal approval: {str(e)}"
-        )
-    finally:
-        if session and session.in_transaction:
-             await session.abort_transaction()
-        if session and session.client:
-            session.end_session()
-
-# Task management endpoints
-@app.post("/api/admin/tasks", dependencies=[Depends(get_current_admin_user)])
-async def create_task(task_data: Task):
-    task_id = str(uuid.uuid4())
-    task_doc = {
-        "task_id": task_id,
-        "title": task_data.title,
-        "description": task_data.description,
-        "reward": str(task_data.reward),
-        "type": task_data.type,
-        "requirements": task_data.requirements,
-        "media": task_data.media,
-        "survey_questions": task_data.survey_questions,
-        "is_active": task_data.is_active,
-        "created_at": datetime.utcnow()
-    }
-    await db.tasks.insert_one(task_doc)
-    logging.info(f"Admin created task: {task_data.title}")
-    return {"success": True, "message": "Task created successfully", "task": json_serializable_doc(task_doc)}
-
-@app.get("/api/admin/tasks", dependencies=[Depends(get_current_admin_user)])
-async def get_all_tasks(status: Optional[bool] = None, task_type: Optional[str] = None):
-    query = {}
-    if status is not None:
-        query["is_active"] = status
-    if task_type:
-        query["type"] = task_type
-    tasks = await db.tasks.find(query).sort("created_at", -1).to_list(100)
-    return {"success": True, "tasks": json_serializable_doc(tasks)}
-
-@app.put("/api/admin/tasks/{task_id}", dependencies=[Depends(get_current_admin_user)])
-async def update_task(task_id: str, task_data: Task):
-    task = await db.tasks.find_one({"task_id": task_id})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    update_data = {
-        "title": task_data.title,
-        "description": task_data.description,
-        "reward": str(task_data.reward),
-        "type": task_data.type,
-        "requirements": task_data.requirements,
-        "media": task_data.media,
-        "survey_questions": task_data.survey_questions,
-        "is_active": task_data.is_active,
-        "updated_at": datetime.utcnow()
-    }
-    await db.tasks.update_one(
-        {"task_id": task_id},
-        {"$set": update_data}
-    )
-    logging.info(f"Admin updated task {task_id}")
-    return {"success": True, "message": "Task updated successfully"}
-
-@app.delete("/api/admin/tasks/{task_id}", dependencies=[Depends(get_current_admin_user)])
-async def delete_task(task_id: str):
-    task = await db.tasks.find_one({"task_id": task_id})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    await db.tasks.delete_one({"task_id": task_id})
-    # Optionally, refund or invalidate related completions
-    await db.task_completions.delete_many({"task_id": task_id})
-    logging.info(f"Admin deleted task {task_id}")
-    return {"success": True, "message": "Task deleted successfully"}
-
-@app.put("/api/admin/tasks/{task_id}/status", dependencies=[Depends(get_current_admin_user)])
-async def update_task_status(task_id: str, update_data: UpdateTaskStatus):
-    task = await db.tasks.find_one({"task_id": task_id})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    await db.tasks.update_one(
-        {"_id": task["_id"]},
-        {"$set": {"is_active": update_data.is_active}}
-    )
-    logging.info(f"Admin updated task {task_id} status to active: {update_data.is_active}")
-    return {"success": True, "message": f"Task status updated to active: {update_data.is_active}"}
-
-@app.get("/api/admin/task-completions", dependencies=[Depends(get_current_admin_user)])
-async def get_all_task_completions(
-    task_id: Optional[str] = None,
-    user_id: Optional[str] = None,
-    status: Optional[str] = None,
-    page: int = Query(1, ge=1),
-    limit: int = Query(20, ge=1, le=100)
-):
-    query = {}
-    if task_id:
-        query["task_id"] = task_id
-    if user_id:
-        query["user_id"] = user_id
-    if status:
-        query["status"] = status
-    
-    skip = (page - 1) * limit
-    total = await db.task_completions.count_documents(query)
-    
-    completions = await db.task_completions.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(None)
-    
-    # Optionally join with task details
-    for comp in completions:
-        task = await db.tasks.find_one({"task_id": comp["task_id"]})
-        if task:
-            comp["task_details"] = json_serializable_doc(task)
-    
-    return {
-        "success": True,
-        "completions": json_serializable_doc(completions),
-        "pagination": {
-            "page": page,
-            "limit": limit,
-            "total": total,
-            "pages": (total + limit - 1) // limit if total > 0 else 0
-        }
+async def run_bulk_payouts(batch_id: str, approved: list, db_instance, on_result=None) -> int:
+    """
+    Sends the payouts for debited withdrawals ((transaction, user) pairs) under the
+    per-gateway limits, calling on_result with each item's result as it finishes.
+    Returns how many payouts were initiated.
+    """
+    mpesa_access_token = None
+    if any(txn["method"] == "mpesa" for txn, _ in approved):
+        try:
+            mpesa_access_token = await get_mpesa_access_token()
+        except Exception as e:
+            logging.error(f"Bulk approval {batch_id}: M-Pesa auth failed, payouts will retry auth individually: {e}")
+
+    limits = {method: asyncio.Semaphore(n) for method, n in PAYOUT_CONCURRENCY.items()}
+    default_limit = asyncio.Semaphore(1)
+
+    async def dispatch(txn, user):
+        async with limits.get(txn["method"], default_limit):
+            try:
+                result = await settle_bulk_withdrawal_payout(txn, user, db_instance, mpesa_access_token)
+            except Exception as e:
+                logging.critical(f"Bulk approval {batch_id}: unhandled error settling {txn['transaction_id']}: {str(e)}", exc_info=True)
+                result = {"transaction_id": txn["transaction_id"], "status": "error", "method": txn["method"], "message": str(e)}
+        if on_result:
+            on_result(result)
+        return result
+
+    results = await asyncio.gather(*(dispatch(txn, user) for txn, user in approved))
+    initiated = sum(1 for result in results if result["status"] == "processing")
+    logging.info(f"Bulk approval {batch_id}: {initiated} of {len(approved)} payouts initiated")
+    return initiated
+
+def start_bulk_payouts(batch_id: str, approved: list, db_instance, on_result=None) -> asyncio.Task:
+    """Runs the batch's payouts in the background, independent of the request that approved them."""
+    task = asyncio.create_task(run_bulk_payouts(batch_id, approved, db_instance, on_result))
+    bulk_payout_tasks.add(task)
+    task.add_done_callback(bulk_payout_tasks.discard)
+    return task
+
+async def recover_bulk_payouts(db_instance=None) -> dict:
+    """
+    Sends the payouts of bulk-approved withdrawals that were debited but never dispatched,
+    e.g. because the worker restarted. Payouts taken but never confirmed by the gateway
+    may or may not have been sent, so those are only reported for manual review.
+    """
+    if db_instance is None:
+        db_instance = db
+    cutoff = datetime.utcnow() - timedelta(seconds=BULK_PAYOUT_RECOVERY_AFTER_SECONDS)
+    stuck = await db_instance.transactions.find(
+        {"type": "withdrawal", "status": "processing", "payout_pending": True, "approved_at": {"$lte": cutoff}}
+    ).sort("approved_at", 1).to_list(BULK_APPROVAL_MAX_ITEMS)
+    users = {
+        user["user_id"]: user
+        for user in await db_instance.users.find({"user_id": {"$in": list({txn["user_id"] for txn in stuck})}}).to_list(None)
     }
+    batches = {}
+    for txn in stuck:
+        if txn["user_id"] not in users:
+            logging.error(f"Bulk approval {txn.get('bulk_approval_id')}: user {txn['user_id']} of {txn['transaction_id']} not found; payout not sent")
+            continue
+        batches.setdefault(txn["bulk_approval_id"], []).append((txn, users[txn["user_id"]]))
+    resent = 0
+    for batch_id, approved in batches.items():
+        logging.warning(f"Bulk approval {batch_id}: resending {len(approved)} payouts left undispatched")
+        resent += await run_bulk_payouts(batch_id, approved, db_instance)
+
+    in_doubt = await db_instance.transactions.count_documents({
+        "type": "withdrawal", "status": "processing", "method": "mpesa", "bulk_approval_id": {"$exists": True},
+        "payout_started_at": {"$lte": cutoff}, "payment_details.mpesa_conversation_id": {"$exists": False}
+    })
+    if in_doubt:
+        logging.warning(f"{in_doubt} bulk-approved M-Pesa withdrawals were taken for payout but have no gateway response; review them manually")
+    return {"stuck": len(stuck), "resent": resent, "in_doubt": in_doubt}
 
-@app.put("/api/admin/task-completions/{completion_id}/status", dependencies=[Depends(get_current_admin_user)])
-async def update_completion_status(completion_id: str, update_data: UpdateWithdrawalStatus):
-    completion = await db.task_completions.find_one({"completion_id": completion_id})
-    if not completion:
-        raise HTTPException(status_code=404, detail="Completion not found")
-    
-    update_fields = {"status": update_data.status}
-    if update_data.reason:
-        update_fields["admin_notes"] = update_data.reason
-    update_fields["admin_updated_at"] = datetime.utcnow()
-    
-    await db.task_completions.update_one(
-        {"completion_id": completion_id},
-        {"$set": update_fields}
-    )
-    
-    # If rejecting, optionally refund (reverse wallet update)
-    if update_data.status == "rejected":
-        user = await db.users.find_one({"user_id": completion["user_id"]})
-        if user:
-            reward = float(completion["reward_amount"])
-            await db.users.update_one(
-                {"user_id": completion["user_id"]},
-                {
-                    "$inc": {
-                        "wallet_balance": str(reward),
-                        "task_earnings": str(-reward),
-                        "total_earned": str(-reward)
-                    }
-                }
-            )
-            # Create refund transaction
-            await db.transactions.insert_one({
-                "transaction_id": str(uuid.uuid4()),
-                "user_id": completion["user_id"],
-                "type": "task_refund",
-                "amount": str(reward),
-                "currency": "KES",
-                "status": "completed",
-                "description": f"Refund for rejected task completion {completion_id}: {update_data.reason}",
-                "created_at": datetime.utcnow(),
-                "completed_at": datetime.utcnow()
-            })
-    
-    logging.info(f"Admin updated completion {completion_id} status to {update_data.status}")
-    return {"success": True, "message": "Completion status updated"}
-
-@app.get("/api/admin/tasks/stats", dependencies=[Depends(get_current_admin_user)])
-async def get_task_stats():
-    # Total tasks
-    total_tasks = await db.tasks.count_documents({})
-    active_tasks = await db.tasks.count_documents({"is_active": True})
-    
-    # Total completions
-    total_completions = await db.task_completions.count_documents({})
-    completed_completions = await db.task_completions.count_documents({"status": "completed"})
-    
-    # Total earnings distributed
-    earnings_agg = await db.task_completions.aggregate([
-        {"$match": {"status": "completed"}},
-        {"$group": {"_id": None, "total_earnings": {"$sum": {"$toDouble": "$reward_amount"}}}}
-    ]).to_list(1)
-    total_earnings = earnings_agg[0]["total_earnings"] if earnings_agg else 0.0
-    
-    # Completions by type
-    by_type = await db.task_completions.aggregate([
-        {"$match": {"status": "completed"}},
-        {
-            "$lookup": {
-                "from": "tasks",
-                "localField": "task_id",
-                "foreignField": "task_id",
-                "as": "task"
-            }
-        },
-        {"$unwind": "$task"},
-        {"$group": {"_id": "$task.type", "count": {"$sum": 1}, "earnings": {"$sum": {"$toDouble": "$reward_amount"}}}}
+async def run_bulk_payout_recovery():
+    """Background loop running recover_bulk_payouts every BULK_PAYOUT_RECOVERY_INTERVAL_SECONDS."""
+    while True:
+        try:
+            await recover_bulk_payouts()
+        except Exception as e:
+            logging.error(f"Bulk payout recovery failed: {e}", exc_info=True)
+        await asyncio.sleep(BULK_PAYOUT_RECOVERY_INTERVAL_SECONDS)
+
+async def compute_task_stats() -> dict:
+    """Full recount of the task_stats documents (keyed by _id) from tasks and task_completions."""
+    tasks = await db.tasks.find({}, {"task_id": 1, "type": 1, "is_active": 1}).to_list(None)
+    task_types = {task["task_id"]: task.get("type", "general") for task in tasks}
+    is_completed = {"$eq": ["$status", "completed"]}
+    rows = await db.task_completions.aggregate([
+        {"$group": {
+            "_id": {"task_id": "$task_id", "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}},
+            "completions": {"$sum": 1},
+            "completed": {"$sum": {"$cond": [is_completed, 1, 0]}},
+            "earnings": {"$sum": {"$cond": [is_completed, {"$toDouble": "$reward_amount"}, 0]}}
+        }}
     ]).to_list(None)
-    
-    return {
-        "success": True,
-        "stats": {
-            "total_tasks": total_tasks,
-            "active_tasks": active_tasks,
-            "total_completions": total_completions,
-            "completed_completions": completed_completions,
-            "total_earnings_distributed": total_earnings,
-            "completions_by_type": json_serializable_doc(by_type)
-        }
-    }
+
+    zero = {field: 0 for field in TASK_STAT_FIELDS}
+    docs = {"totals": {"tasks": len(tasks), "active_tasks": sum(1 for task in tasks if task.get("is_active")), **zero}}
+    for row in rows:
+        task_id, day = row["_id"]["task_id"], row["_id"]["day"]
+        task_type = task_types.get(task_id)
+        if task_type is None:
+            continue  # completions of a deleted task
+        for doc_id, labels in (
+            ("totals", {}),
+            (f"task:{task_id}", {"scope": "task", "task_id": task_id, "type": task_type}),
+            (f"type:{task_type}", {"scope": "type", "type": task_type}),
+            (f"day:{day}:{task_id}", {"scope": "day", "bucket": datetime.strptime(day, "%Y-%m-%d"), "task_id": task_id, "type": task_type})
+        ):
+            doc = docs.setdefault(doc_id, {**labels, **zero})
+            for field in TASK_STAT_FIELDS:
+                doc[field] += row[field]
+    return docs
+
+async def verify_task_stats() -> dict:
+    """
+    Recounts task_stats and corrects drift like verify_platform_counters: each document's
+    recount is written only if its counters did not move during the recount, and a
+    document that did move is left for the next run. Documents no longer backed by any
+    completion are removed.
+    """
+    started = datetime.utcnow()
+    stored = {doc["_id"]: doc for doc in await db.task_stats.find({}).to_list(None)}
+    actual = await compute_task_stats()
+    seeded = "verified_at" in stored.get("totals", {})
+
+    operations, drift = [], {}
+    for doc_id, doc in actual.items():
+        have = stored.pop(doc_id, {})
+        counters = {key: value for key, value in doc.items() if isinstance(value, (int, float))}
+        labels = {key: value for key, value in doc.items() if key not in counters}
+        doc_drift = {key: value - have.get(key, 0) for key, value in counters.items() if abs(value - have.get(key, 0)) > 0.005}
+        update = {"$set": dict(labels, updated_at=started)}
+        if doc_id == "totals":
+            update["$set"]["verified_at"] = started
+        elif not doc_drift and all(have.get(key) == value for key, value in labels.items()):
+            continue
+        if doc_drift:
+            update["$set"].update(counters)
+            drift[doc_id] = doc_drift
+            operations.append(UpdateOne({"_id": doc_id, **unchanged_since(have, counters)}, update, upsert=not have))
+        else:
+            operations.append(UpdateOne({"_id": doc_id}, update, upsert=True))
+    # Left-over documents belong to deleted tasks; skip any touched since the recount began
+    operations.extend(DeleteOne({"_id": doc_id, "updated_at": {"$lt": started}}) for doc_id in stored)
+
+    try:
+        result = (await db.task_stats.bulk_write(operations, ordered=False)).bulk_api_result
+    except BulkWriteError as e:
+        # Duplicate keys: a document was created by an update during the recount
+        result = e.details
+    deferred = len(operations) - len(stored) - result["nMatched"] - result["nUpserted"]
+    if drift and seeded:
+        logging.warning(f"Task stats drifted in {len(drift)} documents, corrected {len(drift) - deferred}")
+    if deferred:
+        logging.warning(f"{deferred} task stats documents changed during the recount; their correction is left for the next run")
+    return {"totals": actual["totals"], "drift": drift, "removed": result["nRemoved"], "deferred": deferred}
 
 # Initialize default tasks and indexes
-@app.on_event("startup")
-async def startup_event():
-    """Initialize default tasks and data, and create database indexes."""
+async def run_startup_work():
+    """Initialize default tasks and data, and create database indexes. Runs in the leader worker only."""
     # Create indexes for frequently queried fields
     logging.info("Ensuring MongoDB indexes are in place...")
 
@@ -4355,14 +2273,54 @@ async def startup_event():
     # Task Completions collection indexes
     await db.task_completions.create_index([("user_id", 1), ("task_id", 1)], unique=True, name="user_task_completion_unique_idx")
     await db.task_completions.create_index("created_at", name="task_completion_created_at_idx")
+    await db.task_stats.create_index([("scope", 1), ("bucket", 1)], name="task_stats_scope_bucket_idx")
+    await db.task_stats.create_index("task_id", sparse=True, name="task_stats_task_id_idx")
     logging.info("Task Completions collection indexes ensured.")
 
+    # Gateway events collection indexes
+    await db.gateway_events.create_index("event_id", unique=True, name="gateway_event_id_unique_idx")
+    await db.gateway_events.create_index([("transaction_id", 1), ("created_at", 1)], name="gateway_event_transaction_idx")
+    logging.info("Gateway events collection indexes ensured.")
+
+    # Webhook inbox: claimed by status and due time; processed entries expire via TTL
+    await webhook_inbox.ensure_indexes(db.webhook_inbox, WEBHOOK_INBOX_RETENTION_DAYS)
+    logging.info("Webhook inbox collection indexes ensured.")
+
+    # Rate limit buckets expire via TTL when Mongo-backed
+    if isinstance(rate_limiter.store, MongoBucketStore):
+        await rate_limiter.store.ensure_indexes()
+        logging.info("Rate limit collection indexes ensured.")
+
+    # Idempotency keys expire via TTL
+    await idempotency_store.ensure_indexes()
+    logging.info("Idempotency keys collection indexes ensured.")
+
+    # Live events relay and cache bus (multi-worker): short-lived rows tailed by change streams
+    if live_event_relay:
+        await live_event_relay.ensure_indexes()
+    await cache_bus.ensure_indexes()
+
     # Notifications collection indexes
     await db.notifications.create_index("user_id", name="notification_user_id_idx", sparse=True)
     await db.notifications.create_index("created_at", name="notification_created_at_idx")
     await db.notifications.create_index("is_read", name="notification_is_read_idx")
+    await db.notifications.create_index([("user_id", 1), ("created_at", -1)], name="notification_user_created_at_idx")
+    await db.broadcast_notifications.create_index([("created_at", -1)], name="broadcast_created_at_idx")
+    await db.broadcast_notifications.create_index("notification_id", unique=True, name="broadcast_notification_id_unique_idx")
+    await db.notification_receipts.create_index([("user_id", 1), ("notification_id", 1)], unique=True, name="notification_receipt_unique_idx")
+    await db.notification_receipts.create_index("notification_id", name="notification_receipt_notification_id_idx")
+    await db.notification_state.create_index("broadcasts_read_through", sparse=True, name="notification_state_read_through_idx")
     logging.info("Notifications collection indexes ensured.")
 
+    # Expired notifications are archived by a background job; archives expire via TTL
+    for collection in (db.notifications, db.broadcast_notifications):
+        await collection.create_index("expires_at", name="expires_at_idx")
+        await collection.create_index("archive_claim", sparse=True, name="archive_claim_idx")
+    if NOTIFICATION_ARCHIVE_RETENTION_DAYS > 0:
+        await db.notifications_archive.create_index(
+            "archived_at", expireAfterSeconds=NOTIFICATION_ARCHIVE_RETENTION_DAYS * 86400, name="archived_at_ttl_idx"
+        )
+
     # Check if tasks already exist
     task_count = await db.tasks.count_documents({})
     if task_count == 0:
@@ -4410,6 +2368,7 @@ async def startup_event():
         ]
         
         await db.tasks.insert_many(default_tasks)
+        await cache_bus.invalidate("tasks")
         logging.info("Default tasks initialized")
     
     # Ensure at least one admin user exists for testing purposes
@@ -4442,6 +2401,7 @@ async def startup_event():
             "role": "admin",
             "has_spun_once": False
         })
+        await bump_platform_counters(total_users=1, activated_users=1)
         logging.info(f"Default admin user created: {admin_email}/{admin_password}")
 
     # Register Pesapal IPN on startup
@@ -4454,6 +2414,92 @@ async def startup_event():
     except Exception as e:
         logging.error(f"Failed to register Pesapal IPN: {str(e)}")
 
+def log_startup_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logging.error("Startup work failed", exc_info=task.exception())
+
+def leader_duties() -> list:
+    """Work that must run in one worker only, started by whichever worker holds the leader lease."""
+    logging.info("Starting leader duties: startup work, notification archiver, platform counter verifier, bulk payout recovery.")
+    startup = asyncio.create_task(run_startup_work())
+    startup.add_done_callback(log_startup_failure)
+    return [
+        startup,
+        asyncio.create_task(run_notification_archiver()),
+        # Dashboard totals are maintained incrementally and recounted nightly
+        asyncio.create_task(run_platform_counter_verifier()),
+        asyncio.create_task(run_bulk_payout_recovery())
+    ]
+
+async def startup_event(app: FastAPI):
+    """Starts this worker's loop watchdog, change-stream listeners, webhook inbox processor and its campaign for the leader lease."""
+    app.state.loop_watchdog_task = asyncio.create_task(loop_watchdog.run())
+    if live_event_relay:
+        app.state.live_event_relay_task = asyncio.create_task(live_event_relay.run())
+        logging.info("Live events relay started.")
+    if cache_bus.collection is not None:
+        app.state.cache_bus_task = asyncio.create_task(cache_bus.run())
+    if user_cache_watcher:
+        app.state.user_cache_watcher_task = asyncio.create_task(user_cache_watcher.run())
+    if webhook_inbox_processor:
+        app.state.webhook_inbox_task = asyncio.create_task(webhook_inbox_processor.run())
+    app.state.leader_task = asyncio.create_task(leader_lease.run(leader_duties))
+
+async def shutdown_event(app: FastAPI):
+    """Stops background tasks started at startup, releasing the leader lease if held."""
+    tasks = [
+        getattr(app.state, name, None)
+        for name in (
+            "loop_watchdog_task", "live_event_relay_task", "cache_bus_task", "user_cache_watcher_task",
+            "webhook_inbox_task", "leader_task"
+        )
+    ]
+    tasks = [task for task in tasks if task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def create_app(groups: List[str] = None) -> FastAPI:
+    """
+    The API with only the given route groups (see routers.GROUPS; all of them by default).
+    Routers are imported here, so modules for groups a worker does not serve are never loaded.
+    """
+    app = FastAPI(title="EarnPlatform API", version="1.0.0")
+
+    if admission_controller:
+        # Innermost, so CORS headers reach shed responses; SSE streams are capped by LIVE_EVENTS_MAX_CONNECTIONS instead.
+        # Bulk approval streams payout results for minutes after its debits commit, so it frees its slot once it starts.
+        app.add_middleware(
+            AdmissionMiddleware,
+            controller=admission_controller,
+            skip_paths=("/metrics", "/api/events/stream"),
+            release_on_start=("/api/admin/approve-withdrawals/bulk",)
+        )
+
+    # Inside CORS as well, so replays and the 409/422/400/503 answers it gives itself carry CORS headers
+    app.middleware("http")(idempotency_middleware)
+
+    # CORS middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"], 
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["Idempotent-Replayed"],
+    )
+    # Request metrics; added last so it is the outermost middleware and times everything above
+    app.add_middleware(MetricsMiddleware, registry=metrics_registry)
+
+    app.add_api_route("/metrics", get_metrics, include_in_schema=False)
+    routers.include_groups(app, groups or list(routers.GROUPS))
+    app.add_event_handler("startup", functools.partial(startup_event, app))
+    app.add_event_handler("shutdown", functools.partial(shutdown_event, app))
+    return app
+
+app = create_app(None if API_ROUTERS == ['all'] else API_ROUTERS)
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # By import string: routers import from the `server` module, which this file is not when run as a script
+    uvicorn.run("server:app", host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# server.py validates the mail settings at import
+for name, value in {"MAIL_USERNAME": "test", "MAIL_PASSWORD": "test", "MAIL_SERVER": "localhost", "MAIL_FROM": "test@example.com"}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,114 @@
+"""idempotency_middleware decides from the gateway calls a request made whether its key may be retried."""
+from collections import Counter
+from datetime import datetime
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import idempotency
+import server
+from metrics import MetricsMiddleware, Registry
+
+STK_URL = f"{server.MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest"
+
+
+class MemoryStore:
+    """IdempotencyStore with the same outcomes, kept in a dict."""
+
+    def __init__(self):
+        self.records = {}
+
+    async def begin(self, record_id, fingerprint):
+        record = self.records.get(record_id)
+        if record is None:
+            record = self.records[record_id] = {"_id": record_id, "fingerprint": fingerprint, "status": idempotency.IN_PROGRESS}
+            return idempotency.NEW, record
+        if record["fingerprint"] != fingerprint:
+            return idempotency.MISMATCH, record
+        if record["status"] == "completed":
+            return idempotency.REPLAY, record
+        return idempotency.IN_PROGRESS, record
+
+    async def complete(self, record_id, status_code, body, media_type):
+        self.records[record_id].update(
+            status="completed", response_status=status_code, response_body=body.decode("utf-8"),
+            response_media_type=media_type, completed_at=datetime.utcnow()
+        )
+
+    async def release(self, record_id):
+        if self.records.get(record_id, {}).get("status") == idempotency.IN_PROGRESS:
+            del self.records[record_id]
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Stands in for the M-Pesa API; set status["oauth"] or status["stkpush"] to make that call fail."""
+    hits = Counter()
+    status = {"oauth": 200, "stkpush": 200}
+
+    def handle(request):
+        kind = "oauth" if "/oauth/" in request.url.path else "stkpush"
+        hits[kind] += 1
+        if status[kind] != 200:
+            return httpx.Response(status[kind], text="unavailable")
+        if kind == "oauth":
+            return httpx.Response(200, json={"access_token": "token", "expires_in": 3599})
+        return httpx.Response(200, json={"ResponseCode": "0"})
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(server.httpx, "AsyncClient", lambda **kwargs: real_client(transport=httpx.MockTransport(handle), **kwargs))
+    monkeypatch.setattr(server.gateway_token_cache, "get", lambda key: None)
+    return hits, status
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "idempotency_store", MemoryStore())
+    monkeypatch.setattr(server, "token_user_id", lambda request: "user-1")
+
+    app = FastAPI()
+
+    @app.post("/api/payments/deposit")
+    async def deposit():
+        access_token = await server.get_mpesa_access_token()
+        response = await server.gateway_request(
+            "mpesa", "POST", STK_URL, marks_side_effect=True, json={}, headers={"Authorization": f"Bearer {access_token}"}
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=502, detail="STK push failed")
+        return {"success": True}
+
+    app.middleware("http")(server.idempotency_middleware)
+    app.add_middleware(MetricsMiddleware, registry=Registry())
+    return TestClient(app)
+
+
+def post(client, key="key-1"):
+    return client.post("/api/payments/deposit", json={"amount": 100}, headers={"Idempotency-Key": key})
+
+
+def test_failed_token_fetch_releases_the_key(client, gateway):
+    hits, status = gateway
+    status["oauth"] = 500
+    assert post(client).status_code == 500
+    assert hits["stkpush"] == 0
+
+    status["oauth"] = 200
+    retried = post(client)
+    assert retried.status_code == 200
+    assert "Idempotent-Replayed" not in retried.headers
+    assert hits["stkpush"] == 1
+
+
+def test_failure_after_the_payment_call_is_replayed(client, gateway):
+    hits, status = gateway
+    status["stkpush"] = 500
+    assert post(client).status_code == 502
+
+    status["stkpush"] = 200
+    replayed = post(client)
+    assert replayed.status_code == 502
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+    assert hits["stkpush"] == 1
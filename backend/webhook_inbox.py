@@ -0,0 +1,183 @@
+"""
+Webhook inbox: provider callbacks are stored, acknowledged straight away and
+settled later.
+
+The webhook ingress pool (webhook_ingress.py) writes each M-Pesa, Paystack
+and Pesapal callback to the webhook_inbox collection and answers as soon as
+the write is acknowledged. It does no other work, so acknowledgements do
+not queue behind dashboard traffic or gateway calls. API workers running a
+WebhookInboxProcessor claim stored callbacks and replay each one through the
+route handler that would have served it. Settlement is therefore unchanged,
+and the handlers stay the single place that knows each provider's payload.
+
+Claims are leases. A callback whose worker died is picked up again once its
+lease expires. A handler error, or a 5xx response, is retried with backoff
+up to max_attempts. Any other response is final, and it is stored with the
+entry; a 4xx (bad signature, malformed payload) is recorded as rejected.
+Processed entries expire after the retention period.
+"""
+import asyncio
+import logging
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from bson import Binary
+from pymongo import ReturnDocument
+from starlette.requests import Request
+
+from metrics import LATENCY_BUCKETS, Registry
+
+# path -> (gateway, body the provider expects in acknowledgement)
+WEBHOOKS = {
+    "/api/payments/mpesa-callback": ("mpesa", {"ResultCode": 0, "ResultDesc": "Accepted"}),
+    "/api/payments/paystack/webhook": ("paystack", {"message": "Webhook received"}),
+    "/api/payments/pesapal/ipn": ("pesapal", {"status": "success"}),
+}
+# Headers kept for the replay; the rest (cookies, tracing, proxies) are not needed to settle a callback
+STORED_HEADERS = ("content-type", "x-paystack-signature", "user-agent", "x-forwarded-for")
+
+
+def inbox_document(path: str, headers, query_string: bytes, body: bytes) -> dict:
+    gateway, _ = WEBHOOKS[path]
+    return {
+        "inbox_id": str(uuid.uuid4()),
+        "gateway": gateway,
+        "path": path,
+        "query_string": query_string.decode("latin-1"),
+        "headers": {name: headers[name] for name in STORED_HEADERS if name in headers},
+        "body": Binary(body),
+        "status": "pending",
+        "attempts": 0,
+        "available_at": datetime.utcnow(),
+        "received_at": datetime.utcnow()
+    }
+
+
+def replay_request(doc: dict) -> Request:
+    """The stored callback as a Starlette request, for calling its route handler directly."""
+    body = bytes(doc["body"])
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "https",
+        "path": doc["path"],
+        "raw_path": doc["path"].encode(),
+        "root_path": "",
+        "query_string": doc.get("query_string", "").encode("latin-1"),
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in doc["headers"].items()],
+        "client": None,
+        "server": None,
+    }
+    return Request(scope, receive)
+
+
+async def ensure_indexes(collection, retention_days: int):
+    await collection.create_index("inbox_id", unique=True, name="inbox_id_unique_idx")
+    await collection.create_index([("status", 1), ("available_at", 1)], name="inbox_status_available_idx")
+    if retention_days > 0:
+        await collection.create_index("processed_at", expireAfterSeconds=retention_days * 86400, name="inbox_processed_at_ttl_idx")
+
+
+async def inbox_stats(collection) -> dict:
+    """Entries per status and gateway, and the age of the oldest entry still waiting."""
+    counts = await collection.aggregate([
+        {"$group": {"_id": {"status": "$status", "gateway": "$gateway"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    oldest = await collection.find_one(
+        {"status": {"$in": ["pending", "processing"]}}, {"received_at": 1}, sort=[("received_at", 1)]
+    )
+    by_status = {}
+    for row in counts:
+        by_status.setdefault(row["_id"]["status"], {})[row["_id"]["gateway"]] = row["count"]
+    return {
+        "by_status": by_status,
+        "oldest_waiting_seconds": round((datetime.utcnow() - oldest["received_at"]).total_seconds(), 1) if oldest else 0.0
+    }
+
+
+class WebhookInboxProcessor:
+    def __init__(
+        self,
+        collection,
+        dispatch,
+        registry: Registry,
+        concurrency: int = 4,
+        poll_interval: float = 0.5,
+        lease_seconds: float = 300,
+        max_attempts: int = 8
+    ):
+        """`dispatch(doc)` replays one stored callback and returns the handler's HTTP status."""
+        self.collection = collection
+        self.dispatch = dispatch
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.processed = registry.counter("webhook_inbox_processed_total", "Stored callbacks processed, by outcome", ("gateway", "outcome"))
+        self.delay = registry.histogram(
+            "webhook_inbox_delay_seconds", "From a callback being stored to its processing finishing", ("gateway",),
+            buckets=LATENCY_BUCKETS
+        )
+
+    async def claim(self):
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "available_at": {"$lte": now}},
+                {"status": "processing", "lease_until": {"$lte": now}}  # the worker holding it died
+            ]},
+            {"$set": {"status": "processing", "lease_until": now + timedelta(seconds=self.lease_seconds)}, "$inc": {"attempts": 1}},
+            sort=[("available_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def process(self, doc: dict):
+        started = time.perf_counter()
+        try:
+            status_code = await self.dispatch(doc)
+            error = f"handler returned {status_code}" if status_code >= 500 else None
+        except Exception as e:
+            logging.error(f"Webhook inbox entry {doc['inbox_id']} ({doc['gateway']}) failed", exc_info=True)
+            status_code, error = None, str(e)
+
+        if error is None:
+            outcome = "rejected" if status_code >= 400 else "done"
+            update = {"status": outcome, "response_status": status_code, "processed_at": datetime.utcnow()}
+        elif doc["attempts"] >= self.max_attempts:
+            outcome = "failed"
+            update = {"status": outcome, "error": error, "processed_at": datetime.utcnow()}
+            logging.error(f"Webhook inbox entry {doc['inbox_id']} ({doc['gateway']}) gave up after {doc['attempts']} attempts: {error}")
+        else:
+            outcome = "retry"
+            backoff = min(2 ** doc["attempts"], 300) * random.uniform(0.5, 1.0)
+            update = {"status": "pending", "error": error, "available_at": datetime.utcnow() + timedelta(seconds=backoff)}
+        await self.collection.update_one({"_id": doc["_id"]}, {"$set": update, "$unset": {"lease_until": ""}})
+        self.processed.inc(doc["gateway"], outcome)
+        if outcome != "retry":
+            self.delay.observe(doc["gateway"], value=(datetime.utcnow() - doc["received_at"]).total_seconds())
+        logging.debug(f"Webhook inbox entry {doc['inbox_id']} {outcome} in {time.perf_counter() - started:.3f}s")
+
+    async def _work(self):
+        while True:
+            doc = None
+            try:
+                doc = await self.claim()
+                if doc is not None:
+                    await self.process(doc)
+            except Exception as e:
+                # Mongo unavailable; an entry claimed before the failure is retried when its lease expires
+                logging.warning(f"Webhook inbox processing failed: {e}")
+                doc = None
+            if doc is None:
+                await asyncio.sleep(self.poll_interval)
+
+    async def run(self):
+        logging.info(f"Webhook inbox processor started with {self.concurrency} slots.")
+        await asyncio.gather(*(self._work() for _ in range(self.concurrency)))
@@ -0,0 +1,136 @@
+"""
+Webhook ingress: the app for a worker pool that only takes provider callbacks.
+
+    gunicorn -c gunicorn.conf.py webhook_ingress:app
+
+It serves the M-Pesa callback, Paystack webhook and Pesapal IPN paths, plus
+/metrics and /healthz. Route those paths to this pool at the load balancer.
+Each callback is checked for size and well-formed JSON (and, for Paystack,
+its signature). It is then written to the webhook inbox and acknowledged
+once the write is durable. The API workers settle it from the inbox
+(WEBHOOK_INBOX_PROCESSING=true, see webhook_inbox.py), so slow dashboards
+and gateway calls cannot push acknowledgements past the providers'
+timeouts.
+
+Only Starlette, Motor and the metrics and logging modules are loaded (not
+server.py), so workers start fast and stay small. Concurrency is limited
+per worker with WEBHOOK_INGRESS_MAX_CONCURRENCY. A callback that cannot get
+a slot within WEBHOOK_INGRESS_QUEUE_TIMEOUT_MS gets a 503, which the
+providers retry.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Match, Route
+
+from log_pipeline import parse_sample_rates, setup_logging
+from metrics import MetricsMiddleware, Registry
+from webhook_inbox import WEBHOOKS, inbox_document
+
+load_dotenv()
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+setup_logging(LOG_LEVEL, json_format=LOG_FORMAT == 'json', sample_rates=parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', '')))
+
+MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+PAYSTACK_SECRET_KEY = os.environ.get('PAYSTACK_SECRET_KEY', '')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Callbacks handled at once per worker, and how long one may wait for a slot before a 503
+WEBHOOK_INGRESS_MAX_CONCURRENCY = int(os.environ.get('WEBHOOK_INGRESS_MAX_CONCURRENCY', 200))
+WEBHOOK_INGRESS_QUEUE_TIMEOUT_MS = float(os.environ.get('WEBHOOK_INGRESS_QUEUE_TIMEOUT_MS', 2000))
+WEBHOOK_MAX_BODY_BYTES = int(os.environ.get('WEBHOOK_MAX_BODY_BYTES', 256 * 1024))
+
+mongo_client = AsyncIOMotorClient(MONGO_URL, maxPoolSize=WEBHOOK_INGRESS_MAX_CONCURRENCY)
+# Acknowledging tells the provider not to retry, so the write must survive a primary failover
+inbox = mongo_client.earnplatform.get_collection("webhook_inbox", write_concern=WriteConcern("majority"))
+
+metrics_registry = Registry()
+slots = asyncio.Semaphore(WEBHOOK_INGRESS_MAX_CONCURRENCY)
+stored_total = metrics_registry.counter("webhook_ingress_stored_total", "Callbacks written to the inbox and acknowledged", ("gateway",))
+refused_total = metrics_registry.counter("webhook_ingress_refused_total", "Callbacks refused without being stored", ("gateway", "reason"))
+waiting_gauge = metrics_registry.gauge("webhook_ingress_waiting", "Callbacks waiting for a concurrency slot")
+waiting = 0
+
+
+@metrics_registry.collector
+def collect_waiting():
+    waiting_gauge.set(value=waiting)
+
+
+class InboxRoute(Route):
+    """Records the matched route in the scope, as FastAPI does, so metrics are labelled by path."""
+
+    def matches(self, scope):
+        match, child_scope = super().matches(scope)
+        if match != Match.NONE:
+            child_scope["route"] = self
+        return match, child_scope
+
+
+def refuse(gateway: str, reason: str, status_code: int, detail: str, headers: dict = None) -> JSONResponse:
+    refused_total.inc(gateway, reason)
+    return JSONResponse({"detail": detail}, status_code=status_code, headers=headers)
+
+
+async def receive_webhook(request: Request):
+    global waiting
+    gateway, acknowledgement = WEBHOOKS[request.url.path]
+    body = await request.body()
+    if len(body) > WEBHOOK_MAX_BODY_BYTES:
+        return refuse(gateway, "too_large", 413, "Payload too large")
+    try:
+        json.loads(body)
+    except ValueError:
+        return refuse(gateway, "invalid_json", 400, "Invalid JSON")
+    if gateway == "paystack" and PAYSTACK_SECRET_KEY:
+        signature = hmac.new(PAYSTACK_SECRET_KEY.encode(), body, hashlib.sha512).hexdigest()
+        if not hmac.compare_digest(signature, request.headers.get("x-paystack-signature", "")):
+            logging.warning("Invalid Paystack webhook signature")
+            return refuse(gateway, "bad_signature", 400, "Invalid signature")
+
+    waiting += 1
+    try:
+        await asyncio.wait_for(slots.acquire(), WEBHOOK_INGRESS_QUEUE_TIMEOUT_MS / 1000)
+    except asyncio.TimeoutError:
+        return refuse(gateway, "saturated", 503, "Busy, retry shortly", {"Retry-After": "1"})
+    finally:
+        waiting -= 1
+    try:
+        await inbox.insert_one(inbox_document(request.url.path, request.headers, request.scope["query_string"], body))
+    except Exception as e:
+        logging.error(f"Could not store {gateway} callback: {e}")
+        return refuse(gateway, "store_failed", 503, "Could not store callback", {"Retry-After": "5"})
+    finally:
+        slots.release()
+    stored_total.inc(gateway)
+    return JSONResponse(acknowledgement)
+
+
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return JSONResponse({"detail": "Invalid metrics token"}, status_code=401)
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def healthz(request: Request):
+    return JSONResponse({"status": "ok"})
+
+
+app = Starlette(routes=[
+    *(InboxRoute(path, receive_webhook, methods=["POST"]) for path in WEBHOOKS),
+    Route("/metrics", get_metrics),
+    Route("/healthz", healthz),
+])
+app.add_middleware(MetricsMiddleware, registry=metrics_registry)